@@ -1,29 +1,131 @@
 """
 Content Processor Agent - Procesa documentos usando RAG
 Lee PDFs, los divide en chunks y los almacena en memoria
+
+Pipeline de ingesta por etapas:
+1. Extracción de páginas en un pool de procesos (rangos de páginas por tarea),
+   salvo las que ya están en la caché de texto por hash del PDF
+2. División en chunks página a página
+3. Escritura en memoria en lotes acotados (INGEST_BATCH_SIZE)
+Así un PDF de 300+ páginas no bloquea el worker ni mantiene todos los chunks a la vez.
 """
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, Tuple
 import os
 import uuid
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timezone
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from memory.memory_manager import MemoryManager
+from pdf_text_cache import extract_page_range, get_pdf_text_cache
+
+# Configuración de la ingesta (sobrescribible por entorno)
+INGEST_BATCH_SIZE = max(1, int(os.getenv("INGEST_BATCH_SIZE", "64")))
+INGEST_WORKERS = max(1, int(os.getenv("INGEST_WORKERS", "0")) or min(4, os.cpu_count() or 1))
+INGEST_PAGES_PER_TASK = max(1, int(os.getenv("INGEST_PAGES_PER_TASK", "20")))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    """Pool de procesos compartido (perezoso). None si no se puede crear."""
+    global _pool
+    if INGEST_WORKERS <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+            except Exception as e:
+                print(f"⚠️ Pool de procesos no disponible, ingesta secuencial: {e}")
+                return None
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _extract_pages_parallel(path: str, first: int, last: int) -> Iterator[Tuple[int, Optional[str]]]:
+    """
+    Itera (page_num, texto) de las páginas [first, last) en orden, extrayendo
+    rangos de páginas en paralelo con una ventana acotada de tareas en vuelo.
+    """
+    ranges = [
+        (start, min(start + INGEST_PAGES_PER_TASK, last))
+        for start in range(first, last, INGEST_PAGES_PER_TASK)
+    ]
+    pool = _get_pool() if len(ranges) > 1 else None
+    if pool is None:
+        for start, end in ranges:
+            yield from extract_page_range(path, start, end)
+        return
+
+    pending = deque()
+    next_range = 0
+    resume_from = first
+    try:
+        while next_range < len(ranges) or pending:
+            # Mantener como máximo 2 tareas por worker en vuelo
+            while next_range < len(ranges) and len(pending) < INGEST_WORKERS * 2:
+                start, end = ranges[next_range]
+                pending.append((start, end, pool.submit(extract_page_range, path, start, end)))
+                next_range += 1
+            start, end, future = pending.popleft()
+            resume_from = start
+            try:
+                pages = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"⚠️ Error extrayendo páginas {start}-{end} de {path}: {e}")
+                pages = extract_page_range(path, start, end)
+            yield from pages
+            resume_from = end
+    except BrokenProcessPool as e:
+        print(f"⚠️ Pool de procesos roto, continuando en secuencial: {e}")
+        _reset_pool()
+        for start, end in ranges:
+            if start >= resume_from:
+                yield from extract_page_range(path, start, end)
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+
+
+def iter_pdf_pages(path: str) -> Iterator[Tuple[int, str]]:
+    """
+    Itera (page_num, texto) de un PDF en orden. Las páginas ya extraídas salen de la
+    caché por contenido (pdf_text_cache); solo las que faltan se extraen en el pool.
+    """
+    return get_pdf_text_cache().iter_pages(
+        path, extractor=lambda start, end: _extract_pages_parallel(path, start, end)
+    )
+
 
 class ContentProcessorAgent:
     """
     Agente especializado en procesar y organizar documentos educativos
     """
     
-    def __init__(self, memory: MemoryManager):
+    def __init__(self, memory: MemoryManager, batch_size: Optional[int] = None):
         """
         Inicializa el agente procesador de contenido
         
         Args:
             memory: Gestor de memoria del sistema
+            batch_size: Chunks por lote de escritura en memoria (por defecto INGEST_BATCH_SIZE)
         """
         self.memory = memory
+        self.batch_size = max(1, batch_size or INGEST_BATCH_SIZE)
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
@@ -31,6 +133,39 @@ class ContentProcessorAgent:
         )
         print("🤖 Content Processor Agent inicializado")
     
+    def _resolve_path(self, doc_path: str) -> str:
+        """Resuelve rutas /api/files/… → documents/…"""
+        if not doc_path.startswith("/api/files/"):
+            return doc_path
+        filename = doc_path.replace("/api/files/", "", 1)
+        candidates = [
+            os.path.join("documents", filename),
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents", filename),
+            os.path.join(os.getcwd(), "documents", filename),
+        ]
+        return next((c for c in candidates if os.path.exists(c)), doc_path)
+    
+    def _flush_batch(
+        self,
+        documents: List[str],
+        metadatas: List[Dict],
+        chat_id: Optional[str],
+        user_id: Optional[str],
+    ) -> int:
+        """Escribe un lote en memoria y lo vacía. Devuelve el número de chunks escritos."""
+        if not documents:
+            return 0
+        written = len(documents)
+        self.memory.store_documents(
+            list(documents),
+            list(metadatas),
+            chat_id=chat_id,
+            user_id=user_id,
+        )
+        documents.clear()
+        metadatas.clear()
+        return written
+    
     def process_documents(
         self,
         document_paths: List[str],
@@ -38,94 +173,79 @@ class ContentProcessorAgent:
         user_id: Optional[str] = None,
     ) -> dict:
         """
-        Procesa documentos PDF y los almacena en memoria
+        Procesa documentos PDF y los almacena en memoria (acumula por chat, no reemplaza)
+        
+        Las páginas se extraen en paralelo y los chunks se escriben en lotes de
+        `self.batch_size`, de modo que nunca se mantienen todos los chunks en memoria.
         
         Args:
             document_paths: Lista de rutas a documentos PDF
+            chat_id: ID del chat para aislar el RAG
+            user_id: ID del usuario
             
         Returns:
             Diccionario con información del procesamiento
         """
-        all_documents = []
-        all_metadatas = []
+        batch_documents: List[str] = []
+        batch_metadatas: List[Dict] = []
         total_chunks = 0
+        existing_count = 0
+        processed_files: List[str] = []
         
         for doc_path in document_paths:
-            # Resolver rutas /api/files/… → documents/…
-            resolved = doc_path
-            if doc_path.startswith("/api/files/"):
-                filename = doc_path.replace("/api/files/", "", 1)
-                candidates = [
-                    os.path.join("documents", filename),
-                    os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents", filename),
-                    os.path.join(os.getcwd(), "documents", filename),
-                ]
-                resolved = next((c for c in candidates if os.path.exists(c)), doc_path)
+            resolved = self._resolve_path(doc_path)
 
             if not os.path.exists(resolved):
                 print(f"⚠️ Archivo no encontrado: {doc_path} (resolved={resolved})")
                 continue
+            existing_count += 1
                 
-            print(f"📄 Procesando: {os.path.basename(resolved)}")
+            source = os.path.basename(resolved)
+            print(f"📄 Procesando: {source}")
             doc_id = f"doc_{uuid.uuid4().hex[:12]}"
             uploaded_at = datetime.now(timezone.utc).isoformat()
+            file_chunks = 0
+            file_pages = 0
             
             try:
-                # Cargar documento PDF
-                loader = PyPDFLoader(resolved)
-                pages = loader.load()
+                for page_num, page_text in iter_pdf_pages(resolved):
+                    file_pages += 1
+                    if not page_text or not page_text.strip():
+                        continue
+                    # Dividir cada página en chunks (misma granularidad que split_documents)
+                    for chunk_text in self.text_splitter.split_text(page_text):
+                        batch_documents.append(chunk_text)
+                        batch_metadatas.append({
+                            "source": source,
+                            "full_path": resolved,
+                            "page": page_num,
+                            "doc_id": doc_id,
+                            "uploaded_at": uploaded_at,
+                        })
+                        file_chunks += 1
+                        if len(batch_documents) >= self.batch_size:
+                            total_chunks += self._flush_batch(batch_documents, batch_metadatas, chat_id, user_id)
                 
-                if not pages:
+                if file_pages == 0:
                     print(f"⚠️ No se pudieron leer páginas de: {resolved}")
                     continue
                 
-                # Dividir en chunks
-                chunks = self.text_splitter.split_documents(pages)
-                
-                # Extraer textos y metadatos
-                for chunk in chunks:
-                    all_documents.append(chunk.page_content)
-                    all_metadatas.append({
-                        "source": os.path.basename(resolved),
-                        "full_path": resolved,
-                        "page": chunk.metadata.get("page", 0),
-                        "doc_id": doc_id,
-                        "uploaded_at": uploaded_at,
-                    })
-                    total_chunks += 1
-                
-                print(f"✅ {len(chunks)} chunks creados de {len(pages)} páginas (chat_id={chat_id})")
+                if file_chunks:
+                    processed_files.append(source)
+                print(f"✅ {file_chunks} chunks creados de {file_pages} páginas (chat_id={chat_id})")
                 
             except Exception as e:
                 print(f"❌ Error procesando {resolved}: {str(e)}")
                 continue
         
-        # Almacenar todos los documentos en memoria (acumula por chat, no reemplaza)
-        if all_documents:
-            self.memory.store_documents(
-                all_documents,
-                all_metadatas,
-                chat_id=chat_id,
-                user_id=user_id,
-            )
+        # Último lote pendiente
+        total_chunks += self._flush_batch(batch_documents, batch_metadatas, chat_id, user_id)
         
-        existing_count = sum(
-            1 for p in document_paths
-            if os.path.exists(p) or (
-                p.startswith("/api/files/") and any(
-                    os.path.exists(os.path.join(d, p.replace("/api/files/", "", 1)))
-                    for d in ("documents", os.path.join(os.getcwd(), "documents"))
-                )
-            )
-        )
         return {
-            "total_documents": existing_count or (1 if all_documents else 0),
+            "total_documents": existing_count or (1 if total_chunks else 0),
             "total_chunks": total_chunks,
-            "status": "processed" if all_documents else "error",
-            "processed_files": [
-                os.path.basename(m.get("source", ""))
-                for m in all_metadatas
-            ][:20],
+            "status": "processed" if total_chunks else "error",
+            "processed_files": processed_files[:20],
             "chat_id": chat_id,
             "user_id": user_id,
         }
@@ -147,8 +267,8 @@ class ContentProcessorAgent:
         # Dividir en chunks
         chunks = self.text_splitter.split_text(text)
         
-        # Preparar metadatas
-        metadatas = [metadata or {}] * len(chunks)
+        # Preparar metadatas (una copia por chunk: store_documents las modifica)
+        metadatas = [dict(metadata or {}) for _ in chunks]
         
         # Almacenar en memoria
         self.memory.store_documents(chunks, metadatas)
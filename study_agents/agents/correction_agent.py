@@ -27,10 +27,13 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+
 try:
-    from model_manager import ModelManager
+    from model_manager import ModelManager, RequestScopedKey
 except ImportError:
     ModelManager = None
+    RequestScopedKey = None
     print("⚠️ Warning: model_manager no disponible, usando OpenAI directamente")
 
 
@@ -40,6 +43,14 @@ class CorrectionAgent:
     Analiza si las respuestas tienen sentido en el contexto de la conversación
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente corrector
@@ -117,11 +128,9 @@ class CorrectionAgent:
                         task_type="analysis",
                         min_quality="low",
                         preferred_model=model if model else None,
-                        context_length=4000
+                        context_length=4000,
+                        temperature=0.3  # Temperatura baja para análisis preciso
                     )
-                    # Ajustar temperatura para análisis preciso
-                    if hasattr(self.llm, 'temperature'):
-                        self.llm.temperature = 0.3
                     print(f"✅ Usando modelo para corrección: {self.current_model_config.name}")
                 except Exception as e:
                     print(f"⚠️ Error al seleccionar modelo: {e}")
@@ -15,6 +15,8 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+
 try:
     from model_manager import ModelManager
 except ImportError:
@@ -28,6 +30,11 @@ class CourseGuideAgent:
     Toma iniciativa como un profesor particular
     """
     
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente guía de cursos
@@ -22,11 +22,25 @@ from memory.memory_manager import MemoryManager
 import json
 import uuid
 
+from execution_context import RequestScoped
+
+try:
+    from model_manager import RequestScopedKey
+except ImportError:
+    RequestScopedKey = None
+
 class ExerciseGeneratorAgent:
     """
     Agente especializado en generar ejercicios complejos con respuestas abiertas
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente generador de ejercicios
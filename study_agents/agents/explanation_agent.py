@@ -31,10 +31,13 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+
 try:
-    from model_manager import ModelManager
+    from model_manager import ModelManager, RequestScopedKey
 except ImportError:
     ModelManager = None
+    RequestScopedKey = None
     print("⚠️ Warning: model_manager no disponible, usando OpenAI directamente")
 
 try:
@@ -48,11 +51,22 @@ except ImportError:
     search_youtube_via_scrape = None  # type: ignore
     shorten_search_query = None  # type: ignore
 
+from image_resolver import get_image_resolver
+from rate_limiter import get_rate_limiter
+
 class ExplanationAgent:
     """
     Agente especializado en generar explicaciones claras y resumidas
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente de explicaciones
@@ -118,7 +132,8 @@ class ExplanationAgent:
                         "client_id": self.unsplash_api_key,
                     }
                     
-                    response = requests.get(search_url, params=params, timeout=10)
+                    with get_rate_limiter().slot("unsplash"):
+                        response = requests.get(search_url, params=params, timeout=10)
                     response.raise_for_status()
                     data = response.json()
                     
@@ -146,7 +161,8 @@ class ExplanationAgent:
                     "orientation": "landscape",
                 }
                 
-                response = requests.get(search_url, headers=headers if headers else None, params=params, timeout=10)
+                with get_rate_limiter().slot("pexels"):
+                    response = requests.get(search_url, headers=headers if headers else None, params=params, timeout=10)
                 response.raise_for_status()
                 data = response.json()
                 
@@ -266,6 +282,9 @@ class ExplanationAgent:
         """
         Procesa bloques de imagen en el contenido y los reemplaza con URLs reales
         
+        Las imágenes de todos los bloques se resuelven a la vez (image_resolver, con
+        caché por descripción); las que no llegan a tiempo usan la imagen de fallback.
+        
         Args:
             content: Contenido con bloques de imagen
             
@@ -275,9 +294,7 @@ class ExplanationAgent:
         # Patrón para detectar bloques de imagen
         image_block_pattern = r'```image\s*\n(.*?)```'
         
-        def replace_image_block(match):
-            block_content = match.group(1).strip()
-            
+        def block_query(block_content):
             # Extraer query y description del bloque
             query = None
             description = None
@@ -292,11 +309,22 @@ class ExplanationAgent:
             if not query:
                 query = description or block_content
             
+            return query, description
+        
+        queries = [
+            block_query(m.group(1).strip())[0]
+            for m in re.finditer(image_block_pattern, content, flags=re.DOTALL | re.IGNORECASE)
+        ]
+        resolved = get_image_resolver().resolve_many([q for q in queries if q], self.search_image, "stock")
+        
+        def replace_image_block(match):
+            query, description = block_query(match.group(1).strip())
+            
             if not query:
                 return ""
             
-            # Buscar imagen
-            image_data = self.search_image(query)
+            # Imagen ya resuelta (None si no se encontró o no llegó a tiempo)
+            image_data = resolved.get(query)
             
             if image_data:
                 image_url = image_data["url"]
@@ -374,12 +402,14 @@ class ExplanationAgent:
         
         return processed_content
     
-    def generate_explanations(self, max_concepts: int = 20) -> Dict[str, str]:
+    def generate_explanations(self, max_concepts: int = 20, chat_id: Optional[str] = None, user_id: Optional[str] = None) -> Dict[str, str]:
         """
         Genera explicaciones claras del contenido procesado
         
         Args:
             max_concepts: Número máximo de conceptos a explicar
+            chat_id: ID del chat cuyos documentos se explican
+            user_id: ID del usuario dueño del chat
             
         Returns:
             Diccionario con explicaciones por concepto o texto completo
@@ -442,8 +472,8 @@ class ExplanationAgent:
                         "status": "error"
                     }
         
-        # Recuperar todo el contenido de la memoria
-        all_content = self.memory.get_all_documents(limit=100)
+        # Contenido del chat (digest precalculado al subir los documentos)
+        all_content = self.memory.get_chat_digest(chat_id, user_id)
         
         if not all_content:
             return {"error": "No hay contenido procesado. Sube documentos primero."}
@@ -566,9 +596,8 @@ Formato el resultado en Markdown con encabezados, listas y secciones bien organi
                     min_quality="medium",
                     preferred_model=model if model else None,
                     context_length=6000,
+                    temperature=0.75,
                 )
-                if hasattr(base_llm, "temperature"):
-                    base_llm.temperature = 0.75
                 self.llm = base_llm
                 print(
                     f"✅ Plan de estudio — modelo: {self.current_model_config.name}"
@@ -1098,11 +1127,9 @@ Cada slide = UNA pantalla completa con:
                     task_type="generation",
                     min_quality="medium",
                     preferred_model=model if model else None,
-                    context_length=8000  # Necesitamos contexto amplio
+                    context_length=8000,  # Necesitamos contexto amplio
+                    temperature=0.9  # Más temperatura para más variación en los apuntes
                 )
-                # Aumentar temperatura para más variación en los apuntes
-                if hasattr(base_llm, 'temperature'):
-                    base_llm.temperature = 0.9
                 self.llm = base_llm
                 print(f"✅ Usando modelo: {self.current_model_config.name} (costo: ${self.current_model_config.cost_per_1k_input:.4f}/{self.current_model_config.cost_per_1k_output:.4f} por 1k tokens)")
             except Exception as e:
@@ -1529,8 +1556,8 @@ description: Este video explica paso a paso cómo resolver ecuaciones de segundo
         if chat_corpus and chat_corpus.strip():
             all_content = [chat_corpus]
         else:
-            # Legacy: sin chat_id — colección global (evitar en producción multi-chat)
-            all_content = self.memory.get_all_documents(limit=50)
+            # Digest del chat (vacío sin chat_id/user_id: nunca se mezcla con otros chats)
+            all_content = self.memory.get_chat_digest(chat_id, user_id)
 
         syllabus_topics = None
         if all_content:
@@ -1584,10 +1611,7 @@ description: Este video explica paso a paso cómo resolver ecuaciones de segundo
                 if conversation_text:
                     combined_content += f"\n\n---\n\nHISTORIAL DE CONVERSACIÓN (contexto adicional):\n{conversation_text}"
         else:
-            # 3) Fallback: documentos globales o historial
-            if not all_content:
-                all_content = self.memory.get_all_documents(limit=100)
-            
+            # 3) Fallback: digest del chat (ya leído arriba) o historial
             if conversation_text and (not all_content or len(all_content) == 0):
                 print("📝 Usando solo historial de conversación (no hay documentos)")
                 combined_content = conversation_text
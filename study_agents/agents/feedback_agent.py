@@ -1,6 +1,11 @@
 """
 Feedback Agent - Corrige tests y proporciona feedback detallado
 Analiza respuestas y da retroalimentación educativa
+La nota se calcula sin LLM; el feedback de cada pregunta se genera en paralelo
+(hasta FEEDBACK_MAX_WORKERS llamadas a la vez) y puede entregarse según termina.
+Las respuestas correctas (y, si se activa, las incorrectas con una explicación
+suficiente) reciben feedback de plantilla al instante; el feedback del LLM se guarda
+en memory.feedback_cache por (pregunta, respuesta) y no se vuelve a pedir.
 """
 
 # Aplicar parche de proxies antes de importar ChatOpenAI
@@ -15,10 +20,13 @@ try:
 except:
     pass
 
-from typing import Dict, List, Optional
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from memory.memory_manager import MemoryManager
+from memory.feedback_cache import get_feedback_cache, question_hash
 import sys
 
 # Importar model_manager
@@ -26,17 +34,35 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+
 try:
-    from model_manager import ModelManager
+    from model_manager import ModelManager, RequestScopedKey
 except ImportError:
     ModelManager = None
+    RequestScopedKey = None
     print("⚠️ Warning: model_manager no disponible, usando OpenAI directamente")
 
+# Llamadas simultáneas al LLM para el feedback por pregunta de un mismo test
+FEEDBACK_MAX_WORKERS = max(1, int(os.getenv("FEEDBACK_MAX_WORKERS", "6")))
+# Feedback de plantilla también para respuestas incorrectas con explicación suficiente
+FEEDBACK_TEMPLATE_WRONG_ANSWERS = os.getenv("FEEDBACK_TEMPLATE_WRONG_ANSWERS", "0").lower() in ("1", "true", "yes")
+# Longitud mínima de la explicación para usar la plantilla en una respuesta incorrecta
+FEEDBACK_TEMPLATE_MIN_EXPLANATION_CHARS = max(0, int(os.getenv("FEEDBACK_TEMPLATE_MIN_EXPLANATION_CHARS", "80")))
+
 class FeedbackAgent:
     """
     Agente especializado en corregir respuestas y proporcionar feedback
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente de feedback
@@ -89,13 +115,69 @@ class FeedbackAgent:
         Returns:
             Feedback detallado con correcciones
         """
+        result = None
+        for kind, payload in self.stream_grade_test(test_id, answers, test_data):
+            if kind in ("done", "error"):
+                result = payload
+        return result
+    
+    def stream_grade_test(
+        self, test_id: str, answers: Dict[str, str], test_data: Optional[Dict] = None
+    ) -> Iterator[Tuple[str, Dict]]:
+        """
+        Versión incremental de grade_test
+        
+        Yields:
+            ("score", resultado sin feedback por pregunta) en cuanto se corrige (sin LLM),
+            ("feedback", {index, question_id, feedback}) por pregunta según terminan,
+            ("done", resultado completo como el de grade_test) o ("error", {error, test_id})
+        """
         if test_data is None:
-            return {
+            yield "error", {
                 "error": "No se proporcionó información del test para corregir.",
                 "test_id": test_id
             }
+            return
+        
+        feedback_items, correct_count, total_questions = self._score_answers(answers, test_data)
+        score = correct_count / total_questions if total_questions > 0 else 0
+        
+        # Generar feedback general (sin LLM)
+        general_feedback, general_feedback_usage = self._generate_general_feedback(score, feedback_items, total_questions, correct_count)
+        
+        result = {
+            "test_id": test_id,
+            "score": round(score, 2),
+            "percentage": round(score * 100, 1),
+            "correct_answers": correct_count,
+            "total_questions": total_questions,
+            "question_feedback": feedback_items,
+            "general_feedback": general_feedback,
+            "recommendations": self._generate_recommendations(score, feedback_items),
+        }
+        yield "score", {**result, "question_feedback": [dict(item) for item in feedback_items]}
         
-        # Construir feedback para cada pregunta
+        # Acumular tokens de todas las llamadas al LLM
+        total_input_tokens = general_feedback_usage.get("inputTokens", 0)
+        total_output_tokens = general_feedback_usage.get("outputTokens", 0)
+        for index, feedback_text, usage in self._iter_question_feedback(feedback_items):
+            feedback_items[index]["feedback"] = feedback_text
+            total_input_tokens += usage.get("inputTokens", 0)
+            total_output_tokens += usage.get("outputTokens", 0)
+            yield "feedback", {
+                "index": index,
+                "question_id": feedback_items[index]["question_id"],
+                "feedback": feedback_text,
+            }
+        
+        result["usage_info"] = {
+            "inputTokens": total_input_tokens,
+            "outputTokens": total_output_tokens
+        }
+        yield "done", result
+    
+    def _score_answers(self, answers: Dict[str, str], test_data: Dict) -> Tuple[List[Dict], int, int]:
+        """Corrige las respuestas (determinista, sin LLM): (items sin feedback, aciertos, total)"""
         feedback_items = []
         correct_count = 0
         total_questions = len(answers)
@@ -139,57 +221,150 @@ class FeedbackAgent:
             if is_correct:
                 correct_count += 1
             
-            # Generar feedback detallado usando LLM
-            feedback_text = self._generate_feedback(
-                question_text,
-                student_answer,
-                correct_answer,
-                question_type,
-                options,
-                is_correct,
-                question.get("explanation", "")
-            )
-            
             feedback_items.append({
                 "question_id": question_id,
                 "question": question_text,
                 "student_answer": student_answer,
                 "correct_answer": correct_answer,
                 "is_correct": is_correct,
-                "feedback": feedback_text,
+                "feedback": None,  # Se rellena al generar el feedback
                 "explanation": question.get("explanation", ""),
                 "concept_ids": question.get("concept_ids") or [],
                 "options": options,
                 "type": question_type,
             })
         
-        score = correct_count / total_questions if total_questions > 0 else 0
-        
-        # Generar feedback general
-        general_feedback, general_feedback_usage = self._generate_general_feedback(score, feedback_items, total_questions, correct_count)
-        
-        # Acumular tokens de todas las llamadas al LLM
-        total_input_tokens = sum(item.get("inputTokens", 0) for item in feedback_items if isinstance(item, dict) and "inputTokens" in item)
-        total_output_tokens = sum(item.get("outputTokens", 0) for item in feedback_items if isinstance(item, dict) and "outputTokens" in item)
+        return feedback_items, correct_count, total_questions
+    
+    @staticmethod
+    def _option_text(item: Dict, letter: str) -> str:
+        """Texto de la opción de una letra (A-D) en preguntas de opción múltiple, o "" """
+        letter = str(letter).strip().upper()
+        options = item.get("options") or []
+        if item.get("type") != "multiple_choice" or letter not in ["A", "B", "C", "D"]:
+            return ""
+        idx = ord(letter) - 65
+        return str(options[idx]) if idx < len(options) else ""
+    
+    def _template_feedback(self, item: Dict) -> Optional[str]:
+        """Feedback sin LLM para respuestas correctas (y, si se activa, incorrectas bien explicadas)"""
+        explanation = (item.get("explanation") or "").strip()
+        correct_answer = item["correct_answer"]
+        correct_text = self._option_text(item, correct_answer)
+        correct_label = f"{correct_answer} ({correct_text})" if correct_text else f"{correct_answer}"
         
-        # Añadir tokens del feedback general
-        total_input_tokens += general_feedback_usage.get("inputTokens", 0)
-        total_output_tokens += general_feedback_usage.get("outputTokens", 0)
+        if item["is_correct"]:
+            feedback = f"✅ ¡Correcto! La respuesta es {correct_label}."
+            if explanation:
+                feedback += f"\n\n{explanation}"
+            return feedback
         
-        return {
-            "test_id": test_id,
-            "score": round(score, 2),
-            "percentage": round(score * 100, 1),
-            "correct_answers": correct_count,
-            "total_questions": total_questions,
-            "question_feedback": feedback_items,
-            "general_feedback": general_feedback,
-            "recommendations": self._generate_recommendations(score, feedback_items),
-            "usage_info": {
-                "inputTokens": total_input_tokens,
-                "outputTokens": total_output_tokens
+        if not FEEDBACK_TEMPLATE_WRONG_ANSWERS or len(explanation) < FEEDBACK_TEMPLATE_MIN_EXPLANATION_CHARS:
+            return None
+        student_text = self._option_text(item, item["student_answer"])
+        student_label = f"{item['student_answer']} ({student_text})" if student_text else f"{item['student_answer']}"
+        return (
+            f"❌ Incorrecto. Respondiste {student_label}, pero la respuesta correcta es {correct_label}."
+            f"\n\n{explanation}"
+            f"\n\n💡 Repasa este concepto y fíjate en qué diferencia la respuesta correcta de la que elegiste."
+        )
+    
+    def _fallback_feedback(self, item: Dict) -> str:
+        """Feedback mínimo cuando no hay LLM disponible o la llamada falla"""
+        explanation = item.get("explanation")
+        if item["is_correct"]:
+            return f"✅ Correcto. {explanation if explanation else 'Bien hecho!'}"
+        return f"❌ Incorrecto. La respuesta correcta es {item['correct_answer']}. {explanation if explanation else 'Revisa este concepto.'}"
+    
+    def _question_hash(self, item: Dict) -> str:
+        return question_hash(item["question"], item["type"], item["options"], item["correct_answer"], item["explanation"])
+    
+    def _instant_feedback(self, item: Dict) -> Optional[str]:
+        """Plantilla o feedback ya cacheado; None si hace falta el LLM"""
+        cache = get_feedback_cache()
+        feedback = self._template_feedback(item)
+        if feedback is not None:
+            cache.record_template()
+            return feedback
+        return cache.get(self._question_hash(item), item["student_answer"])
+    
+    def _question_feedback(self, item: Dict) -> Tuple[str, dict]:
+        """Feedback del LLM para una pregunta; se cachea salvo que sea el de respaldo"""
+        feedback, usage = self._generate_feedback(
+            item["question"],
+            item["student_answer"],
+            item["correct_answer"],
+            item["type"],
+            item["options"],
+            item["is_correct"],
+            item["explanation"]
+        )
+        if feedback and feedback != self._fallback_feedback(item):
+            get_feedback_cache().put(self._question_hash(item), item["student_answer"], feedback)
+        return feedback, usage
+    
+    def _iter_question_feedback(self, feedback_items: List[Dict]) -> Iterator[Tuple[int, str, dict]]:
+        """
+        Entrega (índice, texto, uso) de cada pregunta en orden de llegada: primero las
+        resueltas al instante (plantilla o caché) y después las del LLM, generadas en
+        paralelo (como mucho FEEDBACK_MAX_WORKERS a la vez)
+        """
+        pending = []
+        for index, item in enumerate(feedback_items):
+            feedback = self._instant_feedback(item)
+            if feedback is None:
+                pending.append(index)
+            else:
+                yield index, feedback, {"inputTokens": 0, "outputTokens": 0}
+        if not pending:
+            return
+        # Elegir el modelo una vez, antes de repartir las llamadas entre hilos
+        self._ensure_llm()
+        workers = min(FEEDBACK_MAX_WORKERS, len(pending))
+        if workers == 1:
+            for index in pending:
+                yield (index, *self._question_feedback(feedback_items[index]))
+            return
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feedback") as pool:
+            # Cada hilo con el contexto de la petición (keys por usuario)
+            futures = {
+                pool.submit(contextvars.copy_context().run, self._question_feedback, feedback_items[index]): index
+                for index in pending
             }
-        }
+            for future in as_completed(futures):
+                yield (futures[future], *future.result())
+    
+    def _ensure_llm(self) -> None:
+        """Inicializa el LLM si no está inicializado (usar modo automático)"""
+        if self.llm:
+            return
+        if self.model_manager:
+            try:
+                self.current_model_config, self.llm = self.model_manager.select_model(
+                    task_type="analysis",
+                    min_quality="medium"
+                )
+                print(f"✅ Usando modelo: {self.current_model_config.name} (costo: ${self.current_model_config.cost_per_1k_input:.4f}/{self.current_model_config.cost_per_1k_output:.4f} por 1k tokens)")
+            except Exception as e:
+                print(f"⚠️ Error al seleccionar modelo automáticamente: {e}")
+                if self.api_key:
+                    try:
+                        self.llm = ChatOpenAI(
+                            model="gpt-3.5-turbo",
+                            temperature=0.7,
+                            api_key=self.api_key
+                        )
+                    except:
+                        pass
+        elif self.api_key:
+            try:
+                self.llm = ChatOpenAI(
+                    model="gpt-3.5-turbo",
+                    temperature=0.7,
+                    api_key=self.api_key
+                )
+            except:
+                pass
     
     def _generate_feedback(self, question: str, student_answer: str, correct_answer: str,
                           question_type: str, options: List[str], is_correct: bool,
@@ -260,39 +435,11 @@ Formato de respuesta:
 - Explica el concepto usando la explicación proporcionada
 - Proporciona una sugerencia constructiva"""
         
-        # Inicializar LLM si no está inicializado (usar modo automático)
-        if not self.llm:
-            if self.model_manager:
-                try:
-                    self.current_model_config, self.llm = self.model_manager.select_model(
-                        task_type="analysis",
-                        min_quality="medium"
-                    )
-                    print(f"✅ Usando modelo: {self.current_model_config.name} (costo: ${self.current_model_config.cost_per_1k_input:.4f}/{self.current_model_config.cost_per_1k_output:.4f} por 1k tokens)")
-                except Exception as e:
-                    print(f"⚠️ Error al seleccionar modelo automáticamente: {e}")
-                    if self.api_key:
-                        try:
-                            self.llm = ChatOpenAI(
-                                model="gpt-3.5-turbo",
-                                temperature=0.7,
-                                api_key=self.api_key
-                            )
-                        except:
-                            pass
-            elif self.api_key:
-                try:
-                    self.llm = ChatOpenAI(
-                        model="gpt-3.5-turbo",
-                        temperature=0.7,
-                        api_key=self.api_key
-                    )
-                except:
-                    pass
+        self._ensure_llm()
         
+        fallback = self._fallback_feedback({"is_correct": is_correct, "correct_answer": correct_answer, "explanation": explanation})
         if not self.llm:
-            error_msg = f"✅ Correcto. {explanation if explanation else 'Bien hecho!'}" if is_correct else f"❌ Incorrecto. La respuesta correcta es {correct_answer}. {explanation if explanation else 'Revisa este concepto.'}"
-            return error_msg, {"inputTokens": 0, "outputTokens": 0}
+            return fallback, {"inputTokens": 0, "outputTokens": 0}
         
         try:
             response = self.llm.invoke(feedback_prompt)
@@ -311,8 +458,7 @@ Formato de respuesta:
             
             return response.content, usage_info
         except Exception as e:
-            error_msg = f"✅ Correcto. {explanation if explanation else 'Bien hecho!'}" if is_correct else f"❌ Incorrecto. La respuesta correcta es {correct_answer}. {explanation if explanation else 'Revisa este concepto.'}"
-            return error_msg, {"inputTokens": 0, "outputTokens": 0}
+            return fallback, {"inputTokens": 0, "outputTokens": 0}
     
     def _generate_general_feedback(self, score: float, feedback_items: List[Dict],
                                    total_questions: int, correct_count: int) -> tuple[str, dict]:
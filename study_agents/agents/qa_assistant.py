@@ -4,7 +4,7 @@ Usa RAG para buscar información relevante y responde con contexto
 """
 
 import json
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Iterator
 from langchain_openai import ChatOpenAI
 from memory.memory_manager import MemoryManager
 import os
@@ -17,10 +17,13 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+
 try:
-    from model_manager import ModelManager
+    from model_manager import ModelManager, RequestScopedKey
 except ImportError:
     ModelManager = None
+    RequestScopedKey = None
     print("⚠️ Warning: model_manager no disponible, usando OpenAI directamente")
 
 try:
@@ -34,11 +37,89 @@ except ImportError:
     search_youtube_via_scrape = None  # type: ignore
     shorten_search_query = None  # type: ignore
 
+from image_resolver import get_image_resolver
+from rate_limiter import get_rate_limiter
+
+# Bloques que se resuelven a medida que se cierran durante el streaming
+STREAM_MEDIA_LANGUAGES = ("image", "youtube-video")
+
+
+def _estimate_tokens(text: str) -> int:
+    """Estimación de tokens cuando el proveedor no devuelve uso en streaming"""
+    try:
+        import tiktoken
+        return len(tiktoken.get_encoding("cl100k_base").encode(text))
+    except Exception:
+        return len(text) // 4
+
+
+class _MediaBlockStream:
+    """
+    Filtro incremental para el streaming de respuestas.
+    Deja pasar el texto tal cual salvo los bloques ```image / ```youtube-video,
+    que se retienen hasta cerrarse y se emiten ya resueltos.
+    """
+
+    def __init__(self, resolve: Callable[[str, str], str]):
+        self.resolve = resolve
+        self.pending = ""
+        self.block_language: Optional[str] = None
+
+    def feed(self, text: str) -> List[tuple[str, str]]:
+        self.pending += text
+        events: List[tuple[str, str]] = []
+        while self.pending:
+            if self.block_language:
+                end = self.pending.find("```", self.pending.find("\n") + 1)
+                if end == -1:
+                    break
+                _, _, body = self.pending[:end].partition("\n")
+                self.pending = self.pending[end + 3:]
+                language, self.block_language = self.block_language, None
+                events.append(("block", self.resolve(language, body)))
+                continue
+            start = self.pending.find("```")
+            if start == -1:
+                # Retener posibles comillas de apertura partidas entre chunks
+                keep = len(self.pending) - len(self.pending.rstrip("`"))
+                emit = self.pending[:len(self.pending) - keep]
+                if emit:
+                    events.append(("token", emit))
+                self.pending = self.pending[len(self.pending) - keep:]
+                break
+            if start:
+                events.append(("token", self.pending[:start]))
+                self.pending = self.pending[start:]
+            line_end = self.pending.find("\n")
+            if line_end == -1:
+                break  # aún no sabemos el lenguaje del bloque
+            language = self.pending[3:line_end].strip().lower()
+            if language in STREAM_MEDIA_LANGUAGES:
+                self.block_language = language
+            else:
+                events.append(("token", self.pending[:line_end + 1]))
+                self.pending = self.pending[line_end + 1:]
+        return events
+
+    def flush(self) -> List[tuple[str, str]]:
+        """Emite lo que quede (un bloque sin cerrar se deja como texto)"""
+        rest, self.pending, self.block_language = self.pending, "", None
+        return [("token", rest)] if rest else []
+
+
 class QAAssistantAgent:
     """
     Agente especializado en responder preguntas del estudiante
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente de Q&A
@@ -114,7 +195,8 @@ class QAAssistantAgent:
                         "client_id": self.unsplash_api_key,
                     }
                     
-                    response = requests.get(search_url, params=params, timeout=10)
+                    with get_rate_limiter().slot("unsplash"):
+                        response = requests.get(search_url, params=params, timeout=10)
                     response.raise_for_status()
                     data = response.json()
                     
@@ -142,7 +224,8 @@ class QAAssistantAgent:
                     "orientation": "landscape",
                 }
                 
-                response = requests.get(search_url, headers=headers if headers else None, params=params, timeout=10)
+                with get_rate_limiter().slot("pexels"):
+                    response = requests.get(search_url, headers=headers if headers else None, params=params, timeout=10)
                 response.raise_for_status()
                 data = response.json()
                 
@@ -183,6 +266,9 @@ class QAAssistantAgent:
         """
         Procesa bloques de imagen en el contenido y los reemplaza con URLs reales
         
+        Las imágenes de todos los bloques se resuelven a la vez (image_resolver, con
+        caché por descripción); las que no llegan a tiempo usan la imagen de fallback.
+        
         Args:
             content: Contenido con bloques de imagen
             
@@ -192,51 +278,76 @@ class QAAssistantAgent:
         # Patrón para detectar bloques de imagen
         image_block_pattern = r'```image\s*\n(.*?)```'
         
-        def replace_image_block(match):
-            block_content = match.group(1).strip()
-            
-            # Extraer query y description del bloque
-            query = None
-            description = None
-            
-            for line in block_content.split('\n'):
-                if line.startswith('query:'):
-                    query = line.replace('query:', '').strip()
-                elif line.startswith('description:'):
-                    description = line.replace('description:', '').strip()
-            
-            # Si no hay query, usar la description o el contenido completo
-            if not query:
-                query = description or block_content
-            
-            if not query:
-                return ""
-            
-            # Buscar imagen
-            image_data = self.search_image(query)
-            
-            if image_data:
-                image_url = image_data["url"]
-                image_desc = image_data.get("description", description or query)
-                print(f"✅ Imagen encontrada para '{query}': {image_url[:80]}...")
-                
-                # Reemplazar con markdown de imagen
-                return f'\n\n![{image_desc}]({image_url})\n\n*Imagen: {image_desc}*\n\n'
-            else:
-                print(f"⚠️ No se encontró imagen para '{query}', dejando descripción")
-                fallback_desc = description or query
-                seed = requests.utils.quote((query or "study-agents-image")[:80])
-                fallback_url = f"https://picsum.photos/seed/{seed}/1200/700"
-                return (
-                    f'\n\n![{fallback_desc}]({fallback_url})\n\n'
-                    f'*💡 Imagen sugerida (fallback visual): {fallback_desc}*\n\n'
-                )
+        blocks = [m.group(1) for m in re.finditer(image_block_pattern, content, flags=re.DOTALL | re.IGNORECASE)]
+        queries = [self._image_block_query(block)[0] for block in blocks]
+        resolved = get_image_resolver().resolve_many([q for q in queries if q], self.search_image, "stock")
         
         # Reemplazar todos los bloques de imagen
-        processed_content = re.sub(image_block_pattern, replace_image_block, content, flags=re.DOTALL | re.IGNORECASE)
+        processed_content = re.sub(image_block_pattern, lambda match: self._resolve_image_block(match.group(1), resolved), content, flags=re.DOTALL | re.IGNORECASE)
         
         return processed_content
     
+    @staticmethod
+    def _image_block_query(block_content: str) -> tuple:
+        """(query, description) de un bloque ```image"""
+        block_content = block_content.strip()
+        
+        # Extraer query y description del bloque
+        query = None
+        description = None
+        
+        for line in block_content.split('\n'):
+            if line.startswith('query:'):
+                query = line.replace('query:', '').strip()
+            elif line.startswith('description:'):
+                description = line.replace('description:', '').strip()
+        
+        # Si no hay query, usar la description o el contenido completo
+        if not query:
+            query = description or block_content
+        
+        return query, description
+    
+    def _resolve_image_block(self, block_content: str, resolved: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Resuelve un bloque ```image (query/description) a su markdown final
+        
+        Args:
+            block_content: Contenido interior del bloque
+            resolved: Imágenes ya resueltas por query (las de _process_image_blocks);
+                si no se pasa, se resuelve este bloque (con caché y plazo)
+            
+        Returns:
+            Markdown de la imagen (o imagen de fallback)
+        """
+        query, description = self._image_block_query(block_content)
+        
+        if not query:
+            return ""
+        
+        # Buscar imagen
+        if resolved is None:
+            image_data = get_image_resolver().resolve(query, self.search_image, "stock")
+        else:
+            image_data = resolved.get(query)
+        
+        if image_data:
+            image_url = image_data["url"]
+            image_desc = image_data.get("description", description or query)
+            print(f"✅ Imagen encontrada para '{query}': {image_url[:80]}...")
+            
+            # Reemplazar con markdown de imagen
+            return f'\n\n![{image_desc}]({image_url})\n\n*Imagen: {image_desc}*\n\n'
+        else:
+            print(f"⚠️ No se encontró imagen para '{query}', dejando descripción")
+            fallback_desc = description or query
+            seed = requests.utils.quote((query or "study-agents-image")[:80])
+            fallback_url = f"https://picsum.photos/seed/{seed}/1200/700"
+            return (
+                f'\n\n![{fallback_desc}]({fallback_url})\n\n'
+                f'*💡 Imagen sugerida (fallback visual): {fallback_desc}*\n\n'
+            )
+    
     def search_youtube_video(self, query: str) -> Optional[Dict[str, str]]:
         """
         Busca un video relevante de YouTube usando la API o web scraping
@@ -332,46 +443,61 @@ class QAAssistantAgent:
         # Patrón para detectar bloques de video
         video_block_pattern = r'```youtube-video\s*\n(.*?)```'
         
-        def replace_video_block(match):
-            block_content = match.group(1).strip()
-            
-            # Extraer query y description del bloque
-            query = None
-            description = None
-            
-            for line in block_content.split('\n'):
-                if line.startswith('query:'):
-                    query = line.replace('query:', '').strip()
-                elif line.startswith('description:'):
-                    description = line.replace('description:', '').strip()
-            
-            # Si no hay query, usar la description o el contenido completo
-            if not query:
-                query = description or block_content
-            
-            if not query:
-                return ""
-            
-            # Buscar video
-            video_data = self.search_youtube_video(query)
-            
-            if video_data:
-                video_id = video_data["videoId"]
-                video_title = video_data.get("title", query)
-                video_url = video_data.get("url", f"https://www.youtube.com/watch?v={video_id}")
-                print(f"✅ Video encontrado para '{query}': {video_id}")
-                
-                # Reemplazar con formato especial que el frontend puede procesar
-                return f'\n\n<youtube-video id="{video_id}" url="{video_url}" title="{video_title}" />\n\n'
-            else:
-                print(f"⚠️ No se encontró video para '{query}', dejando descripción")
-                return f'\n\n*🎬 Video sugerido: {description or query}*\n\n'
-        
         # Reemplazar todos los bloques de video
-        processed_content = re.sub(video_block_pattern, replace_video_block, content, flags=re.DOTALL | re.IGNORECASE)
+        processed_content = re.sub(video_block_pattern, lambda match: self._resolve_video_block(match.group(1)), content, flags=re.DOTALL | re.IGNORECASE)
         
         return processed_content
     
+    def _resolve_video_block(self, block_content: str) -> str:
+        """
+        Resuelve un bloque ```youtube-video (query/description) a su markdown final
+        
+        Args:
+            block_content: Contenido interior del bloque
+            
+        Returns:
+            Etiqueta <youtube-video> (o sugerencia en texto)
+        """
+        block_content = block_content.strip()
+        
+        # Extraer query y description del bloque
+        query = None
+        description = None
+        
+        for line in block_content.split('\n'):
+            if line.startswith('query:'):
+                query = line.replace('query:', '').strip()
+            elif line.startswith('description:'):
+                description = line.replace('description:', '').strip()
+        
+        # Si no hay query, usar la description o el contenido completo
+        if not query:
+            query = description or block_content
+        
+        if not query:
+            return ""
+        
+        # Buscar video
+        video_data = self.search_youtube_video(query)
+        
+        if video_data:
+            video_id = video_data["videoId"]
+            video_title = video_data.get("title", query)
+            video_url = video_data.get("url", f"https://www.youtube.com/watch?v={video_id}")
+            print(f"✅ Video encontrado para '{query}': {video_id}")
+            
+            # Reemplazar con formato especial que el frontend puede procesar
+            return f'\n\n<youtube-video id="{video_id}" url="{video_url}" title="{video_title}" />\n\n'
+        else:
+            print(f"⚠️ No se encontró video para '{query}', dejando descripción")
+            return f'\n\n*🎬 Video sugerido: {description or query}*\n\n'
+    
+    def _resolve_media_block(self, language: str, block_content: str) -> str:
+        """Resuelve un bloque multimedia cerrado durante el streaming"""
+        if language == "image":
+            return self._resolve_image_block(block_content)
+        return self._resolve_video_block(block_content)
+    
     def answer_question(
         self,
         question: str,
@@ -398,6 +524,58 @@ class QAAssistantAgent:
         Returns:
             Respuesta contextualizada
         """
+        messages, early = self._prepare_answer(
+            question, user_id, model=model, chat_id=chat_id, topic=topic,
+            force_premium=force_premium, initial_form_data=initial_form_data,
+            course_context=course_context, exam_info=exam_info,
+        )
+        if early is not None:
+            return early
+
+        try:
+            response = self.llm.invoke(messages)
+            
+            answer = response.content
+            
+            # POST-PROCESAMIENTO: Procesar bloques de imagen y video (siempre, para detectar bloques generados por el modelo)
+            answer = self._process_image_blocks(answer)
+            answer = self._process_video_blocks(answer)
+            
+            # Capturar tokens de uso
+            usage_info = self._usage_info(model)
+            
+            # Intentar obtener tokens de la metadata de la respuesta
+            if hasattr(response, 'response_metadata') and response.response_metadata:
+                token_usage = response.response_metadata.get('token_usage', {})
+                usage_info["inputTokens"] = token_usage.get('prompt_tokens', 0)
+                usage_info["outputTokens"] = token_usage.get('completion_tokens', 0)
+            
+            answer = self._finalize_answer(answer, question, user_id, chat_id)
+            return answer, usage_info
+            
+        except Exception as e:
+            error_msg = f"Error al generar respuesta: {str(e)}"
+            print(f"❌ {error_msg}")
+            return f"Lo siento, hubo un error al procesar tu pregunta. Por favor, intenta de nuevo. Error: {str(e)}", {"inputTokens": 0, "outputTokens": 0, "model": None}
+    
+    def _prepare_answer(
+        self,
+        question: str,
+        user_id: str = "default",
+        model: Optional[str] = None,
+        chat_id: Optional[str] = None,
+        topic: Optional[str] = None,
+        force_premium: bool = False,
+        initial_form_data: Optional[dict] = None,
+        course_context: Optional[Any] = None,
+        exam_info: Optional[Any] = None,
+    ) -> tuple[Optional[list], Optional[tuple[str, dict]]]:
+        """
+        Selecciona el modelo y construye los mensajes (RAG + historial + prompt)
+        
+        Returns:
+            Tupla (mensajes, None) o (None, (respuesta de error, usage_info)) si no hay modelo
+        """
         # Usar model_manager si está disponible (modo automático)
         if self.model_manager:
             try:
@@ -423,13 +601,13 @@ class QAAssistantAgent:
                         )
                         print("✅ Fallback a gpt-3.5-turbo")
                     except Exception as e2:
-                        return f"⚠️ Error al inicializar el modelo: {str(e2)}", {"inputTokens": 0, "outputTokens": 0, "model": None}
+                        return None, (f"⚠️ Error al inicializar el modelo: {str(e2)}", {"inputTokens": 0, "outputTokens": 0, "model": None})
                 else:
-                    return "⚠️ Se requiere configurar una API key de OpenAI o tener Ollama instalado. Por favor, configura tu API key en el modal de configuración o instala Ollama.", {"inputTokens": 0, "outputTokens": 0, "model": None}
+                    return None, ("⚠️ Se requiere configurar una API key de OpenAI o tener Ollama instalado. Por favor, configura tu API key en el modal de configuración o instala Ollama.", {"inputTokens": 0, "outputTokens": 0, "model": None})
         else:
             # Fallback: usar OpenAI directamente
             if not self.api_key:
-                return "⚠️ Se requiere configurar una API key de OpenAI para responder preguntas. Por favor, configura tu API key en el modal de configuración.", {"inputTokens": 0, "outputTokens": 0, "model": None}
+                return None, ("⚠️ Se requiere configurar una API key de OpenAI para responder preguntas. Por favor, configura tu API key en el modal de configuración.", {"inputTokens": 0, "outputTokens": 0, "model": None})
             
             # Usar modelo especificado o el más barato disponible
             model_to_use = model if model else "gpt-3.5-turbo"  # Por defecto usar el más barato
@@ -450,7 +628,7 @@ class QAAssistantAgent:
                         api_key=self.api_key
                     )
                 except Exception as e2:
-                    return f"⚠️ Error al inicializar el modelo: {str(e2)}", {"inputTokens": 0, "outputTokens": 0, "model": None}
+                    return None, (f"⚠️ Error al inicializar el modelo: {str(e2)}", {"inputTokens": 0, "outputTokens": 0, "model": None})
         
         # Recuperar contenido relevante de la memoria (solo del chat actual)
         # Modo rápido: bajar de 5 a 3 chunks reduce tokens y tiempo de generación.
@@ -769,109 +947,166 @@ Responde de manera clara, completa y VISUAL usando Markdown. Si el contexto del
         full_prompt = full_prompt.replace("__HISTORY_PLACEHOLDER__", history_str or "No hay historial previo de conversación.")
         full_prompt = full_prompt.replace("__QUESTION_PLACEHOLDER__", question)
 
-        try:
-            # Usar invoke directamente en lugar de ChatPromptTemplate para evitar problemas con llaves
-            from langchain_core.messages import HumanMessage, SystemMessage
-            messages = [
-                SystemMessage(content="Eres un asistente educativo experto que ayuda a estudiantes a entender conceptos."),
-                HumanMessage(content=full_prompt)
-            ]
-            response = self.llm.invoke(messages)
-            
-            answer = response.content
-            
-            # POST-PROCESAMIENTO: Procesar bloques de imagen y video (siempre, para detectar bloques generados por el modelo)
-            answer = self._process_image_blocks(answer)
-            answer = self._process_video_blocks(answer)
-            
-            # Capturar tokens de uso
-            usage_info = {
-                "inputTokens": 0,
-                "outputTokens": 0,
-                "model": None
-            }
-            
-            # Determinar el modelo usado
-            model_used = None
-            if self.current_model_config:
-                model_used = self.current_model_config.name
-            elif model:
-                model_used = model
-            elif hasattr(self.llm, 'model_name'):
-                model_used = self.llm.model_name
-            elif hasattr(self.llm, 'model'):
-                model_used = self.llm.model
-            else:
-                model_used = "gpt-3.5-turbo"  # Fallback
-            
-            usage_info["model"] = model_used
-            
-            # Intentar obtener tokens de la metadata de la respuesta
-            if hasattr(response, 'response_metadata') and response.response_metadata:
-                token_usage = response.response_metadata.get('token_usage', {})
-                usage_info["inputTokens"] = token_usage.get('prompt_tokens', 0)
-                usage_info["outputTokens"] = token_usage.get('completion_tokens', 0)
-            
-            # POST-PROCESAMIENTO: Eliminar cualquier bloque Mermaid que el modelo pueda haber generado
-            # Detectar y eliminar bloques de código Mermaid (multilínea)
-            mermaid_patterns = [
-                r'```\s*mermaid\s*\n.*?```',
-                r'```\s*flowchart\s*\n.*?```',
-                r'```\s*graph\s*\n.*?```',
-                r'```\s*gantt\s*\n.*?```',
-                r'```\s*sequenceDiagram\s*\n.*?```',
-                r'```\s*classDiagram\s*\n.*?```',
-                r'```\s*mindmap\s*\n.*?```',
-            ]
-            
-            for pattern in mermaid_patterns:
-                answer = re.sub(pattern, '', answer, flags=re.DOTALL | re.IGNORECASE | re.MULTILINE)
-            
-            # POST-PROCESAMIENTO: Validar y eliminar diagramas JSON que NO sean comparaciones de 2 elementos
-            import json as json_module
-            diagram_json_pattern = r'```\s*diagram-json\s*\n(.*?)```'
-            diagram_matches = list(re.finditer(diagram_json_pattern, answer, re.DOTALL))
-            diagrams_to_remove = []
-            
-            for match in diagram_matches:
-                diagram_content = match.group(1).strip()
-                try:
-                    diagram_data = json_module.loads(diagram_content)
-                    title = (diagram_data.get("title", "") or "").lower()
-                    nodes = diagram_data.get("nodes", [])
-                    
-                    # Verificar que el título contenga palabras de comparación
-                    has_comparison_keyword = any(keyword in title for keyword in [" vs ", " versus", " contra ", " vs. ", "comparación"])
-                    
-                    # Verificar que tenga exactamente 2 nodos
-                    has_exactly_2_nodes = len(nodes) == 2
-                    
-                    # Si NO es una comparación válida, marcarlo para eliminación
-                    if not (has_comparison_keyword and has_exactly_2_nodes):
-                        diagrams_to_remove.append(match)
-                        print(f"🚫 Diagrama eliminado de respuesta QA: '{diagram_data.get('title', 'Sin título')}' - No es comparación válida (nodos: {len(nodes)}, tiene 'vs': {has_comparison_keyword})")
-                except (json_module.JSONDecodeError, AttributeError, TypeError) as e:
-                    # Si no se puede parsear, eliminar el diagrama
+        # Usar invoke directamente en lugar de ChatPromptTemplate para evitar problemas con llaves
+        from langchain_core.messages import HumanMessage, SystemMessage
+        messages = [
+            SystemMessage(content="Eres un asistente educativo experto que ayuda a estudiantes a entender conceptos."),
+            HumanMessage(content=full_prompt)
+        ]
+        return messages, None
+    
+    def _usage_info(self, model: Optional[str] = None) -> dict:
+        """Estructura de uso con el modelo efectivamente usado (tokens a 0)"""
+        # Determinar el modelo usado
+        model_used = None
+        if self.current_model_config:
+            model_used = self.current_model_config.name
+        elif model:
+            model_used = model
+        elif hasattr(self.llm, 'model_name'):
+            model_used = self.llm.model_name
+        elif hasattr(self.llm, 'model'):
+            model_used = self.llm.model
+        else:
+            model_used = "gpt-3.5-turbo"  # Fallback
+        return {
+            "inputTokens": 0,
+            "outputTokens": 0,
+            "model": model_used
+        }
+    
+    def _finalize_answer(self, answer: str, question: str, user_id: str, chat_id: Optional[str]) -> str:
+        """
+        Limpia la respuesta (Mermaid, diagramas no válidos) y la guarda en el historial
+        
+        Returns:
+            Respuesta final
+        """
+        # POST-PROCESAMIENTO: Eliminar cualquier bloque Mermaid que el modelo pueda haber generado
+        # Detectar y eliminar bloques de código Mermaid (multilínea)
+        mermaid_patterns = [
+            r'```\s*mermaid\s*\n.*?```',
+            r'```\s*flowchart\s*\n.*?```',
+            r'```\s*graph\s*\n.*?```',
+            r'```\s*gantt\s*\n.*?```',
+            r'```\s*sequenceDiagram\s*\n.*?```',
+            r'```\s*classDiagram\s*\n.*?```',
+            r'```\s*mindmap\s*\n.*?```',
+        ]
+        
+        for pattern in mermaid_patterns:
+            answer = re.sub(pattern, '', answer, flags=re.DOTALL | re.IGNORECASE | re.MULTILINE)
+        
+        # POST-PROCESAMIENTO: Validar y eliminar diagramas JSON que NO sean comparaciones de 2 elementos
+        import json as json_module
+        diagram_json_pattern = r'```\s*diagram-json\s*\n(.*?)```'
+        diagram_matches = list(re.finditer(diagram_json_pattern, answer, re.DOTALL))
+        diagrams_to_remove = []
+        
+        for match in diagram_matches:
+            diagram_content = match.group(1).strip()
+            try:
+                diagram_data = json_module.loads(diagram_content)
+                title = (diagram_data.get("title", "") or "").lower()
+                nodes = diagram_data.get("nodes", [])
+                
+                # Verificar que el título contenga palabras de comparación
+                has_comparison_keyword = any(keyword in title for keyword in [" vs ", " versus", " contra ", " vs. ", "comparación"])
+                
+                # Verificar que tenga exactamente 2 nodos
+                has_exactly_2_nodes = len(nodes) == 2
+                
+                # Si NO es una comparación válida, marcarlo para eliminación
+                if not (has_comparison_keyword and has_exactly_2_nodes):
                     diagrams_to_remove.append(match)
-                    print(f"🚫 Diagrama eliminado de respuesta QA: Error al parsear JSON - {e}")
-            
-            # Eliminar diagramas inválidos (de atrás hacia adelante para no afectar índices)
-            for match in reversed(diagrams_to_remove):
-                answer = answer[:match.start()] + answer[match.end():]
-            
-            # Limpiar líneas vacías múltiples
-            answer = re.sub(r'\n{3,}', '\n\n', answer)
-            
-            # Guardar en historial
-            self.memory.add_to_conversation_history(user_id, "user", question, chat_id)
-            self.memory.add_to_conversation_history(user_id, "assistant", answer, chat_id)
-            
-            return answer, usage_info
-            
+                    print(f"🚫 Diagrama eliminado de respuesta QA: '{diagram_data.get('title', 'Sin título')}' - No es comparación válida (nodos: {len(nodes)}, tiene 'vs': {has_comparison_keyword})")
+            except (json_module.JSONDecodeError, AttributeError, TypeError) as e:
+                # Si no se puede parsear, eliminar el diagrama
+                diagrams_to_remove.append(match)
+                print(f"🚫 Diagrama eliminado de respuesta QA: Error al parsear JSON - {e}")
+        
+        # Eliminar diagramas inválidos (de atrás hacia adelante para no afectar índices)
+        for match in reversed(diagrams_to_remove):
+            answer = answer[:match.start()] + answer[match.end():]
+        
+        # Limpiar líneas vacías múltiples
+        answer = re.sub(r'\n{3,}', '\n\n', answer)
+        
+        # Guardar en historial
+        self.memory.add_to_conversation_history(user_id, "user", question, chat_id)
+        self.memory.add_to_conversation_history(user_id, "assistant", answer, chat_id)
+        return answer
+    
+    def stream_answer(
+        self,
+        question: str,
+        user_id: str = "default",
+        model: Optional[str] = None,
+        chat_id: Optional[str] = None,
+        topic: Optional[str] = None,
+        force_premium: bool = False,
+        initial_form_data: Optional[dict] = None,
+        course_context: Optional[Any] = None,
+        exam_info: Optional[Any] = None,
+    ) -> Iterator[tuple[str, Any]]:
+        """
+        Igual que answer_question pero emite la respuesta a medida que se genera
+        
+        Los bloques ```image / ```youtube-video se resuelven en cuanto se cierran.
+        
+        Yields:
+            ("token", texto), ("block", markdown resuelto) y al final
+            ("done", {"answer": respuesta final, "usage": usage_info})
+        """
+        messages, early = self._prepare_answer(
+            question, user_id, model=model, chat_id=chat_id, topic=topic,
+            force_premium=force_premium, initial_form_data=initial_form_data,
+            course_context=course_context, exam_info=exam_info,
+        )
+        if early is not None:
+            answer, usage_info = early
+            yield "token", answer
+            yield "done", {"answer": answer, "usage": usage_info}
+            return
+        
+        resolver = _MediaBlockStream(self._resolve_media_block)
+        parts: List[str] = []
+        raw_parts: List[str] = []
+        usage_info = self._usage_info(model)
+        try:
+            try:
+                chunks = self.llm.stream(messages)
+            except (AttributeError, NotImplementedError):
+                chunks = iter([self.llm.invoke(messages)])
+            for chunk in chunks:
+                text = chunk.content if hasattr(chunk, "content") else str(chunk)
+                metadata = getattr(chunk, "response_metadata", None) or {}
+                token_usage = metadata.get("token_usage") or {}
+                if token_usage:
+                    usage_info["inputTokens"] = token_usage.get("prompt_tokens", 0)
+                    usage_info["outputTokens"] = token_usage.get("completion_tokens", 0)
+                if not text:
+                    continue
+                raw_parts.append(text)
+                for kind, piece in resolver.feed(text):
+                    parts.append(piece)
+                    yield kind, piece
+            for kind, piece in resolver.flush():
+                parts.append(piece)
+                yield kind, piece
         except Exception as e:
             error_msg = f"Error al generar respuesta: {str(e)}"
             print(f"❌ {error_msg}")
-            return f"Lo siento, hubo un error al procesar tu pregunta. Por favor, intenta de nuevo. Error: {str(e)}", {"inputTokens": 0, "outputTokens": 0, "model": None}
+            yield "error", {"message": error_msg}
+            return
+        
+        # El streaming no siempre devuelve uso: estimarlo con tiktoken
+        if not usage_info["inputTokens"] and not usage_info["outputTokens"]:
+            usage_info["inputTokens"] = _estimate_tokens("\n".join(str(m.content) for m in messages))
+            usage_info["outputTokens"] = _estimate_tokens("".join(raw_parts))
+        
+        answer = self._finalize_answer("".join(parts), question, user_id, chat_id)
+        yield "done", {"answer": answer, "usage": usage_info}
     
     def clarify_concept(self, concept: str, user_id: str = "default") -> str:
         """
@@ -30,10 +30,14 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
+from execution_context import RequestScoped
+import generated_tests_storage
+
 try:
-    from model_manager import ModelManager
+    from model_manager import ModelManager, RequestScopedKey
 except ImportError:
     ModelManager = None
+    RequestScopedKey = None
     print("⚠️ Warning: model_manager no disponible, usando OpenAI directamente")
 
 class TestGeneratorAgent:
@@ -41,6 +45,14 @@ class TestGeneratorAgent:
     Agente especializado en generar tests y ejercicios interactivos
     """
     
+    # Key de OpenAI: la de la petición en curso si la hay, si no la del constructor
+    if RequestScopedKey is not None:
+        api_key = RequestScopedKey()
+    # Modelo elegido para la petición en curso: se guarda en su contexto de ejecución,
+    # no en la instancia compartida entre peticiones
+    llm = RequestScoped()
+    current_model_config = RequestScoped()
+    
     def __init__(self, memory: MemoryManager, api_key: Optional[str] = None, mode: str = "auto"):
         """
         Inicializa el agente generador de tests
@@ -79,8 +91,6 @@ class TestGeneratorAgent:
                     print(f"⚠️ Warning: No se pudo inicializar el LLM: {e}")
             else:
                 print("⚠️ Test Generator Agent inicializado sin API key (se requerirá para usar)")
-        
-        self.generated_tests: Dict[str, Dict] = {}  # Almacenar tests generados
     
     def _evaluate_math_expression(self, expr: str) -> Optional[float]:
         """
@@ -165,7 +175,7 @@ class TestGeneratorAgent:
         
         return False
     
-    def generate_test(self, difficulty: str = "medium", num_questions: int = 10, topics: Optional[List[str]] = None, constraints: Optional[str] = None, model: Optional[str] = None, conversation_history: Optional[List[Dict[str, str]]] = None, user_level: Optional[int] = None) -> Dict:
+    def generate_test(self, difficulty: str = "medium", num_questions: int = 10, topics: Optional[List[str]] = None, constraints: Optional[str] = None, model: Optional[str] = None, conversation_history: Optional[List[Dict[str, str]]] = None, user_level: Optional[int] = None, chat_id: Optional[str] = None, user_id: Optional[str] = None) -> Dict:
         """
         Genera un test personalizado
         
@@ -177,6 +187,8 @@ class TestGeneratorAgent:
             model: Modelo preferido (opcional, si no se especifica usa modo automático)
             conversation_history: Historial de conversación del chat (opcional)
             user_level: Nivel del usuario en el tema (1-10, opcional)
+            chat_id: ID del chat cuyos documentos se usan (opcional)
+            user_id: ID del usuario dueño del chat (opcional)
             
         Returns:
             Test generado con preguntas y respuestas correctas
@@ -317,8 +329,8 @@ class TestGeneratorAgent:
         context_parts = []
         use_specific_topic = False
         
-        # Detectar si el contenido subido es un temario
-        all_content = self.memory.get_all_documents(limit=50)
+        # Detectar si el contenido subido al chat es un temario (digest precalculado)
+        all_content = self.memory.get_chat_digest(chat_id, user_id)
         syllabus_topics = None
         if all_content:
             combined_doc_content = "\n\n".join(all_content[:10])  # Revisar primeros documentos
@@ -600,8 +612,8 @@ class TestGeneratorAgent:
         elif not conversation_text or len(conversation_text) <= 50:
             # Solo si NO hay conversación o es muy corta, buscar documentos
             print(f"⚠️ No hay conversación suficiente (longitud: {len(conversation_text) if conversation_text else 0}), buscando documentos como último recurso")
-            query = "conceptos principales del temario"
-            relevant_content = self.memory.retrieve_relevant_content(query, n_results=2)
+            # Chunks representativos del chat (digest), sin búsqueda en la colección
+            relevant_content = all_content[:2]
             if relevant_content:
                 context_parts.append("\n\nCONTEXTO - DOCUMENTOS SUBIDOS (solo porque no hay conversación):")
                 context_parts.append("\n\n".join(relevant_content[:1]))
@@ -1361,8 +1373,8 @@ IMPORTANTE:
             test_data["difficulty"] = difficulty
             test_data["num_questions"] = len(test_data["questions"])
             
-            # Almacenar test
-            self.generated_tests[test_id] = test_data
+            # Almacenar test (persistente: cualquier worker puede corregirlo después)
+            generated_tests_storage.save_test(test_id, test_data)
             
             # Capturar tokens de uso
             usage_info = {
@@ -1399,7 +1411,8 @@ IMPORTANTE:
         Returns:
             Test almacenado
         """
-        return self.generated_tests.get(test_id, {"error": "Test no encontrado"})
+        test = generated_tests_storage.get_test(test_id)
+        return test if test is not None else {"error": "Test no encontrado"}
     
     def adapt_difficulty(self, user_performance: Dict) -> str:
         """
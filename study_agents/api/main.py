@@ -27,7 +27,7 @@ from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Requ
 import asyncio
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.requests import Request as StarletteRequest
 from pydantic import BaseModel, ValidationError
@@ -39,6 +39,7 @@ import sys
 import os
 import importlib.util
 import math
+import json
 
 # Importar chat_storage desde el directorio padre
 chat_storage_path = os.path.join(parent_dir, "chat_storage.py")
@@ -97,12 +98,19 @@ gemini_summary_generator = importlib.util.module_from_spec(spec_gemini)
 spec_gemini.loader.exec_module(gemini_summary_generator)
 print("✅ Módulo gemini_summary_generator cargado correctamente")
 
-# Importar game_storage desde el directorio padre
-game_storage_path = os.path.join(parent_dir, "game_storage.py")
-spec_game = importlib.util.spec_from_file_location("game_storage", game_storage_path)
-game_storage = importlib.util.module_from_spec(spec_game)
-spec_game.loader.exec_module(game_storage)
+# Motor SQLite compartido por los módulos *_storage (misma instancia que usan ellos)
+import storage_engine
+# Directorios de datos (cursos, imágenes generadas...) independientes del cwd
+import data_paths
+# Partidas de parchís (misma instancia que usa game_sessions)
+import game_storage
 print("✅ Módulo game_storage cargado correctamente")
+# Estado en memoria de las partidas activas: lock por partida y push de cambios (SSE)
+from game_sessions import get_game_sessions
+# Estado persistido de la generación de resúmenes (para reanudarla)
+import summary_jobs_storage
+# Contexto por petición: keys de proveedores, modelo de cada agente y uso de tokens
+import execution_context
 
 # Importar course_guide_agent
 course_guide_path = os.path.join(parent_dir, "agents", "course_guide_agent.py")
@@ -112,6 +120,20 @@ spec_guide.loader.exec_module(course_guide_agent)
 CourseGuideAgent = course_guide_agent.CourseGuideAgent
 print("✅ Módulo course_guide_agent cargado correctamente")
 
+# Importar request_executor (pool de hilos para el trabajo síncrono de los endpoints)
+request_executor_path = os.path.join(parent_dir, "request_executor.py")
+spec_executor = importlib.util.spec_from_file_location("request_executor", request_executor_path)
+request_executor = importlib.util.module_from_spec(spec_executor)
+spec_executor.loader.exec_module(request_executor)
+print("✅ Módulo request_executor cargado correctamente")
+
+# Importar system_cache (caché acotada de StudyAgentsSystem)
+system_cache_path = os.path.join(parent_dir, "system_cache.py")
+spec_system_cache = importlib.util.spec_from_file_location("system_cache", system_cache_path)
+system_cache = importlib.util.module_from_spec(spec_system_cache)
+spec_system_cache.loader.exec_module(system_cache)
+print("✅ Módulo system_cache cargado correctamente")
+
 # El path ya fue añadido arriba para el parche
 
 # Importar desde el directorio raíz usando importlib para evitar conflictos de nombres
@@ -262,9 +284,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Cache de sistemas por API key (para evitar recrear sistemas)
-systems_cache: Dict[str, StudyAgentsSystem] = {}
-cache_lock = Lock()
+
+
+class ExecutionContextMiddleware:
+    """
+    Abre un execution_context nuevo por petición HTTP: keys, modelo elegido por cada
+    agente y uso de tokens quedan aislados aunque varias peticiones usen a la vez el
+    mismo StudyAgentsSystem. Es ASGI puro para que el contexto llegue al endpoint
+    (y, vía request_executor, a los hilos) y dure mientras se emite un stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with execution_context.execution_context():
+            await self.app(scope, receive, send)
+
+
+# El último middleware añadido es el más externo: el contexto envuelve a todos los demás
+app.add_middleware(ExecutionContextMiddleware)
+
+# Cache de sistemas por modo (LRU/TTL acotada). Todos comparten cliente Chroma y memoria;
+# la key de cada usuario y el modelo de cada agente van en el contexto de la petición
+systems_cache = system_cache.SystemCache()
 
 # Inicializar ProgressTracker
 progress_tracker_instance = ProgressTracker()
@@ -274,7 +320,7 @@ UPLOAD_DIR = "documents"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Crear directorio para imágenes generadas
-GENERATED_IMAGES_DIR = Path("courses/generated_images")
+GENERATED_IMAGES_DIR = data_paths.GENERATED_IMAGES_DIR
 GENERATED_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 print(f"✅ Directorio de imágenes generadas: {GENERATED_IMAGES_DIR}")
 
@@ -346,25 +392,17 @@ def save_user_cost(user_id: str, input_tokens: int, output_tokens: int, model: s
 def apply_provider_keys_from_request(
     api_key: Optional[str] = None,
     provider_keys: Optional[Dict] = None,
+    merge: bool = False,
 ) -> None:
-    """Inyecta keys multi-proveedor para ModelManager en esta petición."""
-    try:
-        from model_manager import set_request_provider_keys
-    except Exception:
-        try:
-            import importlib.util
-            mm_path = os.path.join(parent_dir, "model_manager.py")
-            spec = importlib.util.spec_from_file_location("model_manager", mm_path)
-            mm = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mm)
-            set_request_provider_keys = mm.set_request_provider_keys
-        except Exception as e:
-            print(f"⚠️ No se pudo cargar model_manager.set_request_provider_keys: {e}")
-            return
-    keys = {k: v for k, v in (provider_keys or {}).items() if v and v != "default"}
-    if api_key and api_key != "default":
+    """
+    Inyecta keys multi-proveedor para ModelManager en el contexto de esta petición.
+    Con merge=True conserva las keys ya inyectadas y no sustituye la de OpenAI.
+    """
+    keys = execution_context.provider_keys() if merge else {}
+    keys.update({k: v for k, v in (provider_keys or {}).items() if v and v != "default"})
+    if api_key and api_key != "default" and not (merge and keys.get("openai")):
         keys["openai"] = api_key
-    set_request_provider_keys(keys)
+    execution_context.set_provider_keys(keys)
 
 
 def resolve_openai_and_llm_access(
@@ -390,44 +428,53 @@ def resolve_openai_and_llm_access(
 
 def get_or_create_system(api_key: Optional[str] = None, mode: str = "auto") -> StudyAgentsSystem:
     """
-    Obtiene o crea un sistema de agentes para una API key
+    Obtiene o crea el sistema de agentes para un modo
     
     Args:
-        api_key: API key de OpenAI del usuario
+        api_key: API key de OpenAI del usuario (se aplica a la petición en curso, no al sistema)
         mode: Modo de selección de modelo ("auto" = optimizar costes, "manual" = usar modelo especificado)
         
     Returns:
         Sistema de agentes configurado
     """
-    if not api_key:
-        api_key = "default"
-    
-    # Usar caché con clave que incluya el modo
-    cache_key = f"{api_key}:{mode}"
-    if cache_key in systems_cache:
-        return systems_cache[cache_key]
+    # La key del usuario solo cambia las credenciales del LLM y de los embeddings de esta
+    # petición; si ya se inyectaron (resolve_openai_and_llm_access) se respetan
+    if api_key and api_key != "default":
+        apply_provider_keys_from_request(api_key, merge=True)
     
-    # Crear nuevo sistema
-    with cache_lock:
-        # Verificar de nuevo por si otro thread lo creó
-        if cache_key not in systems_cache:
-            try:
-                print(f"[FastAPI] Inicializando StudyAgentsSystem con api_key={'***' + api_key[-4:] if api_key and api_key != 'default' else 'None'}, mode={mode}")
-                system = StudyAgentsSystem(
-                    api_key=api_key if api_key != "default" else None,
-                    mode=mode
-                )
-                systems_cache[cache_key] = system
-                print(f"[FastAPI] ✅ StudyAgentsSystem inicializado correctamente")
-                return system
-            except Exception as e:
-                error_msg = str(e)
-                print(f"[FastAPI] ❌ Error al inicializar el sistema: {error_msg}")
-                import traceback
-                traceback.print_exc()
-                raise HTTPException(status_code=500, detail=f"Error al inicializar el sistema: {error_msg}")
+    def build() -> StudyAgentsSystem:
+        try:
+            from memory.memory_manager import get_shared_memory
+
+            print(f"[FastAPI] Inicializando StudyAgentsSystem compartido, mode={mode}")
+            system = StudyAgentsSystem(mode=mode, memory=get_shared_memory())
+            print(f"[FastAPI] ✅ StudyAgentsSystem inicializado correctamente")
+            return system
+        except Exception as e:
+            error_msg = str(e)
+            print(f"[FastAPI] ❌ Error al inicializar el sistema: {error_msg}")
+            import traceback
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=f"Error al inicializar el sistema: {error_msg}")
     
-    return systems_cache[cache_key]
+    return systems_cache.get_or_create(mode, build)
+
+
+async def run_blocking(endpoint: str, fn, *args, **kwargs):
+    """
+    Ejecuta una llamada síncrona (LLM, Chroma, JSON) en el pool de hilos compartido
+    sin bloquear el event loop, respetando el límite de concurrencia del endpoint.
+    Si la cola del endpoint está llena responde 503.
+    """
+    try:
+        return await request_executor.run_blocking(endpoint, fn, *args, **kwargs)
+    except request_executor.ExecutorSaturated as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def _course_corpus_scope(course_id: str) -> tuple:
+    """(chat_id, user_id) con los que se indexan los PDFs de un curso: corpus y digest propios"""
+    return f"course_{course_id}", "course"
 
 
 def preload_game_questions(game_id: str, course_id: str, topic_filter: Optional[str], creator_id: str):
@@ -470,9 +517,10 @@ def preload_game_questions(game_id: str, course_id: str, topic_filter: Optional[
             print(f"[Preload Questions] ⚠️ No se encontraron PDFs para el curso {course_id}")
             return
         
-        # Cargar documentos al sistema
+        # Cargar documentos al sistema (corpus del curso, con su digest)
         print(f"[Preload Questions] Cargando {len(pdf_paths)} PDFs")
-        system.upload_documents(pdf_paths)
+        corpus_chat_id, corpus_user_id = _course_corpus_scope(course_id)
+        system.ensure_documents(pdf_paths, chat_id=corpus_chat_id, user_id=corpus_user_id)
         
         # Generar banco de preguntas (50 preguntas para tener suficiente)
         topics_to_use = [topic_filter] if topic_filter else None
@@ -481,7 +529,9 @@ def preload_game_questions(game_id: str, course_id: str, topic_filter: Optional[
             difficulty="medium",
             num_questions=50,
             topics=topics_to_use,
-            model=None  # modo auto
+            model=None,  # modo auto
+            chat_id=corpus_chat_id,
+            user_id=corpus_user_id,
         )
         
         # Deducir créditos del creador
@@ -508,11 +558,11 @@ def preload_game_questions(game_id: str, course_id: str, topic_filter: Optional[
                 })
         
         # Guardar preguntas en la partida
-        game = game_storage.load_game(game_id)
-        if game:
+        def store_questions(game):
             game["preloaded_questions"] = preloaded_questions
             game["question_index"] = 0
-            game_storage.save_game(game)
+
+        if get_game_sessions().update(game_id, store_questions, "questions_loaded"):
             print(f"[Preload Questions] ✅ {len(preloaded_questions)} preguntas pre-cargadas para partida {game_id}")
         else:
             print(f"[Preload Questions] ❌ No se pudo cargar la partida {game_id} para guardar preguntas")
@@ -711,6 +761,140 @@ async def health_check():
     return {"status": "ok", "message": "Study Agents API is running"}
 
 
+@app.get("/api/metrics/executor")
+async def executor_metrics():
+    """Estado del pool de ejecución: peticiones en curso y en cola por endpoint"""
+    return {"success": True, "executor": request_executor.get_executor().metrics()}
+
+
+@app.get("/api/metrics/system-cache")
+async def system_cache_metrics():
+    """Estado de la caché de sistemas: un sistema por modo, hits/misses y tiempo de construcción"""
+    return {"success": True, "cache": systems_cache.metrics()}
+
+
+@app.get("/api/metrics/conversation-history")
+async def conversation_history_metrics():
+    """Estado del historial de conversación: chats calientes, hits/misses y evicciones"""
+    try:
+        from memory.history_store import get_history_store
+        return {"success": True, "history": get_history_store().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/embedding-cache")
+async def embedding_cache_metrics():
+    """Contadores de la caché persistente de embeddings (hits/misses/evictions)"""
+    try:
+        from memory.embedding_cache import get_embedding_cache
+        return {"success": True, "cache": get_embedding_cache().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/llm-pool")
+async def llm_pool_metrics():
+    """Pool de clientes LLM: entradas por proveedor, hits/misses, evicciones e inventario de Ollama"""
+    try:
+        from llm_pool import get_client_pool, get_ollama_inventory
+        return {
+            "success": True,
+            "pool": get_client_pool().stats(),
+            "ollama_models": get_ollama_inventory().models(),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/provider-limits")
+async def provider_limits_metrics():
+    """Límites por proveedor externo (Gemini, DALL-E): cuota, peticiones en curso, 429 y esperas"""
+    try:
+        from rate_limiter import get_rate_limiter
+        return {"success": True, "providers": get_rate_limiter().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/image-resolver")
+async def image_resolver_metrics():
+    """Resolución de imágenes: caché por descripción, en vuelo y marcadores que no llegaron a tiempo"""
+    try:
+        from image_resolver import get_image_resolver
+        return {"success": True, "resolver": get_image_resolver().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/pdf-text-cache")
+async def pdf_text_cache_metrics():
+    """Caché de texto de PDFs por hash: documentos, páginas, aciertos y páginas extraídas"""
+    try:
+        from pdf_text_cache import get_pdf_text_cache
+        return {"success": True, "cache": get_pdf_text_cache().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/model-routing")
+async def model_routing_metrics():
+    """Tabla de enrutado en vivo: p50/p95, tasa de error, 429 y estado del circuito por modelo y key"""
+    try:
+        from model_manager import ModelManager
+        return {"success": True, "routing": ModelManager.routing_table()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/game-sessions")
+async def game_sessions_metrics():
+    """Partidas en memoria: sesiones, suscriptores SSE, eventos, instantáneas y mensajes enviados"""
+    try:
+        return {"success": True, "games": get_game_sessions().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/execution-context")
+async def execution_context_metrics():
+    """Peticiones con contexto propio en curso y completadas, y llamadas/tokens por modelo"""
+    try:
+        return {"success": True, "execution": execution_context.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/generated-tests")
+async def generated_tests_metrics():
+    """Tests generados guardados: en disco, en la LRU del proceso, aciertos y caducados"""
+    try:
+        import generated_tests_storage
+        return {"success": True, "tests": generated_tests_storage.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/corpus-digest")
+async def corpus_digest_metrics():
+    """Digests de corpus por chat: construidos, aciertos, invalidaciones y construcciones descartadas"""
+    try:
+        from memory.corpus_digest import get_corpus_digest_store
+        return {"success": True, "digest": get_corpus_digest_store().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/metrics/feedback-cache")
+async def feedback_cache_metrics():
+    """Feedback de corrección: caché por (pregunta, respuesta) y respuestas resueltas con plantilla"""
+    try:
+        from memory.feedback_cache import get_feedback_cache
+        return {"success": True, "cache": get_feedback_cache().stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/api/files/{filename:path}")
 async def serve_file(filename: str):
     """
@@ -725,7 +909,7 @@ async def serve_file(filename: str):
     try:
         # Si el archivo está en generated_images/, buscar en courses/generated_images/
         if filename.startswith("generated_images/"):
-            generated_images_dir = Path("courses/generated_images")
+            generated_images_dir = GENERATED_IMAGES_DIR
             file_path = generated_images_dir / filename.replace("generated_images/", "")
             
             if not file_path.exists():
@@ -816,8 +1000,11 @@ async def upload_documents(
         if pdf_paths:
             if not chatId or not userId:
                 print(f"[FastAPI] AVISO upload sin chatId/userId (chatId={chatId}, userId={userId})")
-            system = get_or_create_system(final_api_key, mode="auto")
-            pdf_result = system.upload_documents(
+            apply_provider_keys_from_request(apiKey)
+            system = await run_blocking("system-init", get_or_create_system, final_api_key, mode="auto")
+            pdf_result = await run_blocking(
+                "upload-documents",
+                system.upload_documents,
                 pdf_paths,
                 chat_id=chatId,
                 user_id=userId,
@@ -1016,9 +1203,8 @@ async def extract_concepts(body: ExtractConceptsRequest):
                     min_quality="medium",
                     preferred_model=None,
                     context_length=8000,
+                    temperature=0.2,
                 )
-                if hasattr(llm, "temperature"):
-                    llm.temperature = 0.2
             except Exception as e:
                 print(f"⚠️ extract_concepts ModelManager: {e}")
         if llm is None:
@@ -1109,8 +1295,6 @@ async def temporal_progress(
     """Serie temporal simple de mastery medio (snapshots en mastery file)."""
     try:
         from core import concept_store
-        from pathlib import Path
-        import json as _json
 
         concepts = concept_store.concepts_with_mastery(chatId)
         avg = (
@@ -1118,26 +1302,13 @@ async def temporal_progress(
             if concepts
             else 0.0
         )
-        # Historial de snapshots (si existe)
-        snap_path = concept_store.MASTERY_DIR / f"{concept_store._safe_id(chatId)}_history.json"
-        series = []
-        if snap_path.exists():
-            try:
-                series = _json.loads(snap_path.read_text(encoding="utf-8")).get("series") or []
-            except Exception:
-                series = []
-        series.append({
+        # Añadir snapshot al historial (se conservan los últimos 60 puntos)
+        series = concept_store.append_mastery_snapshot(chatId, {
             "ts": datetime.now().isoformat(),
             "average_mastery": round(avg, 4),
             "concept_count": len(concepts),
         })
-        # Persistir últimos 60 puntos
-        concept_store.MASTERY_DIR.mkdir(parents=True, exist_ok=True)
-        snap_path.write_text(
-            _json.dumps({"series": series[-60:]}, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
-        return {"success": True, "chat_id": chatId, "series": series[-60:]}
+        return {"success": True, "chat_id": chatId, "series": series}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1147,10 +1318,7 @@ async def save_stats_endpoint(body: SaveStatsRequest):
     """Snapshot de sesión para métricas."""
     try:
         from core import concept_store
-        import json as _json
 
-        concept_store.MASTERY_DIR.mkdir(parents=True, exist_ok=True)
-        path = concept_store.MASTERY_DIR / f"session_{concept_store._safe_id(body.chatId)}_{body.userId}.json"
         payload = {
             "chat_id": body.chatId,
             "user_id": body.userId,
@@ -1158,7 +1326,7 @@ async def save_stats_endpoint(body: SaveStatsRequest):
             "stats": body.stats or {},
             "mastery": concept_store.get_mastery_map(body.chatId),
         }
-        path.write_text(_json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+        concept_store.save_session_stats(body.chatId, body.userId, payload)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1177,6 +1345,17 @@ class SrsReviewRequest(BaseModel):
     apiKey: Optional[str] = None
 
 
+class SrsReviewBatchRequest(BaseModel):
+    userId: str
+    reviews: List[Dict]  # [{cardId, rating}]
+    apiKey: Optional[str] = None
+
+
+class SrsOptimizeRequest(BaseModel):
+    userId: str
+    apiKey: Optional[str] = None
+
+
 class SrsGenerateFromErrorsRequest(BaseModel):
     userId: str
     chatId: str
@@ -1221,6 +1400,62 @@ async def srs_review(body: SrsReviewRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/srs/review-batch")
+async def srs_review_batch(body: SrsReviewBatchRequest):
+    """Registra varias revisiones de golpe (una sola escritura)."""
+    try:
+        from core import card_store
+
+        updated, not_found = card_store.review_cards(
+            body.userId,
+            [{"card_id": r.get("cardId") or r.get("card_id"), "rating": r.get("rating")} for r in body.reviews],
+        )
+        return {"success": True, "cards": updated, "count": len(updated), "not_found": not_found}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/srs/forecast")
+async def srs_forecast(
+    userId: str = Query(...),
+    chatId: Optional[str] = Query(None),
+    days: int = Query(7, ge=1, le=365),
+    simulateDays: int = Query(0, ge=0, le=365),
+):
+    """Previsión de vencimientos (y carga de repaso simulada) calculada en lote."""
+    try:
+        from core import card_store
+
+        result = await run_blocking(
+            "srs-forecast", card_store.forecast, userId, chat_id=chatId, days=days, simulate_days=simulateDays
+        )
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/srs/optimize")
+async def srs_optimize(body: SrsOptimizeRequest):
+    """Ajusta los pesos FSRS del usuario con su historial de revisiones."""
+    try:
+        from core import card_store
+
+        result = await run_blocking("srs-optimize", card_store.optimize_user_weights, body.userId)
+        return {"success": True, **result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/srs/generate-from-errors")
 async def srs_generate_from_errors(body: SrsGenerateFromErrorsRequest):
     """Genera tarjetas SRS a partir de errores (también se hace auto en grade-test)."""
@@ -1255,7 +1490,7 @@ async def generate_notes(request: Request, body: GenerateNotesRequest):
             )
         
         print("[FastAPI] Obteniendo sistema...")
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
         print("[FastAPI] Generando resumen (esto puede tardar)...")
         # Usar el tema de la conversación si está disponible
@@ -1274,7 +1509,9 @@ async def generate_notes(request: Request, body: GenerateNotesRequest):
                 print(f"⚠️ No se pudo obtener el nivel del usuario desde chat_id: {e}")
         
         # Generar resumen basado en la conversación y temas (model=None usa modo automático)
-        notes = system.generate_notes(
+        notes = await run_blocking(
+            "generate-notes",
+            system.generate_notes,
             topics=final_topics, 
             model=body.model if body.model else None, 
             user_id=body.user_id,
@@ -1304,7 +1541,7 @@ async def generate_notes(request: Request, body: GenerateNotesRequest):
                 input_tokens = len(str(body.conversation_history or "")) // 4 if body.conversation_history else 1000
                 output_tokens = len(notes) // 4
             
-            save_user_cost(body.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, body.user_id, input_tokens, output_tokens, model_used, system)
         
         return {
             "success": True,
@@ -1343,8 +1580,10 @@ async def generate_study_plan(request: StudyPlanRequest):
         if not topic:
             raise HTTPException(status_code=400, detail="topic es obligatorio")
 
-        system = get_or_create_system(openai_key, mode="auto")
-        plan_md, usage_info = system.generate_study_plan(
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
+        plan_md, usage_info = await run_blocking(
+            "generate-study-plan",
+            system.generate_study_plan,
             topic=topic,
             days=request.days,
             minutes_per_day=request.minutes_per_day,
@@ -1367,7 +1606,7 @@ async def generate_study_plan(request: StudyPlanRequest):
             input_tokens = usage_info.get("inputTokens", 0)
             output_tokens = usage_info.get("outputTokens", 0)
             model_used = usage_info.get("model") or request.model or "gpt-3.5-turbo"
-            save_user_cost(request.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, request.user_id, input_tokens, output_tokens, model_used, system)
 
         return {
             "success": True,
@@ -1388,6 +1627,66 @@ async def generate_study_plan(request: StudyPlanRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _resolve_question_context(body: QuestionRequest) -> tuple:
+    """
+    Reúne el contexto de una pregunta: tema del chat, formulario inicial,
+    contexto del curso e información de examen.
+    
+    Returns:
+        Tupla (chat_topic, initial_form, course_context, exam_info)
+    """
+    # Obtener tema del chat si está disponible
+    chat_topic = body.topic
+    initial_form = body.initial_form_data
+    if not chat_topic and body.chat_id:
+        try:
+            chat_data = progress_tracker_instance.get_chat_level(body.user_id, body.chat_id)
+            chat_topic = chat_data.get("topic")
+        except Exception as e:
+            print(f"⚠️ No se pudo obtener el tema del chat: {e}")
+    
+    # Si no se proporcionó initial_form_data, intentar obtenerlo del chat
+    if not initial_form and body.chat_id:
+        try:
+            # Cargar chat para obtener metadata
+            from chat_storage import load_chat
+            chat_data = load_chat(body.user_id, body.chat_id)
+            if chat_data and chat_data.get("metadata", {}).get("initialForm"):
+                initial_form = chat_data["metadata"]["initialForm"]
+                print(f"📋 Datos del formulario inicial obtenidos del chat: nivel={initial_form.get('level')}, objetivo={initial_form.get('learningGoal', '')[:50]}...")
+        except Exception as e:
+            print(f"⚠️ No se pudo obtener datos del formulario inicial: {e}")
+    
+    # Obtener información del curso si está disponible
+    course_context = None
+    exam_info = None
+    if body.course_id:
+        try:
+            # Proyección precalculada del catálogo (título, temas y subtemas)
+            course_context = course_storage.get_course_context(body.course_id)
+            if course_context:
+                enrollment = course_storage.get_user_enrollment(body.user_id, body.course_id)
+                
+                # Información del examen si está disponible
+                if enrollment and enrollment.get("exam_date"):
+                    from datetime import datetime
+                    exam_date_str = enrollment.get("exam_date")
+                    try:
+                        exam_date = datetime.fromisoformat(exam_date_str.replace('Z', '+00:00'))
+                        today = datetime.now(exam_date.tzinfo) if exam_date.tzinfo else datetime.now()
+                        days_until_exam = (exam_date - today).days
+                        exam_info = {
+                            "exam_date": exam_date_str,
+                            "days_until_exam": days_until_exam
+                        }
+                    except:
+                        pass
+        except Exception as e:
+            print(f"⚠️ Error obteniendo contexto del curso: {e}")
+    
+    return chat_topic, initial_form, course_context, exam_info
+
+
 @app.post("/api/ask-question")
 @_rate_limit("30/minute")
 async def ask_question(request: Request, body: QuestionRequest):
@@ -1412,71 +1711,14 @@ async def ask_question(request: Request, body: QuestionRequest):
             raise HTTPException(status_code=400, detail="Pregunta requerida")
         
         # Embeddings: solo OpenAI (o locales si no hay). Nunca pasar una key de Groq como OpenAI.
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
-        # Obtener tema del chat si está disponible
-        chat_topic = body.topic
-        initial_form = body.initial_form_data
-        if not chat_topic and body.chat_id:
-            try:
-                chat_data = progress_tracker_instance.get_chat_level(body.user_id, body.chat_id)
-                chat_topic = chat_data.get("topic")
-            except Exception as e:
-                print(f"⚠️ No se pudo obtener el tema del chat: {e}")
-        
-        # Si no se proporcionó initial_form_data, intentar obtenerlo del chat
-        if not initial_form and body.chat_id:
-            try:
-                # Cargar chat para obtener metadata
-                from chat_storage import load_chat
-                chat_data = load_chat(body.user_id, body.chat_id)
-                if chat_data and chat_data.get("metadata", {}).get("initialForm"):
-                    initial_form = chat_data["metadata"]["initialForm"]
-                    print(f"📋 Datos del formulario inicial obtenidos del chat: nivel={initial_form.get('level')}, objetivo={initial_form.get('learningGoal', '')[:50]}...")
-            except Exception as e:
-                print(f"⚠️ No se pudo obtener datos del formulario inicial: {e}")
-        
-        # Obtener información del curso si está disponible
-        course_context = None
-        exam_info = None
-        if body.course_id:
-            try:
-                course = course_storage.get_course(body.course_id)
-                if course:
-                    enrollment = course_storage.get_user_enrollment(body.user_id, body.course_id)
-                    course_context = {
-                        "title": course.get("title", ""),
-                        "description": course.get("description", ""),
-                        "topics": [t.get("name", "") for t in course.get("topics", [])],
-                        "subtopics": {}
-                    }
-                    # Añadir subtopics
-                    for topic in course.get("topics", []):
-                        topic_name = topic.get("name", "")
-                        if topic_name:
-                            course_context["subtopics"][topic_name] = [
-                                st.get("name", "") for st in topic.get("subtopics", [])
-                            ]
-                    
-                    # Información del examen si está disponible
-                    if enrollment and enrollment.get("exam_date"):
-                        from datetime import datetime
-                        exam_date_str = enrollment.get("exam_date")
-                        try:
-                            exam_date = datetime.fromisoformat(exam_date_str.replace('Z', '+00:00'))
-                            today = datetime.now(exam_date.tzinfo) if exam_date.tzinfo else datetime.now()
-                            days_until_exam = (exam_date - today).days
-                            exam_info = {
-                                "exam_date": exam_date_str,
-                                "days_until_exam": days_until_exam
-                            }
-                        except:
-                            pass
-            except Exception as e:
-                print(f"⚠️ Error obteniendo contexto del curso: {e}")
+        chat_topic, initial_form, course_context, exam_info = _resolve_question_context(body)
         
         # Responder pregunta (model=None usa modo automático)
-        answer, usage_info = system.ask_question(
+        answer, usage_info = await run_blocking(
+            "ask-question",
+            system.ask_question,
             body.question, 
             body.user_id, 
             model=body.model if body.model else None,
@@ -1493,7 +1735,7 @@ async def ask_question(request: Request, body: QuestionRequest):
         model_used = usage_info.get("model") or body.model or "gpt-3.5-turbo"
         
         if body.user_id:
-            save_user_cost(body.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, body.user_id, input_tokens, output_tokens, model_used, system)
         
         return {
             "success": True,
@@ -1511,6 +1753,81 @@ async def ask_question(request: Request, body: QuestionRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/ask-question/stream")
+@_rate_limit("30/minute")
+async def ask_question_stream(request: Request, body: QuestionRequest):
+    """
+    Responde una pregunta enviando la respuesta por Server-Sent Events
+    
+    Eventos:
+        token: fragmento de texto según lo genera el modelo
+        block: bloque de imagen/video ya resuelto (sustituye al bloque del modelo)
+        done: respuesta final limpia + tokens de entrada/salida
+        error: mensaje de error
+    """
+    openai_key, has_llm = resolve_openai_and_llm_access(body.apiKey, body.provider_keys)
+    if not has_llm:
+        raise HTTPException(
+            status_code=400,
+            detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
+        )
+    if not body.question:
+        raise HTTPException(status_code=400, detail="Pregunta requerida")
+    
+    system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
+    chat_topic, initial_form, course_context, exam_info = _resolve_question_context(body)
+    
+    def sse(event: str, data) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    async def event_stream():
+        try:
+            async for kind, payload in request_executor.iterate_blocking(
+                "ask-question-stream",
+                system.stream_question,
+                body.question,
+                body.user_id,
+                model=body.model if body.model else None,
+                chat_id=body.chat_id,
+                topic=chat_topic or body.subtopic_name,
+                initial_form_data=initial_form,
+                course_context=course_context,
+                exam_info=exam_info,
+            ):
+                if kind in ("token", "block"):
+                    yield sse(kind, {"text": payload})
+                elif kind == "error":
+                    yield sse("error", payload)
+                elif kind == "done":
+                    usage_info = payload.get("usage") or {}
+                    input_tokens = usage_info.get("inputTokens", 0)
+                    output_tokens = usage_info.get("outputTokens", 0)
+                    model_used = usage_info.get("model") or body.model or "gpt-3.5-turbo"
+                    if body.user_id:
+                        await run_blocking("usage-stats", save_user_cost, body.user_id, input_tokens, output_tokens, model_used, system)
+                    yield sse("done", {
+                        "success": True,
+                        "answer": payload.get("answer", ""),
+                        "question": body.question,
+                        "inputTokens": input_tokens,
+                        "outputTokens": output_tokens,
+                        "model": model_used,
+                    })
+        except request_executor.ExecutorSaturated as e:
+            yield sse("error", {"message": str(e), "status": 503})
+        except Exception as e:
+            print(f"[FastAPI] Error en ask_question_stream: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield sse("error", {"message": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/generate-test")
 @_rate_limit("30/minute")
 async def generate_test(request: Request, body: TestRequest):
@@ -1531,7 +1848,7 @@ async def generate_test(request: Request, body: TestRequest):
                 detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
             )
         
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
         # F1.5: dificultad adaptativa desde mastery (zona de desarrollo próximo)
         difficulty = body.difficulty or "medium"
@@ -1591,7 +1908,9 @@ async def generate_test(request: Request, body: TestRequest):
             constraints = (constraints + "\n\n" + focus_hint).strip() if constraints else focus_hint
         
         # Generar test (model=None usa modo automático)
-        test, usage_info = system.generate_test(
+        test, usage_info = await run_blocking(
+            "generate-test",
+            system.generate_test,
             difficulty=difficulty,
             num_questions=body.num_questions,
             topics=body.topics,
@@ -1609,7 +1928,7 @@ async def generate_test(request: Request, body: TestRequest):
         model_used = usage_info.get("model") or body.model or "gpt-3.5-turbo"
         
         if body.user_id:
-            save_user_cost(body.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, body.user_id, input_tokens, output_tokens, model_used, system)
         
         return {
             "success": True,
@@ -1627,6 +1946,92 @@ async def generate_test(request: Request, body: TestRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _apply_grade_results(request: GradeTestRequest, feedback) -> tuple:
+    """
+    Efectos de corregir un test: knowledge tracing, tarjetas SRS de los fallos y
+    XP/progreso del curso. Devuelve (mastery_updates, srs_cards_created, xp_gained).
+    """
+    # Knowledge tracing + SRS desde fallos (Fase 1)
+    mastery_updates = []
+    srs_cards_created = []
+    if isinstance(feedback, dict) and request.chat_id:
+        try:
+            from core import concept_store, card_store
+
+            uid = request.user_id or "default"
+            errors_for_srs = []
+            for item in feedback.get("question_feedback") or []:
+                cids = item.get("concept_ids") or []
+                correct = bool(item.get("is_correct"))
+                for cid in cids:
+                    new_m = concept_store.apply_mastery_update(
+                        request.chat_id, str(cid), correct
+                    )
+                    mastery_updates.append({
+                        "concept_id": cid,
+                        "correct": correct,
+                        "mastery": new_m,
+                    })
+                if not correct:
+                    errors_for_srs.append({
+                        "question": item.get("question"),
+                        "explanation": item.get("explanation") or item.get("feedback"),
+                        "correct_answer": item.get("correct_answer"),
+                        "concept_ids": cids,
+                    })
+            if errors_for_srs:
+                srs_cards_created = card_store.generate_from_errors(
+                    uid, request.chat_id, errors_for_srs
+                )
+        except Exception as e:
+            print(f"[FastAPI] mastery/SRS post grade: {e}")
+    
+    # Si está en contexto de curso, añadir XP y actualizar progreso
+    xp_gained = 0
+    if request.course_id and request.user_id:
+        try:
+            # Calcular XP basado en el score del test
+            # El feedback contiene el score_percentage
+            import json
+            if isinstance(feedback, str):
+                # Intentar parsear JSON del feedback
+                try:
+                    feedback_data = json.loads(feedback)
+                    score_percentage = feedback_data.get("score_percentage", 0)
+                except:
+                    # Si no es JSON, buscar porcentaje en el texto
+                    import re
+                    score_match = re.search(r'(\d+(?:\.\d+)?)%', feedback)
+                    score_percentage = float(score_match.group(1)) if score_match else 50
+            else:
+                score_percentage = feedback.get("score_percentage", 50) if isinstance(feedback, dict) else 50
+            
+            # XP = porcentaje de aciertos * 10 (máximo 50 XP por test)
+            xp_gained = int((score_percentage / 100) * 50)
+            
+            # Añadir XP
+            course_storage.add_xp(request.user_id, request.course_id, xp_gained)
+            
+            # Actualizar progreso del tema si se proporcionó
+            if request.topic:
+                # Aumentar progreso basado en el score
+                # 100% = +20%, 70% = +10%, etc.
+                progress_increase = (score_percentage / 100) * 20
+                enrollment = course_storage.get_user_enrollment(request.user_id, request.course_id)
+                if enrollment:
+                    current_progress = enrollment.get("topic_progress", {}).get(request.topic, 0)
+                    new_progress = min(100, current_progress + progress_increase)
+                    course_storage.update_topic_progress(request.user_id, request.course_id, request.topic, new_progress)
+            
+            print(f"[FastAPI] XP añadido: {xp_gained} XP, progreso actualizado para tema: {request.topic}")
+        except Exception as e:
+            print(f"[FastAPI] Error añadiendo XP/progreso: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    return mastery_updates, srs_cards_created, xp_gained
+
+
 @app.post("/api/grade-test")
 async def grade_test(request: GradeTestRequest):
     """
@@ -1646,94 +2051,20 @@ async def grade_test(request: GradeTestRequest):
                 detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
             )
         
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
         # Corregir test
-        feedback, usage_info = system.grade_test(request.test_id, request.answers)
-
-        # Knowledge tracing + SRS desde fallos (Fase 1)
-        mastery_updates = []
-        srs_cards_created = []
-        if isinstance(feedback, dict) and request.chat_id:
-            try:
-                from core import concept_store, card_store
+        feedback, usage_info = await run_blocking("grade-test", system.grade_test, request.test_id, request.answers)
 
-                uid = request.user_id or "default"
-                errors_for_srs = []
-                for item in feedback.get("question_feedback") or []:
-                    cids = item.get("concept_ids") or []
-                    correct = bool(item.get("is_correct"))
-                    for cid in cids:
-                        new_m = concept_store.apply_mastery_update(
-                            request.chat_id, str(cid), correct
-                        )
-                        mastery_updates.append({
-                            "concept_id": cid,
-                            "correct": correct,
-                            "mastery": new_m,
-                        })
-                    if not correct:
-                        errors_for_srs.append({
-                            "question": item.get("question"),
-                            "explanation": item.get("explanation") or item.get("feedback"),
-                            "correct_answer": item.get("correct_answer"),
-                            "concept_ids": cids,
-                        })
-                if errors_for_srs:
-                    srs_cards_created = card_store.generate_from_errors(
-                        uid, request.chat_id, errors_for_srs
-                    )
-            except Exception as e:
-                print(f"[FastAPI] mastery/SRS post grade: {e}")
+        mastery_updates, srs_cards_created, xp_gained = await run_blocking(
+            "grade-test", _apply_grade_results, request, feedback
+        )
         
         # Calcular y guardar coste (necesitamos user_id, pero no está en el request)
         # Por ahora, no guardamos coste para grade_test si no hay user_id
         input_tokens = usage_info.get("inputTokens", 0)
         output_tokens = usage_info.get("outputTokens", 0)
         
-        # Si está en contexto de curso, añadir XP y actualizar progreso
-        xp_gained = 0
-        if request.course_id and request.user_id:
-            try:
-                # Calcular XP basado en el score del test
-                # El feedback contiene el score_percentage
-                import json
-                if isinstance(feedback, str):
-                    # Intentar parsear JSON del feedback
-                    try:
-                        feedback_data = json.loads(feedback)
-                        score_percentage = feedback_data.get("score_percentage", 0)
-                    except:
-                        # Si no es JSON, buscar porcentaje en el texto
-                        import re
-                        score_match = re.search(r'(\d+(?:\.\d+)?)%', feedback)
-                        score_percentage = float(score_match.group(1)) if score_match else 50
-                else:
-                    score_percentage = feedback.get("score_percentage", 50) if isinstance(feedback, dict) else 50
-                
-                # XP = porcentaje de aciertos * 10 (máximo 50 XP por test)
-                xp_gained = int((score_percentage / 100) * 50)
-                
-                # Añadir XP
-                course_storage.add_xp(request.user_id, request.course_id, xp_gained)
-                
-                # Actualizar progreso del tema si se proporcionó
-                if request.topic:
-                    # Aumentar progreso basado en el score
-                    # 100% = +20%, 70% = +10%, etc.
-                    progress_increase = (score_percentage / 100) * 20
-                    enrollment = course_storage.get_user_enrollment(request.user_id, request.course_id)
-                    if enrollment:
-                        current_progress = enrollment.get("topic_progress", {}).get(request.topic, 0)
-                        new_progress = min(100, current_progress + progress_increase)
-                        course_storage.update_topic_progress(request.user_id, request.course_id, request.topic, new_progress)
-                
-                print(f"[FastAPI] XP añadido: {xp_gained} XP, progreso actualizado para tema: {request.topic}")
-            except Exception as e:
-                print(f"[FastAPI] Error añadiendo XP/progreso: {e}")
-                import traceback
-                traceback.print_exc()
-        
         return {
             "success": True,
             "feedback": feedback,
@@ -1753,6 +2084,70 @@ async def grade_test(request: GradeTestRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/grade-test/stream")
+async def grade_test_stream(request: GradeTestRequest):
+    """
+    Corrige un test enviando el resultado por Server-Sent Events
+    
+    Eventos:
+        score: nota, aciertos y preguntas corregidas (sin esperar al LLM)
+        feedback: feedback de una pregunta ({index, question_id, feedback}) según termina
+        done: mismo cuerpo que /api/grade-test
+        error: mensaje de error
+    """
+    openai_key, has_llm = resolve_openai_and_llm_access(request.apiKey, request.provider_keys)
+    if not has_llm:
+        raise HTTPException(
+            status_code=400,
+            detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
+        )
+    
+    system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
+    
+    def sse(event: str, data) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    async def event_stream():
+        try:
+            async for kind, payload in request_executor.iterate_blocking(
+                "grade-test-stream",
+                system.stream_grade_test,
+                request.test_id,
+                request.answers,
+            ):
+                if kind in ("score", "feedback", "error"):
+                    yield sse(kind, payload)
+                elif kind == "done":
+                    feedback = payload["feedback"]
+                    usage_info = payload.get("usage") or {}
+                    mastery_updates, srs_cards_created, xp_gained = await run_blocking(
+                        "grade-test", _apply_grade_results, request, feedback
+                    )
+                    yield sse("done", {
+                        "success": True,
+                        "feedback": feedback,
+                        "inputTokens": usage_info.get("inputTokens", 0),
+                        "outputTokens": usage_info.get("outputTokens", 0),
+                        "xp_gained": xp_gained if request.course_id else None,
+                        "mastery_updates": mastery_updates,
+                        "srs_cards_created": len(srs_cards_created),
+                        "srs_due_hint": True if srs_cards_created else False,
+                    })
+        except request_executor.ExecutorSaturated as e:
+            yield sse("error", {"message": str(e), "status": 503})
+        except Exception as e:
+            print(f"[FastAPI] Error en grade_test_stream: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield sse("error", {"message": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/generate-exercise")
 async def generate_exercise(request: GenerateExerciseRequest):
     """
@@ -1774,7 +2169,7 @@ async def generate_exercise(request: GenerateExerciseRequest):
                 detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
             )
         
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
         # Log para debug
         print(f"[FastAPI] generate-exercise recibido: topics={request.topics}, difficulty={request.difficulty}, user_id={request.user_id}")
@@ -1829,7 +2224,9 @@ async def generate_exercise(request: GenerateExerciseRequest):
             except Exception:
                 pass
         
-        exercise, usage_info = system.generate_exercise(
+        exercise, usage_info = await run_blocking(
+            "generate-exercise",
+            system.generate_exercise,
             difficulty=difficulty,
             topics=request.topics,
             exercise_type=request.exercise_type,
@@ -1847,7 +2244,7 @@ async def generate_exercise(request: GenerateExerciseRequest):
         model_used = usage_info.get("model") or request.model or "gpt-3.5-turbo"
         
         if request.user_id:
-            save_user_cost(request.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, request.user_id, input_tokens, output_tokens, model_used, system)
         
         return {
             "success": True,
@@ -1887,7 +2284,7 @@ async def correct_exercise(request: CorrectExerciseRequest):
                 detail="Configura al menos una API key (Groq, DeepSeek, OpenRouter u OpenAI).",
             )
         
-        system = get_or_create_system(openai_key, mode="auto")
+        system = await run_blocking("system-init", get_or_create_system, openai_key, mode="auto")
         
         # Si hay imagen, incluirla en la respuesta del estudiante
         # Asegurar que student_answer sea un string
@@ -2096,7 +2493,9 @@ async def correct_exercise(request: CorrectExerciseRequest):
                 pass
         
         # Corregir ejercicio con LLM (model=None usa modo automático)
-        correction, usage_info = system.correct_exercise(
+        correction, usage_info = await run_blocking(
+            "correct-exercise",
+            system.correct_exercise,
             exercise=exercise,
             student_answer=student_answer_text,
             model=request.model if request.model else None
@@ -2154,7 +2553,7 @@ async def correct_exercise(request: CorrectExerciseRequest):
         model_used = usage_info.get("model") or request.model or "gpt-3.5-turbo"
         
         if request.user_id:
-            save_user_cost(request.user_id, input_tokens, output_tokens, model_used, system)
+            await run_blocking("usage-stats", save_user_cost, request.user_id, input_tokens, output_tokens, model_used, system)
 
         # Knowledge tracing + SRS desde fallos de ejercicio (F1.2 / F1.5)
         mastery_updates = []
@@ -2573,6 +2972,7 @@ class ListCoursesRequest(BaseModel):
     """Modelo para listar cursos"""
     creator_id: Optional[str] = None
     active_only: bool = True
+    is_exam: Optional[bool] = None  # True: solo exámenes, False: solo cursos
 
 
 class GetUserEnrollmentsRequest(BaseModel):
@@ -3873,7 +4273,7 @@ async def create_course_endpoint(request: CreateCourseRequest, background_tasks:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def generate_course_summaries_background(
+def generate_course_summaries_background(
     gemini_api_key: str,
     course_id: str,
     course_title: str,
@@ -3882,10 +4282,12 @@ async def generate_course_summaries_background(
     additional_comments: Optional[str] = None,
     model: str = "gemini-1.5-pro",
     exam_examples_pdfs: Optional[List[str]] = None,
-    use_saved_pdfs: bool = False  # Si True, usa los PDFs guardados en el curso
+    use_saved_pdfs: bool = False,  # Si True, usa los PDFs guardados en el curso
+    resume: bool = True  # Si False, regenera también los items ya hechos
 ):
     """
     Función en background para generar resúmenes del curso
+    Es síncrona a propósito: FastAPI la ejecuta en su pool de hilos y no bloquea el event loop.
     """
     try:
         print(f"\n🚀 Iniciando generación de resúmenes en background para curso {course_id}")
@@ -3918,7 +4320,8 @@ async def generate_course_summaries_background(
             topics=topics,
             additional_comments=additional_comments,
             model=model,
-            exam_examples_pdfs=exam_examples_pdfs
+            exam_examples_pdfs=exam_examples_pdfs,
+            resume=resume
         )
         
         # Guardar resúmenes en el curso (incluso si algunos fallaron)
@@ -3940,9 +4343,7 @@ async def generate_course_summaries_background(
                 course["summaries_generated_at"] = datetime.now().isoformat()
                 
                 # Actualizar el curso usando los métodos del módulo
-                all_courses = course_storage.load_all_courses()
-                all_courses[course_id] = course
-                course_storage.save_all_courses(all_courses)
+                course_storage.save_course(course_id, course)
                 
                 print(f"✅ Resúmenes guardados en el curso {course_id}")
                 print(f"   Resúmenes generados para {len([k for k, v in summaries.items() if (isinstance(v, dict) and (v.get('summary') or v.get('subtopics'))) or (isinstance(v, str) and v)])} apartados")
@@ -4033,7 +4434,8 @@ async def regenerate_course_summaries_endpoint(request: RegenerateCourseSummarie
             additional_comments=request.additional_comments,
             model=request.model,
             exam_examples_pdfs=course.get("exam_examples", []), # Usar los exam_examples del curso
-            use_saved_pdfs=True # Indicar que use los PDFs guardados
+            use_saved_pdfs=True, # Indicar que use los PDFs guardados
+            resume=False # Regenerar: no reutilizar los resúmenes anteriores
         )
 
         return {
@@ -4051,6 +4453,87 @@ async def regenerate_course_summaries_endpoint(request: RegenerateCourseSummarie
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class ResumeCourseSummariesRequest(BaseModel):
+    """Modelo para reanudar la generación de resúmenes de un curso"""
+    user_id: str
+    course_id: str
+    gemini_api_key: Optional[str] = None
+
+
+@app.post("/api/resume-course-summaries")
+async def resume_course_summaries_endpoint(request: ResumeCourseSummariesRequest, background_tasks: BackgroundTasks):
+    """
+    Reanuda una generación de resúmenes interrumpida o con items fallidos.
+    Solo se generan los items que faltan (ya están pagados: no se cobra de nuevo).
+    """
+    try:
+        course = course_storage.get_course(request.course_id)
+        if not course:
+            raise HTTPException(status_code=404, detail="Curso no encontrado")
+
+        if course["creator_id"] != request.user_id:
+            raise HTTPException(status_code=403, detail="Solo el creador del curso puede reanudar los resúmenes")
+
+        job = summary_jobs_storage.get_job(request.course_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="No hay ninguna generación de resúmenes para este curso")
+
+        progress = gemini_summary_generator.get_progress(request.course_id)
+        if progress and progress.get("status") == "processing":
+            raise HTTPException(status_code=409, detail="La generación de resúmenes sigue en curso")
+
+        gemini_api_key = request.gemini_api_key or os.getenv("GEMINI_API_KEY")
+        if not gemini_api_key:
+            raise HTTPException(
+                status_code=400,
+                detail="Se requiere gemini_api_key (en el request o en GEMINI_API_KEY del .env) para generar resúmenes"
+            )
+
+        # Mismos parámetros que la generación original: las huellas coinciden y se reutiliza lo hecho
+        params = job["params"]
+        background_tasks.add_task(
+            generate_course_summaries_background,
+            gemini_api_key=gemini_api_key,
+            course_id=request.course_id,
+            course_title=params["course_title"],
+            course_description=params["course_description"],
+            topics=params["topics"],
+            additional_comments=params.get("additional_comments"),
+            model=params["model"],
+            exam_examples_pdfs=params.get("exam_examples_pdfs"),
+            resume=True
+        )
+
+        done = {item["item_id"] for item in job["items"] if item.get("status") == "done"}
+        return {
+            "success": True,
+            "message": "Reanudación de resúmenes iniciada en segundo plano.",
+            "pending_items": len([item_id for item_id in job["item_ids"] if item_id not in done])
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error en resume_course_summaries_endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/summary-job/{course_id}")
+async def get_summary_job(course_id: str):
+    """Estado persistido de la generación de resúmenes: cada item hecho, fallido o pendiente"""
+    try:
+        job = summary_jobs_storage.get_job(course_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="No hay ninguna generación de resúmenes para este curso")
+        job.pop("params", None)
+        job["items"] = [{k: v for k, v in item.items() if k != "summary"} for item in job["items"]]
+        return {"success": True, "job": job}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/get-course")
 async def get_course_endpoint(request: GetCourseRequest):
     """Obtiene un curso por ID"""
@@ -4075,7 +4558,8 @@ async def list_courses_endpoint(request: ListCoursesRequest):
     try:
         courses = course_storage.list_courses(
             creator_id=request.creator_id,
-            active_only=request.active_only
+            active_only=request.active_only,
+            is_exam=request.is_exam
         )
         return {
             "success": True,
@@ -4520,38 +5004,15 @@ async def admin_stats_endpoint(request: AdminStatsRequest):
         # TODO: Verificar que el usuario es admin
         # Por ahora, permitimos a cualquiera (en producción deberías verificar)
         
-        # Obtener todos los cursos
-        all_courses = course_storage.load_all_courses()
-        total_courses = len(all_courses)
+        # Contar cursos (catálogo en memoria)
+        total_courses = course_storage.count_courses()
         
-        # Contar inscripciones
-        total_enrollments = 0
-        active_users = set()
-        enrollments_dir = course_storage.ENROLLMENTS_DIR
-        if enrollments_dir.exists():
-            for enrollment_file in enrollments_dir.glob("*.json"):
-                try:
-                    with open(enrollment_file, "r", encoding="utf-8") as f:
-                        user_enrollments = json.load(f)
-                        total_enrollments += len(user_enrollments)
-                        for course_id in user_enrollments.keys():
-                            # Obtener user_id del nombre del archivo
-                            user_id = enrollment_file.stem
-                            active_users.add(user_id)
-                except:
-                    pass
+        # Contar inscripciones (consultas sobre los índices, sin recorrer ficheros)
+        total_enrollments = course_storage.count_enrollments()
+        active_users = course_storage.list_enrolled_user_ids()
         
         # Calcular ingresos totales (sumar todos los wallets)
-        total_revenue = 0.0
-        wallets_dir = wallet_storage.WALLETS_DIR
-        if wallets_dir.exists():
-            for wallet_file in wallets_dir.glob("*.json"):
-                try:
-                    with open(wallet_file, "r", encoding="utf-8") as f:
-                        wallet = json.load(f)
-                        total_revenue += wallet.get("total_deposited", 0.0)
-                except:
-                    pass
+        total_revenue = wallet_storage.get_total_deposited()
         
         return {
             "success": True,
@@ -4573,31 +5034,18 @@ async def admin_payments_endpoint(request: AdminStatsRequest):
     try:
         # TODO: Verificar que el usuario es admin
         
-        payments = []
-        
-        # Obtener todas las transacciones de wallets
-        wallets_dir = Path("courses/wallets")
-        if wallets_dir.exists():
-            for wallet_file in wallets_dir.glob("*.json"):
-                try:
-                    with open(wallet_file, "r", encoding="utf-8") as f:
-                        wallet = json.load(f)
-                        user_id = wallet_file.stem  # Nombre del archivo sin extensión
-                        transactions = wallet.get("transactions", [])
-                        
-                        for transaction in transactions:
-                            if transaction.get("type") in ["deposit", "course_purchase"]:
-                                payments.append({
-                                    "user_id": user_id,
-                                    "type": transaction.get("type"),
-                                    "amount": abs(transaction.get("amount", 0)),
-                                    "timestamp": transaction.get("timestamp"),
-                                    "status": "completed",
-                                    "metadata": transaction.get("metadata", {})
-                                })
-                except Exception as e:
-                    print(f"Error leyendo wallet {wallet_file}: {e}")
-                    pass
+        # Obtener las transacciones de pago de los wallets (índice por tipo)
+        payments = [
+            {
+                "user_id": transaction.get("user_id"),
+                "type": transaction.get("type"),
+                "amount": abs(transaction.get("amount", 0)),
+                "timestamp": transaction.get("timestamp"),
+                "status": "completed",
+                "metadata": transaction.get("metadata", {})
+            }
+            for transaction in wallet_storage.list_wallet_transactions(["deposit", "course_purchase"])
+        ]
         
         # Ordenar por fecha (más recientes primero)
         payments.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
@@ -4621,40 +5069,18 @@ async def admin_users_endpoint(request: AdminUsersRequest):
         
         users = []
         
-        # Usar las rutas desde los módulos para asegurar que sean correctas
-        enrollments_dir = course_storage.ENROLLMENTS_DIR
-        wallets_dir = wallet_storage.WALLETS_DIR
-        
-        print(f"[Admin Users] Buscando usuarios en:")
-        print(f"  - Enrollments: {enrollments_dir.absolute()}")
-        print(f"  - Wallets: {wallets_dir.absolute()}")
-        print(f"  - Enrollments existe: {enrollments_dir.exists()}")
-        print(f"  - Wallets existe: {wallets_dir.exists()}")
-        
         # Set para evitar duplicados
         user_ids = set()
         
         # Recopilar user_ids de enrollments
-        if enrollments_dir.exists():
-            enrollment_files = list(enrollments_dir.glob("*.json"))
-            print(f"[Admin Users] Encontrados {len(enrollment_files)} archivos de enrollments")
-            for enrollment_file in enrollment_files:
-                user_id = enrollment_file.stem
-                user_ids.add(user_id)
-                print(f"  - Usuario encontrado en enrollments: {user_id}")
-        else:
-            print(f"[Admin Users] ⚠️ Directorio de enrollments no existe: {enrollments_dir.absolute()}")
+        enrolled_user_ids = course_storage.list_enrolled_user_ids()
+        print(f"[Admin Users] Encontrados {len(enrolled_user_ids)} usuarios con enrollments")
+        user_ids.update(enrolled_user_ids)
         
         # Recopilar user_ids de wallets
-        if wallets_dir.exists():
-            wallet_files = list(wallets_dir.glob("*.json"))
-            print(f"[Admin Users] Encontrados {len(wallet_files)} archivos de wallets")
-            for wallet_file in wallet_files:
-                user_id = wallet_file.stem
-                user_ids.add(user_id)
-                print(f"  - Usuario encontrado en wallets: {user_id}")
-        else:
-            print(f"[Admin Users] ⚠️ Directorio de wallets no existe: {wallets_dir.absolute()}")
+        wallet_user_ids = wallet_storage.list_wallet_user_ids()
+        print(f"[Admin Users] Encontrados {len(wallet_user_ids)} usuarios con wallet")
+        user_ids.update(wallet_user_ids)
         
         print(f"[Admin Users] Total de usuarios únicos encontrados: {len(user_ids)}")
         
@@ -4809,14 +5235,11 @@ async def request_withdrawal_endpoint(request: RequestWithdrawalRequest):
         # TODO: Aquí deberías procesar el retiro real (transferencia bancaria, etc.)
         # Por ahora, solo marcamos como retirado en el sistema
         
-        # Actualizar ingresos (marcar como retirado)
-        earnings["withdrawn"] = earnings.get("withdrawn", 0.0) + request.amount
-        
-        # Guardar
-        earnings_file = wallet_storage.get_creator_earnings_file(request.creator_id)
-        with open(earnings_file, "w", encoding="utf-8") as f:
-            import json
-            json.dump(earnings, f, ensure_ascii=False, indent=2)
+        # Actualizar ingresos (marcar como retirado); revalida el saldo dentro de la transacción
+        try:
+            earnings = wallet_storage.withdraw_creator_earnings(request.creator_id, request.amount)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # TODO: Enviar email al creador confirmando el retiro
         # TODO: Procesar transferencia bancaria real
@@ -4824,7 +5247,7 @@ async def request_withdrawal_endpoint(request: RequestWithdrawalRequest):
         return {
             "success": True,
             "message": f"Retiro de {request.amount}€ procesado. Se transferirá a {request.bank_account}",
-            "earnings": wallet_storage.get_creator_earnings(request.creator_id)
+            "earnings": earnings
         }
     except HTTPException:
         raise
@@ -4917,7 +5340,7 @@ async def generate_course_notes_endpoint(request: GenerateCourseNotesRequest):
             
             # Obtener el resumen principal del apartado
             if isinstance(topic_summary_data, dict) and "summary" in topic_summary_data:
-                existing_summary = topic_summary_data["summary"]
+                existing_summary = gemini_summary_generator.patch_pending_images(topic_summary_data["summary"])
                 if existing_summary:
                     print(f"[FastAPI] ✅ Usando resumen generado automáticamente con Gemini para tema '{request.topic_name}' ({len(existing_summary)} caracteres)")
                     # Guardar también en generated_notes para compatibilidad
@@ -4937,6 +5360,7 @@ async def generate_course_notes_endpoint(request: GenerateCourseNotesRequest):
                     print(f"[FastAPI] ⚠️ topic_summary_data tiene 'summary' pero está vacío")
             elif isinstance(topic_summary_data, str) and topic_summary_data:
                 # Si es un string directo
+                topic_summary_data = gemini_summary_generator.patch_pending_images(topic_summary_data)
                 print(f"[FastAPI] ✅ Usando resumen generado automáticamente con Gemini (formato string) para tema '{request.topic_name}' ({len(topic_summary_data)} caracteres)")
                 current_notes = enrollment.get("generated_notes", {})
                 current_notes[request.topic_name] = topic_summary_data
@@ -4991,18 +5415,26 @@ async def generate_course_notes_endpoint(request: GenerateCourseNotesRequest):
                     st.get("name", "") for st in t.get("subtopics", [])
                 ]
         
-        # Procesar documentos
-        system.upload_documents(pdf_paths)
+        # Nivel del alumno en el tema (generate_notes recibe el user_id del corpus del curso)
+        user_level = None
+        try:
+            user_level = progress_tracker_instance.get_topic_level(request.user_id, request.topic_name).get("level", 0)
+        except Exception as e:
+            print(f"⚠️ No se pudo obtener el nivel del usuario: {e}")
+        
+        # Procesar documentos en el corpus del curso (con su digest)
+        corpus_chat_id, corpus_user_id = _course_corpus_scope(request.course_id)
+        system.ensure_documents(pdf_paths, chat_id=corpus_chat_id, user_id=corpus_user_id)
         
         # Generar apuntes orientados a preparación de examen
         notes = system.generate_notes(
             topics=[request.topic_name],
             model=request.model if request.model else None,  # modo auto si es None
-            user_id=request.user_id,
+            user_id=corpus_user_id,
             conversation_history=None,
             topic=request.topic_name,
-            user_level=None,
-            chat_id=None,
+            user_level=user_level,
+            chat_id=corpus_chat_id,
             exam_info=exam_info,
             course_context=course_context
         )
@@ -5585,7 +6017,12 @@ async def create_game_endpoint(request: CreateGameRequest, background_tasks: Bac
 async def join_game_endpoint(request: JoinGameRequest):
     """Une un jugador a una partida"""
     try:
-        game = game_storage.join_game(request.game_id, request.user_id, request.username, request.invite_code)
+        game = get_game_sessions().run(
+            request.game_id,
+            lambda: game_storage.join_game(request.game_id, request.user_id, request.username, request.invite_code),
+            "player_joined",
+            request.user_id,
+        )
         
         if not game:
             raise HTTPException(status_code=400, detail="No se pudo unir a la partida (partida llena, ya estás en ella, código incorrecto, o no existe)")
@@ -5653,9 +6090,9 @@ async def find_game_by_code_endpoint(request: FindGameByCodeRequest):
 
 @app.post("/api/study-agents/get-game")
 async def get_game_endpoint(request: GetGameRequest):
-    """Obtiene el estado de una partida"""
+    """Obtiene el estado de una partida (desde memoria; para seguirla usar game-events)"""
     try:
-        game = game_storage.load_game(request.game_id)
+        game = get_game_sessions().get(request.game_id)
         
         if not game:
             raise HTTPException(status_code=404, detail="Partida no encontrada")
@@ -5677,11 +6114,45 @@ async def get_game_endpoint(request: GetGameRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/study-agents/game-events")
+async def game_events_endpoint(game_id: str = Query(...), user_id: str = Query(...)):
+    """
+    Stream SSE de una partida: un evento "state" con el estado actual y después un
+    evento por cada cambio (dado, respuesta, movimiento, jugadores...) con la partida
+    completa. Sustituye al polling de get-game.
+    """
+    sessions = get_game_sessions()
+    game = sessions.get(game_id)
+    if not game:
+        raise HTTPException(status_code=404, detail="Partida no encontrada")
+    if not any(p["user_id"] == user_id for p in game["players"]):
+        raise HTTPException(status_code=403, detail="No estás en esta partida")
+
+    async def event_stream():
+        async for message in sessions.subscribe(game_id):
+            if message is None:
+                yield ": ping\n\n"
+                continue
+            event = "state" if message.startswith('{"type": "state"') else "update"
+            yield f"event: {event}\ndata: {message}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/study-agents/start-game")
 async def start_game_endpoint(request: GetGameRequest):
     """Inicia una partida"""
     try:
-        game = game_storage.start_game(request.game_id, request.user_id)
+        game = get_game_sessions().run(
+            request.game_id,
+            lambda: game_storage.start_game(request.game_id, request.user_id),
+            "game_started",
+            request.user_id,
+        )
         
         if not game:
             raise HTTPException(status_code=400, detail="No se pudo iniciar la partida. Verifica que seas el creador y que haya al menos 2 jugadores.")
@@ -5699,6 +6170,85 @@ async def start_game_endpoint(request: GetGameRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _check_turn(game: Dict, user_id: str) -> Dict:
+    """Valida que la partida está en juego y que es el turno de user_id; devuelve su jugador"""
+    if game["status"] != "playing":
+        raise HTTPException(status_code=400, detail="La partida no está en juego")
+    current_player = game["players"][game["current_turn"]]
+    if current_player["user_id"] != user_id:
+        raise HTTPException(status_code=400, detail="No es tu turno")
+    return current_player
+
+
+def _generate_game_question(game: Dict) -> Dict:
+    """Genera una pregunta en tiempo real (cuando la partida no tiene preguntas pre-cargadas)"""
+    course = course_storage.get_course(game["course_id"])
+    if not course:
+        raise HTTPException(status_code=404, detail="Curso no encontrado")
+    
+    api_key = os.getenv("OPENAI_API_KEY")
+    system = get_or_create_system(api_key, mode="auto")
+    
+    topic_filter = game.get("topic_filter")
+    topics_to_use = [topic_filter] if topic_filter else None
+    
+    pdf_paths = []
+    for topic in course.get("topics", []):
+        for pdf_url in topic.get("pdfs", []):
+            if pdf_url.startswith("http://localhost:8000/api/files/") or pdf_url.startswith("http://127.0.0.1:8000/api/files/"):
+                filename = pdf_url.split("/api/files/")[-1]
+                pdf_path = os.path.join(UPLOAD_DIR, filename)
+                if os.path.exists(pdf_path) and pdf_path not in pdf_paths:
+                    pdf_paths.append(pdf_path)
+            elif pdf_url.startswith("/api/files/"):
+                filename = pdf_url.replace("/api/files/", "")
+                pdf_path = os.path.join(UPLOAD_DIR, filename)
+                if os.path.exists(pdf_path) and pdf_path not in pdf_paths:
+                    pdf_paths.append(pdf_path)
+    
+    # El corpus del curso ya suele estar indexado: solo se procesan PDFs nuevos
+    corpus_chat_id, corpus_user_id = _course_corpus_scope(game["course_id"])
+    if pdf_paths:
+        system.ensure_documents(pdf_paths, chat_id=corpus_chat_id, user_id=corpus_user_id)
+    
+    test_data, usage_info = system.generate_test(
+        difficulty="medium",
+        num_questions=1,
+        topics=topics_to_use,
+        model=None,
+        chat_id=corpus_chat_id,
+        user_id=corpus_user_id,
+    )
+    
+    if usage_info:
+        input_tokens = usage_info.get("inputTokens", 0)
+        output_tokens = usage_info.get("outputTokens", 0)
+        model_used = "gpt-3.5-turbo"
+        if hasattr(system, 'test_generator') and hasattr(system.test_generator, 'current_model_config'):
+            if system.test_generator.current_model_config:
+                model_used = system.test_generator.current_model_config.name
+        
+        creator_id = game.get("creator_id")
+        if creator_id and (input_tokens > 0 or output_tokens > 0):
+            save_user_cost(creator_id, input_tokens, output_tokens, model_used, system)
+    
+    if test_data.get("test") and test_data["test"].get("questions"):
+        question = test_data["test"]["questions"][0]
+        return {
+            "question": question.get("question", ""),
+            "options": question.get("options", []),
+            "correct_answer_index": question.get("correct_answer", 0) if isinstance(question.get("correct_answer"), int) else 0,
+            "explanation": question.get("explanation", "")
+        }
+    # Fallback: pregunta simple
+    return {
+        "question": "¿Estás listo para continuar?",
+        "options": ["Sí", "No"],
+        "correct_answer_index": 0,
+        "explanation": ""
+    }
+
+
 @app.post("/api/study-agents/roll-dice")
 async def roll_dice_endpoint(request: RollDiceRequest):
     """Lanza el dado en una partida"""
@@ -5706,114 +6256,67 @@ async def roll_dice_endpoint(request: RollDiceRequest):
         import random
         from datetime import datetime
         
-        game = game_storage.load_game(request.game_id)
+        sessions = get_game_sessions()
+        game = sessions.get(request.game_id)
         
         if not game:
             raise HTTPException(status_code=404, detail="Partida no encontrada")
         
-        if game["status"] != "playing":
-            raise HTTPException(status_code=400, detail="La partida no está en juego")
-        
-        # Verificar que es el turno del jugador
-        current_player = game["players"][game["current_turn"]]
-        if current_player["user_id"] != request.user_id:
-            raise HTTPException(status_code=400, detail="No es tu turno")
-        
-        # Lanzar dado (1-6)
-        dice_value = random.randint(1, 6)
-        game["last_dice"] = dice_value
-        game["updated_at"] = datetime.now().isoformat()
-        
-        # Si hay una pregunta activa, no se puede lanzar el dado
+        _check_turn(game, request.user_id)
         if game.get("current_question"):
             raise HTTPException(status_code=400, detail="Debes responder la pregunta actual antes de lanzar el dado")
         
-        # Usar preguntas pre-cargadas si están disponibles
-        preloaded_questions = game.get("preloaded_questions", [])
-        question_index = game.get("question_index", 0)
-        
-        if preloaded_questions and len(preloaded_questions) > 0:
-            # Usar pregunta pre-cargada
-            if question_index >= len(preloaded_questions):
-                # Si nos quedamos sin preguntas, reiniciar el índice
-                question_index = 0
-            
-            question = preloaded_questions[question_index]
-            game["current_question"] = {
-                "question": question.get("question", ""),
-                "options": question.get("options", []),
-                "correct_answer_index": question.get("correct_answer_index", 0),
-                "explanation": question.get("explanation", "")
-            }
-            game["question_index"] = (question_index + 1) % len(preloaded_questions)  # Circular
-            print(f"[Roll Dice] Usando pregunta pre-cargada {question_index + 1}/{len(preloaded_questions)}")
-        else:
-            # Fallback: generar pregunta en tiempo real (si no hay pre-cargadas)
+        # Fallback: generar pregunta en tiempo real (si no hay pre-cargadas), fuera del lock de la partida
+        generated_question = None
+        if not game.get("preloaded_questions"):
             print(f"[Roll Dice] ⚠️ No hay preguntas pre-cargadas, generando en tiempo real...")
-            course = course_storage.get_course(game["course_id"])
-            if not course:
-                raise HTTPException(status_code=404, detail="Curso no encontrado")
-            
-            api_key = os.getenv("OPENAI_API_KEY")
-            system = get_or_create_system(api_key, mode="auto")
-            
-            topic_filter = game.get("topic_filter")
-            topics_to_use = [topic_filter] if topic_filter else None
+            generated_question = _generate_game_question(game)
+        
+        def roll(game):
+            # Se revalida bajo el lock: otro jugador pudo mover mientras tanto
+            _check_turn(game, request.user_id)
             
-            pdf_paths = []
-            for topic in course.get("topics", []):
-                for pdf_url in topic.get("pdfs", []):
-                    if pdf_url.startswith("http://localhost:8000/api/files/") or pdf_url.startswith("http://127.0.0.1:8000/api/files/"):
-                        filename = pdf_url.split("/api/files/")[-1]
-                        pdf_path = os.path.join(UPLOAD_DIR, filename)
-                        if os.path.exists(pdf_path) and pdf_path not in pdf_paths:
-                            pdf_paths.append(pdf_path)
-                    elif pdf_url.startswith("/api/files/"):
-                        filename = pdf_url.replace("/api/files/", "")
-                        pdf_path = os.path.join(UPLOAD_DIR, filename)
-                        if os.path.exists(pdf_path) and pdf_path not in pdf_paths:
-                            pdf_paths.append(pdf_path)
+            # Si hay una pregunta activa, no se puede lanzar el dado
+            if game.get("current_question"):
+                raise HTTPException(status_code=400, detail="Debes responder la pregunta actual antes de lanzar el dado")
             
-            if pdf_paths:
-                system.upload_documents(pdf_paths)
+            # Lanzar dado (1-6)
+            dice_value = random.randint(1, 6)
+            game["last_dice"] = dice_value
+            game["updated_at"] = datetime.now().isoformat()
             
-            test_data, usage_info = system.generate_test(
-                difficulty="medium",
-                num_questions=1,
-                topics=topics_to_use,
-                model=None
-            )
+            # Usar preguntas pre-cargadas si están disponibles
+            preloaded_questions = game.get("preloaded_questions", [])
+            question_index = game.get("question_index", 0)
             
-            if usage_info:
-                input_tokens = usage_info.get("inputTokens", 0)
-                output_tokens = usage_info.get("outputTokens", 0)
-                model_used = "gpt-3.5-turbo"
-                if hasattr(system, 'test_generator') and hasattr(system.test_generator, 'current_model_config'):
-                    if system.test_generator.current_model_config:
-                        model_used = system.test_generator.current_model_config.name
+            if preloaded_questions and len(preloaded_questions) > 0:
+                # Usar pregunta pre-cargada
+                if question_index >= len(preloaded_questions):
+                    # Si nos quedamos sin preguntas, reiniciar el índice
+                    question_index = 0
                 
-                creator_id = game.get("creator_id")
-                if creator_id and (input_tokens > 0 or output_tokens > 0):
-                    save_user_cost(creator_id, input_tokens, output_tokens, model_used, system)
-            
-            if test_data.get("test") and test_data["test"].get("questions"):
-                question = test_data["test"]["questions"][0]
+                question = preloaded_questions[question_index]
                 game["current_question"] = {
                     "question": question.get("question", ""),
                     "options": question.get("options", []),
-                    "correct_answer_index": question.get("correct_answer", 0) if isinstance(question.get("correct_answer"), int) else 0,
+                    "correct_answer_index": question.get("correct_answer_index", 0),
                     "explanation": question.get("explanation", "")
                 }
+                game["question_index"] = (question_index + 1) % len(preloaded_questions)  # Circular
+                print(f"[Roll Dice] Usando pregunta pre-cargada {question_index + 1}/{len(preloaded_questions)}")
             else:
-                # Fallback: pregunta simple
-                game["current_question"] = {
+                game["current_question"] = generated_question or {
                     "question": "¿Estás listo para continuar?",
                     "options": ["Sí", "No"],
                     "correct_answer_index": 0,
                     "explanation": ""
                 }
+            return dice_value
         
-        game_storage.save_game(game)
+        outcome = sessions.update(request.game_id, roll, "dice_rolled", request.user_id)
+        if outcome is None:
+            raise HTTPException(status_code=404, detail="Partida no encontrada")
+        game, dice_value = outcome
         
         return {
             "success": True,
@@ -5835,49 +6338,43 @@ async def answer_question_endpoint(request: AnswerQuestionRequest):
     try:
         from datetime import datetime
         
-        game = game_storage.load_game(request.game_id)
+        def answer(game):
+            current_player = _check_turn(game, request.user_id)
+            
+            if not game.get("current_question"):
+                raise HTTPException(status_code=400, detail="No hay pregunta activa")
+            
+            question = game["current_question"]
+            is_correct = request.answer_index == question["correct_answer_index"]
+            
+            # Añadir al historial
+            game["question_history"].append({
+                "player_id": request.user_id,
+                "question": question["question"],
+                "answer_index": request.answer_index,
+                "correct": is_correct,
+                "timestamp": datetime.now().isoformat()
+            })
+            
+            # Si es correcta, aumentar score
+            if is_correct:
+                current_player["score"] += 1
+            
+            # Limpiar pregunta actual
+            game["current_question"] = None
+            game["updated_at"] = datetime.now().isoformat()
+            return is_correct, question.get("explanation", "")
         
-        if not game:
+        outcome = get_game_sessions().update(request.game_id, answer, "question_answered", request.user_id)
+        if outcome is None:
             raise HTTPException(status_code=404, detail="Partida no encontrada")
-        
-        if game["status"] != "playing":
-            raise HTTPException(status_code=400, detail="La partida no está en juego")
-        
-        # Verificar que es el turno del jugador
-        current_player = game["players"][game["current_turn"]]
-        if current_player["user_id"] != request.user_id:
-            raise HTTPException(status_code=400, detail="No es tu turno")
-        
-        if not game.get("current_question"):
-            raise HTTPException(status_code=400, detail="No hay pregunta activa")
-        
-        question = game["current_question"]
-        is_correct = request.answer_index == question["correct_answer_index"]
-        
-        # Añadir al historial
-        game["question_history"].append({
-            "player_id": request.user_id,
-            "question": question["question"],
-            "answer_index": request.answer_index,
-            "correct": is_correct,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        # Si es correcta, aumentar score
-        if is_correct:
-            current_player["score"] += 1
-        
-        # Limpiar pregunta actual
-        game["current_question"] = None
-        game["updated_at"] = datetime.now().isoformat()
-        
-        game_storage.save_game(game)
+        game, (is_correct, explanation) = outcome
         
         return {
             "success": True,
             "game": game,
             "correct": is_correct,
-            "explanation": question.get("explanation", "")
+            "explanation": explanation
         }
     except HTTPException:
         raise
@@ -5894,64 +6391,56 @@ async def move_piece_endpoint(request: MovePieceRequest):
     try:
         from datetime import datetime
         
-        game = game_storage.load_game(request.game_id)
-        
-        if not game:
-            raise HTTPException(status_code=404, detail="Partida no encontrada")
-        
-        if game["status"] != "playing":
-            raise HTTPException(status_code=400, detail="La partida no está en juego")
-        
-        # Verificar que es el turno del jugador
-        current_player = game["players"][game["current_turn"]]
-        if current_player["user_id"] != request.user_id:
-            raise HTTPException(status_code=400, detail="No es tu turno")
-        
-        if not game.get("last_dice"):
-            raise HTTPException(status_code=400, detail="Debes lanzar el dado primero")
-        
-        if game.get("current_question"):
-            raise HTTPException(status_code=400, detail="Debes responder la pregunta primero")
-        
-        if request.piece_index < 0 or request.piece_index > 3:
-            raise HTTPException(status_code=400, detail="Índice de ficha inválido")
-        
-        dice_value = game["last_dice"]
-        piece_position = current_player["pieces"][request.piece_index]
-        
-        # Lógica simplificada del parchís
-        # Si la ficha está en casa (0) y el dado es 6, puede salir
-        if piece_position == 0:
-            if dice_value == 6:
-                current_player["pieces"][request.piece_index] = 1  # Salir a la casilla inicial
-            else:
-                raise HTTPException(status_code=400, detail="Necesitas un 6 para sacar una ficha de casa")
-        else:
-            # Mover la ficha
-            new_position = piece_position + dice_value
-            if new_position > 68:
-                raise HTTPException(status_code=400, detail="Movimiento inválido (se pasa del tablero)")
+        def move(game):
+            current_player = _check_turn(game, request.user_id)
             
-            current_player["pieces"][request.piece_index] = new_position
+            if not game.get("last_dice"):
+                raise HTTPException(status_code=400, detail="Debes lanzar el dado primero")
             
-            # Si llega a la meta (69), verificar si gana
-            if new_position >= 69:
-                current_player["pieces"][request.piece_index] = 69  # Meta
-                # Verificar si todas las fichas están en la meta
-                if all(p == 69 for p in current_player["pieces"]):
-                    game["status"] = "finished"
-                    game["winner"] = request.user_id
-        
-        # Limpiar dado y pasar turno
-        game["last_dice"] = None
-        game["current_turn"] = (game["current_turn"] + 1) % len(game["players"])
-        game["updated_at"] = datetime.now().isoformat()
+            if game.get("current_question"):
+                raise HTTPException(status_code=400, detail="Debes responder la pregunta primero")
+            
+            if request.piece_index < 0 or request.piece_index > 3:
+                raise HTTPException(status_code=400, detail="Índice de ficha inválido")
+            
+            dice_value = game["last_dice"]
+            piece_position = current_player["pieces"][request.piece_index]
+            
+            # Lógica simplificada del parchís
+            # Si la ficha está en casa (0) y el dado es 6, puede salir
+            if piece_position == 0:
+                if dice_value == 6:
+                    current_player["pieces"][request.piece_index] = 1  # Salir a la casilla inicial
+                else:
+                    raise HTTPException(status_code=400, detail="Necesitas un 6 para sacar una ficha de casa")
+            else:
+                # Mover la ficha
+                new_position = piece_position + dice_value
+                if new_position > 68:
+                    raise HTTPException(status_code=400, detail="Movimiento inválido (se pasa del tablero)")
+                
+                current_player["pieces"][request.piece_index] = new_position
+                
+                # Si llega a la meta (69), verificar si gana
+                if new_position >= 69:
+                    current_player["pieces"][request.piece_index] = 69  # Meta
+                    # Verificar si todas las fichas están en la meta
+                    if all(p == 69 for p in current_player["pieces"]):
+                        game["status"] = "finished"
+                        game["winner"] = request.user_id
+            
+            # Limpiar dado y pasar turno
+            game["last_dice"] = None
+            game["current_turn"] = (game["current_turn"] + 1) % len(game["players"])
+            game["updated_at"] = datetime.now().isoformat()
         
-        game_storage.save_game(game)
+        outcome = get_game_sessions().update(request.game_id, move, "piece_moved", request.user_id)
+        if outcome is None:
+            raise HTTPException(status_code=404, detail="Partida no encontrada")
         
         return {
             "success": True,
-            "game": game
+            "game": outcome[0]
         }
     except HTTPException:
         raise
@@ -5968,43 +6457,35 @@ async def pass_turn_endpoint(request: PassTurnRequest):
     try:
         from datetime import datetime
         
-        game = game_storage.load_game(request.game_id)
+        def pass_turn(game):
+            current_player = _check_turn(game, request.user_id)
+            
+            if not game.get("last_dice"):
+                raise HTTPException(status_code=400, detail="Debes lanzar el dado primero")
+            
+            if game.get("current_question"):
+                raise HTTPException(status_code=400, detail="Debes responder la pregunta primero")
+            
+            # Verificar que no tiene fichas en juego y el dado es menor que 5
+            has_pieces_in_play = any(p > 0 and p < 69 for p in current_player["pieces"])
+            if has_pieces_in_play:
+                raise HTTPException(status_code=400, detail="Tienes fichas en juego, no puedes pasar turno")
+            
+            if game["last_dice"] >= 5:
+                raise HTTPException(status_code=400, detail="Solo puedes pasar turno si sacaste menos de 5 y no tienes fichas")
+            
+            # Limpiar dado y pasar turno
+            game["last_dice"] = None
+            game["current_turn"] = (game["current_turn"] + 1) % len(game["players"])
+            game["updated_at"] = datetime.now().isoformat()
         
-        if not game:
+        outcome = get_game_sessions().update(request.game_id, pass_turn, "turn_passed", request.user_id)
+        if outcome is None:
             raise HTTPException(status_code=404, detail="Partida no encontrada")
         
-        if game["status"] != "playing":
-            raise HTTPException(status_code=400, detail="La partida no está en juego")
-        
-        # Verificar que es el turno del jugador
-        current_player = game["players"][game["current_turn"]]
-        if current_player["user_id"] != request.user_id:
-            raise HTTPException(status_code=400, detail="No es tu turno")
-        
-        if not game.get("last_dice"):
-            raise HTTPException(status_code=400, detail="Debes lanzar el dado primero")
-        
-        if game.get("current_question"):
-            raise HTTPException(status_code=400, detail="Debes responder la pregunta primero")
-        
-        # Verificar que no tiene fichas en juego y el dado es menor que 5
-        has_pieces_in_play = any(p > 0 and p < 69 for p in current_player["pieces"])
-        if has_pieces_in_play:
-            raise HTTPException(status_code=400, detail="Tienes fichas en juego, no puedes pasar turno")
-        
-        if game["last_dice"] >= 5:
-            raise HTTPException(status_code=400, detail="Solo puedes pasar turno si sacaste menos de 5 y no tienes fichas")
-        
-        # Limpiar dado y pasar turno
-        game["last_dice"] = None
-        game["current_turn"] = (game["current_turn"] + 1) % len(game["players"])
-        game["updated_at"] = datetime.now().isoformat()
-        
-        game_storage.save_game(game)
-        
         return {
             "success": True,
-            "game": game
+            "game": outcome[0]
         }
     except HTTPException:
         raise
@@ -6086,7 +6567,12 @@ class DeleteGameRequest(BaseModel):
 async def leave_game_endpoint(request: LeaveGameRequest):
     """Abandona una partida (solo si está en estado waiting)"""
     try:
-        game = game_storage.leave_game(request.game_id, request.user_id)
+        game = get_game_sessions().run(
+            request.game_id,
+            lambda: game_storage.leave_game(request.game_id, request.user_id),
+            "player_left",
+            request.user_id,
+        )
         
         if game is None:
             # Si es None, puede ser que se eliminó la partida o que no se pudo abandonar
@@ -6176,15 +6662,18 @@ async def create_redeem_code_endpoint(request: CreateRedeemCodeRequest):
 async def redeem_code_endpoint(request: RedeemCodeRequest):
     """Canjea un código para añadir saldo a la wallet"""
     try:
-        # Canjear el código
-        redeem_result = redeem_codes_storage.redeem_code(request.code, request.user_id)
-        
-        # Añadir saldo a la wallet
-        wallet_storage.add_to_wallet(
-            request.user_id,
-            redeem_result["amount"],
-            description=f"Código canjeado: {redeem_result['code']}"
-        )
+        # Canje y abono en la misma transacción: si falla el abono, el código no se consume
+        with storage_engine.transaction():
+            # Canjear el código
+            redeem_result = redeem_codes_storage.redeem_code(request.code, request.user_id)
+            
+            # Añadir saldo a la wallet
+            wallet_storage.add_to_wallet(
+                request.user_id,
+                redeem_result["amount"],
+                transaction_type="redeem_code",
+                metadata={"description": f"Código canjeado: {redeem_result['code']}"}
+            )
         
         return {
             "success": True,
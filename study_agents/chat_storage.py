@@ -1,24 +1,58 @@
 """
 Sistema de almacenamiento de conversaciones
-Guarda las conversaciones de los usuarios en archivos JSON
+Guarda las conversaciones de los usuarios en la base de datos embebida (storage_engine):
+una fila por chat, indexada por usuario. Los antiguos chats/<user>/<chat>.json se migran solos.
 """
 
 import json
 import os
+import sys
 from typing import List, Dict, Optional
 from datetime import datetime
 from pathlib import Path
 
-# Directorio para almacenar conversaciones
-CHATS_DIR = Path("chats")
-CHATS_DIR.mkdir(exist_ok=True)
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository
+import data_paths
+
+# Directorio de los chats en JSON (formato antiguo, solo para la migración)
+CHATS_DIR = data_paths.CHATS_DIR
 
 
 def get_chat_file_path(user_id: str, chat_id: str) -> Path:
-    """Obtiene la ruta del archivo de chat"""
-    user_dir = CHATS_DIR / user_id
-    user_dir.mkdir(exist_ok=True)
-    return user_dir / f"{chat_id}.json"
+    """Obtiene la ruta del archivo de chat (formato JSON antiguo)"""
+    return CHATS_DIR / user_id / f"{chat_id}.json"
+
+
+def _legacy_chats():
+    """Lee los chats guardados en chats/<user>/<chat>.json"""
+    if not CHATS_DIR.exists():
+        return
+    for chat_file in CHATS_DIR.glob("*/*.json"):
+        try:
+            with open(chat_file, "r", encoding="utf-8") as f:
+                chat_data = json.load(f)
+        except Exception as e:
+            print(f"Error al leer chat {chat_file}: {e}")
+            continue
+        user_id = chat_data.get("user_id") or chat_file.parent.name
+        chat_id = chat_data.get("chat_id") or chat_file.stem
+        chat_data.update({"user_id": user_id, "chat_id": chat_id})
+        yield _chat_key(user_id, chat_id), chat_data
+
+
+def _chat_key(user_id: str, chat_id: str) -> str:
+    return f"{user_id}/{chat_id}"
+
+
+_chats = Repository("chats", indexes={"user_id": "user_id"}, legacy=_legacy_chats, legacy_sources=[CHATS_DIR])
+
+
+def chat_exists(user_id: str, chat_id: str) -> bool:
+    """Indica si existe la conversación"""
+    return _chats.exists(_chat_key(user_id, chat_id))
 
 
 def save_chat(user_id: str, chat_id: str, title: str, messages: List[Dict], metadata: Optional[Dict] = None) -> Dict:
@@ -35,27 +69,21 @@ def save_chat(user_id: str, chat_id: str, title: str, messages: List[Dict], meta
     Returns:
         Información del chat guardado
     """
-    chat_file = get_chat_file_path(user_id, chat_id)
-    
-    # Si el chat ya existe, actualizar en lugar de crear uno nuevo
-    if chat_file.exists():
-        # Cargar datos existentes
-        with open(chat_file, "r", encoding="utf-8") as f:
-            existing_data = json.load(f)
-        
-        # Actualizar solo los campos que han cambiado
-        chat_data = {
-            "chat_id": chat_id,
-            "user_id": user_id,
-            "title": title or existing_data.get("title", "Nueva conversación"),
-            "messages": messages,  # Actualizar mensajes
-            "created_at": existing_data.get("created_at", datetime.now().isoformat()),
-            "updated_at": datetime.now().isoformat(),
-            "metadata": {**existing_data.get("metadata", {}), **(metadata or {})}
-        }
-    else:
+    def merge(existing_data: Optional[Dict]) -> Dict:
+        # Si el chat ya existe, actualizar en lugar de crear uno nuevo
+        if existing_data is not None:
+            # Actualizar solo los campos que han cambiado
+            return {
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "title": title or existing_data.get("title", "Nueva conversación"),
+                "messages": messages,  # Actualizar mensajes
+                "created_at": existing_data.get("created_at", datetime.now().isoformat()),
+                "updated_at": datetime.now().isoformat(),
+                "metadata": {**existing_data.get("metadata", {}), **(metadata or {})}
+            }
         # Crear nuevo chat
-        chat_data = {
+        return {
             "chat_id": chat_id,
             "user_id": user_id,
             "title": title or "Nueva conversación",
@@ -65,10 +93,7 @@ def save_chat(user_id: str, chat_id: str, title: str, messages: List[Dict], meta
             "metadata": metadata or {}
         }
     
-    with open(chat_file, "w", encoding="utf-8") as f:
-        json.dump(chat_data, f, ensure_ascii=False, indent=2)
-    
-    return chat_data
+    return _chats.update(_chat_key(user_id, chat_id), merge)
 
 
 def load_chat(user_id: str, chat_id: str) -> Optional[Dict]:
@@ -82,13 +107,7 @@ def load_chat(user_id: str, chat_id: str) -> Optional[Dict]:
     Returns:
         Datos del chat o None si no existe
     """
-    chat_file = get_chat_file_path(user_id, chat_id)
-    
-    if not chat_file.exists():
-        return None
-    
-    with open(chat_file, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _chats.get(_chat_key(user_id, chat_id))
 
 
 def list_chats(user_id: str) -> List[Dict]:
@@ -101,27 +120,16 @@ def list_chats(user_id: str) -> List[Dict]:
     Returns:
         Lista de chats con información básica
     """
-    user_dir = CHATS_DIR / user_id
-    
-    if not user_dir.exists():
-        return []
-    
     chats = []
-    for chat_file in user_dir.glob("*.json"):
-        try:
-            with open(chat_file, "r", encoding="utf-8") as f:
-                chat_data = json.load(f)
-                chats.append({
-                    "chat_id": chat_data.get("chat_id"),
-                    "title": chat_data.get("title", "Sin título"),
-                    "created_at": chat_data.get("created_at"),
-                    "updated_at": chat_data.get("updated_at"),
-                    "message_count": len(chat_data.get("messages", [])),
-                    "metadata": chat_data.get("metadata", {})
-                })
-        except Exception as e:
-            print(f"Error al leer chat {chat_file}: {e}")
-            continue
+    for chat_data in _chats.find(user_id=user_id):
+        chats.append({
+            "chat_id": chat_data.get("chat_id"),
+            "title": chat_data.get("title", "Sin título"),
+            "created_at": chat_data.get("created_at"),
+            "updated_at": chat_data.get("updated_at"),
+            "message_count": len(chat_data.get("messages", [])),
+            "metadata": chat_data.get("metadata", {})
+        })
     
     # Ordenar por fecha de actualización (más reciente primero)
     chats.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
@@ -143,30 +151,23 @@ def update_chat(user_id: str, chat_id: str, messages: List[Dict], title: Optiona
     Returns:
         Datos del chat actualizado o None si no existe
     """
-    chat_file = get_chat_file_path(user_id, chat_id)
-    
-    if not chat_file.exists():
-        return None
-    
-    # Cargar datos existentes
-    with open(chat_file, "r", encoding="utf-8") as f:
-        chat_data = json.load(f)
-    
-    # Actualizar
-    chat_data["messages"] = messages
-    chat_data["updated_at"] = datetime.now().isoformat()
-    
-    if title:
-        chat_data["title"] = title
-    
-    if metadata:
-        chat_data["metadata"] = {**chat_data.get("metadata", {}), **metadata}
-    
-    # Guardar
-    with open(chat_file, "w", encoding="utf-8") as f:
-        json.dump(chat_data, f, ensure_ascii=False, indent=2)
+    def apply(chat_data: Optional[Dict]) -> Optional[Dict]:
+        if chat_data is None:
+            return None
+        
+        # Actualizar
+        chat_data["messages"] = messages
+        chat_data["updated_at"] = datetime.now().isoformat()
+        
+        if title:
+            chat_data["title"] = title
+        
+        if metadata:
+            chat_data["metadata"] = {**chat_data.get("metadata", {}), **metadata}
+        
+        return chat_data
     
-    return chat_data
+    return _chats.update(_chat_key(user_id, chat_id), apply)
 
 
 def delete_chat(user_id: str, chat_id: str) -> bool:
@@ -180,13 +181,7 @@ def delete_chat(user_id: str, chat_id: str) -> bool:
     Returns:
         True si se eliminó, False si no existía
     """
-    chat_file = get_chat_file_path(user_id, chat_id)
-    
-    if not chat_file.exists():
-        return False
-    
-    chat_file.unlink()
-    return True
+    return _chats.delete(_chat_key(user_id, chat_id))
 
 
 def generate_chat_id() -> str:
@@ -1,19 +1,32 @@
 """
 Persistencia de tarjetas SRS por usuario (Fase 1).
+Una fila por tarjeta en la base de datos embebida (storage_engine), indexada por
+usuario y chat. Los antiguos data/cards/<user>.json se migran solos.
+Índices compuestos:
+- usuario|due y usuario|chat|due: la cola de pendientes y su recuento son un rango
+  sobre el índice, ordenado por fecha, sin leer las tarjetas que no tocan.
+- usuario|chat|hash(front): detección de duplicados sin recorrer las tarjetas del chat.
+Cada revisión queda en srs_reviews (historial para ajustar los pesos FSRS del usuario,
+que se guardan en srs_params y se usan al reprogramar sus tarjetas).
 """
 
 from __future__ import annotations
 
+import hashlib
 import json
 import re
 import uuid
+from collections import deque
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from core.fsrs import FsrsState, create_card, rating_from_string, review
+from core import fsrs_batch
+from core.fsrs import W, FsrsState, create_card, rating_from_string, review
+from storage_engine import Repository, transaction
 
 _ROOT = Path(__file__).resolve().parent.parent
+# Formato JSON antiguo (solo para la migración)
 CARDS_DIR = _ROOT / "data" / "cards"
 
 
@@ -25,27 +38,85 @@ def cards_path(user_id: str) -> Path:
     return CARDS_DIR / f"{_safe_id(user_id)}.json"
 
 
+def _card_key(owner: str, card_id: str) -> str:
+    return f"{owner}/{card_id}"
+
+
+def _legacy_cards():
+    if not CARDS_DIR.exists():
+        return
+    for path in CARDS_DIR.glob("*.json"):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            continue
+        for card in data.get("cards") or []:
+            yield _card_key(path.stem, card.get("card_id", "")), {**card, "_owner": path.stem}
+
+
+def _due_value(moment: datetime) -> str:
+    """Segundos epoch con ancho fijo: el orden de texto del índice es el orden temporal"""
+    return f"{max(0, int(moment.timestamp())):012d}"
+
+
+def _front_hash(front: str) -> str:
+    return hashlib.sha1(front.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def _front_value(owner: str, chat_id: Optional[str], front: str) -> str:
+    return f"{owner}|{chat_id or ''}|{_front_hash(front)}"
+
+
+# _owner = _safe_id(user_id), igual que el nombre del fichero antiguo
+_cards = Repository(
+    "srs_cards",
+    indexes={
+        "owner": "_owner",
+        "chat_id": "chat_id",
+        "owner_due": lambda c: f"{c.get('_owner')}|{_due_value(_parse_dt(c.get('due_date')))}",
+        "chat_due": lambda c: f"{c.get('_owner')}|{c.get('chat_id') or ''}|{_due_value(_parse_dt(c.get('due_date')))}",
+        "front": lambda c: _front_value(c.get("_owner"), c.get("chat_id"), c.get("front") or ""),
+    },
+    legacy=_legacy_cards,
+    legacy_sources=[CARDS_DIR],
+)
+
+
+# Una fila por revisión: key = owner/card_id/<ms>-<n>, en orden cronológico por tarjeta
+_reviews = Repository("srs_reviews", indexes={"owner": "_owner"})
+# Pesos FSRS ajustados por usuario (key = owner)
+_params = Repository("srs_params")
+
+
+def _public(card: Dict[str, Any]) -> Dict[str, Any]:
+    card.pop("_owner", None)
+    return card
+
+
+def _user_cards(user_id: str, chat_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    cards = [_public(c) for c in _cards.find(owner=_safe_id(user_id), chat_id=chat_id)]
+    cards.sort(key=lambda c: c.get("created_at") or "")
+    return cards
+
+
+def _put_card(user_id: str, card: Dict[str, Any]) -> None:
+    owner = _safe_id(user_id)
+    _cards.put(_card_key(owner, card["card_id"]), {**card, "_owner": owner})
+
+
 def load_cards(user_id: str) -> List[Dict[str, Any]]:
-    path = cards_path(user_id)
-    if not path.exists():
-        return []
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
-        return list(data.get("cards") or [])
+        return _user_cards(user_id)
     except Exception:
         return []
 
 
 def save_cards(user_id: str, cards: List[Dict[str, Any]]) -> None:
-    CARDS_DIR.mkdir(parents=True, exist_ok=True)
-    payload = {
-        "user_id": user_id,
-        "updated_at": datetime.now(timezone.utc).isoformat(),
-        "cards": cards,
-    }
-    cards_path(user_id).write_text(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        encoding="utf-8",
+    """Sustituye las tarjetas del usuario (solo se escriben las que cambian)."""
+    owner = _safe_id(user_id)
+    _cards.replace_all(
+        {_card_key(owner, c["card_id"]): {**c, "_owner": owner} for c in cards},
+        owner=owner,
     )
 
 
@@ -83,27 +154,20 @@ def _apply_state(card: Dict[str, Any], state: FsrsState) -> Dict[str, Any]:
     return card
 
 
-def create_card_from_error(
-    user_id: str,
-    *,
-    chat_id: str,
-    front: str,
-    back: str,
-    concept_id: Optional[str] = None,
-    source: str = "test_error",
-) -> Dict[str, Any]:
-    """Crea tarjeta nacida de un fallo (due pronto)."""
-    cards = load_cards(user_id)
-    for c in cards:
-        if c.get("chat_id") == chat_id and c.get("front", "").strip() == front.strip():
-            return c
+def _due_range(user_id: str, chat_id: Optional[str], now: datetime) -> Tuple[str, str, str]:
+    """(índice, desde, hasta) de las tarjetas con due <= now"""
+    owner = _safe_id(user_id)
+    prefix = f"{owner}|{chat_id}|" if chat_id else f"{owner}|"
+    return ("chat_due" if chat_id else "owner_due"), prefix, prefix + _due_value(now)
+
 
+def _new_card(chat_id: str, front: str, back: str, concept_id: Optional[str], source: str) -> Dict[str, Any]:
     now = datetime.now(timezone.utc)
     state = create_card(grade=1)
     state.due = now  # pendiente de inmediato tras un fallo
     state.stability = max(0.5, state.stability * 0.5)
 
-    card = {
+    return {
         "card_id": uuid.uuid4().hex[:12],
         "chat_id": chat_id,
         "concept_id": concept_id,
@@ -118,9 +182,56 @@ def create_card_from_error(
         "reps": state.reps,
         "lapses": state.lapses,
     }
-    cards.append(card)
-    save_cards(user_id, cards)
-    return card
+
+
+def create_card_from_error(
+    user_id: str,
+    *,
+    chat_id: str,
+    front: str,
+    back: str,
+    concept_id: Optional[str] = None,
+    source: str = "test_error",
+) -> Dict[str, Any]:
+    """Crea tarjeta nacida de un fallo (due pronto)."""
+    return create_cards(
+        user_id,
+        chat_id,
+        [{"front": front, "back": back, "concept_id": concept_id, "source": source}],
+    )[0]
+
+
+def create_cards(user_id: str, chat_id: str, items: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Crea varias tarjetas de golpe: una consulta al índice de duplicados y una sola
+    transacción. items: [{front, back, concept_id?, source?}]. Si ya existe una
+    tarjeta con el mismo front en el chat se devuelve esa (también dentro del lote).
+    """
+    owner = _safe_id(user_id)
+    items = [item for item in items if str(item.get("front") or "").strip()]
+    if not items:
+        return []
+    with transaction():
+        existing = {
+            _front_value(owner, card.get("chat_id"), card.get("front") or ""): _public(card)
+            for card in _cards.find(front=[_front_value(owner, chat_id, item["front"]) for item in items])
+        }
+        result = []
+        for item in items:
+            value = _front_value(owner, chat_id, item["front"])
+            card = existing.get(value)
+            if card is None:
+                card = _new_card(
+                    chat_id,
+                    item["front"],
+                    str(item.get("back") or ""),
+                    item.get("concept_id"),
+                    item.get("source") or "test_error",
+                )
+                _put_card(user_id, card)
+                existing[value] = card
+            result.append(card)
+    return result
 
 
 def due_cards(
@@ -131,55 +242,82 @@ def due_cards(
     limit: int = 40,
 ) -> List[Dict[str, Any]]:
     now = now or datetime.now(timezone.utc)
-    cards = load_cards(user_id)
-    due = []
-    for c in cards:
-        if chat_id and c.get("chat_id") != chat_id:
-            continue
-        if _parse_dt(c.get("due_date")) <= now:
-            due.append(c)
+    field, lower, upper = _due_range(user_id, chat_id or None, now)
+    # Solo las pendientes, ya ordenadas por due (las más atrasadas primero)
+    due = [_public(card) for _, card in _cards.items_in_range(field, lower, upper)]
 
     # Interleaving por concept_id
-    by_concept: Dict[str, List[Dict[str, Any]]] = {}
+    by_concept: Dict[str, deque] = {}
     for c in due:
         key = c.get("concept_id") or "_none"
-        by_concept.setdefault(key, []).append(c)
+        by_concept.setdefault(key, deque()).append(c)
 
     interleaved: List[Dict[str, Any]] = []
-    queues = list(by_concept.values())
+    queues = deque(by_concept.values())
     while queues and len(interleaved) < limit:
-        next_queues = []
-        for q in queues:
-            if not q:
-                continue
-            interleaved.append(q.pop(0))
-            if q:
-                next_queues.append(q)
-            if len(interleaved) >= limit:
-                break
-        queues = next_queues
+        q = queues.popleft()
+        interleaved.append(q.popleft())
+        if q:
+            queues.append(q)
 
     return interleaved
 
 
 def count_due(user_id: str, chat_id: Optional[str] = None) -> int:
-    return len(due_cards(user_id, chat_id=chat_id, limit=10_000))
+    """Tarjetas pendientes: un recuento sobre el índice, sin leer las tarjetas"""
+    field, lower, upper = _due_range(user_id, chat_id or None, datetime.now(timezone.utc))
+    return _cards.count_in_range(field, lower, upper)
 
 
 def review_card(user_id: str, card_id: str, rating: str) -> Dict[str, Any]:
-    grade = rating_from_string(rating)
-    cards = load_cards(user_id)
-    updated = None
-    for i, c in enumerate(cards):
-        if c.get("card_id") == card_id:
-            state = review(_state_from_card(c), grade)
-            cards[i] = _apply_state(c, state)
-            updated = cards[i]
-            break
-    if not updated:
+    updated, missing = review_cards(user_id, [{"card_id": card_id, "rating": rating}])
+    if missing:
         raise KeyError(f"Tarjeta no encontrada: {card_id}")
-    save_cards(user_id, cards)
-    return updated
+    return updated[0]
+
+
+def review_cards(user_id: str, reviews: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Aplica varias revisiones en una sola transacción: [{card_id, rating}].
+    Las revisiones de una misma tarjeta se aplican en orden.
+
+    Returns:
+        (tarjetas actualizadas, card_ids no encontrados)
+    """
+    owner = _safe_id(user_id)
+    # Validar todos los ratings antes de escribir nada (ValueError si alguno no vale)
+    grades = [(str(r.get("card_id") or ""), rating_from_string(r.get("rating"))) for r in reviews]
+    weights = user_weights(user_id)
+    updated: Dict[str, Dict[str, Any]] = {}
+    missing: List[str] = []
+    log: Dict[str, Dict[str, Any]] = {}
+    with transaction():
+        cards = _cards.get_many(_card_key(owner, card_id) for card_id, _ in grades)
+        for n, (card_id, grade) in enumerate(grades):
+            key = _card_key(owner, card_id)
+            card = cards.get(key)
+            if card is None:
+                missing.append(card_id)
+                continue
+            before = _state_from_card(card)
+            after = review(before, grade, w=weights)
+            elapsed = (after.last_review - before.last_review).total_seconds() / 86400.0 if before.last_review else 0.0
+            log[f"{key}/{int(after.last_review.timestamp() * 1000):015d}-{n}"] = {
+                "_owner": owner,
+                "card_id": card_id,
+                "rating": grade,
+                "reviewed_at": after.last_review.isoformat(),
+                "elapsed_days": round(max(0.0, elapsed), 5),
+                "stability": before.stability,
+                "difficulty": before.difficulty,
+            }
+            card = cards[key] = _apply_state(card, after)
+            updated[card_id] = card
+        for card_id, card in updated.items():
+            _cards.put(_card_key(owner, card_id), card)
+        for key, entry in log.items():
+            _reviews.put(key, entry)
+    return [_public(dict(card)) for card in updated.values()], missing
 
 
 def generate_from_errors(
@@ -187,8 +325,8 @@ def generate_from_errors(
     chat_id: str,
     errors: List[Dict[str, Any]],
 ) -> List[Dict[str, Any]]:
-    """errors: [{question, explanation, correct_answer, concept_ids?}]"""
-    created = []
+    """errors: [{question, explanation, correct_answer, concept_ids?}] — una sola escritura"""
+    items = []
     for err in errors:
         question = str(err.get("question") or "").strip()
         if not question:
@@ -200,13 +338,57 @@ def generate_from_errors(
         back = explanation or f"Respuesta correcta: {correct}"
         if correct and correct not in back:
             back = f"{back}\n\nRespuesta correcta: {correct}"
-        card = create_card_from_error(
-            user_id,
-            chat_id=chat_id,
-            front=question,
-            back=back,
-            concept_id=concept_id,
-            source="test_error",
-        )
-        created.append(card)
-    return created
+        items.append({
+            "front": question,
+            "back": back,
+            "concept_id": concept_id,
+            "source": "test_error",
+        })
+    return create_cards(user_id, chat_id, items)
+
+
+def user_weights(user_id: str) -> List[float]:
+    """Pesos FSRS del usuario (los por defecto si aún no se han ajustado)"""
+    params = _params.get(_safe_id(user_id))
+    return list(params["weights"]) if params and params.get("weights") else list(W)
+
+
+def review_histories(user_id: str) -> List[List[Dict[str, Any]]]:
+    """Historial de revisiones agrupado por tarjeta, en orden cronológico"""
+    histories: Dict[str, List[Dict[str, Any]]] = {}
+    for entry in _reviews.find(owner=_safe_id(user_id)):
+        entry.pop("_owner", None)
+        histories.setdefault(entry.get("card_id") or "", []).append(entry)
+    return list(histories.values())
+
+
+def optimize_user_weights(user_id: str) -> Dict[str, Any]:
+    """
+    Ajusta los pesos FSRS del usuario con su historial y los guarda si mejoran la
+    predicción. ValueError si no hay revisiones suficientes; RuntimeError sin numpy.
+    """
+    result = fsrs_batch.optimize_weights(review_histories(user_id), w=W)
+    if result["improved"]:
+        _params.put(_safe_id(user_id), {
+            "weights": result["weights"],
+            "trained_at": datetime.now(timezone.utc).isoformat(),
+            "reviews": result["reviews"],
+            "loss_before": result["loss_before"],
+            "loss_after": result["loss_after"],
+        })
+    return result
+
+
+def forecast(
+    user_id: str,
+    *,
+    chat_id: Optional[str] = None,
+    days: int = 7,
+    simulate_days: int = 0,
+) -> Dict[str, Any]:
+    """Vencimientos de los próximos días y, si simulate_days > 0, carga de repaso simulada"""
+    cards = _user_cards(user_id, chat_id=chat_id or None)
+    result = fsrs_batch.forecast(cards, days=days)
+    if simulate_days > 0:
+        result["workload"] = fsrs_batch.simulate_workload(cards, days=simulate_days, w=user_weights(user_id))
+    return result
@@ -1,5 +1,8 @@
 """
-Almacenamiento JSON de conceptos y mastery por chat (Fase 1).
+Almacenamiento de conceptos y mastery por chat (Fase 1).
+Filas en la base de datos embebida (storage_engine): los conceptos de un chat en una
+fila y el mastery de cada concepto en otra, así que practicar un concepto solo
+reescribe su fila. Los JSON antiguos de data/concepts y data/mastery se migran solos.
 Migrará a Supabase en Fase 3.
 """
 
@@ -13,22 +16,21 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 from core.mastery import update_mastery
+from storage_engine import Repository
 
-# study_agents/data/...
+# study_agents/data/... (formato JSON antiguo, solo para la migración)
 _ROOT = Path(__file__).resolve().parent.parent
 CONCEPTS_DIR = _ROOT / "data" / "concepts"
 MASTERY_DIR = _ROOT / "data" / "mastery"
 
+# Puntos de la serie temporal de mastery que se conservan por chat
+HISTORY_POINTS = 60
+
 
 def _safe_id(chat_id: str) -> str:
     return re.sub(r"[^\w\-]+", "_", chat_id)[:120] or "default"
 
 
-def _ensure_dirs() -> None:
-    CONCEPTS_DIR.mkdir(parents=True, exist_ok=True)
-    MASTERY_DIR.mkdir(parents=True, exist_ok=True)
-
-
 def concepts_path(chat_id: str) -> Path:
     return CONCEPTS_DIR / f"{_safe_id(chat_id)}.json"
 
@@ -37,52 +39,99 @@ def mastery_path(chat_id: str) -> Path:
     return MASTERY_DIR / f"{_safe_id(chat_id)}.json"
 
 
+def _read_json(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _is_mastery_file(path: Path) -> bool:
+    return not path.stem.endswith("_history") and not path.stem.startswith("session_")
+
+
+def _legacy_concepts():
+    if CONCEPTS_DIR.exists():
+        for path in CONCEPTS_DIR.glob("*.json"):
+            yield path.stem, _read_json(path)
+
+
+def _legacy_mastery():
+    if MASTERY_DIR.exists():
+        for path in filter(_is_mastery_file, MASTERY_DIR.glob("*.json")):
+            for concept_id, rec in (_read_json(path).get("records") or {}).items():
+                yield _mastery_key(path.stem, concept_id), {**rec, "_chat": path.stem, "_concept": concept_id}
+
+
+def _legacy_history():
+    if MASTERY_DIR.exists():
+        for path in MASTERY_DIR.glob("*_history.json"):
+            yield path.stem[: -len("_history")], _read_json(path)
+
+
+def _legacy_sessions():
+    if MASTERY_DIR.exists():
+        for path in MASTERY_DIR.glob("session_*.json"):
+            data = _read_json(path)
+            if data.get("chat_id"):
+                yield _session_key(data["chat_id"], str(data.get("user_id", ""))), data
+
+
+def _mastery_key(safe_chat: str, concept_id: str) -> str:
+    return f"{safe_chat}/{concept_id}"
+
+
+def _session_key(chat_id: str, user_id: str) -> str:
+    return f"{_safe_id(chat_id)}/{user_id}"
+
+
+_concepts = Repository("concepts", legacy=_legacy_concepts, legacy_sources=[CONCEPTS_DIR])
+_mastery = Repository("mastery", indexes={"chat": "_chat"}, legacy=_legacy_mastery, legacy_sources=[MASTERY_DIR])
+_history = Repository("mastery_history", legacy=_legacy_history, legacy_sources=[MASTERY_DIR])
+_sessions = Repository("mastery_sessions", legacy=_legacy_sessions, legacy_sources=[MASTERY_DIR])
+
+
 def load_concepts(chat_id: str) -> List[Dict[str, Any]]:
-    path = concepts_path(chat_id)
-    if not path.exists():
-        return []
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
+        data = _concepts.get(_safe_id(chat_id)) or {}
         return list(data.get("concepts") or [])
     except Exception:
         return []
 
 
 def save_concepts(chat_id: str, concepts: List[Dict[str, Any]], meta: Optional[Dict] = None) -> None:
-    _ensure_dirs()
     payload = {
         "chat_id": chat_id,
         "updated_at": datetime.now(timezone.utc).isoformat(),
         "concepts": concepts,
         "meta": meta or {},
     }
-    concepts_path(chat_id).write_text(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    _concepts.put(_safe_id(chat_id), payload)
+
+
+def _mastery_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in rec.items() if k not in ("_chat", "_concept")}
 
 
 def load_mastery_records(chat_id: str) -> Dict[str, Dict[str, Any]]:
-    path = mastery_path(chat_id)
-    if not path.exists():
-        return {}
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
-        return dict(data.get("records") or {})
+        return {
+            rec["_concept"]: _mastery_record(rec)
+            for rec in _mastery.find(chat=_safe_id(chat_id))
+        }
     except Exception:
         return {}
 
 
 def save_mastery_records(chat_id: str, records: Dict[str, Dict[str, Any]]) -> None:
-    _ensure_dirs()
-    payload = {
-        "chat_id": chat_id,
-        "updated_at": datetime.now(timezone.utc).isoformat(),
-        "records": records,
-    }
-    mastery_path(chat_id).write_text(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        encoding="utf-8",
+    """Sustituye el mastery del chat (solo se escriben los conceptos que cambian)."""
+    safe = _safe_id(chat_id)
+    _mastery.replace_all(
+        {
+            _mastery_key(safe, cid): {**rec, "_chat": safe, "_concept": cid}
+            for cid, rec in records.items()
+        },
+        chat=safe,
     )
 
 
@@ -95,23 +144,42 @@ def get_mastery_map(chat_id: str) -> Dict[str, float]:
 
 
 def apply_mastery_update(chat_id: str, concept_id: str, correct: bool) -> float:
-    records = load_mastery_records(chat_id)
-    rec = records.get(concept_id) or {"mastery": 0.0, "last_practiced": None}
-    last = None
-    if rec.get("last_practiced"):
-        try:
-            last = datetime.fromisoformat(str(rec["last_practiced"]).replace("Z", "+00:00"))
-        except Exception:
-            last = None
-    new_m = update_mastery(float(rec.get("mastery", 0.0)), correct, last_practiced=last)
-    records[concept_id] = {
-        "mastery": new_m,
-        "last_practiced": datetime.now(timezone.utc).isoformat(),
-        "attempts": int(rec.get("attempts", 0)) + 1,
-        "correct": int(rec.get("correct", 0)) + (1 if correct else 0),
-    }
-    save_mastery_records(chat_id, records)
-    return new_m
+    safe = _safe_id(chat_id)
+
+    def apply(rec: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        rec = rec or {"mastery": 0.0, "last_practiced": None}
+        last = None
+        if rec.get("last_practiced"):
+            try:
+                last = datetime.fromisoformat(str(rec["last_practiced"]).replace("Z", "+00:00"))
+            except Exception:
+                last = None
+        new_m = update_mastery(float(rec.get("mastery", 0.0)), correct, last_practiced=last)
+        return {
+            "mastery": new_m,
+            "last_practiced": datetime.now(timezone.utc).isoformat(),
+            "attempts": int(rec.get("attempts", 0)) + 1,
+            "correct": int(rec.get("correct", 0)) + (1 if correct else 0),
+            "_chat": safe,
+            "_concept": concept_id,
+        }
+
+    return _mastery.update(_mastery_key(safe, concept_id), apply)["mastery"]
+
+
+def append_mastery_snapshot(chat_id: str, point: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Añade un punto a la serie temporal de mastery del chat (últimos HISTORY_POINTS)."""
+    def apply(data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        series = list((data or {}).get("series") or [])
+        series.append(point)
+        return {"series": series[-HISTORY_POINTS:]}
+
+    return _history.update(_safe_id(chat_id), apply)["series"]
+
+
+def save_session_stats(chat_id: str, user_id: str, payload: Dict[str, Any]) -> None:
+    """Snapshot de la última sesión de un usuario en un chat."""
+    _sessions.put(_session_key(chat_id, user_id), payload)
 
 
 def concepts_with_mastery(chat_id: str) -> List[Dict[str, Any]]:
@@ -1,6 +1,7 @@
 """
 FSRS simplificado (Fase 1) — fórmulas públicas del DSR model.
-Usa pesos por defecto de FSRS-4.5 (aprox.) para scheduling sin entrenar.
+Usa pesos por defecto de FSRS-4.5 (aprox.) para scheduling sin entrenar; todas las
+funciones aceptan w con los pesos ajustados de un usuario (ver core.fsrs_batch).
 """
 
 from __future__ import annotations
@@ -8,7 +9,7 @@ from __future__ import annotations
 import math
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Literal, Optional, Tuple
+from typing import Literal, Optional, Sequence, Tuple
 
 Rating = Literal[1, 2, 3, 4]  # Again, Hard, Good, Easy
 
@@ -45,45 +46,45 @@ def retrievability(elapsed_days: float, stability: float) -> float:
     return (1 + FACTOR * elapsed_days / (9 * stability)) ** DECAY
 
 
-def init_difficulty(grade: Rating) -> float:
-    d = W[4] - math.exp(W[5] * (grade - 1)) + 1
+def init_difficulty(grade: Rating, w: Sequence[float] = W) -> float:
+    d = w[4] - math.exp(w[5] * (grade - 1)) + 1
     return clamp(d, 1.0, 10.0)
 
 
-def init_stability(grade: Rating) -> float:
-    return max(W[grade - 1], 0.1)
+def init_stability(grade: Rating, w: Sequence[float] = W) -> float:
+    return max(w[grade - 1], 0.1)
 
 
-def next_difficulty(d: float, grade: Rating) -> float:
-    delta = -W[6] * (grade - 3)
+def next_difficulty(d: float, grade: Rating, w: Sequence[float] = W) -> float:
+    delta = -w[6] * (grade - 3)
     # linear damping
     next_d = d + delta * (10 - d) / 9
     # mean reversion toward D0(Easy≈4)
-    d0_easy = init_difficulty(4)
-    next_d = W[7] * d0_easy + (1 - W[7]) * next_d
+    d0_easy = init_difficulty(4, w)
+    next_d = w[7] * d0_easy + (1 - w[7]) * next_d
     return clamp(next_d, 1.0, 10.0)
 
 
-def next_recall_stability(d: float, s: float, r: float, grade: Rating) -> float:
-    hard_pen = W[15] if grade == 2 else 1.0
-    easy_bon = W[16] if grade == 4 else 1.0
+def next_recall_stability(d: float, s: float, r: float, grade: Rating, w: Sequence[float] = W) -> float:
+    hard_pen = w[15] if grade == 2 else 1.0
+    easy_bon = w[16] if grade == 4 else 1.0
     return s * (
         1
-        + math.exp(W[8])
+        + math.exp(w[8])
         * (11 - d)
-        * (s ** (-W[9]))
-        * (math.exp(W[10] * (1 - r)) - 1)
+        * (s ** (-w[9]))
+        * (math.exp(w[10] * (1 - r)) - 1)
         * hard_pen
         * easy_bon
     )
 
 
-def next_forget_stability(d: float, s: float, r: float) -> float:
+def next_forget_stability(d: float, s: float, r: float, w: Sequence[float] = W) -> float:
     return (
-        W[11]
-        * (d ** (-W[12]))
-        * (((s + 1) ** W[13]) - 1)
-        * math.exp(W[14] * (1 - r))
+        w[11]
+        * (d ** (-w[12]))
+        * (((s + 1) ** w[13]) - 1)
+        * math.exp(w[14] * (1 - r))
     )
 
 
@@ -97,10 +98,10 @@ def next_interval_days(stability: float, request_retention: float = 0.9) -> floa
     return max(1.0, t)
 
 
-def create_card(grade: Rating = 3, now: Optional[datetime] = None) -> FsrsState:
+def create_card(grade: Rating = 3, now: Optional[datetime] = None, w: Sequence[float] = W) -> FsrsState:
     now = now or datetime.now(timezone.utc)
-    s = init_stability(grade)
-    d = init_difficulty(grade)
+    s = init_stability(grade, w)
+    d = init_difficulty(grade, w)
     days = next_interval_days(s)
     return FsrsState(
         stability=round(s, 4),
@@ -116,6 +117,7 @@ def review(
     state: FsrsState,
     grade: Rating,
     now: Optional[datetime] = None,
+    w: Sequence[float] = W,
 ) -> FsrsState:
     now = now or datetime.now(timezone.utc)
     last = state.last_review or now
@@ -123,15 +125,15 @@ def review(
         last = last.replace(tzinfo=timezone.utc)
     elapsed = max(0.0, (now - last).total_seconds() / 86400.0)
     r = retrievability(elapsed, state.stability)
-    d = next_difficulty(state.difficulty, grade)
+    d = next_difficulty(state.difficulty, grade, w)
 
     if grade == 1:
-        s = next_forget_stability(d, state.stability, r)
+        s = next_forget_stability(d, state.stability, r, w)
         lapses = state.lapses + 1
         # relearning: due soon
         days = min(1.0, next_interval_days(s))
     else:
-        s = next_recall_stability(d, state.stability, r, grade)
+        s = next_recall_stability(d, state.stability, r, grade, w)
         lapses = state.lapses
         days = next_interval_days(s)
         if grade == 2:
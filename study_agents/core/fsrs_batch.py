@@ -0,0 +1,359 @@
+"""
+FSRS vectorizado (NumPy): las mismas fórmulas que core.fsrs aplicadas a miles de
+tarjetas a la vez.
+- Retrievability, intervalos y siguiente estado en lote.
+- Previsión de vencimientos (próximos N días) y simulación de carga de repaso.
+- Optimizador de pesos por usuario a partir del historial de revisiones.
+Los pesos pueden ser un vector (19,) o una pila (19, P, 1): así el optimizador evalúa
+todas las perturbaciones del gradiente en una sola pasada.
+numpy es opcional: sin él core.fsrs sigue funcionando y aquí se lanza RuntimeError.
+"""
+
+from __future__ import annotations
+
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from core.fsrs import DECAY, FACTOR, W
+
+NUMPY_AVAILABLE = np is not None
+
+# Revisiones mínimas (con intervalo > 0) para ajustar pesos de un usuario
+OPTIMIZER_MIN_REVIEWS = max(1, int(os.getenv("FSRS_OPTIMIZER_MIN_REVIEWS", "100")))
+OPTIMIZER_ITERATIONS = max(1, int(os.getenv("FSRS_OPTIMIZER_ITERATIONS", "150")))
+
+# Pesos que el optimizador ajusta: dificultad (w4-w7), recuerdo (w8-w10), olvido
+# (w11-w14) y penalización/bonus Hard/Easy (w15-w16). La estabilidad inicial (w0-w3)
+# no influye: el estado de partida de cada tarjeta viene del historial.
+FITTED_WEIGHTS = list(range(4, 17))
+WEIGHT_BOUNDS = [
+    (0.1, 100.0), (0.1, 100.0), (0.1, 100.0), (0.1, 100.0),
+    (1.0, 10.0), (0.001, 4.0), (0.001, 4.0), (0.001, 0.75),
+    (0.0, 4.5), (0.0, 0.8), (0.001, 3.5),
+    (0.001, 5.0), (0.001, 0.25), (0.001, 0.9), (0.0, 4.0),
+    (0.0, 1.0), (1.0, 6.0), (0.0, 2.0), (0.0, 2.0),
+]
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("numpy no está instalado. Instálalo con: pip install numpy")
+
+
+def _weights(w: Optional[Sequence[float]]) -> "np.ndarray":
+    return np.asarray(W if w is None else w, dtype=float)
+
+
+def _epoch_days(value: Optional[str], default: float) -> float:
+    if not value:
+        return default
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp() / 86400.0
+    except Exception:
+        return default
+
+
+# ---------------------------------------------------------------- fórmulas en lote
+
+
+def retrievability(elapsed_days: Any, stability: Any) -> "np.ndarray":
+    _require_numpy()
+    s = np.asarray(stability, dtype=float)
+    t = np.maximum(np.asarray(elapsed_days, dtype=float), 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (1 + FACTOR * t / (9 * s)) ** DECAY
+    return np.where(s > 0, r, 0.0)
+
+
+def next_interval_days(stability: Any, request_retention: float = 0.9) -> "np.ndarray":
+    """Días hasta que R caiga a request_retention (mínimo 1)"""
+    _require_numpy()
+    s = np.asarray(stability, dtype=float)
+    t = (s / FACTOR) * (request_retention ** (1 / DECAY) - 1) * 9
+    return np.where(s > 0, np.maximum(1.0, t), 1.0)
+
+
+def init_difficulty(grade: Any, w: Any) -> "np.ndarray":
+    return np.clip(w[4] - np.exp(w[5] * (np.asarray(grade) - 1)) + 1, 1.0, 10.0)
+
+
+def next_difficulty(d: Any, grade: Any, w: Any) -> "np.ndarray":
+    delta = -w[6] * (np.asarray(grade) - 3)
+    next_d = d + delta * (10 - d) / 9
+    next_d = w[7] * init_difficulty(4, w) + (1 - w[7]) * next_d
+    return np.clip(next_d, 1.0, 10.0)
+
+
+def next_recall_stability(d: Any, s: Any, r: Any, grade: Any, w: Any) -> "np.ndarray":
+    grade = np.asarray(grade)
+    hard_pen = np.where(grade == 2, w[15], 1.0)
+    easy_bon = np.where(grade == 4, w[16], 1.0)
+    return s * (
+        1
+        + np.exp(w[8])
+        * (11 - d)
+        * (s ** (-w[9]))
+        * (np.exp(w[10] * (1 - r)) - 1)
+        * hard_pen
+        * easy_bon
+    )
+
+
+def next_forget_stability(d: Any, s: Any, r: Any, w: Any) -> "np.ndarray":
+    return w[11] * (d ** (-w[12])) * (((s + 1) ** w[13]) - 1) * np.exp(w[14] * (1 - r))
+
+
+def review_batch(
+    stability: Any,
+    difficulty: Any,
+    elapsed_days: Any,
+    grades: Any,
+    w: Optional[Any] = None,
+    request_retention: float = 0.9,
+) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    """
+    Equivalente en lote de core.fsrs.review
+
+    Returns:
+        (estabilidad, dificultad, días hasta el siguiente repaso)
+    """
+    _require_numpy()
+    w = _weights(None) if w is None else (w if isinstance(w, np.ndarray) else _weights(w))
+    s = np.asarray(stability, dtype=float)
+    grades = np.asarray(grades)
+    r = retrievability(elapsed_days, s)
+    d = next_difficulty(np.asarray(difficulty, dtype=float), grades, w)
+
+    forget = grades == 1
+    recall_s = next_recall_stability(d, s, r, grades, w)
+    forget_s = next_forget_stability(d, s, r, w)
+    new_s = np.maximum(0.1, np.where(forget, forget_s, recall_s))
+
+    days = next_interval_days(np.where(forget, forget_s, recall_s), request_retention)
+    days = np.where(forget, np.minimum(1.0, days), days)
+    days = np.where(grades == 2, np.maximum(1.0, days * 1.2), days)
+    days = np.where(grades == 4, days * 1.3, days)
+    return new_s, d, days
+
+
+# ---------------------------------------------------------------- tarjetas
+
+
+def card_arrays(cards: List[Dict[str, Any]], now: Optional[datetime] = None) -> Dict[str, "np.ndarray"]:
+    """
+    Columnas de un conjunto de tarjetas de card_store, relativas a now:
+    stability, difficulty, elapsed_days (desde el último repaso) y
+    due_in_days (negativo = atrasada).
+    """
+    _require_numpy()
+    now_days = (now or datetime.now(timezone.utc)).timestamp() / 86400.0
+    stability = np.fromiter((float(c.get("stability") or 1.0) for c in cards), dtype=float, count=len(cards))
+    difficulty = np.fromiter((float(c.get("difficulty") or 5.0) for c in cards), dtype=float, count=len(cards))
+    due = np.fromiter((_epoch_days(c.get("due_date"), now_days) for c in cards), dtype=float, count=len(cards))
+    last = np.fromiter((_epoch_days(c.get("last_review"), now_days) for c in cards), dtype=float, count=len(cards))
+    return {
+        "stability": stability,
+        "difficulty": difficulty,
+        "elapsed_days": np.maximum(0.0, now_days - last),
+        "due_in_days": due - now_days,
+    }
+
+
+def forecast(
+    cards: List[Dict[str, Any]],
+    days: int = 7,
+    now: Optional[datetime] = None,
+    request_retention: float = 0.9,
+) -> Dict[str, Any]:
+    """
+    Vencimientos de los próximos días sin repasar nada: cuántas tarjetas están
+    pendientes ya y cuántas vencen cada día, más la retrievability actual.
+    """
+    _require_numpy()
+    now = now or datetime.now(timezone.utc)
+    cols = card_arrays(cards, now)
+    day_index = np.ceil(cols["due_in_days"]).astype(int)
+    upcoming = day_index[(day_index >= 1) & (day_index <= days)]
+    per_day = np.bincount(upcoming, minlength=days + 1)[1:days + 1]
+    overdue = int(np.count_nonzero(day_index <= 0))
+    r = retrievability(cols["elapsed_days"], cols["stability"])
+    return {
+        "total": len(cards),
+        "due_now": overdue,
+        "due_by_day": [
+            {"day": k + 1, "date": (now + timedelta(days=k + 1)).date().isoformat(), "due": int(n)}
+            for k, n in enumerate(per_day)
+        ],
+        "due_within": overdue + int(per_day.sum()),
+        "mean_retrievability": round(float(r.mean()), 4) if len(cards) else None,
+        "below_target": int(np.count_nonzero(r < request_retention)),
+    }
+
+
+def simulate_workload(
+    cards: List[Dict[str, Any]],
+    days: int = 30,
+    now: Optional[datetime] = None,
+    grade: int = 3,
+    w: Optional[Sequence[float]] = None,
+    request_retention: float = 0.9,
+) -> List[Dict[str, Any]]:
+    """
+    Repasos por día si cada tarjeta se repasa el día que vence con la nota grade:
+    a diferencia de forecast cuenta también los repasos que generan los repasos.
+    El día 0 es hoy (incluye las atrasadas).
+    """
+    _require_numpy()
+    now = now or datetime.now(timezone.utc)
+    weights = _weights(w)
+    cols = card_arrays(cards, now)
+    s, d, due = cols["stability"], cols["difficulty"], cols["due_in_days"]
+    last = -cols["elapsed_days"]
+    result = []
+    for day in range(days + 1):
+        mask = due <= day
+        reviews = int(np.count_nonzero(mask))
+        if reviews:
+            new_s, new_d, interval = review_batch(
+                s[mask], d[mask], day - last[mask], np.full(reviews, grade), weights, request_retention
+            )
+            s[mask], d[mask] = new_s, new_d
+            last[mask] = day
+            due[mask] = day + interval
+        result.append({
+            "day": day,
+            "date": (now + timedelta(days=day)).date().isoformat(),
+            "reviews": reviews,
+        })
+    return result
+
+
+# ---------------------------------------------------------------- optimizador
+
+
+def _pack_histories(histories: List[List[Dict[str, Any]]]) -> Dict[str, "np.ndarray"]:
+    """Historiales [{elapsed_days, rating, stability, difficulty}] -> matrices (tarjetas, pasos)"""
+    histories = [h for h in histories if h]
+    steps = max((len(h) for h in histories), default=0)
+    n = len(histories)
+    elapsed = np.zeros((n, steps))
+    grades = np.full((n, steps), 3)
+    mask = np.zeros((n, steps), dtype=bool)
+    for i, history in enumerate(histories):
+        for j, entry in enumerate(history):
+            elapsed[i, j] = max(0.0, float(entry.get("elapsed_days") or 0.0))
+            grades[i, j] = int(entry["rating"])
+            mask[i, j] = True
+    return {
+        "s0": np.array([float(h[0].get("stability") or 1.0) for h in histories]),
+        "d0": np.array([float(h[0].get("difficulty") or 5.0) for h in histories]),
+        "elapsed": elapsed,
+        "grades": grades,
+        # Solo puntúan los repasos con tiempo transcurrido: con t=0 R=1 siempre
+        "scored": mask & (elapsed > 0),
+        "mask": mask,
+    }
+
+
+def _replay_loss(w: "np.ndarray", packed: Dict[str, "np.ndarray"]) -> "np.ndarray":
+    """Log-loss media de R frente a recordado (rating > 1); una por cada juego de pesos de w"""
+    s = packed["s0"]
+    d = packed["d0"]
+    total = 0.0
+    for j in range(packed["elapsed"].shape[1]):
+        elapsed = packed["elapsed"][:, j]
+        grades = packed["grades"][:, j]
+        r = np.clip(retrievability(elapsed, s), 1e-4, 1 - 1e-4)
+        recalled = grades > 1
+        total = total + np.sum(
+            np.where(packed["scored"][:, j], -np.where(recalled, np.log(r), np.log(1 - r)), 0.0), axis=-1
+        )
+        new_s, new_d, _ = review_batch(s, d, elapsed, grades, w)
+        active = packed["mask"][:, j]
+        s = np.where(active, new_s, s)
+        d = np.where(active, new_d, d)
+    return total / max(1, int(packed["scored"].sum()))
+
+
+def optimize_weights(
+    histories: List[List[Dict[str, Any]]],
+    w: Optional[Sequence[float]] = None,
+    iterations: int = OPTIMIZER_ITERATIONS,
+    learning_rate: float = 0.02,
+    regularization: float = 0.01,
+) -> Dict[str, Any]:
+    """
+    Ajusta los pesos FSRS a un historial de revisiones (una lista por tarjeta, en orden).
+    Descenso tipo Adam con gradiente por diferencias centradas: todas las
+    perturbaciones se evalúan en la misma pasada vectorizada. Una penalización L2
+    hacia los pesos de partida evita sobreajustar historiales cortos.
+
+    Args:
+        histories: [[{elapsed_days, rating (1-4), stability, difficulty}, ...], ...];
+            stability/difficulty del primer repaso son el estado de partida
+        w: Pesos de partida (por defecto los de core.fsrs)
+
+    Returns:
+        {weights, loss_before, loss_after, reviews, cards, improved}
+
+    Raises:
+        ValueError: si no hay revisiones suficientes
+    """
+    _require_numpy()
+    packed = _pack_histories(histories)
+    reviews = int(packed["scored"].sum())
+    if reviews < OPTIMIZER_MIN_REVIEWS:
+        raise ValueError(
+            f"Se necesitan al menos {OPTIMIZER_MIN_REVIEWS} revisiones para ajustar los pesos (hay {reviews})"
+        )
+
+    start = _weights(w)
+    lower = np.array([lo for lo, _ in WEIGHT_BOUNDS])
+    upper = np.array([hi for _, hi in WEIGHT_BOUNDS])
+    idx = np.array(FITTED_WEIGHTS)
+    scale = np.maximum(np.abs(start[idx]), 0.1)
+    eps = scale * 1e-3
+
+    def objective(stack: "np.ndarray") -> "np.ndarray":
+        penalty = regularization * np.sum(((stack[idx] - start[idx, None]) / scale[:, None]) ** 2, axis=0)
+        return _replay_loss(stack[:, :, None], packed) + penalty
+
+    current = start.copy()
+    m = np.zeros(len(idx))
+    v = np.zeros(len(idx))
+    loss_before = float(_replay_loss(start, packed))
+    for step in range(1, iterations + 1):
+        # Columna 0: pesos actuales; luego +eps y -eps de cada peso ajustado
+        stack = np.repeat(current[:, None], 2 * len(idx) + 1, axis=1)
+        for k, i in enumerate(idx):
+            stack[i, 1 + 2 * k] += eps[k]
+            stack[i, 2 + 2 * k] -= eps[k]
+        stack = np.clip(stack, lower[:, None], upper[:, None])
+        losses = objective(stack)
+        grad = (losses[1::2] - losses[2::2]) / (2 * eps)
+        m = 0.9 * m + 0.1 * grad
+        v = 0.999 * v + 0.001 * grad ** 2
+        m_hat = m / (1 - 0.9 ** step)
+        v_hat = v / (1 - 0.999 ** step)
+        current[idx] -= learning_rate * scale * m_hat / (np.sqrt(v_hat) + 1e-8)
+        current = np.clip(current, lower, upper)
+
+    loss_after = float(_replay_loss(current, packed))
+    improved = loss_after < loss_before
+    return {
+        "weights": [round(float(x), 4) for x in (current if improved else start)],
+        "loss_before": round(loss_before, 5),
+        "loss_after": round(loss_after if improved else loss_before, 5),
+        "reviews": reviews,
+        "cards": len(packed["s0"]),
+        "improved": improved,
+    }
@@ -1,41 +1,227 @@
 """
 Sistema de almacenamiento de Cursos/Exámenes
-Guarda los cursos creados por usuarios y las inscripciones
+Guarda los cursos creados por usuarios y las inscripciones en la base de datos
+embebida (storage_engine): una fila por curso, por inscripción y por review.
+Los JSON antiguos (all_courses.json, enrollments/<user>.json, reviews.json) se migran solos.
+Las lecturas del catálogo (get_course, list_courses...) salen de una caché en memoria
+(CourseCatalog) con índices por creador, activo y examen.
 """
 
+import copy
 import json
 import os
 import shutil
-from typing import List, Dict, Optional
+import sys
+import threading
+import time
+from typing import List, Dict, Optional, Set
 from datetime import datetime
 from pathlib import Path
 
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, transaction
+import data_paths
+
 # Directorio para almacenar cursos
-COURSES_DIR = Path("courses")
-COURSES_DIR.mkdir(exist_ok=True)
+COURSES_DIR = data_paths.COURSES_DIR
+COURSES_DIR.mkdir(parents=True, exist_ok=True)
 
 # Archivo principal de cursos (todos los cursos públicos)
 COURSES_FILE = COURSES_DIR / "all_courses.json"
 
-# Directorio para inscripciones de usuarios
+# Directorio de inscripciones en JSON (formato antiguo, solo para la migración)
 ENROLLMENTS_DIR = COURSES_DIR / "enrollments"
-ENROLLMENTS_DIR.mkdir(exist_ok=True)
 
 # Directorio para PDFs de cursos (guardados permanentemente)
 COURSE_PDFS_DIR = COURSES_DIR / "course_pdfs"
 COURSE_PDFS_DIR.mkdir(exist_ok=True)
 
 
+# Archivo de reviews (formato JSON antiguo, solo para la migración)
+REVIEWS_FILE = COURSES_DIR / "reviews.json"
+
+# Cada cuánto se comprueba si otro proceso ha modificado el catálogo (las escrituras
+# de este proceso invalidan la caché al instante)
+CATALOG_REFRESH_SECONDS = float(os.getenv("COURSE_CATALOG_REFRESH_SECONDS", "1.0"))
+
+
 def get_courses_file() -> Path:
-    """Obtiene la ruta del archivo de cursos"""
+    """Obtiene la ruta del archivo de cursos (formato JSON antiguo)"""
     return COURSES_FILE
 
 
 def get_enrollment_file(user_id: str) -> Path:
-    """Obtiene la ruta del archivo de inscripciones de un usuario"""
+    """Obtiene la ruta del archivo de inscripciones de un usuario (formato JSON antiguo)"""
     return ENROLLMENTS_DIR / f"{user_id}.json"
 
 
+def _read_json(path: Path) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error al leer {path}: {e}")
+        return {}
+
+
+def _legacy_courses():
+    if COURSES_FILE.exists():
+        yield from _read_json(COURSES_FILE).items()
+
+
+def _legacy_enrollments():
+    for enrollment_file in ENROLLMENTS_DIR.glob("*.json"):
+        for course_id, enrollment in _read_json(enrollment_file).items():
+            enrollment.setdefault("user_id", enrollment_file.stem)
+            enrollment.setdefault("course_id", course_id)
+            yield _enrollment_key(enrollment["user_id"], course_id), enrollment
+
+
+def _legacy_reviews():
+    if REVIEWS_FILE.exists():
+        for course_id, reviews in _read_json(REVIEWS_FILE).items():
+            for review in reviews:
+                review["course_id"] = course_id
+                yield _review_key(course_id, review.get("user_id", "")), review
+
+
+def _enrollment_key(user_id: str, course_id: str) -> str:
+    return f"{user_id}/{course_id}"
+
+
+def _review_key(course_id: str, user_id: str) -> str:
+    return f"{course_id}/{user_id}"
+
+
+_courses = Repository(
+    "courses",
+    indexes={
+        "user_id": "creator_id",
+        "status": lambda course: "active" if course.get("is_active", True) else "inactive",
+    },
+    legacy=_legacy_courses,
+    legacy_sources=[COURSES_FILE],
+    versioned=True,
+)
+_enrollments = Repository(
+    "enrollments",
+    indexes={"user_id": "user_id", "course_id": "course_id"},
+    legacy=_legacy_enrollments,
+    legacy_sources=[ENROLLMENTS_DIR],
+)
+_reviews = Repository(
+    "course_reviews",
+    indexes={"course_id": "course_id", "user_id": "user_id"},
+    legacy=_legacy_reviews,
+    legacy_sources=[REVIEWS_FILE],
+)
+
+
+def _course_info(course_id: str, course_data: Dict) -> Dict:
+    """Proyección pública de un curso para los listados (sin información sensible)"""
+    return {
+        "course_id": course_id,
+        "creator_id": course_data.get("creator_id"),
+        "title": course_data.get("title"),
+        "description": course_data.get("description"),
+        "price": course_data.get("price"),
+        "max_duration_days": course_data.get("max_duration_days"),
+        "cover_image": course_data.get("cover_image"),
+        "is_exam": course_data.get("is_exam", False),
+        "topics": course_data.get("topics", []),
+        "available_tools": course_data.get("available_tools", {}),
+        "enrollment_count": course_data.get("enrollment_count", 0),
+        "satisfaction_rating": course_data.get("satisfaction_rating"),
+        "satisfaction_count": course_data.get("satisfaction_count", 0),
+        "created_at": course_data.get("created_at"),
+        "updated_at": course_data.get("updated_at")
+    }
+
+
+def _course_context(course_data: Dict) -> Dict:
+    """Proyección mínima que usan los agentes como contexto del curso"""
+    topics = course_data.get("topics", [])
+    return {
+        "title": course_data.get("title", ""),
+        "description": course_data.get("description", ""),
+        "topics": [t.get("name", "") for t in topics],
+        "subtopics": {
+            t.get("name", ""): [st.get("name", "") for st in t.get("subtopics", [])]
+            for t in topics
+            if t.get("name", "")
+        },
+    }
+
+
+class _CatalogSnapshot:
+    """Catálogo inmutable: cursos, índices secundarios y proyecciones precalculadas"""
+
+    def __init__(self, version: int, courses: Dict[str, Dict]):
+        self.version = version
+        self.courses = courses
+        self.by_creator: Dict[str, Set[str]] = {}
+        self.active: Set[str] = set()
+        self.exams: Set[str] = set()
+        self.infos: Dict[str, Dict] = {}
+        self.contexts: Dict[str, Dict] = {}
+        for course_id, course_data in courses.items():
+            self.by_creator.setdefault(course_data.get("creator_id"), set()).add(course_id)
+            if course_data.get("is_active", True):
+                self.active.add(course_id)
+            if course_data.get("is_exam", False):
+                self.exams.add(course_id)
+            self.infos[course_id] = _course_info(course_id, course_data)
+            self.contexts[course_id] = _course_context(course_data)
+        # Orden de los listados: más reciente primero
+        self.ordered = sorted(
+            courses, key=lambda course_id: self.infos[course_id].get("created_at") or "", reverse=True
+        )
+
+
+class CourseCatalog:
+    """
+    Caché en memoria del catálogo de cursos.
+    Se invalida al confirmar cualquier escritura de este proceso (write-through) y
+    comprueba el contador de versión de la base de datos como mucho cada
+    CATALOG_REFRESH_SECONDS para ver cambios de otros procesos.
+    """
+
+    def __init__(self, repository: Repository, refresh_seconds: float = CATALOG_REFRESH_SECONDS):
+        self._repository = repository
+        self._refresh_seconds = refresh_seconds
+        self._snapshot: Optional[_CatalogSnapshot] = None
+        self._checked_at = 0.0
+        self._dirty = True
+        self._lock = threading.Lock()
+        repository.on_change(self.invalidate)
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def snapshot(self) -> _CatalogSnapshot:
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and not self._dirty
+            and time.monotonic() - self._checked_at < self._refresh_seconds
+        ):
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            self._dirty = False
+            version = self._repository.version()
+            if snapshot is None or snapshot.version != version:
+                snapshot = _CatalogSnapshot(version, self._repository.all())
+                self._snapshot = snapshot
+            self._checked_at = time.monotonic()
+            return snapshot
+
+
+_catalog = CourseCatalog(_courses)
+
+
 def create_course(
     creator_id: str,
     title: str,
@@ -178,14 +364,8 @@ def create_course(
         "is_active": True
     }
     
-    # Cargar cursos existentes
-    all_courses = load_all_courses()
-    
     # Añadir o actualizar curso
-    all_courses[course_id] = course_data
-    
-    # Guardar
-    save_all_courses(all_courses)
+    _courses.put(course_id, course_data)
     
     return course_data
 
@@ -210,76 +390,75 @@ def calculate_revenue_split(price: float) -> Dict[str, float]:
 
 
 def load_all_courses() -> Dict[str, Dict]:
-    """Carga todos los cursos"""
-    if not COURSES_FILE.exists():
-        return {}
-    
+    """Carga todos los cursos (copia: el llamador puede modificarla)"""
     try:
-        with open(COURSES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return copy.deepcopy(_catalog.snapshot().courses)
     except Exception as e:
         print(f"Error al cargar cursos: {e}")
         return {}
 
 
 def save_all_courses(courses: Dict[str, Dict]):
-    """Guarda todos los cursos"""
-    with open(COURSES_FILE, "w", encoding="utf-8") as f:
-        json.dump(courses, f, ensure_ascii=False, indent=2)
+    """Guarda todos los cursos (solo se escriben los que han cambiado)"""
+    _courses.replace_all(courses)
+
+
+def save_course(course_id: str, course_data: Dict) -> Dict:
+    """Guarda un único curso"""
+    return _courses.put(course_id, course_data)
 
 
 def get_course(course_id: str) -> Optional[Dict]:
-    """Obtiene un curso por ID"""
-    all_courses = load_all_courses()
-    return all_courses.get(course_id)
+    """Obtiene un curso por ID (copia: el llamador puede modificarla)"""
+    course = _catalog.snapshot().courses.get(course_id)
+    return copy.deepcopy(course) if course is not None else None
+
+
+def get_course_context(course_id: str) -> Optional[Dict]:
+    """Título, descripción, temas y subtemas de un curso (proyección precalculada)"""
+    context = _catalog.snapshot().contexts.get(course_id)
+    return copy.deepcopy(context) if context is not None else None
+
+
+def count_courses() -> int:
+    """Número total de cursos"""
+    return len(_catalog.snapshot().courses)
 
 
-def list_courses(creator_id: Optional[str] = None, active_only: bool = True) -> List[Dict]:
+def list_courses(
+    creator_id: Optional[str] = None,
+    active_only: bool = True,
+    is_exam: Optional[bool] = None
+) -> List[Dict]:
     """
     Lista todos los cursos
     
     Args:
         creator_id: Si se proporciona, filtra por creador
         active_only: Si es True, solo muestra cursos activos
+        is_exam: Si se proporciona, filtra exámenes (True) o cursos (False)
         
     Returns:
         Lista de cursos
     """
-    all_courses = load_all_courses()
-    
-    courses_list = []
-    for course_id, course_data in all_courses.items():
-        if active_only and not course_data.get("is_active", True):
-            continue
-        
-        if creator_id and course_data.get("creator_id") != creator_id:
-            continue
-        
-        # Preparar datos para respuesta (sin información sensible)
-        course_info = {
-            "course_id": course_id,
-            "creator_id": course_data.get("creator_id"),
-            "title": course_data.get("title"),
-            "description": course_data.get("description"),
-            "price": course_data.get("price"),
-            "max_duration_days": course_data.get("max_duration_days"),
-            "cover_image": course_data.get("cover_image"),
-            "is_exam": course_data.get("is_exam", False),
-            "topics": course_data.get("topics", []),
-            "available_tools": course_data.get("available_tools", {}),
-            "enrollment_count": course_data.get("enrollment_count", 0),
-            "satisfaction_rating": course_data.get("satisfaction_rating"),
-            "satisfaction_count": course_data.get("satisfaction_count", 0),
-            "created_at": course_data.get("created_at"),
-            "updated_at": course_data.get("updated_at")
-        }
-        
-        courses_list.append(course_info)
-    
-    # Ordenar por fecha de creación (más reciente primero)
-    courses_list.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    
-    return courses_list
+    snapshot = _catalog.snapshot()
+    
+    # Intersección de índices en lugar de recorrer todos los cursos
+    matching: Optional[Set[str]] = None
+    if creator_id:
+        matching = snapshot.by_creator.get(creator_id, set())
+    if active_only:
+        matching = snapshot.active if matching is None else matching & snapshot.active
+    if is_exam is not None:
+        exams = snapshot.exams if is_exam else set(snapshot.courses) - snapshot.exams
+        matching = exams if matching is None else matching & exams
+    
+    # Proyecciones precalculadas, ya ordenadas (más reciente primero)
+    return [
+        dict(snapshot.infos[course_id])
+        for course_id in snapshot.ordered
+        if matching is None or course_id in matching
+    ]
 
 
 def enroll_user(user_id: str, course_id: str, exam_date: Optional[str] = None, skip_payment: bool = False) -> Dict:
@@ -302,17 +481,16 @@ def enroll_user(user_id: str, course_id: str, exam_date: Optional[str] = None, s
     if not course:
         raise ValueError(f"Curso {course_id} no encontrado")
     
-    # Cargar inscripciones del usuario
-    enrollment_file = get_enrollment_file(user_id)
-    enrollments = {}
-    
-    if enrollment_file.exists():
-        with open(enrollment_file, "r", encoding="utf-8") as f:
-            enrollments = json.load(f)
-    
+    # Pago, inscripción y contador van en la misma transacción
+    with transaction():
+        return _enroll_user(user_id, course_id, course, exam_date, skip_payment)
+
+
+def _enroll_user(user_id: str, course_id: str, course: Dict, exam_date: Optional[str], skip_payment: bool) -> Dict:
     # Verificar si ya está inscrito
-    if course_id in enrollments:
-        return enrollments[course_id]
+    existing = _enrollments.get(_enrollment_key(user_id, course_id))
+    if existing is not None:
+        return existing
     
     # Procesar pago si el curso es de pago
     course_price = course.get("price", 0)
@@ -394,48 +572,34 @@ def enroll_user(user_id: str, course_id: str, exam_date: Optional[str] = None, s
         enrollment["topic_progress"][topic_name] = 0
         enrollment["flashcard_responses"][topic_name] = []
     
-    enrollments[course_id] = enrollment
-    
     # Guardar inscripción
-    with open(enrollment_file, "w", encoding="utf-8") as f:
-        json.dump(enrollments, f, ensure_ascii=False, indent=2)
+    _enrollments.put(_enrollment_key(user_id, course_id), enrollment)
     
     # Actualizar contador de inscripciones del curso
-    all_courses = load_all_courses()
-    if course_id in all_courses:
-        all_courses[course_id]["enrollment_count"] = all_courses[course_id].get("enrollment_count", 0) + 1
-        save_all_courses(all_courses)
+    def increment(course_data: Optional[Dict]) -> Optional[Dict]:
+        if course_data is not None:
+            course_data["enrollment_count"] = course_data.get("enrollment_count", 0) + 1
+        return course_data
+    
+    _courses.update(course_id, increment)
     
     return enrollment
 
 
 def get_user_enrollment(user_id: str, course_id: str) -> Optional[Dict]:
     """Obtiene la inscripción de un usuario en un curso"""
-    enrollment_file = get_enrollment_file(user_id)
-    
-    if not enrollment_file.exists():
-        return None
-    
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
-    
-    return enrollments.get(course_id)
+    return _enrollments.get(_enrollment_key(user_id, course_id))
 
 
 def get_user_enrollments(user_id: str) -> List[Dict]:
     """Obtiene todos los cursos en los que está inscrito un usuario"""
-    enrollment_file = get_enrollment_file(user_id)
-    
-    if not enrollment_file.exists():
-        return []
-    
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
+    enrollments = _enrollments.find(user_id=user_id)
+    courses = _courses.get_many(e.get("course_id") for e in enrollments)
     
     # Obtener información completa de cada curso
     enrolled_courses = []
-    for course_id, enrollment_data in enrollments.items():
-        course = get_course(course_id)
+    for enrollment_data in enrollments:
+        course = courses.get(enrollment_data.get("course_id"))
         if course:
             enrolled_courses.append({
                 "course": course,
@@ -447,26 +611,15 @@ def get_user_enrollments(user_id: str) -> List[Dict]:
 
 def update_enrollment(user_id: str, course_id: str, updates: Dict) -> Optional[Dict]:
     """Actualiza la inscripción de un usuario"""
-    enrollment_file = get_enrollment_file(user_id)
-    
-    if not enrollment_file.exists():
-        return None
-    
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
-    
-    if course_id not in enrollments:
-        return None
-    
-    # Actualizar campos
-    enrollments[course_id].update(updates)
-    enrollments[course_id]["updated_at"] = datetime.now().isoformat()
-    
-    # Guardar
-    with open(enrollment_file, "w", encoding="utf-8") as f:
-        json.dump(enrollments, f, ensure_ascii=False, indent=2)
+    def apply(enrollment: Optional[Dict]) -> Optional[Dict]:
+        if enrollment is None:
+            return None
+        # Actualizar campos
+        enrollment.update(updates)
+        enrollment["updated_at"] = datetime.now().isoformat()
+        return enrollment
     
-    return enrollments[course_id]
+    return _enrollments.update(_enrollment_key(user_id, course_id), apply)
 
 
 def unenroll_user(user_id: str, course_id: str) -> bool:
@@ -480,57 +633,47 @@ def unenroll_user(user_id: str, course_id: str) -> bool:
     Returns:
         True si se desapuntó correctamente, False si no estaba inscrito
     """
-    enrollment_file = get_enrollment_file(user_id)
-    
-    if not enrollment_file.exists():
-        return False
-    
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
-    
-    if course_id not in enrollments:
-        return False
-    
-    # Eliminar inscripción
-    del enrollments[course_id]
-    
-    # Guardar
-    with open(enrollment_file, "w", encoding="utf-8") as f:
-        json.dump(enrollments, f, ensure_ascii=False, indent=2)
-    
-    # Actualizar contador de inscripciones del curso
-    all_courses = load_all_courses()
-    if course_id in all_courses:
-        current_count = all_courses[course_id].get("enrollment_count", 0)
-        if current_count > 0:
-            all_courses[course_id]["enrollment_count"] = current_count - 1
-        save_all_courses(all_courses)
+    with transaction():
+        # Eliminar inscripción
+        if not _enrollments.delete(_enrollment_key(user_id, course_id)):
+            return False
+        
+        # Actualizar contador de inscripciones del curso
+        def decrement(course_data: Optional[Dict]) -> Optional[Dict]:
+            if course_data is not None and course_data.get("enrollment_count", 0) > 0:
+                course_data["enrollment_count"] -= 1
+                return course_data
+            return None
+        
+        _courses.update(course_id, decrement)
     
     return True
 
 
 def add_xp(user_id: str, course_id: str, xp_amount: int) -> Dict:
     """Añade XP a un usuario en un curso"""
-    enrollment = get_user_enrollment(user_id, course_id)
-    if not enrollment:
-        raise ValueError(f"Usuario {user_id} no está inscrito en curso {course_id}")
-    
-    current_xp = enrollment.get("xp", 0)
-    new_xp = current_xp + xp_amount
-    
-    return update_enrollment(user_id, course_id, {"xp": new_xp})
+    with transaction():
+        enrollment = get_user_enrollment(user_id, course_id)
+        if not enrollment:
+            raise ValueError(f"Usuario {user_id} no está inscrito en curso {course_id}")
+        
+        current_xp = enrollment.get("xp", 0)
+        new_xp = current_xp + xp_amount
+        
+        return update_enrollment(user_id, course_id, {"xp": new_xp})
 
 
 def update_topic_progress(user_id: str, course_id: str, topic_name: str, percentage: float) -> Dict:
     """Actualiza el progreso de un tema"""
-    enrollment = get_user_enrollment(user_id, course_id)
-    if not enrollment:
-        raise ValueError(f"Usuario {user_id} no está inscrito en curso {course_id}")
-    
-    topic_progress = enrollment.get("topic_progress", {})
-    topic_progress[topic_name] = min(100, max(0, percentage))  # Asegurar 0-100
-    
-    return update_enrollment(user_id, course_id, {"topic_progress": topic_progress})
+    with transaction():
+        enrollment = get_user_enrollment(user_id, course_id)
+        if not enrollment:
+            raise ValueError(f"Usuario {user_id} no está inscrito en curso {course_id}")
+        
+        topic_progress = enrollment.get("topic_progress", {})
+        topic_progress[topic_name] = min(100, max(0, percentage))  # Asegurar 0-100
+        
+        return update_enrollment(user_id, course_id, {"topic_progress": topic_progress})
 
 
 def use_credits(user_id: str, course_id: str, amount: int) -> bool:
@@ -540,22 +683,23 @@ def use_credits(user_id: str, course_id: str, amount: int) -> bool:
     Returns:
         True si se pudieron usar los créditos, False si no hay suficientes
     """
-    enrollment = get_user_enrollment(user_id, course_id)
-    if not enrollment:
-        return False
-    
-    credits_remaining = enrollment.get("credits_remaining", 0)
-    
-    if credits_remaining < amount:
-        return False
-    
-    credits_remaining -= amount
-    credits_used = enrollment.get("credits_used", 0) + amount
-    
-    update_enrollment(user_id, course_id, {
-        "credits_remaining": credits_remaining,
-        "credits_used": credits_used
-    })
+    with transaction():
+        enrollment = get_user_enrollment(user_id, course_id)
+        if not enrollment:
+            return False
+        
+        credits_remaining = enrollment.get("credits_remaining", 0)
+        
+        if credits_remaining < amount:
+            return False
+        
+        credits_remaining -= amount
+        credits_used = enrollment.get("credits_used", 0) + amount
+        
+        update_enrollment(user_id, course_id, {
+            "credits_remaining": credits_remaining,
+            "credits_used": credits_used
+        })
     
     return True
 
@@ -567,20 +711,14 @@ def get_course_ranking(course_id: str, limit: int = 10) -> List[Dict]:
     Returns:
         Lista de usuarios ordenados por XP (mayor a menor)
     """
-    all_enrollments = []
-    
-    # Buscar en todos los archivos de inscripciones
-    for enrollment_file in ENROLLMENTS_DIR.glob("*.json"):
-        with open(enrollment_file, "r", encoding="utf-8") as f:
-            user_enrollments = json.load(f)
-            
-            if course_id in user_enrollments:
-                enrollment = user_enrollments[course_id]
-                all_enrollments.append({
-                    "user_id": enrollment.get("user_id"),
-                    "xp": enrollment.get("xp", 0),
-                    "enrolled_at": enrollment.get("enrolled_at")
-                })
+    all_enrollments = [
+        {
+            "user_id": enrollment.get("user_id"),
+            "xp": enrollment.get("xp", 0),
+            "enrolled_at": enrollment.get("enrolled_at")
+        }
+        for enrollment in _enrollments.find(course_id=course_id)
+    ]
     
     # Ordenar por XP (mayor a menor)
     all_enrollments.sort(key=lambda x: x.get("xp", 0), reverse=True)
@@ -608,63 +746,38 @@ def submit_satisfaction_feedback(user_id: str, course_id: str, rating: int, comm
     if not course:
         raise ValueError(f"Curso {course_id} no encontrado")
     
-    # Cargar o crear archivo de reviews
-    reviews_file = COURSES_DIR / "reviews.json"
-    if reviews_file.exists():
-        with open(reviews_file, "r", encoding="utf-8") as f:
-            all_reviews = json.load(f)
-    else:
-        all_reviews = {}
-    
-    # Inicializar reviews del curso si no existe
-    if course_id not in all_reviews:
-        all_reviews[course_id] = []
-    
-    # Verificar si el usuario ya hizo una review
-    existing_review_index = None
-    for i, review in enumerate(all_reviews[course_id]):
-        if review.get("user_id") == user_id:
-            existing_review_index = i
-            break
-    
-    # Crear nueva review
+    # Crear nueva review (sustituye a la anterior del mismo usuario)
     new_review = {
         "user_id": user_id,
+        "course_id": course_id,
         "rating": rating,
         "comment": comment or "",
         "created_at": datetime.now().isoformat(),
         "updated_at": datetime.now().isoformat()
     }
     
-    if existing_review_index is not None:
-        # Actualizar review existente
-        old_rating = all_reviews[course_id][existing_review_index].get("rating", rating)
-        all_reviews[course_id][existing_review_index] = new_review
-    else:
-        # Añadir nueva review
-        all_reviews[course_id].append(new_review)
-    
-    # Guardar reviews
-    with open(reviews_file, "w", encoding="utf-8") as f:
-        json.dump(all_reviews, f, ensure_ascii=False, indent=2)
-    
-    # Actualizar satisfacción del curso
-    all_courses = load_all_courses()
-    if course_id in all_courses:
-        reviews = all_reviews.get(course_id, [])
-        if reviews:
-            total_rating = sum(r.get("rating", 0) for r in reviews)
-            new_count = len(reviews)
-            new_rating = total_rating / new_count
-        else:
-            new_rating = None
-            new_count = 0
+    with transaction():
+        _reviews.put(_review_key(course_id, user_id), new_review)
         
-        all_courses[course_id]["satisfaction_rating"] = new_rating
-        all_courses[course_id]["satisfaction_count"] = new_count
-        save_all_courses(all_courses)
-    
-    return get_course(course_id)
+        # Actualizar satisfacción del curso
+        reviews = _reviews.find(course_id=course_id)
+        
+        def apply(course_data: Optional[Dict]) -> Optional[Dict]:
+            if course_data is None:
+                return None
+            if reviews:
+                total_rating = sum(r.get("rating", 0) for r in reviews)
+                new_count = len(reviews)
+                new_rating = total_rating / new_count
+            else:
+                new_rating = None
+                new_count = 0
+            
+            course_data["satisfaction_rating"] = new_rating
+            course_data["satisfaction_count"] = new_count
+            return course_data
+        
+        return _courses.update(course_id, apply)
 
 
 def get_course_reviews(course_id: str, limit: int = 50) -> List[Dict]:
@@ -678,14 +791,7 @@ def get_course_reviews(course_id: str, limit: int = 50) -> List[Dict]:
     Returns:
         Lista de reviews ordenadas por fecha (más recientes primero)
     """
-    reviews_file = COURSES_DIR / "reviews.json"
-    if not reviews_file.exists():
-        return []
-    
-    with open(reviews_file, "r", encoding="utf-8") as f:
-        all_reviews = json.load(f)
-    
-    reviews = all_reviews.get(course_id, [])
+    reviews = _reviews.find(course_id=course_id)
     # Ordenar por fecha (más recientes primero)
     reviews.sort(key=lambda x: x.get("created_at", ""), reverse=True)
     
@@ -693,6 +799,12 @@ def get_course_reviews(course_id: str, limit: int = 50) -> List[Dict]:
 
 
 def update_streak_and_credits(user_id: str, course_id: str) -> Dict:
+    """Actualiza la racha diaria (lectura y escritura de la inscripción en una transacción)"""
+    with transaction():
+        return _update_streak_and_credits(user_id, course_id)
+
+
+def _update_streak_and_credits(user_id: str, course_id: str) -> Dict:
     """
     Actualiza la racha diaria y marca créditos como disponibles para reclamar
     
@@ -708,24 +820,9 @@ def update_streak_and_credits(user_id: str, course_id: str) -> Dict:
             "today_claimed": bool  # Si ya se reclamaron los créditos de hoy
         }
     """
-    enrollment_file = get_enrollment_file(user_id)
-    
-    if not enrollment_file.exists():
-        return {
-            "streak_days": 0,
-            "credits_available": 0,
-            "credits_remaining": 0,
-            "max_credits": 0,
-            "is_new_streak": False,
-            "streak_calendar": {},
-            "pending_credits": 0,
-            "today_claimed": False
-        }
-    
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
+    enrollment = get_user_enrollment(user_id, course_id)
     
-    if course_id not in enrollments:
+    if enrollment is None:
         return {
             "streak_days": 0,
             "credits_available": 0,
@@ -737,7 +834,6 @@ def update_streak_and_credits(user_id: str, course_id: str) -> Dict:
             "today_claimed": False
         }
     
-    enrollment = enrollments[course_id]
     today = datetime.now().date().isoformat()
     last_connection = enrollment.get("last_connection_date")
     
@@ -868,8 +964,7 @@ def update_streak_and_credits(user_id: str, course_id: str) -> Dict:
     enrollment["streak_days"] = streak_days
     
     # Guardar cambios
-    with open(enrollment_file, "w", encoding="utf-8") as f:
-        json.dump(enrollments, f, ensure_ascii=False, indent=2)
+    _enrollments.put(_enrollment_key(user_id, course_id), enrollment)
     
     return {
         "streak_days": enrollment.get("streak_days", 0),
@@ -884,6 +979,12 @@ def update_streak_and_credits(user_id: str, course_id: str) -> Dict:
 
 
 def claim_daily_credits(user_id: str, course_id: str) -> Dict:
+    """Reclama los créditos diarios (lectura y escritura de la inscripción en una transacción)"""
+    with transaction():
+        return _claim_daily_credits(user_id, course_id)
+
+
+def _claim_daily_credits(user_id: str, course_id: str) -> Dict:
     """
     Reclama los créditos diarios disponibles
     
@@ -895,9 +996,9 @@ def claim_daily_credits(user_id: str, course_id: str) -> Dict:
             "message": str
         }
     """
-    enrollment_file = get_enrollment_file(user_id)
+    enrollment = get_user_enrollment(user_id, course_id)
     
-    if not enrollment_file.exists():
+    if enrollment is None:
         return {
             "success": False,
             "credits_claimed": 0,
@@ -905,18 +1006,6 @@ def claim_daily_credits(user_id: str, course_id: str) -> Dict:
             "message": "Inscripción no encontrada"
         }
     
-    with open(enrollment_file, "r", encoding="utf-8") as f:
-        enrollments = json.load(f)
-    
-    if course_id not in enrollments:
-        return {
-            "success": False,
-            "credits_claimed": 0,
-            "credits_remaining": 0,
-            "message": "Curso no encontrado"
-        }
-    
-    enrollment = enrollments[course_id]
     today = datetime.now().date().isoformat()
     
     print(f"[Claim Credits] Buscando créditos para hoy: {today}")
@@ -988,10 +1077,9 @@ def claim_daily_credits(user_id: str, course_id: str) -> Dict:
     print(f"  - Máximo: {max_credits}")
     
     # Guardar cambios
-    with open(enrollment_file, "w", encoding="utf-8") as f:
-        json.dump(enrollments, f, ensure_ascii=False, indent=2)
+    _enrollments.put(_enrollment_key(user_id, course_id), enrollment)
     
-    print(f"[Claim Credits] ✅ Archivo guardado correctamente")
+    print(f"[Claim Credits] ✅ Inscripción guardada correctamente")
     
     return {
         "success": True,
@@ -1000,3 +1088,12 @@ def claim_daily_credits(user_id: str, course_id: str) -> Dict:
         "message": f"¡Has reclamado {actual_credits_claimed} créditos!"
     }
 
+
+def list_enrolled_user_ids() -> List[str]:
+    """IDs de todos los usuarios con alguna inscripción"""
+    return _enrollments.index_values("user_id")
+
+
+def count_enrollments() -> int:
+    """Número total de inscripciones"""
+    return _enrollments.count()
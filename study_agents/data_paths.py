@@ -0,0 +1,24 @@
+"""
+Data Paths - Directorios de datos en disco compartidos por la API y los módulos *_storage
+La API se arranca con `cd api && uvicorn main:app` (Procfile, railway.json, dev:api),
+así que las rutas relativas de siempre (Path("courses"), Path("chats")...) vivían en
+study_agents/api/. DATA_DIR fija ese directorio sin depender del cwd del proceso
+(STUDY_AGENTS_DATA_DIR lo cambia). Los JSON antiguos se migran desde aquí.
+"""
+
+import os
+from pathlib import Path
+
+_module_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIR = Path(os.getenv("STUDY_AGENTS_DATA_DIR", str(_module_dir / "api"))).resolve()
+
+# Cursos: PDFs permanentes, imágenes generadas y JSON antiguos (catálogo, inscripciones, wallets...)
+COURSES_DIR = DATA_DIR / "courses"
+GENERATED_IMAGES_DIR = COURSES_DIR / "generated_images"
+# JSON antiguos (solo para la migración a storage_engine)
+CHATS_DIR = DATA_DIR / "chats"
+REDEEM_CODES_DIR = DATA_DIR / "redeem_codes"
+LEARNED_WORDS_DIR = DATA_DIR / "data" / "learned_words"
+# Las partidas siempre se guardaron junto al repositorio, no bajo el cwd de la API
+GAMES_DIR = _module_dir.parent / "courses" / "games"
@@ -0,0 +1,149 @@
+"""
+Execution Context - Estado de una petición que antes vivía en los agentes compartidos
+- Keys de proveedores de la petición (sustituye a set_request_provider_keys).
+- Modelo elegido por cada agente (self.llm, self.current_model_config): con
+  RequestScoped, asignarlos dentro de un contexto no toca la instancia compartida,
+  así un mismo StudyAgentsSystem atiende varias peticiones a la vez en el pool de hilos.
+- Contadores de uso (llamadas y tokens por modelo), alimentados por los callbacks
+  del router.
+El contexto viaja en una ContextVar: request_executor y los pools que copian el
+contexto (contextvars.copy_context) lo llevan a los hilos de trabajo. Fuera de un
+contexto (scripts, CLI) los agentes se comportan como antes.
+"""
+
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+_CURRENT: ContextVar[Optional["ExecutionContext"]] = ContextVar("execution_context", default=None)
+
+_stats_lock = threading.Lock()
+_active = 0
+_completed = 0
+_totals: Dict[str, Dict[str, int]] = {}
+
+
+class ExecutionContext:
+    """Keys, modelos enlazados y uso de una petición; seguro entre los hilos de esa petición"""
+
+    def __init__(self, provider_keys: Optional[Dict[str, str]] = None):
+        self.provider_keys: Dict[str, str] = {k: v for k, v in (provider_keys or {}).items() if v}
+        # (id del agente, atributo) -> (agente, valor); guardar el agente evita reusar su id
+        self._bindings: Dict[Tuple[int, str], Tuple[Any, Any]] = {}
+        self._usage: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, owner: Any, name: str, value: Any) -> None:
+        with self._lock:
+            self._bindings[(id(owner), name)] = (owner, value)
+
+    def lookup(self, owner: Any, name: str) -> Tuple[bool, Any]:
+        """(enlazado, valor) del atributo name de owner en esta petición"""
+        with self._lock:
+            entry = self._bindings.get((id(owner), name))
+        return (True, entry[1]) if entry is not None else (False, None)
+
+    def record_usage(self, model: str, input_tokens: int = 0, output_tokens: int = 0) -> None:
+        with self._lock:
+            usage = self._usage.setdefault(model, {"calls": 0, "inputTokens": 0, "outputTokens": 0})
+            usage["calls"] += 1
+            usage["inputTokens"] += input_tokens
+            usage["outputTokens"] += output_tokens
+
+    def usage(self) -> Dict[str, Any]:
+        """Totales y desglose por modelo de las llamadas hechas en esta petición"""
+        with self._lock:
+            by_model = {model: dict(u) for model, u in self._usage.items()}
+        return {
+            "calls": sum(u["calls"] for u in by_model.values()),
+            "inputTokens": sum(u["inputTokens"] for u in by_model.values()),
+            "outputTokens": sum(u["outputTokens"] for u in by_model.values()),
+            "models": by_model,
+        }
+
+
+def current_context() -> Optional[ExecutionContext]:
+    return _CURRENT.get()
+
+
+@contextmanager
+def execution_context(provider_keys: Optional[Dict[str, str]] = None) -> Iterator[ExecutionContext]:
+    """Abre un contexto nuevo para una petición (lo usa el middleware de la API)"""
+    global _active, _completed
+    context = ExecutionContext(provider_keys)
+    token = _CURRENT.set(context)
+    with _stats_lock:
+        _active += 1
+    try:
+        yield context
+    finally:
+        _CURRENT.reset(token)
+        with _stats_lock:
+            _active -= 1
+            _completed += 1
+            for model, usage in context.usage()["models"].items():
+                total = _totals.setdefault(model, {"calls": 0, "inputTokens": 0, "outputTokens": 0})
+                for field, value in usage.items():
+                    total[field] += value
+
+
+def set_provider_keys(keys: Optional[Dict[str, str]]) -> None:
+    """Keys de proveedores de la petición en curso (abre un contexto si no hay ninguno)"""
+    clean = {k: v for k, v in (keys or {}).items() if v}
+    context = _CURRENT.get()
+    if context is None:
+        _CURRENT.set(ExecutionContext(clean))
+    else:
+        context.provider_keys = clean
+
+
+def provider_keys() -> Dict[str, str]:
+    context = _CURRENT.get()
+    return dict(context.provider_keys) if context is not None else {}
+
+
+def record_usage(model: str, input_tokens: int = 0, output_tokens: int = 0) -> None:
+    context = _CURRENT.get()
+    if context is not None:
+        context.record_usage(model, input_tokens, output_tokens)
+
+
+class RequestScoped:
+    """
+    Descriptor para atributos que dependen de la petición (llm, current_model_config).
+    Dentro de un contexto de ejecución, asignar y leer usan el contexto; fuera, la
+    instancia. El valor de la instancia sirve de respaldo dentro de un contexto.
+    """
+
+    def __set_name__(self, owner, name: str) -> None:
+        self._name = name
+        self._attr = f"_{name}_default"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        context = _CURRENT.get()
+        if context is not None:
+            bound, value = context.lookup(obj, self._name)
+            if bound:
+                return value
+        return getattr(obj, self._attr, None)
+
+    def __set__(self, obj, value: Any) -> None:
+        context = _CURRENT.get()
+        if context is not None:
+            context.bind(obj, self._name, value)
+        else:
+            setattr(obj, self._attr, value)
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return {
+            "active": _active,
+            "completed": _completed,
+            "models": {model: dict(total) for model, total in _totals.items()},
+        }
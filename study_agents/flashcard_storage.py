@@ -1,23 +1,154 @@
 """
 Sistema de almacenamiento de respuestas de flashcards
-Implementa repetición espaciada (Spaced Repetition)
+Implementa repetición espaciada (Spaced Repetition).
+Cada flashcard respondida es una fila de la base de datos embebida (storage_engine),
+indexada por usuario+curso, tema y momento en que vuelve a tocar (next_due_at), que
+se calcula al responder. Así saber qué tarjetas se pueden mostrar es una consulta
+por rango sobre el índice, sin recorrer el historial de cada tarjeta.
+El historial se compacta: contadores de respuestas más las últimas
+FLASHCARD_RESPONSE_TAIL respuestas. Los JSON antiguos se migran solos.
 """
 
 import json
+import os
+import sys
+import threading
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
 from pathlib import Path
 
-# Directorio para almacenar respuestas de flashcards
-FLASHCARD_RESPONSES_DIR = Path("courses/flashcard_responses")
-FLASHCARD_RESPONSES_DIR.mkdir(parents=True, exist_ok=True)
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, get_engine, transaction
+import data_paths
+
+# Directorio de respuestas en JSON (formato antiguo, solo para la migración)
+FLASHCARD_RESPONSES_DIR = data_paths.COURSES_DIR / "flashcard_responses"
+# Respuestas individuales que se conservan por tarjeta (el resto queda en los contadores)
+FLASHCARD_RESPONSE_TAIL = max(1, int(os.getenv("FLASHCARD_RESPONSE_TAIL", "20")))
+
+# Espera tras un fallo y tras N aciertos consecutivos (N >= 3 usa el último valor)
+RETRY_AFTER_INCORRECT = timedelta(minutes=10)
+INTERVALS_AFTER_CORRECT = [timedelta(0), timedelta(hours=1), timedelta(days=1), timedelta(days=10)]
 
 
 def get_flashcard_responses_file(user_id: str, course_id: str) -> Path:
-    """Obtiene la ruta del archivo de respuestas de flashcards de un usuario en un curso"""
+    """Obtiene la ruta del archivo de respuestas de flashcards (formato JSON antiguo)"""
     return FLASHCARD_RESPONSES_DIR / f"{user_id}_{course_id}.json"
 
 
+def _owner(user_id: str, course_id: str) -> str:
+    return f"{user_id}/{course_id}"
+
+
+def _flashcard_key(user_id: str, course_id: str, flashcard_key: str) -> str:
+    return f"{_owner(user_id, course_id)}/{flashcard_key}"
+
+
+def _legacy_responses():
+    if not FLASHCARD_RESPONSES_DIR.exists():
+        return
+    for responses_file in FLASHCARD_RESPONSES_DIR.glob("*.json"):
+        # <user_id>_<course_id>.json; los IDs de curso empiezan por "course_"
+        user_id, sep, course_id = responses_file.stem.partition("_course_")
+        if sep:
+            course_id = f"course_{course_id}"
+        else:
+            user_id, _, course_id = responses_file.stem.rpartition("_")
+        try:
+            with open(responses_file, "r", encoding="utf-8") as f:
+                responses = json.load(f)
+        except Exception as e:
+            print(f"Error al leer {responses_file}: {e}")
+            continue
+        for flashcard_key, flashcard_data in responses.items():
+            record = {**flashcard_data, "user_id": user_id, "course_id": course_id}
+            yield _flashcard_key(user_id, course_id, flashcard_key), record
+
+
+def _next_due_at(flashcard_data: Dict) -> Optional[datetime]:
+    """Momento a partir del cual la tarjeta se puede volver a mostrar (None = ya)"""
+    last_response_at = flashcard_data.get("last_response_at")
+    responses_list = flashcard_data.get("responses") or []
+    if responses_list:
+        last_response_at = responses_list[-1].get("answered_at") or last_response_at
+    if not last_response_at:
+        return None
+    last_was_correct = flashcard_data.get("last_was_correct")
+    if last_was_correct is None:
+        last_was_correct = bool(responses_list and responses_list[-1].get("is_correct"))
+    if not last_was_correct:
+        wait = RETRY_AFTER_INCORRECT
+    else:
+        consecutive_correct = flashcard_data.get("consecutive_correct", 0)
+        wait = INTERVALS_AFTER_CORRECT[min(consecutive_correct, len(INTERVALS_AFTER_CORRECT) - 1)]
+    return datetime.fromisoformat(last_response_at) + wait
+
+
+def _due_index_value(moment: Optional[datetime]) -> str:
+    """Segundos epoch con ancho fijo: el orden de texto del índice es el orden temporal"""
+    return f"{int(moment.timestamp()) if moment else 0:012d}"
+
+
+def _compact(flashcard_data: Dict) -> Dict:
+    """Pasa el historial a contadores + cola acotada y precalcula next_due_at"""
+    responses_list = flashcard_data.get("responses") or []
+    if "total_responses" not in flashcard_data:
+        flashcard_data["total_responses"] = len(responses_list)
+        flashcard_data["correct_responses"] = sum(1 for r in responses_list if r.get("is_correct"))
+    if responses_list:
+        flashcard_data["last_was_correct"] = bool(responses_list[-1].get("is_correct"))
+    flashcard_data["responses"] = responses_list[-FLASHCARD_RESPONSE_TAIL:]
+    next_due = _next_due_at(flashcard_data)
+    flashcard_data["next_due_at"] = next_due.isoformat() if next_due else None
+    return flashcard_data
+
+
+_responses = Repository(
+    "flashcard_responses",
+    indexes={
+        "owner": lambda r: _owner(r.get("user_id"), r.get("course_id")),
+        "topic_name": "topic_name",
+        "next_due": lambda r: _due_index_value(
+            datetime.fromisoformat(r["next_due_at"]) if r.get("next_due_at") else _next_due_at(r)
+        ),
+    },
+    legacy=lambda: ((key, _compact(record)) for key, record in _legacy_responses()),
+    legacy_sources=[FLASHCARD_RESPONSES_DIR],
+)
+
+_schedule_ready = False
+_schedule_lock = threading.Lock()
+
+
+def _ensure_schedule() -> None:
+    """
+    Una sola vez: compacta y calcula next_due_at de las filas guardadas antes de
+    que existiera el índice (la migración de JSON ya las escribe compactadas).
+    """
+    global _schedule_ready
+    if _schedule_ready:
+        return
+    with _schedule_lock:
+        if _schedule_ready:
+            return
+        marker = "flashcard_responses:schedule_v1"
+        if get_engine().get_meta(marker) is None:
+            with transaction():
+                pending = [(key, record) for key, record in _responses.items() if "next_due_at" not in record]
+                for key, record in pending:
+                    _responses.put(key, _compact(record))
+                get_engine().set_meta(marker, datetime.now().isoformat())
+            if pending:
+                print(f"📦 Calendario de {len(pending)} flashcards precalculado")
+        _schedule_ready = True
+
+
+def _public(record: Dict) -> Dict:
+    return {k: v for k, v in record.items() if k not in ("user_id", "course_id")}
+
+
 def save_flashcard_response(
     user_id: str,
     course_id: str,
@@ -38,49 +169,47 @@ def save_flashcard_response(
     Returns:
         Datos de la respuesta guardada
     """
-    responses_file = get_flashcard_responses_file(user_id, course_id)
-    
-    # Cargar respuestas existentes
-    if responses_file.exists():
-        with open(responses_file, "r", encoding="utf-8") as f:
-            responses = json.load(f)
-    else:
-        responses = {}
-    
     # Crear clave única para la flashcard (topic + flashcard_id)
     flashcard_key = f"{topic_name}::{flashcard_id}"
     
-    # Obtener historial de respuestas para esta flashcard
-    if flashcard_key not in responses:
-        responses[flashcard_key] = {
-            "topic_name": topic_name,
-            "flashcard_id": flashcard_id,
-            "responses": [],
-            "consecutive_correct": 0,
-            "last_response_at": None
-        }
-    
-    flashcard_data = responses[flashcard_key]
-    
-    # Añadir nueva respuesta
-    response_record = {
-        "is_correct": is_correct,
-        "answered_at": datetime.now().isoformat()
-    }
-    flashcard_data["responses"].append(response_record)
-    flashcard_data["last_response_at"] = datetime.now().isoformat()
-    
-    # Actualizar contador de respuestas correctas consecutivas
-    if is_correct:
-        flashcard_data["consecutive_correct"] += 1
-    else:
-        flashcard_data["consecutive_correct"] = 0
+    def apply(flashcard_data: Optional[Dict]) -> Dict:
+        # Obtener historial de respuestas para esta flashcard
+        if flashcard_data is None:
+            flashcard_data = {
+                "user_id": user_id,
+                "course_id": course_id,
+                "topic_name": topic_name,
+                "flashcard_id": flashcard_id,
+                "responses": [],
+                "total_responses": 0,
+                "correct_responses": 0,
+                "consecutive_correct": 0,
+                "last_response_at": None
+            }
+        _compact(flashcard_data)
+        
+        # Añadir nueva respuesta
+        answered_at = datetime.now().isoformat()
+        flashcard_data["responses"].append({
+            "is_correct": is_correct,
+            "answered_at": answered_at
+        })
+        flashcard_data["last_response_at"] = answered_at
+        flashcard_data["total_responses"] += 1
+        if is_correct:
+            flashcard_data["correct_responses"] += 1
+        
+        # Actualizar contador de respuestas correctas consecutivas
+        if is_correct:
+            flashcard_data["consecutive_correct"] += 1
+        else:
+            flashcard_data["consecutive_correct"] = 0
+        # Recortar la cola y recalcular cuándo vuelve a tocar
+        return _compact(flashcard_data)
     
     # Guardar
-    with open(responses_file, "w", encoding="utf-8") as f:
-        json.dump(responses, f, ensure_ascii=False, indent=2)
-    
-    return flashcard_data
+    _ensure_schedule()
+    return _public(_responses.update(_flashcard_key(user_id, course_id, flashcard_key), apply))
 
 
 def can_show_flashcard(
@@ -102,50 +231,19 @@ def can_show_flashcard(
     Returns:
         True si la flashcard puede mostrarse, False si debe esperar
     """
-    responses_file = get_flashcard_responses_file(user_id, course_id)
-    
-    if not responses_file.exists():
-        return True  # Nunca se ha respondido, puede mostrarse
-    
-    with open(responses_file, "r", encoding="utf-8") as f:
-        responses = json.load(f)
-    
     flashcard_key = f"{topic_name}::{flashcard_id}"
-    
-    if flashcard_key not in responses:
+    return _is_due(_responses.get(_flashcard_key(user_id, course_id, flashcard_key)))
+
+
+def _is_due(flashcard_data: Optional[Dict], now: Optional[datetime] = None) -> bool:
+    """Aplica las reglas de repetición espaciada al estado de una flashcard"""
+    if flashcard_data is None:
         return True  # Esta flashcard nunca se ha respondido
-    
-    flashcard_data = responses[flashcard_key]
-    responses_list = flashcard_data.get("responses", [])
-    
-    if not responses_list:
-        return True  # No hay respuestas, puede mostrarse
-    
-    # Obtener última respuesta
-    last_response = responses_list[-1]
-    last_response_time = datetime.fromisoformat(last_response["answered_at"])
-    now = datetime.now()
-    time_since_last = now - last_response_time
-    
-    consecutive_correct = flashcard_data.get("consecutive_correct", 0)
-    last_was_correct = last_response.get("is_correct", False)
-    
-    # Si la última respuesta fue incorrecta: puede mostrarse después de 10 minutos
-    if not last_was_correct:
-        return time_since_last >= timedelta(minutes=10)
-    
-    # Si la última respuesta fue correcta, aplicar reglas según número de aciertos consecutivos
-    if consecutive_correct == 1:
-        # Primera vez correcta: esperar 1 hora
-        return time_since_last >= timedelta(hours=1)
-    elif consecutive_correct == 2:
-        # Segunda vez correcta consecutiva: esperar 1 día
-        return time_since_last >= timedelta(days=1)
-    elif consecutive_correct >= 3:
-        # Tercera vez o más correcta consecutiva: esperar 10 días
-        return time_since_last >= timedelta(days=10)
-    
-    return True  # Por defecto, puede mostrarse
+    if flashcard_data.get("next_due_at"):
+        next_due = datetime.fromisoformat(flashcard_data["next_due_at"])
+    else:
+        next_due = _next_due_at(flashcard_data)
+    return next_due is None or (now or datetime.now()) >= next_due
 
 
 def get_available_flashcards(
@@ -166,12 +264,21 @@ def get_available_flashcards(
     Returns:
         Lista de flashcards que pueden mostrarse ahora
     """
+    _ensure_schedule()
+    owner = _owner(user_id, course_id)
+    # Dos consultas sobre los índices (sin leer ni parsear el historial):
+    # tarjetas ya respondidas del tema y, de ellas, las que ya vuelven a tocar
+    answered = set(_responses.keys(owner=owner, topic_name=topic_name))
+    due = set(_responses.keys_in_range(
+        "next_due", upper=_due_index_value(datetime.now()), owner=owner, topic_name=topic_name
+    ))
     available = []
     
     for idx, flashcard in enumerate(all_flashcards):
         flashcard_id = flashcard.get("id", str(idx))
+        key = _flashcard_key(user_id, course_id, f"{topic_name}::{flashcard_id}")
         
-        if can_show_flashcard(user_id, course_id, topic_name, flashcard_id):
+        if key not in answered or key in due:
             available.append(flashcard)
     
     return available
@@ -193,9 +300,9 @@ def get_flashcard_stats(
     Returns:
         Diccionario con estadísticas
     """
-    responses_file = get_flashcard_responses_file(user_id, course_id)
+    responses = _responses.find(owner=_owner(user_id, course_id))
     
-    if not responses_file.exists():
+    if not responses:
         return {
             "total_flashcards": 0,
             "total_responses": 0,
@@ -205,15 +312,12 @@ def get_flashcard_stats(
             "by_topic": {}
         }
     
-    with open(responses_file, "r", encoding="utf-8") as f:
-        responses = json.load(f)
-    
     total_responses = 0
     correct_responses = 0
     incorrect_responses = 0
     by_topic = {}
     
-    for flashcard_key, flashcard_data in responses.items():
+    for flashcard_data in responses:
         topic = flashcard_data.get("topic_name", "unknown")
         
         if topic_name and topic != topic_name:
@@ -226,17 +330,16 @@ def get_flashcard_stats(
                 "incorrect": 0
             }
         
-        flashcard_responses = flashcard_data.get("responses", [])
-        for response in flashcard_responses:
-            total_responses += 1
-            by_topic[topic]["total"] += 1
-            
-            if response.get("is_correct"):
-                correct_responses += 1
-                by_topic[topic]["correct"] += 1
-            else:
-                incorrect_responses += 1
-                by_topic[topic]["incorrect"] += 1
+        # Contadores compactados (las respuestas individuales solo guardan la cola)
+        flashcard_data = _compact(flashcard_data)
+        total = flashcard_data["total_responses"]
+        correct = flashcard_data["correct_responses"]
+        total_responses += total
+        correct_responses += correct
+        incorrect_responses += total - correct
+        by_topic[topic]["total"] += total
+        by_topic[topic]["correct"] += correct
+        by_topic[topic]["incorrect"] += total - correct
     
     accuracy = (correct_responses / total_responses * 100) if total_responses > 0 else 0.0
     
@@ -0,0 +1,294 @@
+"""
+Game Sessions - Estado en memoria de las partidas de parchís con push de cambios
+- Cada partida activa vive en memoria con su propio lock: las jugadas de varios
+  jugadores se serializan y ninguna pisa a otra (antes era cargar-modificar-guardar
+  sin lock).
+- Cada jugada se persiste como un evento pequeño en game_storage (solo los campos que
+  cambian); la instantánea completa se reescribe cada GAME_SNAPSHOT_EVERY eventos o
+  cuando cambia algo indexado (estado, jugadores, código).
+- Los clientes se suscriben (SSE) y reciben el estado tras cada cambio en lugar de
+  hacer polling de get-game.
+Pensado para un solo proceso de la API, como el resto de cachés en memoria.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+_module_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+if str(_module_dir) not in sys.path:
+    sys.path.insert(0, str(_module_dir))
+import game_storage
+
+# Eventos entre instantáneas completas de la partida
+GAME_SNAPSHOT_EVERY = max(1, int(os.getenv("GAME_SNAPSHOT_EVERY", "20")))
+# Segundos sin actividad ni suscriptores tras los que una partida sale de memoria
+GAME_SESSION_IDLE_SECONDS = max(60, int(os.getenv("GAME_SESSION_IDLE_SECONDS", "1800")))
+# Mensajes pendientes por suscriptor; si se llena se descartan los más antiguos
+GAME_SUBSCRIBER_QUEUE_SIZE = max(1, int(os.getenv("GAME_SUBSCRIBER_QUEUE_SIZE", "32")))
+
+_MISSING = object()
+
+
+def _index_view(game: Dict) -> Tuple:
+    """Campos que alimentan los índices de game_storage: si cambian hay que reescribir la fila"""
+    return (
+        game.get("status"),
+        tuple(p.get("user_id") for p in game.get("players", [])),
+        game.get("invite_code"),
+        game.get("course_id"),
+        game.get("creator_id"),
+    )
+
+
+def _diff(before: Dict, after: Dict) -> Tuple[Dict[str, Any], List[str]]:
+    changes = {
+        field: value for field, value in after.items()
+        if field != "event_seq" and before.get(field, _MISSING) != value
+    }
+    removed = [field for field in before if field not in after and field != "event_seq"]
+    return changes, removed
+
+
+class _Subscriber:
+    __slots__ = ("loop", "queue")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=GAME_SUBSCRIBER_QUEUE_SIZE)
+
+    def _offer(self, message: str) -> bool:
+        dropped = False
+        if self.queue.full():
+            self.queue.get_nowait()
+            dropped = True
+        self.queue.put_nowait(message)
+        return dropped
+
+
+class GameSession:
+    """Estado de una partida en memoria; game se sustituye entero en cada cambio (no se modifica)"""
+
+    def __init__(self, game: Dict, snapshot_seq: int):
+        self.game = game
+        self.snapshot_seq = snapshot_seq
+        self.lock = threading.RLock()
+        self.subscribers: Set[_Subscriber] = set()
+        self.last_access = time.time()
+        # True mientras run() ejecuta una operación de game_storage sobre esta partida
+        self.running = False
+
+
+class GameSessionManager:
+    """Partidas activas en memoria, con lock por partida, registro de eventos y suscriptores"""
+
+    def __init__(self, snapshot_every: int = GAME_SNAPSHOT_EVERY, idle_seconds: int = GAME_SESSION_IDLE_SECONDS):
+        self.snapshot_every = snapshot_every
+        self.idle_seconds = idle_seconds
+        self._sessions: Dict[str, GameSession] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.events = 0
+        self.snapshots = 0
+        self.pushes = 0
+        self.dropped_messages = 0
+        game_storage.on_game_changed(self._external_change)
+
+    # ------------------------------------------------------------------ sesiones
+
+    def _session(self, game_id: str) -> Optional[GameSession]:
+        with self._lock:
+            session = self._sessions.get(game_id)
+        if session is not None:
+            session.last_access = time.time()
+            return session
+        game, snapshot_seq = game_storage.load_game_state(game_id)
+        if game is None:
+            return None
+        with self._lock:
+            self.loads += 1
+            session = self._sessions.setdefault(game_id, GameSession(game, snapshot_seq))
+            self._evict_idle()
+        return session
+
+    def _evict_idle(self) -> None:
+        now = time.time()
+        for game_id, session in list(self._sessions.items()):
+            idle = now - session.last_access > self.idle_seconds
+            if not session.subscribers and (idle or session.game.get("status") == "finished"):
+                del self._sessions[game_id]
+
+    def get(self, game_id: str) -> Optional[Dict]:
+        """Copia del estado actual (desde memoria; solo lee la base de datos la primera vez)"""
+        session = self._session(game_id)
+        if session is None:
+            return None
+        with session.lock:
+            return copy.deepcopy(session.game)
+
+    # ------------------------------------------------------------------ cambios
+
+    def _commit(self, game_id: str, session: GameSession, after: Dict, event_type: str, actor: Optional[str]) -> None:
+        before = session.game
+        changes, removed = _diff(before, after)
+        if not changes and not removed:
+            return
+        seq = int(before.get("event_seq") or 0) + 1
+        after["event_seq"] = seq
+        snapshot = seq - session.snapshot_seq >= self.snapshot_every or _index_view(before) != _index_view(after)
+        game_storage.record_game_event(after, event_type, actor, changes, removed, snapshot=snapshot)
+        session.game = after
+        with self._lock:
+            self.events += 1
+            if snapshot:
+                session.snapshot_seq = seq
+                self.snapshots += 1
+        self._publish(session, {"type": event_type, "actor": actor, "seq": seq, "game": after})
+
+    def update(
+        self,
+        game_id: str,
+        mutate: Callable[[Dict], Any],
+        event_type: str,
+        actor: Optional[str] = None,
+    ) -> Optional[Tuple[Dict, Any]]:
+        """
+        Aplica mutate(game) bajo el lock de la partida, persiste el evento y avisa a
+        los suscriptores. mutate trabaja sobre una copia: si lanza una excepción la
+        partida no cambia.
+
+        Returns:
+            (estado nuevo, lo que devuelva mutate) o None si la partida no existe
+        """
+        session = self._session(game_id)
+        if session is None:
+            return None
+        with session.lock:
+            working = copy.deepcopy(session.game)
+            result = mutate(working)
+            self._commit(game_id, session, working, event_type, actor)
+            return copy.deepcopy(session.game), result
+
+    def run(self, game_id: str, operation: Callable[[], Any], event_type: str, actor: Optional[str] = None) -> Any:
+        """
+        Ejecuta una operación de game_storage (unirse, empezar, abandonar...) bajo el
+        lock de la partida y después sincroniza la memoria y avisa a los suscriptores.
+        """
+        session = self._session(game_id)
+        if session is None:
+            return operation()
+        with session.lock:
+            session.running = True
+            try:
+                result = operation()
+            finally:
+                session.running = False
+            self._reload(game_id, session, event_type, actor)
+            return result
+
+    def _reload(self, game_id: str, session: GameSession, event_type: str, actor: Optional[str]) -> None:
+        game, snapshot_seq = game_storage.load_game_state(game_id)
+        if game is None:
+            with self._lock:
+                self._sessions.pop(game_id, None)
+            self._publish(session, {"type": "deleted", "actor": actor, "seq": None, "game": None})
+            return
+        session.snapshot_seq = snapshot_seq
+        self._commit(game_id, session, game, event_type, actor)
+
+    def _external_change(self, game_id: str) -> None:
+        """game_storage guardó o borró la partida por su cuenta: recargar si está en memoria"""
+        with self._lock:
+            session = self._sessions.get(game_id)
+        if session is None:
+            return
+        with session.lock:
+            if session.running:
+                return  # run() recarga al terminar
+            self._reload(game_id, session, "sync", None)
+
+    # ------------------------------------------------------------------ push
+
+    def _publish(self, session: GameSession, payload: Dict[str, Any]) -> None:
+        if not session.subscribers:
+            return
+        message = json.dumps(payload, ensure_ascii=False, default=str)
+        for subscriber in list(session.subscribers):
+            try:
+                subscriber.loop.call_soon_threadsafe(self._deliver, subscriber, message)
+            except RuntimeError:
+                session.subscribers.discard(subscriber)  # loop cerrado
+
+    def _deliver(self, subscriber: _Subscriber, message: str) -> None:
+        dropped = subscriber._offer(message)
+        with self._lock:
+            self.pushes += 1
+            if dropped:
+                self.dropped_messages += 1
+
+    async def subscribe(self, game_id: str, heartbeat: float = 15.0):
+        """
+        Generador asíncrono de mensajes JSON: primero el estado actual y después
+        uno por cambio. Cada heartbeat segundos sin cambios produce None (para
+        mantener viva la conexión). Termina cuando se borra la partida.
+        """
+        session = self._session(game_id)
+        if session is None:
+            return
+        subscriber = _Subscriber(asyncio.get_running_loop())
+        with session.lock:
+            session.subscribers.add(subscriber)
+            current = json.dumps(
+                {"type": "state", "actor": None, "seq": session.game.get("event_seq", 0), "game": session.game},
+                ensure_ascii=False,
+                default=str,
+            )
+        try:
+            yield current
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield message
+                if message.startswith('{"type": "deleted"'):
+                    return
+        finally:
+            with session.lock:
+                session.subscribers.discard(subscriber)
+                session.last_access = time.time()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "subscribers": sum(len(s.subscribers) for s in self._sessions.values()),
+                "loads": self.loads,
+                "events": self.events,
+                "snapshots": self.snapshots,
+                "pushes": self.pushes,
+                "dropped_messages": self.dropped_messages,
+                "snapshot_every": self.snapshot_every,
+            }
+
+
+_manager: Optional[GameSessionManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_game_sessions() -> GameSessionManager:
+    """Gestor compartido por todo el proceso"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = GameSessionManager()
+        return _manager
@@ -1,26 +1,133 @@
 """
 Sistema de almacenamiento de Juegos (Parchís con preguntas del curso)
-Gestiona partidas multijugador online
+Gestiona partidas multijugador online.
+Cada partida es una fila de la base de datos embebida (storage_engine), indexada por
+curso, creador, estado, jugadores y código de invitación; las búsquedas no recorren
+todas las partidas. Los JSON antiguos de courses/games se migran solos.
+Las jugadas se registran como eventos (game_events, solo se añaden) con los campos
+que cambian; la fila de la partida es una instantánea que se reescribe cada cierto
+número de eventos. load_game aplica sobre la instantánea los eventos posteriores.
 """
 
 import json
 import os
-from typing import List, Dict, Optional
+import sys
+from typing import Any, Callable, List, Dict, Optional, Tuple
 from datetime import datetime
 from pathlib import Path
 import uuid
 
-# Directorio para almacenar partidas (usar ruta absoluta basada en el directorio del módulo)
 _module_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-GAMES_DIR = _module_dir.parent / "courses" / "games"
-GAMES_DIR.mkdir(parents=True, exist_ok=True)
+if str(_module_dir) not in sys.path:
+    sys.path.insert(0, str(_module_dir))
+from storage_engine import Repository, get_engine, snapshot, transaction
+import data_paths
+
+# Directorio de partidas en JSON (formato antiguo, solo para la migración)
+GAMES_DIR = data_paths.GAMES_DIR
+
+ACTIVE_STATUSES = ["waiting", "playing"]
+
+# Avisos a game_sessions cuando una partida cambia fuera de su gestor
+_change_listeners: List[Callable[[str], None]] = []
 
 
 def get_game_file(game_id: str) -> Path:
-    """Obtiene la ruta del archivo de una partida"""
+    """Obtiene la ruta del archivo de una partida (formato JSON antiguo)"""
     return GAMES_DIR / f"{game_id}.json"
 
 
+def _legacy_games():
+    if not GAMES_DIR.exists():
+        return
+    for game_file in GAMES_DIR.glob("*.json"):
+        try:
+            with open(game_file, "r", encoding="utf-8") as f:
+                game = json.load(f)
+        except Exception as e:
+            print(f"[Games] Error leyendo {game_file}: {e}")
+            continue
+        yield game.get("game_id") or game_file.stem, game
+
+
+_games = Repository(
+    "games",
+    indexes={
+        "course_id": "course_id",
+        "creator_id": "creator_id",
+        "status": "status",
+        "player": lambda game: [p.get("user_id") for p in game.get("players", [])],
+        "invite_code": lambda game: (game.get("invite_code") or "").upper(),
+    },
+    legacy=_legacy_games,
+    legacy_sources=[GAMES_DIR],
+)
+
+
+def _event_value(game_id: str, seq: int) -> str:
+    return f"{game_id}|{seq:010d}"
+
+
+# Una fila por evento: key = game_id/seq; el índice seq ordena los eventos de cada partida
+_events = Repository(
+    "game_events",
+    indexes={"seq": lambda event: _event_value(event["game_id"], event["seq"])},
+)
+
+
+def on_game_changed(listener: Callable[[str], None]) -> None:
+    """Registra listener(game_id) para cambios hechos con save_game/delete_game (tras el commit)"""
+    _change_listeners.append(listener)
+
+
+def _notify_change(game_id: str) -> None:
+    def notify():
+        for listener in _change_listeners:
+            try:
+                listener(game_id)
+            except Exception as e:
+                print(f"[Games] Error notificando cambio de {game_id}: {e}")
+
+    get_engine().after_commit(notify)
+
+
+def apply_game_event(game: Dict, event: Dict) -> Dict:
+    """Aplica un evento (campos nuevos y eliminados) sobre el estado de una partida"""
+    game.update(event.get("changes") or {})
+    for field in event.get("removed") or []:
+        game.pop(field, None)
+    game["event_seq"] = event["seq"]
+    return game
+
+
+def record_game_event(
+    game: Dict,
+    event_type: str,
+    actor: Optional[str],
+    changes: Dict[str, Any],
+    removed: List[str],
+    snapshot: bool = False,
+) -> Dict:
+    """
+    Añade el evento game["event_seq"] al registro de la partida y, si snapshot,
+    reescribe también la instantánea (lo que compacta los eventos anteriores).
+    """
+    event = {
+        "game_id": game["game_id"],
+        "seq": game["event_seq"],
+        "type": event_type,
+        "actor": actor,
+        "changes": changes,
+        "removed": removed,
+        "at": datetime.now().isoformat(),
+    }
+    with transaction():
+        _events.put(f"{game['game_id']}/{event['seq']:010d}", event)
+        if snapshot:
+            _save_snapshot(game)
+    return event
+
+
 def create_game(
     course_id: str,
     creator_id: str,
@@ -82,14 +189,24 @@ def create_game(
     return game_data
 
 
+def _save_snapshot(game_data: Dict) -> None:
+    """Escribe la instantánea y borra los eventos que ya contiene"""
+    game_id = game_data["game_id"]
+    with transaction():
+        _games.put(game_id, game_data)
+        for key in _events.keys_in_range(
+            "seq", _event_value(game_id, 0), _event_value(game_id, int(game_data.get("event_seq") or 0))
+        ):
+            _events.delete(key)
+
+
 def save_game(game_data: Dict) -> bool:
     """Guarda una partida"""
     try:
-        game_file = get_game_file(game_data["game_id"])
-        print(f"[Save Game] Guardando partida {game_data.get('game_id')} en {game_file.absolute()}")
+        print(f"[Save Game] Guardando partida {game_data.get('game_id')}")
         print(f"[Save Game] Código de invitación: {game_data.get('invite_code')}")
-        with open(game_file, "w", encoding="utf-8") as f:
-            json.dump(game_data, f, indent=2, ensure_ascii=False)
+        _save_snapshot(game_data)
+        _notify_change(game_data["game_id"])
         print(f"[Save Game] ✅ Partida guardada correctamente")
         return True
     except Exception as e:
@@ -99,17 +216,42 @@ def save_game(game_data: Dict) -> bool:
         return False
 
 
+def _replay_events(game: Dict) -> Dict:
+    """Aplica a una instantánea los eventos posteriores a ella"""
+    game_id = game["game_id"]
+    for _, event in _events.items_in_range(
+        "seq", _event_value(game_id, int(game.get("event_seq") or 0) + 1), _event_value(game_id, 10 ** 10 - 1)
+    ):
+        apply_game_event(game, event)
+    return game
+
+
+def _find_games(**filters: Any) -> List[Dict]:
+    """Partidas por índices (los campos indexados siempre van en la instantánea) con sus eventos"""
+    with snapshot(_games, _events):
+        return [_replay_events(game) for game in _games.find(**filters)]
+
+
+def load_game_state(game_id: str) -> Tuple[Optional[Dict], int]:
+    """
+    (partida con los eventos aplicados, event_seq de su instantánea).
+    Devuelve (None, 0) si la partida no existe.
+    """
+    with snapshot(_games, _events):
+        game = _games.get(game_id)
+        if game is None:
+            return None, 0
+        snapshot_seq = int(game.get("event_seq") or 0)
+        return _replay_events(game), snapshot_seq
+
+
 def load_game(game_id: str) -> Optional[Dict]:
     """Carga una partida"""
     try:
-        game_file = get_game_file(game_id)
-        if not game_file.exists():
-            print(f"[Load Game] ❌ Archivo no existe: {game_file.absolute()}")
-            return None
-        
-        with open(game_file, "r", encoding="utf-8") as f:
-            game = json.load(f)
-            return game
+        game, _ = load_game_state(game_id)
+        if game is None:
+            print(f"[Load Game] ❌ Partida no existe: {game_id}")
+        return game
     except Exception as e:
         print(f"[Load Game] ❌ Error cargando partida: {e}")
         import traceback
@@ -118,6 +260,12 @@ def load_game(game_id: str) -> Optional[Dict]:
 
 
 def join_game(game_id: str, user_id: str, username: Optional[str] = None, invite_code: Optional[str] = None) -> Optional[Dict]:
+    """Une un jugador a una partida (lectura y escritura en una transacción)"""
+    with transaction():
+        return _join_game(game_id, user_id, username, invite_code)
+
+
+def _join_game(game_id: str, user_id: str, username: Optional[str] = None, invite_code: Optional[str] = None) -> Optional[Dict]:
     """
     Une un jugador a una partida
     
@@ -182,6 +330,12 @@ def join_game(game_id: str, user_id: str, username: Optional[str] = None, invite
 
 
 def start_game(game_id: str, user_id: str) -> Optional[Dict]:
+    """Inicia una partida (lectura y escritura en una transacción)"""
+    with transaction():
+        return _start_game(game_id, user_id)
+
+
+def _start_game(game_id: str, user_id: str) -> Optional[Dict]:
     """
     Inicia una partida (debe tener al menos 2 jugadores y solo el creador puede iniciarla)
     
@@ -222,20 +376,7 @@ def start_game(game_id: str, user_id: str) -> Optional[Dict]:
 
 def get_course_games(course_id: str, status: Optional[str] = None) -> List[Dict]:
     """Obtiene todas las partidas de un curso"""
-    games = []
-    
-    if not GAMES_DIR.exists():
-        return games
-    
-    for game_file in GAMES_DIR.glob("*.json"):
-        try:
-            with open(game_file, "r", encoding="utf-8") as f:
-                game = json.load(f)
-                if game.get("course_id") == course_id:
-                    if status is None or game.get("status") == status:
-                        games.append(game)
-        except:
-            continue
+    games = _find_games(course_id=course_id, status=status)
     
     # Ordenar por fecha de creación (más recientes primero)
     games.sort(key=lambda g: g.get("created_at", ""), reverse=True)
@@ -244,21 +385,7 @@ def get_course_games(course_id: str, status: Optional[str] = None) -> List[Dict]
 
 def get_user_games(user_id: str, status: Optional[str] = None) -> List[Dict]:
     """Obtiene todas las partidas de un usuario"""
-    games = []
-    
-    if not GAMES_DIR.exists():
-        return games
-    
-    for game_file in GAMES_DIR.glob("*.json"):
-        try:
-            with open(game_file, "r", encoding="utf-8") as f:
-                game = json.load(f)
-                # Verificar si el usuario está en la partida
-                if any(p.get("user_id") == user_id for p in game.get("players", [])):
-                    if status is None or game.get("status") == status:
-                        games.append(game)
-        except:
-            continue
+    games = _find_games(player=user_id, status=status)
     
     # Ordenar por fecha de actualización (más recientes primero)
     games.sort(key=lambda g: g.get("updated_at", ""), reverse=True)
@@ -276,28 +403,12 @@ def find_game_by_invite_code(invite_code: str) -> Optional[Dict]:
         Datos de la partida o None si no se encuentra
     """
     invite_code_upper = invite_code.upper().strip()
-    
-    if not GAMES_DIR.exists():
+    if not invite_code_upper:
         return None
     
-    # Buscar en todos los archivos
-    for game_file in GAMES_DIR.glob("*.json"):
-        try:
-            with open(game_file, "r", encoding="utf-8") as f:
-                game = json.load(f)
-                game_code = game.get("invite_code", "")
-                game_status = game.get("status")
-                
-                # Comparar código de invitación (case-insensitive)
-                if game_code and game_code.upper() == invite_code_upper:
-                    # Solo devolver partidas en estado waiting
-                    if game_status == "waiting":
-                        return game
-        except Exception as e:
-            print(f"[Find Game by Code] Error procesando {game_file}: {e}")
-            continue
-    
-    return None
+    # Solo devolver partidas en estado waiting (código case-insensitive)
+    games = _find_games(invite_code=invite_code_upper, status="waiting")
+    return games[0] if games else None
 
 
 def get_user_active_games(user_id: str, creator_only: bool = False) -> List[Dict]:
@@ -310,25 +421,20 @@ def get_user_active_games(user_id: str, creator_only: bool = False) -> List[Dict
     """
     if creator_only:
         # Buscar partidas donde el usuario es el creador
-        games = []
-        if not GAMES_DIR.exists():
-            return games
-        
-        for game_file in GAMES_DIR.glob("*.json"):
-            try:
-                with open(game_file, "r", encoding="utf-8") as f:
-                    game = json.load(f)
-                    if game.get("creator_id") == user_id and game.get("status") in ["waiting", "playing"]:
-                        games.append(game)
-            except:
-                continue
-        return games
+        return _find_games(creator_id=user_id, status=ACTIVE_STATUSES)
     else:
-        all_games = get_user_games(user_id)
-        return [g for g in all_games if g.get("status") in ["waiting", "playing"]]
+        games = _find_games(player=user_id, status=ACTIVE_STATUSES)
+        games.sort(key=lambda g: g.get("updated_at", ""), reverse=True)
+        return games
 
 
 def leave_game(game_id: str, user_id: str) -> Optional[Dict]:
+    """Abandona una partida (lectura y escritura en una transacción)"""
+    with transaction():
+        return _leave_game(game_id, user_id)
+
+
+def _leave_game(game_id: str, user_id: str) -> Optional[Dict]:
     """
     Abandona una partida (waiting o playing)
     Si todos los jugadores abandonan, la partida se termina automáticamente
@@ -385,11 +491,13 @@ def leave_game(game_id: str, user_id: str) -> Optional[Dict]:
 def delete_game(game_id: str) -> bool:
     """Elimina una partida"""
     try:
-        game_file = get_game_file(game_id)
-        if game_file.exists():
-            game_file.unlink()
-            return True
-        return False
+        with transaction():
+            for key in _events.keys_in_range("seq", _event_value(game_id, 0), _event_value(game_id, 10 ** 10 - 1)):
+                _events.delete(key)
+            deleted = _games.delete(game_id)
+        if deleted:
+            _notify_change(game_id)
+        return deleted
     except Exception as e:
         print(f"Error eliminando partida: {e}")
         return False
@@ -407,21 +515,12 @@ def cleanup_abandoned_games(max_age_hours: int = 24, min_age_minutes: int = 30)
     Returns:
         Número de partidas eliminadas
     """
-    if not GAMES_DIR.exists():
-        return 0
-    
     deleted_count = 0
     now = datetime.now()
     
-    for game_file in GAMES_DIR.glob("*.json"):
+    # Solo limpiar partidas en estado waiting
+    for game in _find_games(status="waiting"):
         try:
-            with open(game_file, "r", encoding="utf-8") as f:
-                game = json.load(f)
-                
-            # Solo limpiar partidas en estado waiting
-            if game.get("status") != "waiting":
-                continue
-            
             # Verificar antigüedad mínima (no eliminar partidas recién creadas)
             created_at_str = game.get("created_at")
             age_minutes = None
@@ -461,14 +560,11 @@ def cleanup_abandoned_games(max_age_hours: int = 24, min_age_minutes: int = 30)
                         print(f"[Cleanup] Error parseando fecha de partida {game.get('game_id')}: {e}")
             
             if should_delete:
-                try:
-                    game_file.unlink()
+                if delete_game(game.get("game_id")):
                     deleted_count += 1
                     print(f"[Cleanup] ✅ Eliminada partida {game.get('game_id')}")
-                except Exception as e:
-                    print(f"[Cleanup] ❌ Error eliminando archivo {game_file}: {e}")
         except Exception as e:
-            print(f"[Cleanup] Error procesando {game_file}: {e}")
+            print(f"[Cleanup] Error procesando {game.get('game_id')}: {e}")
             import traceback
             traceback.print_exc()
             continue
@@ -487,21 +583,16 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
     Returns:
         Número de partidas eliminadas o jugadores removidos
     """
-    if not GAMES_DIR.exists():
-        print(f"[Delete User Games] GAMES_DIR no existe: {GAMES_DIR.absolute()}")
-        return 0
-    
     deleted_count = 0
-    games_to_process = list(GAMES_DIR.glob("*.json"))  # Copia para evitar problemas al modificar
+    # Partidas creadas por el usuario o en las que juega
+    games_to_process = {g["game_id"]: g for g in _find_games(creator_id=user_id, course_id=course_id)}
+    games_to_process.update((g["game_id"], g) for g in _find_games(player=user_id, course_id=course_id))
     
     print(f"[Delete User Games] Buscando partidas para usuario {user_id}, curso: {course_id}")
-    print(f"[Delete User Games] Total de archivos encontrados: {len(games_to_process)}")
+    print(f"[Delete User Games] Total de partidas encontradas: {len(games_to_process)}")
     
-    for game_file in games_to_process:
+    for game in games_to_process.values():
         try:
-            with open(game_file, "r", encoding="utf-8") as f:
-                game = json.load(f)
-            
             game_id = game.get("game_id", "unknown")
             game_creator_id = game.get("creator_id")
             game_status = game.get("status")
@@ -524,12 +615,9 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
                 print(f"[Delete User Games] ✅ Usuario {user_id} es creador de partida {game_id} (status: {game_status})")
                 # Eliminar si está en waiting (siempre)
                 if game_status == "waiting":
-                    try:
-                        game_file.unlink()
+                    if delete_game(game_id):
                         deleted_count += 1
                         print(f"[Delete User Games] ✅ Eliminada partida WAITING {game_id} creada por {user_id}")
-                    except Exception as e:
-                        print(f"[Delete User Games] ❌ Error eliminando archivo {game_file}: {e}")
                 # Para partidas en playing: remover al creador y terminar la partida si no quedan jugadores
                 elif game_status == "playing":
                     players = game.get("players", [])
@@ -541,12 +629,9 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
                     
                     # Si no quedan jugadores, eliminar la partida
                     if len(game["players"]) == 0:
-                        try:
-                            game_file.unlink()
+                        if delete_game(game_id):
                             deleted_count += 1
                             print(f"[Delete User Games] ✅ Eliminada partida PLAYING {game_id} (creador removido, sin jugadores restantes)")
-                        except Exception as e:
-                            print(f"[Delete User Games] ❌ Error eliminando archivo {game_file}: {e}")
                     else:
                         # Si quedan jugadores, terminar la partida (marcar como finished)
                         game["status"] = "finished"
@@ -556,12 +641,9 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
                         print(f"[Delete User Games] ✅ Partida PLAYING {game_id} terminada (creador removido, {len(game['players'])} jugadores restantes)")
                 else:
                     # Para otros estados (finished, etc), simplemente eliminar si es el creador
-                    try:
-                        game_file.unlink()
+                    if delete_game(game_id):
                         deleted_count += 1
                         print(f"[Delete User Games] ✅ Eliminada partida {game_status.upper()} {game_id} creada por {user_id}")
-                    except Exception as e:
-                        print(f"[Delete User Games] ❌ Error eliminando archivo {game_file}: {e}")
             else:
                 print(f"[Delete User Games] ⏭️ Usuario {user_id} NO es creador de partida {game_id} (creator: {game_creator_id})")
                 # Si el usuario no es el creador, intentar removerlo de la partida
@@ -575,12 +657,9 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
                     
                     # Si no quedan jugadores, eliminar la partida
                     if len(game["players"]) == 0:
-                        try:
-                            game_file.unlink()
+                        if delete_game(game_id):
                             deleted_count += 1
                             print(f"[Delete User Games] ✅ Eliminada partida {game_status.upper()} {game_id} (último jugador removido)")
-                        except Exception as e:
-                            print(f"[Delete User Games] ❌ Error eliminando archivo {game_file}: {e}")
                     else:
                         # Si quedan jugadores pero la partida está en playing y quedan menos de 2, terminarla
                         if game_status == "playing" and len(game["players"]) < 2:
@@ -594,7 +673,7 @@ def delete_user_games(user_id: str, course_id: Optional[str] = None) -> int:
                     print(f"[Delete User Games] ⏭️ Usuario {user_id} no está en jugadores de partida {game_id}")
                     
         except Exception as e:
-            print(f"[Delete User Games] ❌ Error procesando {game_file}: {e}")
+            print(f"[Delete User Games] ❌ Error procesando {game.get('game_id')}: {e}")
             import traceback
             traceback.print_exc()
             continue
@@ -3,15 +3,27 @@ Generador de resúmenes/apuntes usando Google Gemini API
 Genera apuntes de la academia para cada apartado y subapartado de un curso
 """
 
+import hashlib
+import html as html_lib
 import os
+import sys
+import time
 import requests
 import json
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
-import io
 from threading import Lock
 import re
 
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from rate_limiter import get_rate_limiter
+from image_resolver import description_key, get_image_resolver
+import summary_jobs_storage
+import data_paths
+
 # Intentar importar markdown para conversión
 try:
     import markdown
@@ -24,13 +36,26 @@ except ImportError:
 _progress_tracker: Dict[str, Dict] = {}
 _progress_lock = Lock()
 
-# Intentar importar PyPDF2, si no está disponible usar alternativa
-try:
-    import PyPDF2
-    PDF_AVAILABLE = True
-except ImportError:
-    PDF_AVAILABLE = False
-    print("⚠️ PyPDF2 no está instalado. Instálalo con: pip install PyPDF2")
+# Apartados que se generan a la vez (la cuota de Gemini la reparte rate_limiter)
+SUMMARY_MAX_WORKERS = max(1, int(os.getenv("SUMMARY_MAX_WORKERS", "4")))
+# Reintentos tras un 429 y espera por defecto si no llega Retry-After
+RATE_LIMIT_RETRIES = max(0, int(os.getenv("RATE_LIMIT_RETRIES", "3")))
+RATE_LIMIT_RETRY_SECONDS = float(os.getenv("RATE_LIMIT_RETRY_SECONDS", "20"))
+# Resumen map-reduce del material: a partir de cuántos caracteres se trocea, tamaño
+# de cada trozo, resúmenes que se fusionan por llamada y llamadas simultáneas
+MAP_REDUCE_THRESHOLD_CHARS = max(1, int(os.getenv("MAP_REDUCE_THRESHOLD_CHARS", "200000")))
+MAP_REDUCE_CHUNK_CHARS = max(1000, int(os.getenv("MAP_REDUCE_CHUNK_CHARS", "100000")))
+MAP_REDUCE_FANIN = max(2, int(os.getenv("MAP_REDUCE_FANIN", "4")))
+MAP_REDUCE_WORKERS = max(1, int(os.getenv("MAP_REDUCE_WORKERS", "4")))
+# Vida de la lista de modelos de Gemini cacheada por API key
+GEMINI_MODELS_TTL_SECONDS = max(0, int(os.getenv("GEMINI_MODELS_TTL_SECONDS", "600")))
+_gemini_models_cache: Dict[str, Tuple[float, List[str]]] = {}
+_gemini_models_lock = Lock()
+
+# Extracción de texto de PDFs con caché por página (pypdf, o PyPDF2 como alternativa)
+from pdf_text_cache import PDF_BACKEND_AVAILABLE, get_pdf_text_cache
+if not PDF_BACKEND_AVAILABLE:
+    print("⚠️ pypdf no está instalado. Instálalo con: pip install pypdf")
 
 
 def _is_technical_diagram(description: str) -> bool:
@@ -133,7 +158,7 @@ El diagrama debe ser útil para estudiantes que aprenden este concepto."""
                 }
                 
                 print(f"   🔄 Intentando con {model_name}...")
-                response = requests.post(url, headers=headers, json=payload, timeout=60)
+                response = _provider_post("gemini", url, headers=headers, json=payload, timeout=60)
                 
                 if response.status_code == 200:
                     result = response.json()
@@ -170,7 +195,7 @@ El diagrama debe ser útil para estudiantes que aprenden este concepto."""
                                         image_bytes = base64.b64decode(image_data)
                                         
                                         # Guardar la imagen localmente
-                                        images_dir = Path("courses/generated_images")
+                                        images_dir = data_paths.GENERATED_IMAGES_DIR
                                         images_dir.mkdir(parents=True, exist_ok=True)
                                         
                                         hash_obj = hashlib.md5(description.encode())
@@ -196,7 +221,7 @@ El diagrama debe ser útil para estudiantes que aprenden este concepto."""
                                         print(f"📥 Descargando imagen desde URL de Gemini: {image_url[:80]}...")
                                         image_response = requests.get(image_url, timeout=60)
                                         if image_response.status_code == 200:
-                                            images_dir = Path("courses/generated_images")
+                                            images_dir = data_paths.GENERATED_IMAGES_DIR
                                             images_dir.mkdir(parents=True, exist_ok=True)
                                             
                                             hash_obj = hashlib.md5(description.encode())
@@ -364,13 +389,13 @@ El diagrama debe ser útil para estudiantes que aprenden este concepto."""
             }
         }
         
-        response = requests.post(url, json=payload, timeout=60)
+        response = _provider_post("gemini", url, json=payload, timeout=60)
         
         # Si el modelo no está disponible, intentar con gemini-1.5-pro
         if response.status_code == 404:
             print(f"   ⚠️ Modelo gemini-2.0-flash-exp no disponible, intentando con gemini-1.5-pro...")
             url = f"https://generativelanguage.googleapis.com/v1/models/gemini-1.5-pro:generateContent?key={gemini_api_key}"
-            response = requests.post(url, json=payload, timeout=60)
+            response = _provider_post("gemini", url, json=payload, timeout=60)
         
         if response.status_code == 200:
             result = response.json()
@@ -469,7 +494,7 @@ Responde SOLO con la descripción mejorada completa, sin explicaciones adicional
             }
         }
         
-        response = requests.post(url, json=payload, timeout=30)
+        response = _provider_post("gemini", url, json=payload, timeout=30)
         if response.status_code == 200:
             result = response.json()
             if "candidates" in result and len(result["candidates"]) > 0:
@@ -601,7 +626,7 @@ The diagram must help students understand the concept clearly and directly."""
             "response_format": "url"  # Obtener URL directamente
         }
         
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        response = _provider_post("openai_images", url, headers=headers, json=data, timeout=60)
         
         if response.status_code == 200:
             result = response.json()
@@ -613,7 +638,7 @@ The diagram must help students understand the concept clearly and directly."""
                 image_response = requests.get(image_url, timeout=60)
                 if image_response.status_code == 200:
                     # Crear directorio para imágenes generadas
-                    images_dir = Path("courses/generated_images")
+                    images_dir = data_paths.GENERATED_IMAGES_DIR
                     images_dir.mkdir(parents=True, exist_ok=True)
                     
                     # Generar nombre único para la imagen
@@ -672,7 +697,8 @@ def _search_wikimedia_commons(query: str) -> Optional[Dict[str, str]]:
             "srprop": "size|wordcount|timestamp",
         }
         
-        response = requests.get(search_url, params=params, timeout=10)
+        with get_rate_limiter().slot("wikimedia"):
+            response = requests.get(search_url, params=params, timeout=10)
         if response.status_code == 200:
             data = response.json()
             if "query" in data and "search" in data["query"]:
@@ -692,7 +718,8 @@ def _search_wikimedia_commons(query: str) -> Optional[Dict[str, str]]:
                         "iiurlwidth": 800,
                     }
                     
-                    image_info_response = requests.get(search_url, params=image_info_params, timeout=10)
+                    with get_rate_limiter().slot("wikimedia"):
+                        image_info_response = requests.get(search_url, params=image_info_params, timeout=10)
                     if image_info_response.status_code == 200:
                         image_data = image_info_response.json()
                         if "query" in image_data and "pages" in image_data["query"]:
@@ -777,7 +804,8 @@ def search_image(query: str) -> Optional[Dict[str, str]]:
         if unsplash_key:
             unsplash_url = f"https://api.unsplash.com/search/photos?query={enhanced_query}&per_page=5&orientation=landscape"
             headers = {"Authorization": f"Client-ID {unsplash_key}"}
-            response = requests.get(unsplash_url, headers=headers, timeout=5)
+            with get_rate_limiter().slot("unsplash"):
+                response = requests.get(unsplash_url, headers=headers, timeout=5)
             if response.status_code == 200:
                 data = response.json()
                 if data.get("results") and len(data["results"]) > 0:
@@ -802,7 +830,8 @@ def search_image(query: str) -> Optional[Dict[str, str]]:
         if pexels_key:
             pexels_url = f"https://api.pexels.com/v1/search?query={enhanced_query}&per_page=5&orientation=landscape"
             headers = {"Authorization": pexels_key}
-            response = requests.get(pexels_url, headers=headers, timeout=5)
+            with get_rate_limiter().slot("pexels"):
+                response = requests.get(pexels_url, headers=headers, timeout=5)
             if response.status_code == 200:
                 data = response.json()
                 if data.get("photos") and len(data["photos"]) > 0:
@@ -931,59 +960,21 @@ def _markdown_to_html(content: str) -> str:
         return md.convert(content)
 
 
-def _process_image_markers(content: str) -> str:
+def _image_html(image_url: str, safe_desc: str) -> str:
+    return f'\n<div style="margin: 2rem 0; text-align: center;"><img src="{image_url}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1);" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">{safe_desc}</p></div>\n'
+
+
+def _placeholder_html(description: str, pending_key: Optional[str] = None) -> str:
     """
-    Procesa marcadores de imagen 🖼️ [INSERTAR IMAGEN: ...] y los reemplaza con imágenes reales
-    
-    Args:
-        content: Contenido con marcadores de imagen
-        
-    Returns:
-        Contenido con imágenes insertadas
+    Placeholder para una imagen no encontrada. Con pending_key la imagen sigue
+    resolviéndose en segundo plano y patch_pending_images la sustituirá después.
     """
-    # Patrón para detectar marcadores de imagen (multilínea)
-    # Formato: > 🖼️ [INSERTAR IMAGEN: Descripción]
-    # También puede estar dentro de bloques HTML como <blockquote> o <p>
-    # Buscar el marcador incluso si está dentro de tags HTML
-    image_pattern = r'(?:>|&gt;)\s*🖼️\s*\[INSERTAR IMAGEN:\s*([^\]]+?)\]'
-    
-    def replace_image_marker(match):
-        description = match.group(1).strip()
-        if not description:
-            return ""
-        
-        # Limpiar entidades HTML que puedan estar en la descripción
-        description = description.replace('&gt;', '>').replace('&lt;', '<').replace('&amp;', '&')
-        
-        print(f"🖼️ Procesando marcador de imagen: '{description[:100]}...'")
-        
-        # Buscar imagen
-        image_data = search_image(description)
-        
-        if image_data:
-            image_url = image_data["url"]
-            image_desc = image_data.get("description", description)
-            print(f"✅ Imagen encontrada para '{description[:50]}...': {image_url[:80]}...")
-            
-            # Reemplazar con tag HTML de imagen
-            # Escapar comillas en la descripción para evitar problemas con HTML
-            safe_desc = image_desc.replace('"', '&quot;').replace("'", "&#39;")
-            return f'\n<div style="margin: 2rem 0; text-align: center;"><img src="{image_url}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1);" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">{safe_desc}</p></div>\n'
-        else:
-            print(f"⚠️ No se encontró imagen para '{description[:50]}...', usando placeholder SVG")
-            # Generar un placeholder SVG más apropiado para contenido educativo
-            safe_desc = description.replace('"', '&quot;').replace("'", "&#39;")
-            is_technical = _is_technical_diagram(description)
-            
-            if is_technical:
-                # Para diagramas técnicos, usar un SVG placeholder que indique que es un diagrama
-                import hashlib
-                import base64
-                hash_obj = hashlib.md5(description.encode())
-                hash_int = int(hash_obj.hexdigest()[:8], 16)
-                
-                # Generar un SVG placeholder con un diseño que sugiera un diagrama técnico
-                svg_placeholder = f'''<svg width="800" height="400" xmlns="http://www.w3.org/2000/svg" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border-radius: 8px;">
+    safe_desc = description.replace('"', '&quot;').replace("'", "&#39;")
+    
+    if _is_technical_diagram(description):
+        # Para diagramas técnicos, usar un SVG placeholder que indique que es un diagrama
+        # Generar un SVG placeholder con un diseño que sugiera un diagrama técnico
+        svg_placeholder = f'''<svg width="800" height="400" xmlns="http://www.w3.org/2000/svg" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border-radius: 8px;">
   <rect width="800" height="400" fill="rgba(255,255,255,0.1)" rx="8"/>
   <text x="400" y="180" font-family="Arial, sans-serif" font-size="24" font-weight="bold" fill="white" text-anchor="middle" opacity="0.9">📊 Diagrama Técnico</text>
   <text x="400" y="220" font-family="Arial, sans-serif" font-size="16" fill="rgba(255,255,255,0.8)" text-anchor="middle">{safe_desc[:60]}{"..." if len(safe_desc) > 60 else ""}</text>
@@ -993,75 +984,98 @@ def _process_image_markers(content: str) -> str:
   <rect x="350" y="290" width="100" height="60" fill="rgba(255,255,255,0.2)" rx="4"/>
   <polygon points="550,320 600,290 650,320 600,350" fill="rgba(255,255,255,0.2)"/>
 </svg>'''
-                
-                # Convertir SVG a data URI
-                svg_encoded = base64.b64encode(svg_placeholder.encode('utf-8')).decode('utf-8')
-                placeholder_url = f"data:image/svg+xml;base64,{svg_encoded}"
-            else:
-                # Para imágenes generales, usar Lorem Picsum pero con un mensaje más claro
-                import hashlib
-                hash_obj = hashlib.md5(description.encode())
-                hash_int = int(hash_obj.hexdigest()[:8], 16)
-                placeholder_url = f"https://picsum.photos/800/400?random={hash_int}"
-            
-            return f'\n<div style="margin: 2rem 0; text-align: center;"><img src="{placeholder_url}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); opacity: 0.8;" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">🖼️ <strong>Imagen ilustrativa:</strong> {safe_desc}</p></div>\n'
+        
+        # Convertir SVG a data URI
+        import base64
+        svg_encoded = base64.b64encode(svg_placeholder.encode('utf-8')).decode('utf-8')
+        placeholder_url = f"data:image/svg+xml;base64,{svg_encoded}"
+    else:
+        # Para imágenes generales, usar Lorem Picsum pero con un mensaje más claro
+        hash_int = int(hashlib.md5(description.encode()).hexdigest()[:8], 16)
+        placeholder_url = f"https://picsum.photos/800/400?random={hash_int}"
+    
+    pending_attr = f' data-image-pending="{pending_key}"' if pending_key else ""
+    return f'\n<div{pending_attr} style="margin: 2rem 0; text-align: center;"><img src="{placeholder_url}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); opacity: 0.8;" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">🖼️ <strong>Imagen ilustrativa:</strong> {safe_desc}</p></div>\n'
+
+
+def patch_pending_images(content: Optional[str]) -> Optional[str]:
+    """
+    Sustituye los placeholders de imágenes que se quedaron resolviendo tras el plazo
+    por la imagen real, si ya está en la caché. Se puede llamar al servir el resumen.
+    """
+    if not content or "data-image-pending" not in content:
+        return content
+    resolver = get_image_resolver()
+    
+    def patch(match):
+        found, image_data = resolver.lookup("summary", match.group(1))
+        if not found:
+            return match.group(0)
+        if not image_data:
+            # Ya se sabe que no hay imagen: queda como placeholder definitivo
+            return match.group(0).replace(f' data-image-pending="{match.group(1)}"', "", 1)
+        safe_desc = html_lib.unescape(match.group(2)).replace('"', '&quot;').replace("'", "&#39;")
+        return _image_html(image_data["url"], safe_desc).strip("\n")
+    
+    return re.sub(
+        r'<div data-image-pending="([0-9a-f]+)"[^>]*><img [^>]*alt="([^"]*)"[^>]*/>.*?</div>',
+        patch,
+        content,
+        flags=re.DOTALL
+    )
+
+
+def _process_image_markers(content: str) -> str:
+    """
+    Procesa marcadores de imagen 🖼️ [INSERTAR IMAGEN: ...] y los reemplaza con imágenes reales
+    
+    Todas las imágenes del documento se resuelven a la vez (image_resolver, con caché
+    por descripción); las que no llegan en IMAGE_RESOLVE_DEADLINE_SECONDS quedan como
+    placeholder pendiente y se sustituyen después con patch_pending_images.
+    
+    Args:
+        content: Contenido con marcadores de imagen
+        
+    Returns:
+        Contenido con imágenes insertadas
+    """
+    # Patrón universal que busca el marcador en cualquier contexto
+    # Busca 🖼️ [INSERTAR IMAGEN: ...] sin importar qué tags HTML lo rodeen
+    universal_pattern = r'🖼️\s*\[INSERTAR IMAGEN:\s*([^\]]+?)\]'
+    
+    def marker_description(match) -> str:
+        # Limpiar entidades HTML que puedan estar en la descripción
+        return match.group(1).strip().replace('&gt;', '>').replace('&lt;', '<').replace('&amp;', '&')
+    
+    descriptions = [
+        marker_description(m) for m in re.finditer(universal_pattern, content, flags=re.IGNORECASE | re.DOTALL)
+    ]
+    descriptions = [d for d in descriptions if d]
+    if descriptions:
+        print(f"🖼️ Resolviendo {len(set(descriptions))} imagen(es) en paralelo...")
+    resolved = get_image_resolver().resolve_many(descriptions, search_image, "summary")
     
     # ESTRATEGIA: Procesar cada marcador individualmente, sin importar dónde esté
     # Esto asegura que TODOS los marcadores se procesen, incluso si están en blockquotes con múltiples <p>
     
     def process_single_image_marker(match):
-        """Procesa un solo marcador de imagen y retorna el HTML de la imagen"""
-        description = match.group(1).strip().replace('&gt;', '>').replace('&lt;', '<').replace('&amp;', '&')
+        """Sustituye un marcador por su imagen ya resuelta (o por un placeholder)"""
+        description = marker_description(match)
         if not description:
             return ""
         
-        print(f"🖼️ Procesando marcador de imagen: '{description[:100]}...'")
-        
-        image_data = search_image(description)
-        safe_desc = description.replace('"', '&quot;').replace("'", "&#39;")
+        if description not in resolved:
+            print(f"⏳ Imagen pendiente para '{description[:50]}...', placeholder temporal")
+            return _placeholder_html(description, pending_key=description_key(description))
         
+        image_data = resolved[description]
         if image_data:
             print(f"✅ Imagen encontrada para '{description[:50]}...': {image_data['url'][:80]}...")
-            return f'\n<div style="margin: 2rem 0; text-align: center;"><img src="{image_data["url"]}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1);" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">{safe_desc}</p></div>\n'
-        else:
-            print(f"⚠️ No se encontró imagen para '{description[:50]}...', usando placeholder SVG")
-            # Generar un placeholder SVG más apropiado para contenido educativo
-            is_technical = _is_technical_diagram(description)
-            
-            if is_technical:
-                # Para diagramas técnicos, usar un SVG placeholder que indique que es un diagrama
-                import hashlib
-                hash_obj = hashlib.md5(description.encode())
-                hash_int = int(hash_obj.hexdigest()[:8], 16)
-                
-                # Generar un SVG placeholder con un diseño que sugiera un diagrama técnico
-                svg_placeholder = f'''<svg width="800" height="400" xmlns="http://www.w3.org/2000/svg" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border-radius: 8px;">
-  <rect width="800" height="400" fill="rgba(255,255,255,0.1)" rx="8"/>
-  <text x="400" y="180" font-family="Arial, sans-serif" font-size="24" font-weight="bold" fill="white" text-anchor="middle" opacity="0.9">📊 Diagrama Técnico</text>
-  <text x="400" y="220" font-family="Arial, sans-serif" font-size="16" fill="rgba(255,255,255,0.8)" text-anchor="middle">{safe_desc[:60]}{"..." if len(safe_desc) > 60 else ""}</text>
-  <text x="400" y="260" font-family="Arial, sans-serif" font-size="14" fill="rgba(255,255,255,0.7)" text-anchor="middle">Imagen no disponible - Diagrama educativo requerido</text>
-  <!-- Elementos decorativos que sugieren un diagrama -->
-  <circle cx="200" cy="320" r="30" fill="rgba(255,255,255,0.2)"/>
-  <rect x="350" y="290" width="100" height="60" fill="rgba(255,255,255,0.2)" rx="4"/>
-  <polygon points="550,320 600,290 650,320 600,350" fill="rgba(255,255,255,0.2)"/>
-</svg>'''
-                
-                # Convertir SVG a data URI
-                import base64
-                svg_encoded = base64.b64encode(svg_placeholder.encode('utf-8')).decode('utf-8')
-                placeholder_url = f"data:image/svg+xml;base64,{svg_encoded}"
-            else:
-                # Para imágenes generales, usar Lorem Picsum pero con un mensaje más claro
-                import hashlib
-                hash_obj = hashlib.md5(description.encode())
-                hash_int = int(hash_obj.hexdigest()[:8], 16)
-                placeholder_url = f"https://picsum.photos/800/400?random={hash_int}"
-            
-            return f'\n<div style="margin: 2rem 0; text-align: center;"><img src="{placeholder_url}" alt="{safe_desc}" style="max-width: 100%; height: auto; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); opacity: 0.8;" /><p style="margin-top: 0.5rem; font-size: 0.9rem; color: #6b7280; font-style: italic;">🖼️ <strong>Imagen ilustrativa:</strong> {safe_desc}</p></div>\n'
-    
-    # Patrón universal que busca el marcador en cualquier contexto
-    # Busca 🖼️ [INSERTAR IMAGEN: ...] sin importar qué tags HTML lo rodeen
-    universal_pattern = r'🖼️\s*\[INSERTAR IMAGEN:\s*([^\]]+?)\]'
+            safe_desc = description.replace('"', '&quot;').replace("'", "&#39;")
+            return _image_html(image_data["url"], safe_desc)
+        
+        print(f"⚠️ No se encontró imagen para '{description[:50]}...', usando placeholder SVG")
+        return _placeholder_html(description)
     
     # Reemplazar todos los marcadores encontrados
     processed_content = re.sub(universal_pattern, process_single_image_marker, content, flags=re.IGNORECASE | re.DOTALL)
@@ -1102,6 +1116,49 @@ def _process_image_markers(content: str) -> str:
     return processed_content
 
 
+def _provider_post(provider: str, url: str, **kwargs) -> requests.Response:
+    """POST respetando el límite del proveedor; tras un 429 pausa el proveedor y reintenta"""
+    limiter = get_rate_limiter()
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        with limiter.slot(provider):
+            response = requests.post(url, **kwargs)
+        if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return response
+        try:
+            wait = float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            wait = RATE_LIMIT_RETRY_SECONDS * (attempt + 1)
+        print(f"   ⏳ Límite de {provider} alcanzado (429), reintentando en {wait:.0f}s...")
+        limiter.pause(provider, wait)
+    return response
+
+
+def _list_gemini_models(gemini_api_key: str) -> List[str]:
+    """Modelos de Gemini con generateContent para esta API key (cacheados GEMINI_MODELS_TTL_SECONDS)"""
+    cache_key = hashlib.sha256((gemini_api_key or "").encode("utf-8")).hexdigest()[:16]
+    with _gemini_models_lock:
+        cached = _gemini_models_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < GEMINI_MODELS_TTL_SECONDS:
+            return list(cached[1])
+    available_models = []
+    try:
+        list_url = f"https://generativelanguage.googleapis.com/v1/models?key={gemini_api_key}"
+        list_response = requests.get(list_url, timeout=10)
+        if list_response.status_code == 200:
+            models_data = list_response.json()
+            if "models" in models_data:
+                for m in models_data["models"]:
+                    name = m.get("name", "").replace("models/", "")
+                    if "gemini" in name.lower() and "generateContent" in m.get("supportedGenerationMethods", []):
+                        available_models.append(name)
+    except:
+        pass
+    if available_models:
+        with _gemini_models_lock:
+            _gemini_models_cache[cache_key] = (time.monotonic(), available_models)
+    return list(available_models)
+
+
 def extract_text_from_pdf(pdf_url: str) -> Optional[str]:
     """
     Extrae texto de un PDF desde una URL o ruta de archivo local
@@ -1112,10 +1169,7 @@ def extract_text_from_pdf(pdf_url: str) -> Optional[str]:
     Returns:
         Texto extraído del PDF o None si hay error
     """
-    if not PDF_AVAILABLE:
-        print(f"⚠️ PyPDF2 no está disponible. No se puede extraer texto de {pdf_url}")
-        return None
-    
+    cache = get_pdf_text_cache()
     try:
         # Primero verificar si es una ruta de archivo local (no URL)
         # Las rutas locales no empiezan con http:// o https://
@@ -1126,12 +1180,7 @@ def extract_text_from_pdf(pdf_url: str) -> Optional[str]:
             pdf_path = Path(pdf_url)
             if pdf_path.exists() and pdf_path.is_file():
                 print(f"   📄 Leyendo archivo local: {pdf_path}")
-                with open(pdf_path, "rb") as f:
-                    pdf_reader = PyPDF2.PdfReader(f)
-                    text = ""
-                    for page in pdf_reader.pages:
-                        text += page.extract_text() + "\n"
-                    return text
+                return cache.text(pdf_path)
             else:
                 print(f"   ⚠️ Archivo local no encontrado: {pdf_path}")
                 return None
@@ -1145,48 +1194,21 @@ def extract_text_from_pdf(pdf_url: str) -> Optional[str]:
                 documents_dir = Path("documents")
                 pdf_path = documents_dir / file_path
                 if pdf_path.exists():
-                    with open(pdf_path, "rb") as f:
-                        pdf_reader = PyPDF2.PdfReader(f)
-                        text = ""
-                        for page in pdf_reader.pages:
-                            text += page.extract_text() + "\n"
-                        return text
+                    return cache.text(pdf_path)
         else:
-            # Descargar desde URL externa
+            # Descargar desde URL externa (la caché usa el hash del contenido descargado)
             response = requests.get(pdf_url, timeout=30)
             response.raise_for_status()
-            pdf_file = io.BytesIO(response.content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text
+            return cache.text(response.content)
     except Exception as e:
         print(f"⚠️ Error extrayendo texto de PDF {pdf_url}: {e}")
         return None
 
 
-def summarize_content_for_context(
-    gemini_api_key: str,
-    content_text: str,
-    content_type: str,  # "teorico" o "examenes"
-    model: str = "gemini-1.5-pro"
-) -> Optional[str]:
-    """
-    Hace un resumen inteligente del contenido para usarlo como contexto
-    
-    Args:
-        gemini_api_key: API key de Google Gemini
-        content_text: Texto completo a resumir
-        content_type: Tipo de contenido ("teorico" o "examenes")
-        model: Modelo de Gemini a usar
-        
-    Returns:
-        Texto resumido con conceptos clave o None si hay error
-    """
-    try:
-        if content_type == "examenes":
-            prompt = f"""Analiza los siguientes exámenes y extrae:
+def _context_prompt(content_text: str, content_type: str) -> str:
+    """Prompt de extracción de contexto ("teorico" o "examenes")"""
+    if content_type == "examenes":
+        return f"""Analiza los siguientes exámenes y extrae:
 
 1. **Temas y conceptos que aparecen frecuentemente** (lista con frecuencia)
 2. **Tipos de preguntas más comunes** (múltiple opción, desarrollo, etc.)
@@ -1200,8 +1222,8 @@ EXÁMENES:
 {content_text}
 
 Extrae y estructura la información relevante:"""
-        else:  # teorico
-            prompt = f"""Analiza el siguiente material teórico y extrae:
+    else:  # teorico
+        return f"""Analiza el siguiente material teórico y extrae:
 
 1. **Conceptos principales y definiciones clave**
 2. **Estructura temática** (qué temas se cubren y en qué orden)
@@ -1215,150 +1237,193 @@ MATERIAL TEÓRICO:
 {content_text}
 
 Extrae y estructura la información relevante:"""
-        
-        # Primero, intentar obtener modelos disponibles de la API
-        available_models = []
+
+
+def _merge_prompt(partials: List[str], content_type: str) -> str:
+    """Prompt de la fase reduce: fusiona extractos parciales con la misma estructura"""
+    material = "EXÁMENES" if content_type == "examenes" else "MATERIAL TEÓRICO"
+    joined = "\n\n--- EXTRACTO ---\n\n".join(partials)
+    return f"""Los siguientes extractos son análisis parciales y consecutivos del mismo {material.lower()}.
+Fusiónalos en un único análisis con la misma estructura que los extractos:
+
+- Une los apartados equivalentes y elimina repeticiones, sin perder ningún concepto, definición, fórmula, procedimiento o ejemplo.
+- Respeta el orden temático original.
+- Si hay frecuencias o patrones, combínalos en lugar de repetirlos.
+
+Mantén TODA la información relevante pero de forma estructurada.
+
+EXTRACTOS DE {material}:
+{joined}
+
+Análisis fusionado:"""
+
+
+def _gemini_context_call(gemini_api_key: str, prompt: str, model: str) -> Tuple[Optional[str], Dict]:
+    """
+    Envía un prompt de contexto a Gemini (con fallback de modelo) y devuelve
+    (texto en bruto, usageMetadata). Lanza excepción si la API rechaza la petición.
+    """
+    # Primero, intentar obtener modelos disponibles de la API
+    available_models = _list_gemini_models(gemini_api_key)
+    
+    # Si no se pudieron listar, usar modelos por defecto conocidos
+    if not available_models:
+        available_models = ["gemini-pro", "gemini-1.0-pro", "gemini-1.5-pro", "gemini-1.5-flash"]
+    
+    # Mapear nombres antiguos a nombres correctos
+    model_mapping = {
+        "gemini-3-pro": "gemini-pro",
+        "gemini-3-flash": "gemini-pro",
+        "gemini-2.5-pro": "gemini-pro",
+        "gemini-2.5-flash": "gemini-pro",
+        "gemini-1.5-pro": "gemini-pro",
+        "gemini-1.5-flash": "gemini-pro",
+        "gemini-1.5-flash-8b": "gemini-pro",
+        "gemini-pro": "gemini-pro",
+    }
+    
+    # Intentar usar el modelo solicitado o su mapeo
+    preferred_model = model_mapping.get(model, model)
+    
+    # Si el modelo preferido no está disponible, usar el primero disponible
+    if preferred_model not in available_models and available_models:
+        preferred_model = available_models[0]
+        print(f"⚠️ Modelo {model} no disponible, usando {preferred_model}")
+    
+    # Usar directamente v1 (ya no está en beta)
+    url = f"https://generativelanguage.googleapis.com/v1/models/{preferred_model}:generateContent?key={gemini_api_key}"
+    
+    payload = {
+        "contents": [{
+            "parts": [{
+                "text": prompt
+            }]
+        }],
+        "generationConfig": {
+            "temperature": 0.3,  # Más bajo para resúmenes más precisos
+            "topK": 40,
+            "topP": 0.95,
+            "maxOutputTokens": 16384,  # Más tokens para resúmenes completos
+        }
+    }
+    
+    response = _provider_post("gemini", url, json=payload, timeout=180)
+    
+    # Si falla, intentar con otros modelos disponibles
+    if response.status_code == 404 and available_models:
+        for fallback_model in available_models:
+            if fallback_model != preferred_model:
+                print(f"⚠️ Modelo {preferred_model} no encontrado, intentando {fallback_model}...")
+                url_fallback = f"https://generativelanguage.googleapis.com/v1/models/{fallback_model}:generateContent?key={gemini_api_key}"
+                response = _provider_post("gemini", url_fallback, json=payload, timeout=180)
+                if response.status_code == 200:
+                    break
+    
+    # Si aún falla, verificar el error real
+    if response.status_code != 200:
         try:
-            list_url = f"https://generativelanguage.googleapis.com/v1/models?key={gemini_api_key}"
-            list_response = requests.get(list_url, timeout=10)
-            if list_response.status_code == 200:
-                models_data = list_response.json()
-                if "models" in models_data:
-                    for m in models_data["models"]:
-                        name = m.get("name", "").replace("models/", "")
-                        if "gemini" in name.lower() and "generateContent" in m.get("supportedGenerationMethods", []):
-                            available_models.append(name)
+            error_detail = response.json()
+            error_message = error_detail.get("error", {}).get("message", str(error_detail))
         except:
-            pass
-        
-        # Si no se pudieron listar, usar modelos por defecto conocidos
-        if not available_models:
-            available_models = ["gemini-pro", "gemini-1.0-pro", "gemini-1.5-pro", "gemini-1.5-flash"]
-        
-        # Mapear nombres antiguos a nombres correctos
-        model_mapping = {
-            "gemini-3-pro": "gemini-pro",
-            "gemini-3-flash": "gemini-pro",
-            "gemini-2.5-pro": "gemini-pro",
-            "gemini-2.5-flash": "gemini-pro",
-            "gemini-1.5-pro": "gemini-pro",
-            "gemini-1.5-flash": "gemini-pro",
-            "gemini-1.5-flash-8b": "gemini-pro",
-            "gemini-pro": "gemini-pro",
-        }
-        
-        # Intentar usar el modelo solicitado o su mapeo
-        preferred_model = model_mapping.get(model, model)
-        
-        # Si el modelo preferido no está disponible, usar el primero disponible
-        if preferred_model not in available_models and available_models:
-            preferred_model = available_models[0]
-            print(f"⚠️ Modelo {model} no disponible, usando {preferred_model}")
-        
-        # Usar directamente v1 (ya no está en beta)
-        url = f"https://generativelanguage.googleapis.com/v1/models/{preferred_model}:generateContent?key={gemini_api_key}"
-        
-        payload = {
-            "contents": [{
-                "parts": [{
-                    "text": prompt
-                }]
-            }],
-            "generationConfig": {
-                "temperature": 0.3,  # Más bajo para resúmenes más precisos
-                "topK": 40,
-                "topP": 0.95,
-                "maxOutputTokens": 16384,  # Más tokens para resúmenes completos
-            }
-        }
-        
-        response = requests.post(url, json=payload, timeout=180)
-        
-        # Si falla, intentar con otros modelos disponibles
-        if response.status_code == 404 and available_models:
-            for fallback_model in available_models:
-                if fallback_model != preferred_model:
-                    print(f"⚠️ Modelo {preferred_model} no encontrado, intentando {fallback_model}...")
-                    url_fallback = f"https://generativelanguage.googleapis.com/v1/models/{fallback_model}:generateContent?key={gemini_api_key}"
-                    response = requests.post(url_fallback, json=payload, timeout=180)
-                    if response.status_code == 200:
-                        break
-        
-        # Si aún falla, verificar el error real
-        if response.status_code != 200:
-            try:
-                error_detail = response.json()
-                error_message = error_detail.get("error", {}).get("message", str(error_detail))
-            except:
-                error_message = response.text[:500]
-            
-            print(f"❌ Error de API de Gemini (status {response.status_code}): {error_message}")
-            print(f"⚠️ URL intentada: {url_fallback if 'url_fallback' in locals() else url}")
-            print(f"⚠️ API Key configurada: {'Sí' if gemini_api_key else 'No'} (primeros 10 chars: {gemini_api_key[:10] if gemini_api_key else 'N/A'}...)")
-            
-            # Si es 401 o 403, el problema es la API key
-            if response.status_code in [401, 403]:
-                raise Exception(f"API key de Gemini inválida o sin permisos. Obtén una nueva en https://aistudio.google.com/app/apikey. Error: {error_message}")
-            # Si es 404, puede ser modelo o URL incorrecta
-            elif response.status_code == 404:
-                raise Exception(f"No se pudo conectar con la API de Gemini. Verifica:\n1. Que tu API key sea válida (obtén una en https://aistudio.google.com/app/apikey)\n2. Que tengas acceso a la API de Gemini\n3. Que la API key tenga los permisos necesarios\nError: {error_message}")
-        
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if "candidates" in result and len(result["candidates"]) > 0:
-            content = result["candidates"][0].get("content", {})
-            parts = content.get("parts", [])
-            if parts and "text" in parts[0]:
-                summarized_text = parts[0]["text"]
-                
-                # Limpiar HTML: eliminar bloques ```html si existen
-                if summarized_text.strip().startswith('```html') or summarized_text.strip().startswith('``` html'):
-                    match = re.search(r'```\s*html\s*\n(.*?)\n```\s*$', summarized_text, flags=re.DOTALL | re.IGNORECASE)
-                    if match:
-                        summarized_text = match.group(1)
-                        print(f"🧹 Extraído contenido HTML del bloque ```html")
-                    else:
-                        summarized_text = re.sub(r'^```\s*html\s*\n', '', summarized_text, flags=re.MULTILINE | re.IGNORECASE)
-                        summarized_text = summarized_text.strip()
-                
-                # Detectar si es Markdown o HTML ANTES de procesar imágenes
-                # Verificar si tiene elementos HTML válidos
-                has_html_tags = bool(re.search(r'<[a-z][a-z0-9]*[^>]*>', summarized_text[:500], re.IGNORECASE))
-                has_markdown = bool(re.search(r'\*\*[^*]+\*\*|^#+\s+', summarized_text[:500], re.MULTILINE))
-                
-                # Si tiene Markdown pero no HTML válido, convertir PRIMERO
-                if has_markdown and not has_html_tags:
-                    print(f"📝 Detectado Markdown, convirtiendo a HTML...")
-                    print(f"   Primeros 200 chars: {summarized_text[:200]}")
-                    summarized_text = _markdown_to_html(summarized_text)
-                    print(f"✅ Markdown convertido a HTML ({len(summarized_text)} chars)")
-                elif has_html_tags:
-                    print(f"✅ Contenido ya es HTML ({len(summarized_text)} chars)")
-                else:
-                    print(f"ℹ️ Contenido sin formato detectado, procesando como texto plano")
-                
-                # Procesar marcadores de imagen DESPUÉS de convertir Markdown a HTML
-                # Esto asegura que las imágenes se inserten en HTML válido
-                summarized_text = _process_image_markers(summarized_text)
-                
-                # Verificación final: asegurar que el contenido final sea HTML válido
-                # Si después de todo el procesamiento aún tiene Markdown, forzar conversión
-                if re.search(r'\*\*[^*]+\*\*|^#+\s+', summarized_text[:1000], re.MULTILINE):
-                    print(f"⚠️ Aún queda Markdown después del procesamiento, forzando conversión final...")
-                    summarized_text = _markdown_to_html(summarized_text)
-                    print(f"✅ Conversión final completada ({len(summarized_text)} chars)")
-                
-                usage_metadata = result.get("usageMetadata", {})
-                print(f"✅ Resumen de {content_type} generado:")
-                print(f"   - Tokens entrada: {usage_metadata.get('promptTokenCount', 0):,}")
-                print(f"   - Tokens salida: {usage_metadata.get('candidatesTokenCount', 0):,}")
-                
-                return summarized_text
-        
-        return None
-        
+            error_message = response.text[:500]
+        
+        print(f"❌ Error de API de Gemini (status {response.status_code}): {error_message}")
+        print(f"⚠️ URL intentada: {url_fallback if 'url_fallback' in locals() else url}")
+        print(f"⚠️ API Key configurada: {'Sí' if gemini_api_key else 'No'} (primeros 10 chars: {gemini_api_key[:10] if gemini_api_key else 'N/A'}...)")
+        
+        # Si es 401 o 403, el problema es la API key
+        if response.status_code in [401, 403]:
+            raise Exception(f"API key de Gemini inválida o sin permisos. Obtén una nueva en https://aistudio.google.com/app/apikey. Error: {error_message}")
+        # Si es 404, puede ser modelo o URL incorrecta
+        elif response.status_code == 404:
+            raise Exception(f"No se pudo conectar con la API de Gemini. Verifica:\n1. Que tu API key sea válida (obtén una en https://aistudio.google.com/app/apikey)\n2. Que tengas acceso a la API de Gemini\n3. Que la API key tenga los permisos necesarios\nError: {error_message}")
+    
+    response.raise_for_status()
+    
+    result = response.json()
+    usage_metadata = result.get("usageMetadata", {})
+    if "candidates" in result and len(result["candidates"]) > 0:
+        content = result["candidates"][0].get("content", {})
+        parts = content.get("parts", [])
+        if parts and "text" in parts[0]:
+            return parts[0]["text"], usage_metadata
+    return None, usage_metadata
+
+
+def _finish_context_summary(summarized_text: str) -> str:
+    """Limpia el bloque ```html, convierte Markdown a HTML y procesa marcadores de imagen"""
+    # Limpiar HTML: eliminar bloques ```html si existen
+    if summarized_text.strip().startswith('```html') or summarized_text.strip().startswith('``` html'):
+        match = re.search(r'```\s*html\s*\n(.*?)\n```\s*$', summarized_text, flags=re.DOTALL | re.IGNORECASE)
+        if match:
+            summarized_text = match.group(1)
+            print(f"🧹 Extraído contenido HTML del bloque ```html")
+        else:
+            summarized_text = re.sub(r'^```\s*html\s*\n', '', summarized_text, flags=re.MULTILINE | re.IGNORECASE)
+            summarized_text = summarized_text.strip()
+    
+    # Detectar si es Markdown o HTML ANTES de procesar imágenes
+    # Verificar si tiene elementos HTML válidos
+    has_html_tags = bool(re.search(r'<[a-z][a-z0-9]*[^>]*>', summarized_text[:500], re.IGNORECASE))
+    has_markdown = bool(re.search(r'\*\*[^*]+\*\*|^#+\s+', summarized_text[:500], re.MULTILINE))
+    
+    # Si tiene Markdown pero no HTML válido, convertir PRIMERO
+    if has_markdown and not has_html_tags:
+        print(f"📝 Detectado Markdown, convirtiendo a HTML...")
+        print(f"   Primeros 200 chars: {summarized_text[:200]}")
+        summarized_text = _markdown_to_html(summarized_text)
+        print(f"✅ Markdown convertido a HTML ({len(summarized_text)} chars)")
+    elif has_html_tags:
+        print(f"✅ Contenido ya es HTML ({len(summarized_text)} chars)")
+    else:
+        print(f"ℹ️ Contenido sin formato detectado, procesando como texto plano")
+    
+    # Procesar marcadores de imagen DESPUÉS de convertir Markdown a HTML
+    # Esto asegura que las imágenes se inserten en HTML válido
+    summarized_text = _process_image_markers(summarized_text)
+    
+    # Verificación final: asegurar que el contenido final sea HTML válido
+    # Si después de todo el procesamiento aún tiene Markdown, forzar conversión
+    if re.search(r'\*\*[^*]+\*\*|^#+\s+', summarized_text[:1000], re.MULTILINE):
+        print(f"⚠️ Aún queda Markdown después del procesamiento, forzando conversión final...")
+        summarized_text = _markdown_to_html(summarized_text)
+        print(f"✅ Conversión final completada ({len(summarized_text)} chars)")
+    return summarized_text
+
+
+def summarize_content_for_context(
+    gemini_api_key: str,
+    content_text: str,
+    content_type: str,  # "teorico" o "examenes"
+    model: str = "gemini-1.5-pro"
+) -> Optional[str]:
+    """
+    Hace un resumen inteligente del contenido para usarlo como contexto
+
+    Args:
+        gemini_api_key: API key de Google Gemini
+        content_text: Texto completo a resumir
+        content_type: Tipo de contenido ("teorico" o "examenes")
+        model: Modelo de Gemini a usar
+
+    Returns:
+        Texto resumido con conceptos clave o None si hay error
+    """
+    try:
+        summarized_text, usage_metadata = _gemini_context_call(
+            gemini_api_key, _context_prompt(content_text, content_type), model
+        )
+        if summarized_text is None:
+            return None
+
+        summarized_text = _finish_context_summary(summarized_text)
+
+        print(f"✅ Resumen de {content_type} generado:")
+        print(f"   - Tokens entrada: {usage_metadata.get('promptTokenCount', 0):,}")
+        print(f"   - Tokens salida: {usage_metadata.get('candidatesTokenCount', 0):,}")
+
+        return summarized_text
+
     except Exception as e:
         print(f"❌ Error generando resumen de {content_type}: {e}")
         import traceback
@@ -1366,6 +1431,198 @@ Extrae y estructura la información relevante:"""
         return None
 
 
+def _split_for_map_reduce(text: str, chunk_chars: int) -> List[str]:
+    """Trozos de hasta chunk_chars cortando por párrafos (o en seco si un párrafo no cabe)"""
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if current and size + len(paragraph) + 2 > chunk_chars:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current and "".join(current).strip():
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _cached_context_call(gemini_api_key: str, prompt: str, model: str, cache_key: str, kind: str) -> Optional[str]:
+    """Llamada de contexto cuyo resultado se guarda por la huella de sus entradas"""
+    cached = summary_jobs_storage.get_chunk_summary(cache_key)
+    if cached is not None:
+        return cached
+    text, _ = _gemini_context_call(gemini_api_key, prompt, model)
+    if text:
+        summary_jobs_storage.save_chunk_summary(cache_key, kind, text)
+    return text
+
+
+def _run_context_calls(gemini_api_key: str, model: str, tasks: List[Tuple[str, str, str]]) -> List[str]:
+    """Lanza en paralelo las llamadas (cache_key, prompt, kind); devuelve los textos en orden"""
+    results: List[Optional[str]] = [None] * len(tasks)
+    with ThreadPoolExecutor(max_workers=min(MAP_REDUCE_WORKERS, len(tasks)), thread_name_prefix="map-reduce") as pool:
+        futures = {
+            pool.submit(_cached_context_call, gemini_api_key, prompt, model, key, kind): index
+            for index, (key, prompt, kind) in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"   ⚠️ Resumen parcial fallido: {e}")
+    missing = sum(1 for r in results if not r)
+    if missing:
+        raise Exception(f"{missing} de {len(tasks)} resúmenes parciales fallaron (los demás quedan cacheados)")
+    return results
+
+
+def summarize_documents_for_context(
+    gemini_api_key: str,
+    texts: List[str],
+    content_type: str,  # "teorico" o "examenes"
+    model: str = "gemini-1.5-pro",
+    separator: str = "\n\n---\n\n",
+    force_map_reduce: bool = False
+) -> Optional[str]:
+    """
+    Resume varios documentos para usarlos como contexto. Si caben en un prompt
+    (MAP_REDUCE_THRESHOLD_CHARS) y no se pide force_map_reduce se resumen juntos como
+    siempre; si no, en modo map-reduce:
+    1. map: cada documento se trocea por separado y los trozos se resumen en paralelo
+    2. reduce: los resúmenes parciales se fusionan en árbol, de MAP_REDUCE_FANIN en MAP_REDUCE_FANIN
+    Cada trozo y cada fusión se cachean por la huella de su contenido, así que al
+    regenerar solo se vuelven a resumir los PDFs que han cambiado (y las fusiones
+    que dependen de ellos).
+
+    Returns:
+        Texto resumido o None si falla algún paso
+    """
+    texts = [t for t in texts if t and t.strip()]
+    if not texts:
+        return None
+    total_chars = sum(len(t) for t in texts)
+    if total_chars <= MAP_REDUCE_THRESHOLD_CHARS and not force_map_reduce:
+        return summarize_content_for_context(
+            gemini_api_key=gemini_api_key,
+            content_text=separator.join(texts),
+            content_type=content_type,
+            model=model
+        )
+
+    try:
+        # Trocear cada documento por separado: cambiar un PDF no desplaza los trozos de los demás
+        level: List[Tuple[str, str]] = []
+        for text in texts:
+            for chunk in _split_for_map_reduce(text, MAP_REDUCE_CHUNK_CHARS):
+                chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+                level.append((summary_jobs_storage.fingerprint("map", content_type, model, chunk_hash), chunk))
+        leaves = len(level)
+        print(f"🧩 Map-reduce de {content_type}: {total_chars:,} caracteres en {leaves} trozos")
+
+        summaries = _run_context_calls(
+            gemini_api_key, model, [(key, _context_prompt(chunk, content_type), "map") for key, chunk in level]
+        )
+        level = [(key, summary) for (key, _), summary in zip(level, summaries)]
+
+        depth = 0
+        while len(level) > 1:
+            depth += 1
+            groups = [level[i:i + MAP_REDUCE_FANIN] for i in range(0, len(level), MAP_REDUCE_FANIN)]
+            keys = [
+                summary_jobs_storage.fingerprint("reduce", content_type, model, [key for key, _ in group])
+                for group in groups
+            ]
+            tasks = [
+                (key, _merge_prompt([text for _, text in group], content_type), "reduce")
+                for key, group in zip(keys, groups) if len(group) > 1
+            ]
+            merged = dict(zip([key for key, _, _ in tasks], _run_context_calls(gemini_api_key, model, tasks)))
+            level = [
+                group[0] if len(group) == 1 else (key, merged[key])
+                for key, group in zip(keys, groups)
+            ]
+            print(f"   🔗 Nivel {depth} de fusión: {len(level)} resumen(es)")
+
+        summarized_text = _finish_context_summary(level[0][1])
+        print(f"✅ Resumen de {content_type} generado por map-reduce ({leaves} trozos, {depth} niveles de fusión)")
+        return summarized_text
+
+    except Exception as e:
+        print(f"❌ Error en el resumen map-reduce de {content_type}: {e}")
+        return None
+
+
+def build_exam_context(
+    gemini_api_key: str,
+    exam_examples_pdfs: Optional[List[str]],
+    model: str = "gemini-1.5-pro"
+) -> Optional[str]:
+    """
+    Extrae y resume los PDFs de exámenes. Es igual para todos los apartados de un
+    curso, así que generate_all_course_summaries lo calcula una sola vez.
+    
+    Returns:
+        Resumen de los exámenes; None si no hay exámenes o si no se pudo resumir
+    """
+    if not exam_examples_pdfs:
+        return None
+    
+    # Extraer texto de TODOS los PDFs de exámenes (sin límites)
+    print(f"📝 Extrayendo texto completo de {len(exam_examples_pdfs)} PDF(s) de exámenes...")
+    exam_texts = []
+    for exam_pdf_url in exam_examples_pdfs:
+        exam_text = extract_text_from_pdf(exam_pdf_url)
+        if exam_text:
+            exam_texts.append(exam_text)
+            print(f"   ✅ Examen extraído: {exam_pdf_url} ({len(exam_text):,} caracteres)")
+    
+    if not exam_texts:
+        return None
+    
+    material_examenes_completo = "\n\n--- EXAMEN ---\n\n".join(exam_texts)
+    print(f"📋 Material de exámenes completo: {len(material_examenes_completo):,} caracteres")
+    
+    # Hacer resumen inteligente de los exámenes (map-reduce si no caben en un prompt)
+    print(f"\n🔄 Generando resumen inteligente de los exámenes...")
+    material_examenes = summarize_documents_for_context(
+        gemini_api_key=gemini_api_key,
+        texts=exam_texts,
+        content_type="examenes",
+        model=model,
+        separator="\n\n--- EXAMEN ---\n\n"
+    )
+    
+    if not material_examenes:
+        # Reintento por map-reduce: trozos más pequeños y los parciales ya hechos salen de caché
+        print(f"⚠️ No se pudo generar resumen de exámenes, reintentando por map-reduce...")
+        material_examenes = summarize_documents_for_context(
+            gemini_api_key=gemini_api_key,
+            texts=exam_texts,
+            content_type="examenes",
+            model=model,
+            separator="\n\n--- EXAMEN ---\n\n",
+            force_map_reduce=True
+        )
+    
+    if not material_examenes:
+        if len(material_examenes_completo) <= MAP_REDUCE_THRESHOLD_CHARS:
+            # Cabe en un prompt: se usa completo, sin truncar
+            print(f"⚠️ Usando el texto completo de los exámenes")
+            return material_examenes_completo
+        # Sin truncar: cada apartado vuelve a intentarlo (los parciales quedan cacheados)
+        print(f"❌ No se pudo resumir el material de exámenes")
+        return None
+    
+    return material_examenes
+
+
 def generate_summary_with_gemini(
     gemini_api_key: str,
     topic_name: str,
@@ -1375,7 +1632,8 @@ def generate_summary_with_gemini(
     additional_comments: Optional[str] = None,
     is_subtopic: bool = False,
     model: str = "gemini-1.5-pro",  # Modelo por defecto: Gemini 1.5 Pro (mejor calidad)
-    exam_examples_pdfs: Optional[List[str]] = None  # PDFs de exámenes para priorizar contenido
+    exam_examples_pdfs: Optional[List[str]] = None,  # PDFs de exámenes para priorizar contenido
+    exam_context: Optional[str] = None  # Resumen de exámenes ya calculado (build_exam_context)
 ) -> Optional[str]:
     """
     Genera un resumen/apunte usando Gemini API con el prompt de academia
@@ -1390,6 +1648,8 @@ def generate_summary_with_gemini(
         is_subtopic: Si es True, es un subapartado
         model: Modelo de Gemini a usar
         exam_examples_pdfs: Lista de URLs de PDFs de exámenes para priorizar contenido
+        exam_context: Material de exámenes ya resumido; si se pasa, no se vuelven a
+            leer ni resumir exam_examples_pdfs
         
     Returns:
         Texto del resumen generado o None si hay error
@@ -1408,62 +1668,27 @@ def generate_summary_with_gemini(
             print(f"⚠️ No se pudo extraer texto de los PDFs para {topic_name}")
             return None
         
-        # Combinar TODOS los textos del material teórico (sin truncar)
-        material_teorico_completo = "\n\n---\n\n".join(pdf_texts)
-        print(f"📚 Material teórico completo: {len(material_teorico_completo):,} caracteres")
-        
-        # Extraer texto de TODOS los PDFs de exámenes (sin límites)
-        material_examenes_completo = None
-        if exam_examples_pdfs:
-            print(f"📝 Extrayendo texto completo de {len(exam_examples_pdfs)} PDF(s) de exámenes...")
-            exam_texts = []
-            for exam_pdf_url in exam_examples_pdfs:
-                exam_text = extract_text_from_pdf(exam_pdf_url)
-                if exam_text:
-                    exam_texts.append(exam_text)
-                    print(f"   ✅ Examen extraído: {exam_pdf_url} ({len(exam_text):,} caracteres)")
-            
-            if exam_texts:
-                material_examenes_completo = "\n\n--- EXAMEN ---\n\n".join(exam_texts)
-                print(f"📋 Material de exámenes completo: {len(material_examenes_completo):,} caracteres")
+        print(f"📚 Material teórico completo: {sum(len(text) for text in pdf_texts):,} caracteres")
         
         # Hacer resumen inteligente del material teórico para preservar todo el contenido
+        # (map-reduce por trozos cacheados si no cabe en un prompt)
         print(f"\n🔄 Generando resumen inteligente del material teórico...")
-        material_teorico = summarize_content_for_context(
+        material_teorico = summarize_documents_for_context(
             gemini_api_key=gemini_api_key,
-            content_text=material_teorico_completo,
+            texts=pdf_texts,
             content_type="teorico",
             model=model
         )
         
         if not material_teorico:
-            print(f"⚠️ No se pudo generar resumen del material teórico, usando texto completo (puede ser truncado)")
-            # Fallback: usar texto completo pero truncado si es muy largo
-            max_chars = 500000
-            if len(material_teorico_completo) > max_chars:
-                material_teorico = material_teorico_completo[:max_chars] + "\n\n[... texto truncado por límite ...]"
-            else:
-                material_teorico = material_teorico_completo
+            # Sin truncar: el elemento queda como fallido y el job lo reintenta al reanudarse
+            print(f"⚠️ No se pudo generar resumen del material teórico para {topic_name}")
+            return None
         
-        # Hacer resumen inteligente de los exámenes si existen
-        material_examenes = None
-        if material_examenes_completo:
-            print(f"\n🔄 Generando resumen inteligente de los exámenes...")
-            material_examenes = summarize_content_for_context(
-                gemini_api_key=gemini_api_key,
-                content_text=material_examenes_completo,
-                content_type="examenes",
-                model=model
-            )
-            
-            if not material_examenes:
-                print(f"⚠️ No se pudo generar resumen de exámenes, usando texto completo (puede ser truncado)")
-                # Fallback: usar texto completo pero truncado si es muy largo
-                max_chars = 300000
-                if len(material_examenes_completo) > max_chars:
-                    material_examenes = material_examenes_completo[:max_chars] + "\n\n[... exámenes truncados ...]"
-                else:
-                    material_examenes = material_examenes_completo
+        # Resumen de los exámenes: el precalculado para todo el curso o, si no hay, uno nuevo
+        material_examenes = exam_context
+        if material_examenes is None and exam_examples_pdfs:
+            material_examenes = build_exam_context(gemini_api_key, exam_examples_pdfs, model=model)
         
         # Construir el prompt usando el formato de academia
         topic_type = "subapartado" if is_subtopic else "apartado"
@@ -1593,19 +1818,7 @@ $$F = m \\cdot a$$
 ¡Comienza la generación ahora!"""
         
         # Primero, intentar obtener modelos disponibles de la API
-        available_models = []
-        try:
-            list_url = f"https://generativelanguage.googleapis.com/v1/models?key={gemini_api_key}"
-            list_response = requests.get(list_url, timeout=10)
-            if list_response.status_code == 200:
-                models_data = list_response.json()
-                if "models" in models_data:
-                    for m in models_data["models"]:
-                        name = m.get("name", "").replace("models/", "")
-                        if "gemini" in name.lower() and "generateContent" in m.get("supportedGenerationMethods", []):
-                            available_models.append(name)
-        except:
-            pass
+        available_models = _list_gemini_models(gemini_api_key)
         
         # Si no se pudieron listar, usar modelos por defecto conocidos
         if not available_models:
@@ -1648,7 +1861,7 @@ $$F = m \\cdot a$$
             }
         }
         
-        response = requests.post(url, json=payload, timeout=120)
+        response = _provider_post("gemini", url, json=payload, timeout=120)
         
         # Si falla, intentar con otros modelos disponibles
         if response.status_code == 404 and available_models:
@@ -1656,7 +1869,7 @@ $$F = m \\cdot a$$
                 if fallback_model != preferred_model:
                     print(f"⚠️ Modelo {preferred_model} no encontrado, intentando {fallback_model}...")
                     url_fallback = f"https://generativelanguage.googleapis.com/v1/models/{fallback_model}:generateContent?key={gemini_api_key}"
-                    response = requests.post(url_fallback, json=payload, timeout=120)
+                    response = _provider_post("gemini", url_fallback, json=payload, timeout=120)
                     if response.status_code == 200:
                         break
         
@@ -1849,7 +2062,14 @@ def estimate_gemini_cost(
     }
 
 
-def update_progress(course_id: str, current: int, total: int, current_item: str, status: str = "processing"):
+def update_progress(
+    course_id: str,
+    current: int,
+    total: int,
+    current_item: str,
+    status: str = "processing",
+    failed: int = 0
+):
     """Actualiza el progreso de generación de resúmenes"""
     with _progress_lock:
         _progress_tracker[course_id] = {
@@ -1858,7 +2078,10 @@ def update_progress(course_id: str, current: int, total: int, current_item: str,
             "percentage": int((current / total * 100)) if total > 0 else 0,
             "current_item": current_item,
             "status": status,
-            "completed": current >= total
+            "completed": current >= total,
+            "failed": failed,
+            # Los items fallidos se pueden reanudar sin repetir los que ya están hechos
+            "resumable": failed > 0
         }
 
 def get_progress(course_id: str) -> Optional[Dict]:
@@ -1872,6 +2095,34 @@ def clear_progress(course_id: str):
         if course_id in _progress_tracker:
             del _progress_tracker[course_id]
 
+def _course_items(topics: List[Dict]) -> List[Dict]:
+    """Apartados y subapartados con PDFs, en el orden del curso"""
+    items = []
+    for topic_index, topic in enumerate(topics):
+        topic_name = topic.get("name", "")
+        if topic.get("pdfs"):
+            items.append({
+                "item_id": f"t{topic_index}",
+                "topic_name": topic_name,
+                "name": topic_name,
+                "pdfs": topic.get("pdfs", []),
+                "is_subtopic": False,
+                "label": f"Apartado: {topic_name}",
+            })
+        for subtopic_index, subtopic in enumerate(topic.get("subtopics", [])):
+            if subtopic.get("pdfs"):
+                subtopic_name = subtopic.get("name", "")
+                items.append({
+                    "item_id": f"t{topic_index}s{subtopic_index}",
+                    "topic_name": topic_name,
+                    "name": subtopic_name,
+                    "pdfs": subtopic.get("pdfs", []),
+                    "is_subtopic": True,
+                    "label": f"Subapartado: {subtopic_name}",
+                })
+    return items
+
+
 def generate_all_course_summaries(
     gemini_api_key: str,
     course_id: str,
@@ -1880,11 +2131,18 @@ def generate_all_course_summaries(
     topics: List[Dict],
     additional_comments: Optional[str] = None,
     model: str = "gemini-1.5-pro",  # Modelo por defecto: Gemini 1.5 Pro
-    exam_examples_pdfs: Optional[List[str]] = None  # PDFs de exámenes para priorizar contenido
+    exam_examples_pdfs: Optional[List[str]] = None,  # PDFs de exámenes para priorizar contenido
+    resume: bool = True,  # Reutilizar los items ya generados con las mismas entradas
+    max_workers: Optional[int] = None  # Apartados en paralelo (por defecto SUMMARY_MAX_WORKERS)
 ) -> Dict[str, Dict]:
     """
     Genera resúmenes para todos los apartados y subapartados de un curso
     
+    Los items se generan en paralelo (la cuota de Gemini la reparte rate_limiter) y
+    el resumen de los exámenes se calcula una sola vez para todo el curso. El estado
+    de cada item se guarda en summary_jobs_storage: si la generación se corta o algún
+    item falla, volver a llamar con resume=True solo genera los que faltan.
+    
     Args:
         gemini_api_key: API key de Google Gemini
         course_id: ID del curso
@@ -1892,6 +2150,8 @@ def generate_all_course_summaries(
         course_description: Descripción del curso
         topics: Lista de temas con sus PDFs y subtopics
         additional_comments: Comentarios adicionales del usuario
+        resume: Si es False, regenera todos los items aunque ya estén hechos
+        max_workers: Número de items que se generan a la vez
         
     Returns:
         Diccionario con los resúmenes generados:
@@ -1904,8 +2164,6 @@ def generate_all_course_summaries(
             }
         }
     """
-    summaries = {}
-    
     print(f"\n📚 Iniciando generación de resúmenes para curso: {course_title}")
     print(f"   Total de apartados: {len(topics)}")
     
@@ -1920,77 +2178,101 @@ def generate_all_course_summaries(
     if cost_estimate.get('note'):
         print(f"   - {cost_estimate['note']}")
     
-    # Calcular total de items a procesar (apartados + subapartados)
-    total_items = 0
-    for topic in topics:
-        if topic.get("pdfs"):
-            total_items += 1  # Apartado principal
-        total_items += len([st for st in topic.get("subtopics", []) if st.get("pdfs")])
+    # Items a procesar (apartados + subapartados con PDFs) y la huella de sus entradas
+    items = _course_items(topics)
+    total_items = len(items)
+    fingerprints = {
+        item["item_id"]: summary_jobs_storage.fingerprint(
+            item["name"], item["pdfs"], item["is_subtopic"], course_title, course_description,
+            additional_comments, model, exam_examples_pdfs or []
+        )
+        for item in items
+    }
+    summary_jobs_storage.start_job(
+        course_id,
+        params={
+            "course_title": course_title,
+            "course_description": course_description,
+            "topics": topics,
+            "additional_comments": additional_comments,
+            "model": model,
+            "exam_examples_pdfs": exam_examples_pdfs or [],
+        },
+        item_ids=[item["item_id"] for item in items],
+    )
     
-    current_item = 0
+    results: Dict[str, Optional[str]] = {}
+    if resume:
+        results.update(summary_jobs_storage.get_completed_items(course_id, fingerprints))
+        if results:
+            print(f"♻️ Reanudando: {len(results)}/{total_items} items ya generados")
+    pending = [item for item in items if item["item_id"] not in results]
     
-    # Inicializar progreso
-    update_progress(course_id, 0, total_items, "Iniciando...", "processing")
+    completed = len(results)
+    failed = 0
+    update_progress(course_id, completed, total_items, "Iniciando...", "processing")
     
-    # Generar resúmenes para cada apartado
-    for topic in topics:
-        topic_name = topic.get("name", "")
-        pdfs = topic.get("pdfs", [])
-        subtopics = topic.get("subtopics", [])
-        
-        print(f"\n📖 Generando resumen para apartado: {topic_name}")
+    if pending:
+        # El contexto de exámenes es el mismo para todos los items: una sola extracción y resumen
+        exam_context = build_exam_context(gemini_api_key, exam_examples_pdfs, model=model)
         
-        # Generar resumen del apartado principal (si tiene PDFs)
-        topic_summary = None
-        if pdfs:
-            current_item += 1
-            update_progress(course_id, current_item, total_items, f"Apartado: {topic_name}", "processing")
-            topic_summary = generate_summary_with_gemini(
+        def generate_item(item: Dict) -> Optional[str]:
+            print(f"\n📖 Generando resumen para {item['label'].lower()}")
+            return generate_summary_with_gemini(
                 gemini_api_key=gemini_api_key,
-                topic_name=topic_name,
-                pdf_urls=pdfs,
+                topic_name=item["name"],
+                pdf_urls=item["pdfs"],
                 course_title=course_title,
                 course_description=course_description,
                 additional_comments=additional_comments,
-                is_subtopic=False,
+                is_subtopic=item["is_subtopic"],
                 model=model,
-                exam_examples_pdfs=exam_examples_pdfs
+                exam_context=exam_context
             )
         
-        # Generar resúmenes para subapartados
-        subtopic_summaries = {}
-        for subtopic in subtopics:
-            subtopic_name = subtopic.get("name", "")
-            subtopic_pdfs = subtopic.get("pdfs", [])
-            
-            if subtopic_pdfs:
-                current_item += 1
-                update_progress(course_id, current_item, total_items, f"Subapartado: {subtopic_name}", "processing")
-                print(f"   📝 Generando resumen para subapartado: {subtopic_name}")
-                subtopic_summary = generate_summary_with_gemini(
-                    gemini_api_key=gemini_api_key,
-                    topic_name=subtopic_name,
-                    pdf_urls=subtopic_pdfs,
-                    course_title=course_title,
-                    course_description=course_description,
-                    additional_comments=additional_comments,
-                    is_subtopic=True,
-                    model=model,
-                    exam_examples_pdfs=exam_examples_pdfs
+        workers = max(1, min(max_workers or SUMMARY_MAX_WORKERS, len(pending)))
+        print(f"⚙️ Generando {len(pending)} items con {workers} workers en paralelo")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary") as pool:
+            futures = {pool.submit(generate_item, item): item for item in pending}
+            for future in as_completed(futures):
+                item = futures[future]
+                error = None
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    summary, error = None, str(e)
+                summary_jobs_storage.save_item_result(
+                    course_id, item["item_id"], fingerprints[item["item_id"]], item["name"],
+                    summary=summary, error=error
                 )
-                if subtopic_summary:
-                    subtopic_summaries[subtopic_name] = subtopic_summary
-        
-        # Guardar resúmenes del apartado
-        summaries[topic_name] = {
-            "summary": topic_summary,
+                completed += 1
+                if summary:
+                    results[item["item_id"]] = summary
+                else:
+                    failed += 1
+                    print(f"⚠️ Falló {item['label']}: se podrá reanudar más tarde")
+                update_progress(course_id, completed, total_items, item["label"], "processing", failed=failed)
+    
+    # Imágenes que quedaron resolviéndose mientras se generaban otros apartados
+    results = {item_id: patch_pending_images(summary) for item_id, summary in results.items()}
+    
+    # Montar la respuesta en el orden del curso
+    summaries = {}
+    for topic_index, topic in enumerate(topics):
+        subtopic_summaries = {}
+        for subtopic_index, subtopic in enumerate(topic.get("subtopics", [])):
+            subtopic_summary = results.get(f"t{topic_index}s{subtopic_index}")
+            if subtopic_summary:
+                subtopic_summaries[subtopic.get("name", "")] = subtopic_summary
+        summaries[topic.get("name", "")] = {
+            "summary": results.get(f"t{topic_index}"),
             "subtopics": subtopic_summaries
         }
     
     # Marcar como completado
-    update_progress(course_id, total_items, total_items, "Completado", "completed")
+    summary_jobs_storage.finish_job(course_id, "failed" if failed else "completed", failed)
+    update_progress(course_id, total_items, total_items, "Completado", "completed", failed=failed)
     
-    print(f"\n✅ Generación de resúmenes completada para {len(summaries)} apartados")
+    print(f"\n✅ Generación de resúmenes completada para {len(summaries)} apartados ({failed} items fallidos)")
     
     return summaries
-
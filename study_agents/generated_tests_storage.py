@@ -0,0 +1,123 @@
+"""
+Sistema de almacenamiento de tests generados
+Guarda cada test (preguntas, respuestas correctas y explicaciones) en la base de
+datos embebida (storage_engine) con clave test_id, para que /api/grade-test pueda
+corregirlo aunque llegue a otro worker de uvicorn o a otra entrada de systems_cache.
+Delante hay una LRU en memoria acotada (los tests no cambian una vez generados) y
+cada test caduca a los GENERATED_TEST_TTL_SECONDS.
+"""
+
+import copy
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, transaction
+
+# Segundos que se puede corregir un test desde que se generó
+GENERATED_TEST_TTL_SECONDS = max(60, int(os.getenv("GENERATED_TEST_TTL_SECONDS", str(7 * 24 * 3600))))
+# Tests recientes que cada proceso mantiene en memoria
+GENERATED_TEST_CACHE_SIZE = max(1, int(os.getenv("GENERATED_TEST_CACHE_SIZE", "256")))
+# Cada cuántos tests guardados se borran los caducados
+_PURGE_EVERY = 100
+
+
+def _expires_value(expires_at: Optional[float]) -> Optional[str]:
+    """Segundos epoch con ancho fijo: el orden de texto del índice es el orden temporal"""
+    return f"{max(0, int(expires_at)):012d}" if expires_at is not None else None
+
+
+_tests = Repository("generated_tests", indexes={"expires": lambda t: _expires_value(t.get("expires_at"))})
+
+_lock = threading.Lock()
+_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_counters = {"saved": 0, "hits": 0, "misses": 0, "expired": 0}
+
+
+def _remember(test_id: str, record: Dict) -> None:
+    with _lock:
+        _cache[test_id] = record
+        _cache.move_to_end(test_id)
+        while len(_cache) > GENERATED_TEST_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def save_test(test_id: str, test_data: Dict) -> None:
+    """Guarda un test recién generado (se copia: cambios posteriores del llamador no le afectan)"""
+    now = time.time()
+    record = {
+        "test_id": test_id,
+        "test": copy.deepcopy(test_data),
+        "created_at": datetime.now().isoformat(),
+        "expires_at": now + GENERATED_TEST_TTL_SECONDS,
+    }
+    _tests.put(test_id, record)
+    _remember(test_id, record)
+    with _lock:
+        _counters["saved"] += 1
+        purge = _counters["saved"] % _PURGE_EVERY == 1
+    if purge:
+        purge_expired()
+
+
+def get_test(test_id: str) -> Optional[Dict]:
+    """Copia del test o None si no existe o ha caducado"""
+    with _lock:
+        record = _cache.get(test_id)
+        if record is not None:
+            _cache.move_to_end(test_id)
+    if record is None:
+        record = _tests.get(test_id)
+        if record is not None:
+            _remember(test_id, record)
+    if record is not None and record.get("expires_at", 0) <= time.time():
+        delete_test(test_id)
+        with _lock:
+            _counters["expired"] += 1
+        record = None
+    with _lock:
+        _counters["hits" if record is not None else "misses"] += 1
+    return copy.deepcopy(record["test"]) if record is not None else None
+
+
+def delete_test(test_id: str) -> bool:
+    with _lock:
+        _cache.pop(test_id, None)
+    return _tests.delete(test_id)
+
+
+def purge_expired() -> int:
+    """Borra los tests caducados; devuelve cuántos"""
+    keys = _tests.keys_in_range("expires", upper=_expires_value(time.time()))
+    if not keys:
+        return 0
+    with transaction():
+        for test_id in keys:
+            _tests.delete(test_id)
+    with _lock:
+        for test_id in keys:
+            _cache.pop(test_id, None)
+        _counters["expired"] += len(keys)
+    print(f"🧹 {len(keys)} test(s) generados caducados eliminados")
+    return len(keys)
+
+
+def stats() -> Dict:
+    stored = _tests.count()
+    with _lock:
+        lookups = _counters["hits"] + _counters["misses"]
+        return {
+            "stored": stored,
+            "cached": len(_cache),
+            "cache_size": GENERATED_TEST_CACHE_SIZE,
+            "ttl_seconds": GENERATED_TEST_TTL_SECONDS,
+            **_counters,
+            "hit_rate": round(_counters["hits"] / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,200 @@
+"""
+Image Resolver - Resolución de imágenes de los marcadores con caché persistente
+- ImageCache: resultado de cada búsqueda/generación en kv_cache (SQLite), con clave
+  (espacio, sha256 de la descripción normalizada). Los "no encontrado" caducan
+  (IMAGE_CACHE_NEGATIVE_TTL_SECONDS) para reintentar fallos transitorios; una imagen
+  generada en disco deja de valer si se borra el fichero.
+- ImageResolver: resuelve todos los marcadores de un documento a la vez en un pool
+  compartido. La misma descripción en vuelo se resuelve una sola vez. Pasado el plazo
+  (deadline) devuelve lo que haya y el resto sigue resolviéndose en segundo plano: su
+  resultado queda en caché para sustituir después los placeholders.
+El límite de concurrencia por proveedor (Gemini, DALL-E, Unsplash...) lo aplica rate_limiter.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from kv_cache import LRUKVCache
+
+IMAGE_CACHE_MAX_ENTRIES = max(1, int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "20000")))
+# Segundos que se recuerda un "no se encontró imagen" antes de volver a intentarlo
+IMAGE_CACHE_NEGATIVE_TTL_SECONDS = max(0, int(os.getenv("IMAGE_CACHE_NEGATIVE_TTL_SECONDS", "21600")))
+# Resoluciones simultáneas (el límite por proveedor lo pone rate_limiter)
+IMAGE_RESOLVE_WORKERS = max(1, int(os.getenv("IMAGE_RESOLVE_WORKERS", "8")))
+# Segundos que se espera a las imágenes de un documento antes de emitir placeholders
+IMAGE_RESOLVE_DEADLINE_SECONDS = max(0.0, float(os.getenv("IMAGE_RESOLVE_DEADLINE_SECONDS", "60")))
+
+ImageResult = Optional[Dict[str, Any]]
+ImageSearch = Callable[[str], ImageResult]
+
+
+def normalize_description(description: str) -> str:
+    """Misma clave para descripciones que solo difieren en mayúsculas, espacios o entidades HTML"""
+    text = unicodedata.normalize("NFKC", html.unescape(description or ""))
+    text = re.sub(r"\s+", " ", text).strip().strip(".,;:!¡?¿\"'").strip()
+    return text.lower()
+
+
+def description_key(description: str) -> str:
+    return hashlib.sha256(normalize_description(description).encode("utf-8")).hexdigest()[:32]
+
+
+class ImageCache:
+    """
+    Caché de resoluciones de imagen sobre kv_cache (clave "espacio:hash") con evicción LRU.
+    Segura entre hilos; guarda también los resultados negativos con caducidad.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+        negative_ttl_seconds: int = IMAGE_CACHE_NEGATIVE_TTL_SECONDS,
+        store: Optional[LRUKVCache] = None,
+    ):
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.store = store or LRUKVCache("images", max_entries)
+
+    def _valid(self, value: str) -> bool:
+        entry = json.loads(value)
+        result = entry.get("result")
+        if result is None:
+            return time.time() - entry["created_at"] <= self.negative_ttl_seconds
+        return not result.get("local_path") or os.path.exists(result["local_path"])
+
+    def get(self, namespace: str, key: str) -> Tuple[bool, ImageResult]:
+        """(encontrado, resultado); resultado None = se buscó y no había imagen"""
+        value = self.store.get(f"{namespace}:{key}", valid=self._valid)
+        if value is None:
+            return False, None
+        return True, json.loads(value).get("result")
+
+    def put(self, namespace: str, key: str, description: str, result: ImageResult) -> None:
+        entry = {"description": description, "result": result or None, "created_at": time.time()}
+        self.store.put(f"{namespace}:{key}", json.dumps(entry, ensure_ascii=False))
+
+    def stats(self) -> Dict[str, Any]:
+        return self.store.stats()
+
+
+class ImageResolver:
+    """
+    Resuelve descripciones de imagen con caché y en paralelo.
+    resolve_many espera como mucho deadline segundos; las que no han terminado se
+    quedan resolviendo en segundo plano (y en caché al acabar).
+    """
+
+    def __init__(self, cache: Optional[ImageCache] = None, workers: int = IMAGE_RESOLVE_WORKERS):
+        self.cache = cache or ImageCache()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-resolve")
+        self._inflight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.resolved = 0
+        self.failed = 0
+        self.deadline_misses = 0
+
+    def _run(self, namespace: str, key: str, description: str, search: ImageSearch) -> ImageResult:
+        try:
+            result = search(description)
+            self.cache.put(namespace, key, description, result)
+            with self._lock:
+                self.resolved += 1
+            return result
+        except Exception as e:
+            print(f"⚠️ Error resolviendo imagen '{description[:60]}': {e}")
+            with self._lock:
+                self.failed += 1
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop((namespace, key), None)
+
+    def _submit(self, namespace: str, description: str, search: ImageSearch) -> Future:
+        key = description_key(description)
+        found, result = self.cache.get(namespace, key)
+        if found:
+            future: Future = Future()
+            future.set_result(result)
+            return future
+        with self._lock:
+            future = self._inflight.get((namespace, key))
+            if future is None:
+                future = self._pool.submit(self._run, namespace, key, description, search)
+                self._inflight[(namespace, key)] = future
+            return future
+
+    def lookup(self, namespace: str, key: str) -> Tuple[bool, ImageResult]:
+        """Solo caché: (encontrado, resultado) para la clave de description_key"""
+        return self.cache.get(namespace, key)
+
+    def resolve(
+        self,
+        description: str,
+        search: ImageSearch,
+        namespace: str,
+        timeout: Optional[float] = IMAGE_RESOLVE_DEADLINE_SECONDS,
+    ) -> ImageResult:
+        """Una sola descripción; None si no hay imagen o no llega a tiempo"""
+        return self.resolve_many([description], search, namespace, deadline=timeout).get(description)
+
+    def resolve_many(
+        self,
+        descriptions: Iterable[str],
+        search: ImageSearch,
+        namespace: str,
+        deadline: Optional[float] = IMAGE_RESOLVE_DEADLINE_SECONDS,
+    ) -> Dict[str, ImageResult]:
+        """
+        Resuelve todas las descripciones a la vez
+
+        Args:
+            descriptions: Descripciones (se deduplican)
+            search: Función que busca o genera la imagen de una descripción
+            namespace: Espacio de la caché (p. ej. "summary" o "stock")
+            deadline: Segundos máximos de espera (None = sin límite)
+
+        Returns:
+            {descripción: resultado} de las terminadas (None = sin imagen);
+            las que siguen pendientes no aparecen
+        """
+        futures = {d: self._submit(namespace, d, search) for d in dict.fromkeys(descriptions) if d}
+        if not futures:
+            return {}
+        done, pending = wait(list(futures.values()), timeout=deadline)
+        if pending:
+            with self._lock:
+                self.deadline_misses += len(pending)
+            print(f"⏳ {len(pending)} imagen(es) siguen resolviéndose en segundo plano")
+        return {d: f.result() for d, f in futures.items() if f in done}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            runtime = {
+                "in_flight": len(self._inflight),
+                "resolved": self.resolved,
+                "failed": self.failed,
+                "deadline_misses": self.deadline_misses,
+            }
+        return {**runtime, "cache": self.cache.stats()}
+
+
+_resolver: Optional[ImageResolver] = None
+_resolver_lock = threading.Lock()
+
+
+def get_image_resolver() -> ImageResolver:
+    """Resolver compartido por todo el proceso"""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = ImageResolver()
+        return _resolver
@@ -0,0 +1,228 @@
+"""
+KV Cache - Cachés clave/valor persistentes con evicción LRU
+Todas las cachés derivadas (embeddings, feedback, texto de PDFs, imágenes) comparten
+un único fichero SQLite (modo WAL) y una tabla; cada caché es un nombre dentro de ella
+con su propio límite de entradas y sus contadores de aciertos/fallos.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+_ROOT = Path(__file__).resolve().parent
+CACHE_PATH = Path(os.getenv("KV_CACHE_PATH", str(_ROOT / "data" / "cache.sqlite3")))
+# Espera máxima por el lock de escritura (varias cachés escriben en el mismo fichero)
+BUSY_TIMEOUT_MS = max(0, int(os.getenv("KV_CACHE_BUSY_TIMEOUT_MS", "10000")))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    cache TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (cache, key)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_last_used ON cache_entries(cache, last_used);
+"""
+
+# Límite de parámetros por consulta en SQLite
+_BATCH = 500
+
+Value = Any  # str o bytes
+
+
+class LRUKVCache:
+    """
+    Una caché con nombre dentro del fichero compartido.
+    max_entries=None desactiva la evicción (el dueño borra las entradas él mismo).
+    on_evict(claves) se llama con las claves expulsadas, ya confirmado el borrado.
+    Segura entre hilos.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: Optional[int],
+        path: Path = CACHE_PATH,
+        on_evict: Optional[Callable[[List[str]], None]] = None,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.path = Path(path)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COUNT(*) FROM cache_entries WHERE cache = ?", (name,)
+        ).fetchone()[0]
+
+    # ------------------------------------------------------------------ lectura
+
+    def get(self, key: str, valid: Optional[Callable[[Value], bool]] = None, track: bool = True) -> Optional[Value]:
+        """
+        Valor guardado para key o None; actualiza su uso (LRU).
+        valid(valor) permite descartar entradas caducadas (cuentan como fallo).
+        track=False no toca los contadores (el dueño decide qué es un acierto con record()).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache_entries WHERE cache = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            if row is None or (valid is not None and not valid(row[0])):
+                if track:
+                    self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE cache_entries SET last_used = ? WHERE cache = ? AND key = ?",
+                (time.time(), self.name, key),
+            )
+            self._conn.commit()
+            if track:
+                self.hits += 1
+            return row[0]
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, Value]:
+        """Devuelve {clave: valor} para las claves presentes y actualiza su uso (LRU)."""
+        found: Dict[str, Value] = {}
+        if not keys:
+            return found
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), _BATCH):
+                part = unique[start:start + _BATCH]
+                placeholders = ",".join("?" for _ in part)
+                found.update(self._conn.execute(
+                    f"SELECT key, value FROM cache_entries WHERE cache = ? AND key IN ({placeholders})",
+                    [self.name, *part],
+                ).fetchall())
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE cache_entries SET last_used = ? WHERE cache = ? AND key = ?",
+                    [(now, self.name, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def scan(self, start: str, end: str) -> List[Tuple[str, Value]]:
+        """(clave, valor) con start <= clave < end, en orden; no cuenta ni actualiza el uso"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, value FROM cache_entries WHERE cache = ? AND key >= ? AND key < ? ORDER BY key",
+                (self.name, start, end),
+            ).fetchall()
+
+    def count(self, start: str, end: str) -> int:
+        """Número de claves con start <= clave < end"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE cache = ? AND key >= ? AND key < ?",
+                (self.name, start, end),
+            ).fetchone()[0]
+
+    # ------------------------------------------------------------------ escritura
+
+    def put(self, key: str, value: Value, replace: bool = True) -> None:
+        self.put_many({key: value}, replace=replace)
+
+    def put_many(self, items: Dict[str, Value], replace: bool = True) -> None:
+        """
+        Guarda las entradas y aplica la evicción LRU si se supera max_entries.
+        replace=False conserva el valor de las claves que ya existían.
+        """
+        if not items:
+            return
+        now = time.time()
+        keys = list(items)
+        with self._lock:
+            existing = 0
+            for start in range(0, len(keys), _BATCH):
+                part = keys[start:start + _BATCH]
+                placeholders = ",".join("?" for _ in part)
+                existing += self._conn.execute(
+                    f"SELECT COUNT(*) FROM cache_entries WHERE cache = ? AND key IN ({placeholders})",
+                    [self.name, *part],
+                ).fetchone()[0]
+            verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+            self._conn.executemany(
+                f"{verb} INTO cache_entries (cache, key, value, last_used) VALUES (?, ?, ?, ?)",
+                [(self.name, key, value, now) for key, value in items.items()],
+            )
+            self._size += len(keys) - existing
+            victims = self._evict()
+            self._conn.commit()
+        if self.on_evict is not None and victims:
+            self.on_evict(victims)
+
+    def delete_range(self, start: str, end: str) -> int:
+        """Borra las claves con start <= clave < end"""
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM cache_entries WHERE cache = ? AND key >= ? AND key < ?",
+                (self.name, start, end),
+            ).rowcount
+            self._size -= deleted
+            self._conn.commit()
+            return deleted
+
+    def _evict(self) -> List[str]:
+        if self.max_entries is None:
+            return []
+        overflow = self._size - self.max_entries
+        if overflow <= 0:
+            return []
+        victims = [
+            row[0] for row in self._conn.execute(
+                "SELECT key FROM cache_entries WHERE cache = ? ORDER BY last_used ASC LIMIT ?",
+                (self.name, overflow),
+            )
+        ]
+        self._conn.executemany(
+            "DELETE FROM cache_entries WHERE cache = ? AND key = ?", [(self.name, key) for key in victims]
+        )
+        self._size -= len(victims)
+        self.evictions += len(victims)
+        return victims
+
+    # ------------------------------------------------------------------ métricas
+
+    def record(self, hit: bool) -> None:
+        """Cuenta un acierto/fallo decidido por el dueño de la caché (p. ej. rango completo)"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    """(start, end) para scan/count/delete_range de todas las claves que empiezan por prefix"""
+    return prefix, prefix + "\uffff"
@@ -1,22 +1,64 @@
 """
 Almacenamiento de palabras aprendidas por usuario e idioma
+Una fila por palabra en la base de datos embebida (storage_engine): añadir una palabra
+no reescribe el vocabulario entero. Los JSON antiguos de data/learned_words se migran solos.
 """
 
+import hashlib
 import json
+import os
+import sys
 from pathlib import Path
 from typing import List, Dict, Optional
 from datetime import datetime
 
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository
+import data_paths
+
+# Directorio de palabras en JSON (formato antiguo, solo para la migración)
+LEARNED_WORDS_DIR = data_paths.LEARNED_WORDS_DIR
+
+
+def _normalize_language(language: str) -> str:
+    return language.lower().replace(" ", "_").replace("/", "_")
+
 
 def get_learned_words_file_path(user_id: str, language: str) -> Path:
-    """Obtiene la ruta del archivo de palabras aprendidas para un usuario e idioma"""
-    base_dir = Path("data/learned_words")
-    base_dir.mkdir(parents=True, exist_ok=True)
-    user_dir = base_dir / user_id
-    user_dir.mkdir(exist_ok=True)
-    # Normalizar el nombre del idioma para el archivo
-    language_normalized = language.lower().replace(" ", "_").replace("/", "_")
-    return user_dir / f"{language_normalized}.json"
+    """Obtiene la ruta del archivo de palabras aprendidas (formato JSON antiguo)"""
+    return LEARNED_WORDS_DIR / user_id / f"{_normalize_language(language)}.json"
+
+
+def _word_key(user_id: str, language_normalized: str, word: str, translation: str) -> str:
+    digest = hashlib.sha1(f"{word}\x1f{translation}".encode("utf-8")).hexdigest()[:16]
+    return f"{user_id}/{language_normalized}/{digest}"
+
+
+def _legacy_words():
+    if not LEARNED_WORDS_DIR.exists():
+        return
+    for words_file in LEARNED_WORDS_DIR.glob("*/*.json"):
+        try:
+            with open(words_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error al leer {words_file}: {e}")
+            continue
+        user_id = words_file.parent.name
+        language_normalized = words_file.stem
+        for w in data.get("words", []):
+            record = {**w, "user_id": user_id, "language": language_normalized}
+            yield _word_key(user_id, language_normalized, w.get("word"), w.get("translation")), record
+
+
+_words = Repository(
+    "learned_words",
+    indexes={"owner": lambda w: f"{w.get('user_id')}/{w.get('language')}"},
+    legacy=_legacy_words,
+    legacy_sources=[LEARNED_WORDS_DIR],
+)
 
 
 def add_learned_word(
@@ -44,47 +86,20 @@ def add_learned_word(
         True si se agregó correctamente
     """
     try:
-        words_file = get_learned_words_file_path(user_id, language)
+        language_normalized = _normalize_language(language)
+        new_word = {
+            "word": word,
+            "translation": translation,
+            "source": source,
+            "example": example,
+            "romanization": romanization,
+            "learned_at": datetime.now().isoformat(),
+            "user_id": user_id,
+            "language": language_normalized
+        }
         
-        # Cargar palabras existentes
-        learned_words = []
-        if words_file.exists():
-            with open(words_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                learned_words = data.get("words", [])
-        
-        # Verificar si la palabra ya existe
-        word_exists = any(
-            w.get("word") == word and w.get("translation") == translation
-            for w in learned_words
-        )
-        
-        if not word_exists:
-            # Agregar nueva palabra
-            new_word = {
-                "word": word,
-                "translation": translation,
-                "source": source,
-                "example": example,
-                "romanization": romanization,
-                "learned_at": datetime.now().isoformat()
-            }
-            learned_words.append(new_word)
-            
-            # Guardar
-            data = {
-                "user_id": user_id,
-                "language": language,
-                "words": learned_words,
-                "updated_at": datetime.now().isoformat()
-            }
-            
-            with open(words_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            return True
-        
-        return False
+        # La clave depende de (palabra, traducción): si ya existe no se duplica
+        return _words.insert(_word_key(user_id, language_normalized, word, translation), new_word)
     except Exception as e:
         print(f"Error adding learned word: {e}")
         return False
@@ -102,14 +117,12 @@ def get_learned_words(user_id: str, language: str) -> List[Dict]:
         Lista de palabras aprendidas
     """
     try:
-        words_file = get_learned_words_file_path(user_id, language)
-        
-        if not words_file.exists():
-            return []
-        
-        with open(words_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("words", [])
+        words = [
+            {k: v for k, v in w.items() if k not in ("user_id", "language")}
+            for w in _words.find(owner=f"{user_id}/{_normalize_language(language)}")
+        ]
+        words.sort(key=lambda w: w.get("learned_at") or "")
+        return words
     except Exception as e:
         print(f"Error getting learned words: {e}")
         return []
@@ -126,8 +139,11 @@ def get_all_learned_words_count(user_id: str, language: str) -> int:
     Returns:
         Número de palabras aprendidas
     """
-    words = get_learned_words(user_id, language)
-    return len(words)
+    try:
+        return _words.count(owner=f"{user_id}/{_normalize_language(language)}")
+    except Exception as e:
+        print(f"Error counting learned words: {e}")
+        return 0
 
 
 def calculate_level_from_words(word_count: int) -> int:
@@ -0,0 +1,220 @@
+"""
+LLM Pool - Reutilización de clientes LLM entre peticiones
+- LLMClientPool: clientes ChatOpenAI/ChatOllama por (proveedor, modelo, hash de key,
+  temperatura, max_tokens) con TTL por inactividad y límite de entradas.
+- Cada cliente del pool conserva su propio cliente HTTP (keep-alive): el handshake TLS
+  se paga una vez por cliente, no una vez por petición. No se comparte un httpx.Client
+  entre clientes: langchain-openai 0.0.8 usaría el mismo objeto para la ruta asíncrona.
+- OllamaInventory: lista de modelos de Ollama cacheada y refrescada en segundo plano.
+Los clientes no guardan estado de la conversación, así que un mismo cliente sirve a
+varias peticiones a la vez; quien lo recibe no debe modificarlo (p. ej. temperature).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# Clientes LLM residentes como máximo
+LLM_POOL_MAX_ENTRIES = max(1, int(os.getenv("LLM_POOL_MAX_ENTRIES", "64")))
+# Segundos sin uso antes de descartar un cliente (0 = sin TTL)
+LLM_POOL_TTL_SECONDS = max(0, int(os.getenv("LLM_POOL_TTL_SECONDS", "900")))
+# Timeout de cada llamada HTTP a un proveedor compatible con OpenAI
+LLM_HTTP_TIMEOUT_SECONDS = float(os.getenv("LLM_HTTP_TIMEOUT_SECONDS", "120"))
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# Antigüedad máxima del inventario de Ollama antes de refrescarlo en segundo plano
+OLLAMA_INVENTORY_TTL_SECONDS = max(1, int(os.getenv("OLLAMA_INVENTORY_TTL_SECONDS", "60")))
+
+PoolKey = Tuple[str, str, str, float, Optional[int]]
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """Hash corto de la API key: la clave del pool nunca contiene la key en claro"""
+    if not api_key:
+        return "-"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class _Entry:
+    __slots__ = ("value", "last_used")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self.last_used = time.monotonic()
+
+
+class LLMClientPool:
+    """
+    Caché LRU/TTL de clientes LLM. get_or_create construye el cliente solo si no hay
+    uno vivo para esa clave; dos peticiones simultáneas no construyen el mismo.
+    """
+
+    def __init__(self, max_entries: int = LLM_POOL_MAX_ENTRIES, ttl_seconds: int = LLM_POOL_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[PoolKey, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._building: Dict[PoolKey, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions: Dict[str, int] = {"ttl": 0, "size": 0}
+
+    def _lookup(self, key: PoolKey, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl_seconds and now - entry.last_used > self.ttl_seconds:
+            del self._entries[key]
+            self.evictions["ttl"] += 1
+            return None
+        entry.last_used = now
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict(self, now: float) -> None:
+        if self.ttl_seconds:
+            for key in [k for k, e in self._entries.items() if now - e.last_used > self.ttl_seconds]:
+                del self._entries[key]
+                self.evictions["ttl"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions["size"] += 1
+
+    def get_or_create(self, key: PoolKey, factory: Callable[[], Any]) -> Any:
+        """Devuelve el cliente de key; si no existe lo crea con factory (None no se cachea)"""
+        with self._lock:
+            entry = self._lookup(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry.value
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                entry = self._lookup(key, time.monotonic())
+                if entry is not None:
+                    self.hits += 1
+                    return entry.value
+                self.misses += 1
+            value = None
+            try:
+                value = factory()
+            finally:
+                with self._lock:
+                    if value is not None:
+                        self._entries[key] = _Entry(value)
+                        self._evict(time.monotonic())
+                    self._building.pop(key, None)
+            return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._evict(time.monotonic())
+            providers: Dict[str, int] = {}
+            for key in self._entries:
+                providers[key[0]] = providers.get(key[0], 0) + 1
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": dict(self.evictions),
+                "by_provider": providers,
+            }
+
+
+class OllamaInventory:
+    """
+    Modelos instalados en Ollama. La primera consulta es síncrona (timeout corto);
+    después se devuelve el último inventario conocido y, si está caducado, se
+    refresca en un hilo en segundo plano sin bloquear la petición.
+    """
+
+    def __init__(self, base_url: str = OLLAMA_BASE_URL, ttl_seconds: int = OLLAMA_INVENTORY_TTL_SECONDS):
+        self.base_url = base_url.rstrip("/")
+        self.ttl_seconds = ttl_seconds
+        self._models: Optional[List[str]] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self) -> List[str]:
+        """Nombres de modelo (sin tag); lista vacía si Ollama no responde"""
+        if requests is None:
+            return []
+        try:
+            response = requests.get(f"{self.base_url}/api/tags", timeout=2)
+            if response.status_code != 200:
+                return []
+            models = response.json().get("models", [])
+            return [m.get("name", "").split(":")[0] for m in models if m.get("name")]
+        except Exception:
+            return []
+
+    def _store(self, models: List[str]) -> None:
+        with self._lock:
+            self._models = models
+            self._fetched_at = time.monotonic()
+            self._refreshing = False
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=lambda: self._store(self._fetch()), name="ollama-inventory", daemon=True
+        ).start()
+
+    def models(self) -> List[str]:
+        models = self._models
+        if models is None:
+            self._store(self._fetch())
+            return list(self._models or [])
+        if time.monotonic() - self._fetched_at > self.ttl_seconds:
+            self._refresh_in_background()
+        return list(models)
+
+    def available(self) -> bool:
+        return bool(self.models())
+
+    def refresh(self) -> List[str]:
+        """Refresco síncrono (p. ej. tras instalar un modelo)"""
+        self._store(self._fetch())
+        return list(self._models or [])
+
+
+_pool: Optional[LLMClientPool] = None
+_inventory: Optional[OllamaInventory] = None
+_singleton_lock = threading.Lock()
+
+
+def get_client_pool() -> LLMClientPool:
+    """Pool compartido por todos los ModelManager del proceso"""
+    global _pool
+    with _singleton_lock:
+        if _pool is None:
+            _pool = LLMClientPool()
+        return _pool
+
+
+def get_ollama_inventory() -> OllamaInventory:
+    global _inventory
+    with _singleton_lock:
+        if _inventory is None:
+            _inventory = OllamaInventory()
+        return _inventory
@@ -4,7 +4,7 @@ Sistema principal que coordina todos los agentes
 """
 
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator
 from dotenv import load_dotenv
 
 # APLICAR PARCHE DE PROXIES ANTES DE CUALQUIER IMPORTACIÓN DE AGENTES
@@ -37,20 +37,21 @@ class StudyAgentsSystem:
     Sistema principal que coordina todos los agentes
     """
     
-    def __init__(self, api_key: Optional[str] = None, mode: str = "auto"):
+    def __init__(self, api_key: Optional[str] = None, mode: str = "auto", memory: Optional[MemoryManager] = None):
         """
         Inicializa el sistema y todos los agentes
         
         Args:
             api_key: API key de OpenAI del usuario (opcional)
             mode: Modo de selección de modelo ("auto" = optimizar costes, "manual" = usar modelo especificado)
+            memory: MemoryManager compartido (opcional; por defecto se crea uno propio)
         """
         # Usar API key proporcionada o de entorno
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.mode = mode
         
-        # Inicializar memoria con API key
-        self.memory = MemoryManager(api_key=self.api_key)
+        # Inicializar memoria con API key (o reutilizar la compartida)
+        self.memory = memory or MemoryManager(api_key=self.api_key)
         
         # Inicializar todos los agentes con la misma API key y modo automático
         self.content_processor = ContentProcessorAgent(memory=self.memory)
@@ -96,24 +97,53 @@ class StudyAgentsSystem:
         )
         print("✅ Documentos procesados y almacenados en memoria")
         
+        # Precalcular el digest del chat: las generaciones leen ese blob, no la colección
+        self.memory.refresh_chat_digest(chat_id, user_id)
+        
         # Detectar tema del documento procesado
-        detected_topic = self._detect_topic_from_documents()
+        detected_topic = self._detect_topic_from_documents(chat_id, user_id)
         if detected_topic:
             print(f"🎯 Tema detectado del documento: {detected_topic}")
             processed_content["detected_topic"] = detected_topic
         
         return processed_content
     
-    def _detect_topic_from_documents(self) -> Optional[str]:
+    def ensure_documents(
+        self,
+        document_paths: list[str],
+        chat_id: Optional[str] = None,
+        user_id: Optional[str] = None,
+    ) -> dict:
+        """
+        Como upload_documents, pero solo procesa los ficheros que el chat aún no tiene.
+        Si ya están todos indexados no se reprocesa nada y el digest solo se calcula
+        si falta (para rutas que se llaman en cada petición, p. ej. un corpus de curso).
+        
+        Returns:
+            Información del procesamiento (skipped = ficheros ya indexados)
+        """
+        missing = [
+            path for path in document_paths
+            if not self.memory.has_document(chat_id, user_id, os.path.basename(path))
+        ]
+        skipped = len(document_paths) - len(missing)
+        if missing:
+            processed_content = self.upload_documents(missing, chat_id=chat_id, user_id=user_id)
+            processed_content["skipped"] = skipped
+            return processed_content
+        self.memory.get_chat_digest(chat_id, user_id)
+        return {"skipped": skipped}
+    
+    def _detect_topic_from_documents(self, chat_id: Optional[str] = None, user_id: Optional[str] = None) -> Optional[str]:
         """
-        Detecta el tema principal del contenido de los documentos subidos
+        Detecta el tema principal del contenido de los documentos subidos al chat
         
         Returns:
             Tema detectado o None
         """
         try:
-            # Obtener contenido de los documentos
-            all_content = self.memory.get_all_documents(limit=10)
+            # Obtener contenido de los documentos (digest del chat)
+            all_content = self.memory.get_chat_digest(chat_id, user_id)
             if not all_content:
                 return None
             
@@ -152,15 +182,19 @@ class StudyAgentsSystem:
             print(f"⚠️ Error al detectar tema del documento: {e}")
             return None
     
-    def generate_explanations(self) -> dict:
+    def generate_explanations(self, chat_id: Optional[str] = None, user_id: Optional[str] = None) -> dict:
         """
         Genera explicaciones claras del contenido procesado
         
+        Args:
+            chat_id: ID del chat cuyos documentos se explican
+            user_id: ID del usuario
+            
         Returns:
             Explicaciones generadas
         """
         print("\n📖 Generando explicaciones...")
-        explanations = self.explanation_agent.generate_explanations()
+        explanations = self.explanation_agent.generate_explanations(chat_id=chat_id, user_id=user_id)
         print("✅ Explicaciones generadas")
         return explanations
     
@@ -562,6 +596,39 @@ class StudyAgentsSystem:
             print(f"⚠️ Error en corrección, usando respuesta original: {e}")
             return answer, usage_info
     
+    def stream_question(
+        self,
+        question: str,
+        user_id: str = "default",
+        model: Optional[str] = None,
+        chat_id: Optional[str] = None,
+        topic: Optional[str] = None,
+        initial_form_data: Optional[dict] = None,
+        course_context: Optional[Any] = None,
+        exam_info: Optional[Any] = None,
+    ) -> Iterator[tuple[str, Any]]:
+        """
+        Versión en streaming de ask_question (eventos token / block / done / error)
+        
+        No aplica el agente corrector: la respuesta se envía según se genera.
+        
+        Yields:
+            Eventos (tipo, payload) de QAAssistantAgent.stream_answer
+        """
+        needs_premium = self._detect_negative_feedback(question)
+        print(f"\n❓ Pregunta (streaming): {question} (modelo: {model or 'automático'}, tema: {topic or 'General'})")
+        yield from self.qa_assistant.stream_answer(
+            question,
+            user_id,
+            model=model,
+            chat_id=chat_id,
+            topic=topic,
+            force_premium=needs_premium,
+            initial_form_data=initial_form_data,
+            course_context=course_context,
+            exam_info=exam_info,
+        )
+    
     def generate_test(self, difficulty: str = "medium", num_questions: int = 10, topics: Optional[list[str]] = None, constraints: Optional[str] = None, model: Optional[str] = None, conversation_history: Optional[list[dict]] = None, user_id: Optional[str] = None, chat_id: Optional[str] = None, user_level: Optional[int] = None) -> tuple[dict, dict]:
         """
         Genera un test personalizado
@@ -594,7 +661,7 @@ class StudyAgentsSystem:
         
         model_str = model if model else "automático (optimizando costes)"
         print(f"\n📝 Generando test ({difficulty}, {num_questions} preguntas, nivel usuario: {user_level if user_level is not None else 'N/A'}/10) con modelo {model_str}...")
-        test = self.test_generator.generate_test(difficulty, num_questions, topics, constraints=constraints, model=model, conversation_history=conversation_history, user_level=user_level)
+        test = self.test_generator.generate_test(difficulty, num_questions, topics, constraints=constraints, model=model, conversation_history=conversation_history, user_level=user_level, chat_id=chat_id, user_id=user_id)
         print("✅ Test generado")
         
         # Extraer información de tokens del test
@@ -632,6 +699,29 @@ class StudyAgentsSystem:
         print("✅ Feedback generado")
         return feedback, usage_info
     
+    def stream_grade_test(self, test_id: str, answers: dict) -> Iterator[tuple[str, Any]]:
+        """
+        Versión incremental de grade_test: la nota llega sin esperar al LLM
+        
+        Yields:
+            Eventos (tipo, payload) de FeedbackAgent.stream_grade_test: score, feedback,
+            done (con usage_info aparte, como en grade_test) y error
+        """
+        print(f"\n✏️ Corrigiendo test {test_id} (streaming)...")
+        
+        test = self.test_generator.get_test(test_id)
+        if "error" in test:
+            yield "error", {"error": test["error"]}
+            return
+        
+        for kind, payload in self.feedback_agent.stream_grade_test(test_id, answers, test_data=test):
+            if kind == "done":
+                usage_info = payload.pop("usage_info", None) or {"inputTokens": 0, "outputTokens": 0}
+                print("✅ Feedback generado")
+                yield "done", {"feedback": payload, "usage": usage_info}
+            else:
+                yield kind, payload
+    
     def generate_exercise(
         self,
         difficulty: str = "medium",
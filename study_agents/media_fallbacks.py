@@ -12,6 +12,11 @@ from typing import Any, Dict, List, Optional
 
 import requests
 
+try:
+    from rate_limiter import get_rate_limiter
+except ImportError:
+    get_rate_limiter = None
+
 WIKIMEDIA_UA = "StudyAgents/1.0 (educational study app; local development)"
 YOUTUBE_UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
@@ -115,6 +120,14 @@ def search_youtube_via_scrape(query: str, timeout: float = 12) -> Optional[Dict[
     return None
 
 
+def _wikimedia_get(url: str, **kwargs: Any) -> requests.Response:
+    """GET a la API de Commons respetando el límite del proveedor "wikimedia" (rate_limiter)"""
+    if get_rate_limiter is None:
+        return requests.get(url, **kwargs)
+    with get_rate_limiter().slot("wikimedia"):
+        return requests.get(url, **kwargs)
+
+
 def search_wikimedia_commons_image(query: str, timeout: float = 14) -> Optional[Dict[str, str]]:
     """Una imagen de Wikimedia Commons relacionada con la consulta (sin API key propia)."""
     q = " ".join(query.split()).strip()[:240]
@@ -122,7 +135,7 @@ def search_wikimedia_commons_image(query: str, timeout: float = 14) -> Optional[
         return None
     headers = {"User-Agent": WIKIMEDIA_UA}
     try:
-        r = requests.get(
+        r = _wikimedia_get(
             "https://commons.wikimedia.org/w/api.php",
             params={
                 "action": "query",
@@ -141,7 +154,7 @@ def search_wikimedia_commons_image(query: str, timeout: float = 14) -> Optional[
             title = hit.get("title") or ""
             if not title.startswith("File:"):
                 continue
-            r2 = requests.get(
+            r2 = _wikimedia_get(
                 "https://commons.wikimedia.org/w/api.php",
                 params={
                     "action": "query",
@@ -0,0 +1,208 @@
+"""
+Corpus Digest - Resumen precalculado del corpus de cada chat para la generación
+En lugar de leer chunks al azar de toda la colección en cada test/apuntes, cada chat
+(user_id, chat_id) tiene un digest: hasta CORPUS_DIGEST_CHUNKS chunks representativos
+(repartidos entre documentos y a lo largo de cada uno), con un tope de caracteres.
+Se calcula al subir documentos y se invalida al escribir o borrar chunks del chat;
+la versión evita guardar un digest calculado antes de una invalidación concurrente.
+SQLite (modo WAL): compartido entre workers.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from pathlib import Path
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+_ROOT = Path(__file__).resolve().parent.parent
+DIGEST_PATH = Path(os.getenv("CORPUS_DIGEST_PATH", str(_ROOT / "data" / "corpus_digest.sqlite3")))
+# Chunks representativos por chat
+DIGEST_CHUNKS = max(1, int(os.getenv("CORPUS_DIGEST_CHUNKS", "40")))
+# Tope de caracteres del digest (lo más que lee una generación: apuntes usan 24000)
+DIGEST_MAX_CHARS = max(1000, int(os.getenv("CORPUS_DIGEST_MAX_CHARS", "24000")))
+# Chunks más cortos que esto (cabeceras, números de página) solo entran si no hay otros
+_MIN_CHUNK_CHARS = 80
+
+
+def _spread(count: int, quota: int) -> List[int]:
+    """quota posiciones repartidas de 0 a count-1 (siempre incluye la primera)"""
+    if quota >= count:
+        return list(range(count))
+    if quota <= 1:
+        return [0]
+    return sorted({round(i * (count - 1) / (quota - 1)) for i in range(quota)})
+
+
+def select_representative(
+    entries: Sequence[Tuple[str, Dict[str, Any]]],
+    max_chunks: int = DIGEST_CHUNKS,
+    max_chars: int = DIGEST_MAX_CHARS,
+) -> List[str]:
+    """
+    Elige chunks representativos de (texto, metadatos): reparte el cupo entre
+    documentos por igual y, dentro de cada uno, en orden de página a intervalos
+    regulares. Devuelve los chunks agrupados por documento en orden de lectura.
+    """
+    seen = set()
+    documents: Dict[str, List[Tuple[int, int, str]]] = {}
+    for position, (text, meta) in enumerate(entries):
+        text = (text or "").strip()
+        meta = meta or {}
+        key = meta.get("content_hash") or text
+        if not text or key in seen:
+            continue
+        seen.add(key)
+        doc_id = str(meta.get("doc_id") or meta.get("source") or "unknown")
+        documents.setdefault(doc_id, []).append((int(meta.get("page") or 0), position, text))
+    if not documents:
+        return []
+
+    chunks_by_doc = []
+    for doc_chunks in documents.values():
+        doc_chunks.sort()
+        texts = [text for _, _, text in doc_chunks]
+        long_texts = [text for text in texts if len(text) >= _MIN_CHUNK_CHARS]
+        chunks_by_doc.append(long_texts or texts)
+
+    # Cupo por documento: igual para todos; lo que no usa uno pasa a los demás
+    quotas = [0] * len(chunks_by_doc)
+    remaining = max_chunks
+    open_docs = [i for i, texts in enumerate(chunks_by_doc) if texts]
+    while remaining > 0 and open_docs:
+        share = max(1, math.floor(remaining / len(open_docs)))
+        for i in list(open_docs):
+            take = min(share, len(chunks_by_doc[i]) - quotas[i], remaining)
+            quotas[i] += take
+            remaining -= take
+            if quotas[i] >= len(chunks_by_doc[i]):
+                open_docs.remove(i)
+            if remaining <= 0:
+                break
+
+    selected: List[str] = []
+    total = 0
+    for texts, quota in zip(chunks_by_doc, quotas):
+        for index in _spread(len(texts), quota):
+            chunk = texts[index]
+            if total + len(chunk) > max_chars:
+                remain = max_chars - total
+                if remain > 100:
+                    selected.append(chunk[:remain])
+                return selected
+            selected.append(chunk)
+            total += len(chunk)
+    return selected
+
+
+class CorpusDigestStore:
+    """
+    Digests por (user_id, chat_id) en disco (SQLite, modo WAL). Segura entre hilos.
+    Cada invalidación sube la versión del chat; put solo guarda si la versión no cambió.
+    """
+
+    def __init__(self, path: Path = DIGEST_PATH):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.invalidations = 0
+        self.stale_builds = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS digests (
+                user_id TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0,
+                data TEXT,
+                built_at REAL,
+                PRIMARY KEY (user_id, chat_id)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, user_id: str, chat_id: str) -> Tuple[Optional[List[str]], int]:
+        """(chunks del digest o None si falta, versión actual del chat)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, version FROM digests WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+            if row is None or row[0] is None:
+                self.misses += 1
+                return None, row[1] if row else 0
+            self.hits += 1
+            return json.loads(row[0]), row[1]
+
+    def put(self, user_id: str, chat_id: str, chunks: List[str], version: int) -> bool:
+        """Guarda el digest calculado con la versión version; False si se invalidó entretanto"""
+        data = json.dumps(chunks, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO digests (user_id, chat_id, version) VALUES (?, ?, 0)", (user_id, chat_id)
+            )
+            cursor = self._conn.execute(
+                "UPDATE digests SET data = ?, built_at = ? WHERE user_id = ? AND chat_id = ? AND version = ?",
+                (data, time.time(), user_id, chat_id, version),
+            )
+            self._conn.commit()
+            if cursor.rowcount:
+                self.builds += 1
+                return True
+            self.stale_builds += 1
+            return False
+
+    def invalidate(self, user_id: str, chat_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO digests (user_id, chat_id, version) VALUES (?, ?, 1) "
+                "ON CONFLICT(user_id, chat_id) DO UPDATE SET version = version + 1, data = NULL, built_at = NULL",
+                (user_id, chat_id),
+            )
+            self._conn.commit()
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        """Invalida todos los digests (p. ej. al vaciar la memoria)"""
+        with self._lock:
+            self._conn.execute("UPDATE digests SET version = version + 1, data = NULL, built_at = NULL")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            chats, built = self._conn.execute(
+                "SELECT COUNT(*), COUNT(data) FROM digests"
+            ).fetchone()
+            total = self.hits + self.misses
+            return {
+                "chats": chats,
+                "built": built,
+                "max_chunks": DIGEST_CHUNKS,
+                "max_chars": DIGEST_MAX_CHARS,
+                "hits": self.hits,
+                "misses": self.misses,
+                "builds": self.builds,
+                "stale_builds": self.stale_builds,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_store: Optional[CorpusDigestStore] = None
+_store_lock = threading.Lock()
+
+
+def get_corpus_digest_store() -> CorpusDigestStore:
+    """Store compartido por todo el proceso"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CorpusDigestStore()
+        return _store
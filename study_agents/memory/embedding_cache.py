@@ -0,0 +1,93 @@
+"""
+Embedding Cache - Caché persistente de embeddings en SQLite
+Clave: (model_name, sha256(texto)). Evicción LRU por número de entradas (kv_cache).
+Envuelve cualquier función de embeddings de Chroma para no pagar dos veces el mismo texto.
+"""
+
+from typing import Dict, List, Optional, Sequence
+from array import array
+import hashlib
+import os
+import threading
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from kv_cache import LRUKVCache
+
+MAX_ENTRIES = max(1, int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000")))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Caché de embeddings sobre kv_cache (clave "modelo:hash", vector float32 en bytes).
+    Segura entre hilos; expone contadores de aciertos/fallos.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, store: Optional[LRUKVCache] = None):
+        self.store = store or LRUKVCache("embeddings", max_entries)
+
+    def get_many(self, model: str, hashes: Sequence[str]) -> Dict[str, List[float]]:
+        """Devuelve {hash: embedding} para los hashes presentes y actualiza su uso (LRU)."""
+        prefix = f"{model}:"
+        found = self.store.get_many([prefix + h for h in hashes])
+        embeddings: Dict[str, List[float]] = {}
+        for key, blob in found.items():
+            vector = array("f")
+            vector.frombytes(blob)
+            embeddings[key[len(prefix):]] = vector.tolist()
+        return embeddings
+
+    def put_many(self, model: str, items: Dict[str, Sequence[float]]) -> None:
+        """Guarda embeddings y aplica la evicción LRU si se supera max_entries."""
+        self.store.put_many(
+            {f"{model}:{h}": array("f", vector).tobytes() for h, vector in items.items()}, replace=False
+        )
+
+    def stats(self) -> Dict[str, float]:
+        return self.store.stats()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    Función de embeddings para Chroma que consulta la caché antes de llamar al modelo.
+    Solo los textos no cacheados (y deduplicados) llegan a la función original.
+    """
+
+    def __init__(self, inner: EmbeddingFunction, model_name: str, cache: Optional[EmbeddingCache] = None):
+        self.inner = inner
+        self.model_name = model_name
+        self.cache = cache or get_embedding_cache()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        texts = list(input)
+        hashes = [text_hash(t) for t in texts]
+        cached = self.cache.get_many(self.model_name, hashes)
+
+        missing: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = t
+        if missing:
+            computed = self.inner(list(missing.values()))
+            fresh = {h: list(vector) for h, vector in zip(missing.keys(), computed)}
+            self.cache.put_many(self.model_name, fresh)
+            cached.update(fresh)
+
+        return [cached[h] for h in hashes]
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Caché compartida por todo el proceso"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
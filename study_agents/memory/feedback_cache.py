@@ -0,0 +1,72 @@
+"""
+Feedback Cache - Caché persistente del feedback generado por el LLM al corregir tests
+Clave: (hash de la pregunta, respuesta del estudiante normalizada). El hash cubre el
+enunciado, las opciones, la respuesta correcta y la explicación, así que si cambia
+cualquiera de ellos la entrada deja de servir. Evicción LRU por número de entradas (kv_cache).
+"""
+
+from typing import Dict, Iterable, Optional
+import hashlib
+import json
+import os
+import threading
+
+from kv_cache import LRUKVCache
+
+MAX_ENTRIES = max(1, int(os.getenv("FEEDBACK_CACHE_MAX_ENTRIES", "50000")))
+
+
+def question_hash(question: str, question_type: str, options: Iterable[str], correct_answer: str, explanation: str) -> str:
+    payload = json.dumps(
+        [question, question_type, list(options or []), str(correct_answer).strip().upper(), explanation or ""],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def normalize_answer(answer: str) -> str:
+    return str(answer).strip().upper()
+
+
+class FeedbackCache:
+    """
+    Caché de feedback sobre kv_cache (clave "hash_pregunta:respuesta") con evicción LRU.
+    Segura entre hilos; expone contadores de aciertos/fallos.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, store: Optional[LRUKVCache] = None):
+        self.store = store or LRUKVCache("feedback", max_entries)
+        self.templated = 0
+        self._lock = threading.Lock()
+
+    def get(self, q_hash: str, answer: str) -> Optional[str]:
+        """Feedback guardado para (pregunta, respuesta) o None; actualiza su uso (LRU)."""
+        return self.store.get(f"{q_hash}:{normalize_answer(answer)}")
+
+    def put(self, q_hash: str, answer: str, feedback: str) -> None:
+        """Guarda el feedback y aplica la evicción LRU si se supera max_entries."""
+        self.store.put(f"{q_hash}:{normalize_answer(answer)}", feedback, replace=False)
+
+    def record_template(self) -> None:
+        """Cuenta un feedback resuelto con plantilla (sin caché ni LLM)"""
+        with self._lock:
+            self.templated += 1
+
+    def stats(self) -> Dict[str, float]:
+        stats = self.store.stats()
+        with self._lock:
+            stats["templated"] = self.templated
+        return stats
+
+
+_cache: Optional[FeedbackCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_feedback_cache() -> FeedbackCache:
+    """Caché compartida por todo el proceso"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FeedbackCache()
+        return _cache
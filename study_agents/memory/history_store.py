@@ -0,0 +1,397 @@
+"""
+History Store - Historial de conversación persistente por chat
+Backends intercambiables (SQLite, log append-only por chat o memoria) con una
+caché LRU de chats calientes, TTL para los inactivos y memoria acotada.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_ROOT = Path(__file__).resolve().parent.parent
+
+# "sqlite" (por defecto), "jsonl" (un log append-only por chat) o "memory" (sin persistencia)
+HISTORY_BACKEND = os.getenv("CONVERSATION_HISTORY_BACKEND", "sqlite").strip().lower()
+HISTORY_PATH = os.getenv("CONVERSATION_HISTORY_PATH", "")
+# Mensajes que se conservan por chat
+HISTORY_MAX_MESSAGES = max(1, int(os.getenv("CONVERSATION_HISTORY_MAX_MESSAGES", "50")))
+# Chats calientes en memoria, segundos de inactividad antes de soltarlos y memoria máxima
+HISTORY_HOT_CHATS = max(1, int(os.getenv("CONVERSATION_HISTORY_HOT_CHATS", "1024")))
+HISTORY_IDLE_TTL_SECONDS = max(0, int(os.getenv("CONVERSATION_HISTORY_IDLE_TTL", "1800")))
+HISTORY_CACHE_MAX_MB = max(1, int(os.getenv("CONVERSATION_HISTORY_CACHE_MB", "64")))
+
+
+def _message_bytes(message: Dict[str, str]) -> int:
+    return len(message.get("content", "")) + len(message.get("role", "")) + 64
+
+
+class HistoryBackend(ABC):
+    """
+    Interfaz de almacenamiento del historial.
+    chat_version() debe ser barato: la caché lo usa para detectar escrituras de otros workers.
+    """
+
+    @abstractmethod
+    def load(self, user_id: str, chat_id: str, limit: int) -> List[Dict[str, str]]:
+        ...
+
+    @abstractmethod
+    def append(self, user_id: str, chat_id: str, messages: List[Dict[str, str]], keep: int) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self, user_id: str, chat_id: Optional[str] = None) -> None:
+        ...
+
+    def chat_version(self, user_id: str, chat_id: str) -> Any:
+        return None
+
+    def changed_externally(self) -> bool:
+        """True si otro proceso pudo escribir desde la última comprobación"""
+        return False
+
+
+class MemoryHistoryBackend(HistoryBackend):
+    """Sin persistencia (comportamiento anterior): el historial vive solo en este proceso"""
+
+    def __init__(self):
+        self._chats: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+
+    def load(self, user_id: str, chat_id: str, limit: int) -> List[Dict[str, str]]:
+        return list(self._chats.get((user_id, chat_id), [])[-limit:])
+
+    def append(self, user_id: str, chat_id: str, messages: List[Dict[str, str]], keep: int) -> None:
+        chat = self._chats.setdefault((user_id, chat_id), [])
+        chat.extend(messages)
+        del chat[:-keep]
+
+    def clear(self, user_id: str, chat_id: Optional[str] = None) -> None:
+        for key in [k for k in self._chats if k[0] == user_id and (chat_id is None or k[1] == chat_id)]:
+            del self._chats[key]
+
+
+class SQLiteHistoryBackend(HistoryBackend):
+    """Historial en SQLite (modo WAL), compartido por todos los workers del host"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(user_id, chat_id, id)")
+        self._conn.commit()
+        self._data_version = self._read_data_version()
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self, user_id: str, chat_id: str, limit: int) -> List[Dict[str, str]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE user_id = ? AND chat_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, chat_id, limit),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def append(self, user_id: str, chat_id: str, messages: List[Dict[str, str]], keep: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO messages (user_id, chat_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, chat_id, m["role"], m["content"], now) for m in messages],
+            )
+            # Conservar solo los últimos `keep` mensajes del chat
+            self._conn.execute(
+                """
+                DELETE FROM messages WHERE user_id = ? AND chat_id = ? AND id <= (
+                    SELECT id FROM messages WHERE user_id = ? AND chat_id = ?
+                    ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (user_id, chat_id, user_id, chat_id, keep),
+            )
+            self._conn.commit()
+
+    def clear(self, user_id: str, chat_id: Optional[str] = None) -> None:
+        with self._lock:
+            if chat_id is None:
+                self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            else:
+                self._conn.execute("DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            self._conn.commit()
+
+    def chat_version(self, user_id: str, chat_id: str) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(id), COUNT(*) FROM messages WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        return tuple(row)
+
+    def changed_externally(self) -> bool:
+        # data_version solo cambia con commits de otras conexiones (otros workers)
+        with self._lock:
+            current = self._read_data_version()
+            changed = current != self._data_version
+            self._data_version = current
+        return changed
+
+
+class JsonlHistoryBackend(HistoryBackend):
+    """
+    Un log append-only (JSON Lines) por chat. Se compacta al superar 2x el máximo.
+    La versión de un chat es (mtime, tamaño) del fichero: un stat por lectura.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._line_counts: Dict[Path, int] = {}
+
+    def _user_dir(self, user_id: str) -> Path:
+        return self.root / hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+
+    def _chat_path(self, user_id: str, chat_id: str) -> Path:
+        name = hashlib.sha256(chat_id.encode("utf-8")).hexdigest()[:32]
+        return self._user_dir(user_id) / f"{name}.jsonl"
+
+    @staticmethod
+    def _read(path: Path) -> List[Dict[str, str]]:
+        messages = []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Línea truncada (escritura interrumpida): se ignora
+                        continue
+        except FileNotFoundError:
+            pass
+        return messages
+
+    def load(self, user_id: str, chat_id: str, limit: int) -> List[Dict[str, str]]:
+        path = self._chat_path(user_id, chat_id)
+        with self._lock:
+            messages = self._read(path)
+            self._line_counts[path] = len(messages)
+        return messages[-limit:]
+
+    def append(self, user_id: str, chat_id: str, messages: List[Dict[str, str]], keep: int) -> None:
+        path = self._chat_path(user_id, chat_id)
+        lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+        with self._lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            if path not in self._line_counts:
+                self._line_counts[path] = len(self._read(path))
+            else:
+                self._line_counts[path] += len(messages)
+            if self._line_counts[path] > 2 * keep:
+                kept = self._read(path)[-keep:]
+                tmp = path.with_suffix(".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in kept))
+                os.replace(tmp, path)
+                self._line_counts[path] = len(kept)
+
+    def clear(self, user_id: str, chat_id: Optional[str] = None) -> None:
+        with self._lock:
+            if chat_id is None:
+                paths = list(self._user_dir(user_id).glob("*.jsonl"))
+            else:
+                paths = [self._chat_path(user_id, chat_id)]
+            for path in paths:
+                self._line_counts.pop(path, None)
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def chat_version(self, user_id: str, chat_id: str) -> Any:
+        try:
+            stat = self._chat_path(user_id, chat_id).stat()
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def changed_externally(self) -> bool:
+        # Sin señal global barata: cada lectura compara la versión del chat
+        return True
+
+
+class _HotChat:
+    __slots__ = ("messages", "version", "generation", "last_used", "size_bytes")
+
+    def __init__(self, messages: List[Dict[str, str]], version: Any, generation: int):
+        self.messages = messages
+        self.version = version
+        self.generation = generation
+        self.last_used = time.monotonic()
+        self.size_bytes = sum(_message_bytes(m) for m in messages)
+
+
+class ConversationHistoryStore:
+    """
+    Historial por (user_id, chat_id) sobre un backend persistente.
+    Los chats calientes se sirven desde memoria; se revalidan contra el backend
+    solo cuando otro worker ha escrito.
+    """
+
+    def __init__(
+        self,
+        backend: HistoryBackend,
+        max_messages: int = HISTORY_MAX_MESSAGES,
+        hot_chats: int = HISTORY_HOT_CHATS,
+        idle_ttl_seconds: int = HISTORY_IDLE_TTL_SECONDS,
+        max_bytes: int = HISTORY_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.backend = backend
+        self.max_messages = max_messages
+        self.hot_chats = hot_chats
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_bytes = max_bytes
+        self._hot: "OrderedDict[Tuple[str, str], _HotChat]" = OrderedDict()
+        self._bytes = 0
+        # Se incrementa cada vez que el backend avisa de escrituras externas
+        self._generation = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        entry = self._hot.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size_bytes
+
+    def _store(self, key: Tuple[str, str], entry: _HotChat) -> None:
+        self._drop(key)
+        self._hot[key] = entry
+        self._bytes += entry.size_bytes
+        self._evict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        if self.idle_ttl_seconds:
+            for key in [k for k, e in self._hot.items() if now - e.last_used > self.idle_ttl_seconds]:
+                self._drop(key)
+                self.evictions += 1
+        while self._hot and (len(self._hot) > self.hot_chats or self._bytes > self.max_bytes):
+            key, entry = self._hot.popitem(last=False)
+            self._bytes -= entry.size_bytes
+            self.evictions += 1
+
+    def _hot_entry(self, user_id: str, chat_id: str) -> _HotChat:
+        key = (user_id, chat_id)
+        entry = self._hot.get(key)
+        if self.backend.changed_externally():
+            self._generation += 1
+        if entry is not None:
+            if entry.generation != self._generation:
+                version = self.backend.chat_version(user_id, chat_id)
+                if version != entry.version:
+                    entry = None
+                    self.reloads += 1
+                else:
+                    entry.generation = self._generation
+            if entry is not None:
+                self.hits += 1
+                entry.last_used = time.monotonic()
+                self._hot.move_to_end(key)
+                return entry
+        else:
+            self.misses += 1
+        version = self.backend.chat_version(user_id, chat_id)
+        entry = _HotChat(self.backend.load(user_id, chat_id, self.max_messages), version, self._generation)
+        self._store(key, entry)
+        return entry
+
+    def get(self, user_id: str, chat_id: str) -> List[Dict[str, str]]:
+        with self._lock:
+            return list(self._hot_entry(user_id, chat_id).messages)
+
+    def append(self, user_id: str, chat_id: str, role: str, content: str) -> None:
+        message = {"role": role, "content": content}
+        with self._lock:
+            entry = self._hot_entry(user_id, chat_id)
+            self.backend.append(user_id, chat_id, [message], self.max_messages)
+            entry.messages.append(message)
+            entry.size_bytes += _message_bytes(message)
+            self._bytes += _message_bytes(message)
+            if len(entry.messages) > self.max_messages:
+                for removed in entry.messages[:-self.max_messages]:
+                    entry.size_bytes -= _message_bytes(removed)
+                    self._bytes -= _message_bytes(removed)
+                del entry.messages[:-self.max_messages]
+            entry.version = self.backend.chat_version(user_id, chat_id)
+            self._evict()
+
+    def clear(self, user_id: str, chat_id: Optional[str] = None) -> None:
+        with self._lock:
+            self.backend.clear(user_id, chat_id)
+            for key in [k for k in self._hot if k[0] == user_id and (chat_id is None or k[1] == chat_id)]:
+                self._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hot_chats": len(self._hot),
+                "max_hot_chats": self.hot_chats,
+                "cache_mb": round(self._bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def create_history_backend(kind: str = HISTORY_BACKEND, path: str = HISTORY_PATH) -> HistoryBackend:
+    if kind == "memory":
+        return MemoryHistoryBackend()
+    if kind == "jsonl":
+        return JsonlHistoryBackend(Path(path) if path else _ROOT / "data" / "conversation_history")
+    return SQLiteHistoryBackend(Path(path) if path else _ROOT / "data" / "conversation_history.sqlite3")
+
+
+_store: Optional[ConversationHistoryStore] = None
+_store_lock = threading.Lock()
+
+
+def get_history_store() -> ConversationHistoryStore:
+    """Historial compartido por todo el proceso"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ConversationHistoryStore(create_history_backend())
+        return _store
@@ -7,13 +7,127 @@ from typing import List, Dict, Any, Optional
 import chromadb
 from chromadb.config import Settings
 from chromadb.utils import embedding_functions
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from dotenv import load_dotenv
+from .embedding_cache import CachedEmbeddingFunction, get_embedding_cache
+from .history_store import get_history_store
+from .corpus_digest import get_corpus_digest_store, select_representative
+
+try:
+    from execution_context import provider_keys as get_request_provider_keys
+except ImportError:
+    def get_request_provider_keys() -> Dict[str, str]:
+        return {}
 
 load_dotenv()
 
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Dimensión de cada modelo: identifica el de colecciones antiguas sin "embedding_model"
+EMBEDDING_MODEL_BY_DIMENSION = {1536: OPENAI_EMBEDDING_MODEL, 384: DEFAULT_EMBEDDING_MODEL}
+
+# Tamaño máximo de cada collection.add (Chroma limita el tamaño del lote y
+# los embeddings se calculan por llamada)
+STORE_BATCH_SIZE = max(1, int(os.getenv("CHROMA_STORE_BATCH_SIZE", "128")))
+
+# Particionado vectorial: "chat" (una colección por chat), "user" (una por usuario)
+# o "global" (colección única study_content filtrada por metadatos, modo antiguo)
+VECTOR_PARTITION_MODE = os.getenv("VECTOR_PARTITION_MODE", "chat").strip().lower()
+if VECTOR_PARTITION_MODE not in ("chat", "user", "global"):
+    print(
+        f"⚠️ VECTOR_PARTITION_MODE={VECTOR_PARTITION_MODE!r} no es válido "
+        "(valores: chat, user, global). Se usa 'global'."
+    )
+    VECTOR_PARTITION_MODE = "global"
+# Máximo de colecciones de partición abiertas a la vez (LRU)
+MAX_OPEN_PARTITIONS = max(1, int(os.getenv("VECTOR_MAX_OPEN_PARTITIONS", "256")))
+# Máximo de chats recordados en el memo de "tiene chunks antiguos en study_content" (LRU)
+MAX_LEGACY_CHAT_MEMO = max(1, int(os.getenv("VECTOR_MAX_LEGACY_CHAT_MEMO", "10000")))
+
+
+def content_hash(text: str) -> str:
+    """Hash estable del texto de un chunk (clave del índice de deduplicación)"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_location(metadata: Dict) -> str:
+    """Dónde aparece un chunk (fichero y página): el mismo texto en otra página es otro chunk"""
+    if not metadata.get("source") and metadata.get("page") is None:
+        return ""
+    return f"{metadata.get('source') or ''}#{metadata.get('page') if metadata.get('page') is not None else ''}"
+
+
+def chunk_id(text_hash: str, chat_id: Optional[str] = None, user_id: Optional[str] = None, location: str = "") -> str:
+    """
+    ID determinista de un chunk: mismo texto en el mismo sitio del mismo chat → mismo ID
+    (volver a subir un fichero no duplica nada). Sin location es el ID antiguo, solo por texto.
+    """
+    key = f"{user_id or ''}\x1f{chat_id or ''}\x1f{text_hash}"
+    if location:
+        key += f"\x1f{location}"
+    scope = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return f"chunk_{scope[:32]}"
+
+
+# Clientes Chroma compartidos por todo el proceso (uno por ruta)
+_chroma_clients: Dict[str, Any] = {}
+_chroma_clients_lock = threading.Lock()
+
+
+def get_chroma_client(path: str = "./chroma_db"):
+    """Devuelve el PersistentClient compartido para la ruta (se crea una sola vez)"""
+    key = os.path.abspath(path)
+    with _chroma_clients_lock:
+        if key not in _chroma_clients:
+            _chroma_clients[key] = chromadb.PersistentClient(path=path)
+        return _chroma_clients[key]
+
+
+class RequestKeyOpenAIEmbeddingFunction(EmbeddingFunction):
+    """
+    Embeddings de OpenAI con la key de la petición en curso (o la del servidor).
+    Permite compartir una misma colección entre usuarios con keys distintas.
+    """
+    
+    MAX_CLIENTS = 32
+    
+    def __init__(self, default_key: Optional[str], model_name: str = OPENAI_EMBEDDING_MODEL):
+        self.default_key = default_key
+        self.model_name = model_name
+        self._functions: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __call__(self, input: Documents) -> Embeddings:
+        key = get_request_provider_keys().get("openai") or self.default_key
+        if not key:
+            raise ValueError("Esta colección usa embeddings de OpenAI: hace falta una API key de OpenAI")
+        with self._lock:
+            function = self._functions.get(key)
+            if function is None:
+                function = embedding_functions.OpenAIEmbeddingFunction(
+                    api_key=key,
+                    model_name=self.model_name
+                )
+                self._functions[key] = function
+                while len(self._functions) > self.MAX_CLIENTS:
+                    self._functions.popitem(last=False)
+            else:
+                self._functions.move_to_end(key)
+        return function(input)
+
+
+def partition_name(mode: str, chat_id: str, user_id: str) -> str:
+    """Nombre de colección Chroma de la partición (3-63 caracteres alfanuméricos)"""
+    key = user_id if mode == "user" else f"{user_id}\x1f{chat_id}"
+    return f"part_{mode}_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:40]}"
+
+
 class MemoryManager:
     """
     Gestiona la memoria del sistema usando ChromaDB para RAG con embeddings
@@ -32,35 +146,28 @@ class MemoryManager:
         # Usar API key proporcionada o de entorno
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         
-        # Configurar función de embeddings
-        if self.api_key:
-            embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=self.api_key,
-                model_name="text-embedding-3-small"
-            )
-        else:
-            # Usar embeddings por defecto si no hay API key
-            embedding_function = embedding_functions.DefaultEmbeddingFunction()
-        
-        # Inicializar ChromaDB
-        self.client = chromadb.PersistentClient(
-            path="./chroma_db"
-        )
+        # Inicializar ChromaDB (cliente compartido entre todas las instancias)
+        self.client = get_chroma_client("./chroma_db")
         
         # Intentar obtener la colección existente primero
         try:
-            self.collection = self.client.get_collection(
+            existing = self.client.get_collection(
                 name="study_content"
             )
-            # Si existe, verificar que la función de embedding sea compatible
+            # Reabrir con la función de embeddings con la que se creó (cacheada)
+            self.collection = self.client.get_collection(
+                name="study_content",
+                embedding_function=self._build_embedding_function(self._stored_embedding_model(existing))
+            )
             print("📚 Colección existente encontrada")
         except Exception:
             # Si no existe, crear una nueva con la función de embedding especificada
+            embedding_function = self._build_embedding_function()
             try:
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Nueva colección creada")
             except Exception as e:
@@ -74,14 +181,20 @@ class MemoryManager:
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Nueva colección creada después de limpiar conflicto")
         
-        # Historial de conversación por usuario (en memoria por ahora)
-        # Historial de conversación indexado por user_id y luego por chat_id
-        # Estructura: {user_id: {chat_id: [messages]}}
-        self.conversation_histories: Dict[str, Dict[str, List[Dict[str, str]]]] = {}
+        # Registro de particiones abiertas (nombre → colección), cerradas por LRU
+        self.partition_mode = VECTOR_PARTITION_MODE
+        self._partitions: "OrderedDict[str, Any]" = OrderedDict()
+        self._partitions_lock = threading.Lock()
+        # Chats con chunks antiguos en study_content (lectura de compatibilidad), LRU
+        self._legacy_chats: "OrderedDict[str, bool]" = OrderedDict()
+        
+        # Historial de conversación por (user_id, chat_id): persistente (SQLite / log por chat)
+        # con caché LRU de chats calientes; ver memory/history_store.py
+        self.history = get_history_store()
         
         # Inicializar colección de estadísticas de usuarios
         try:
@@ -102,13 +215,186 @@ class MemoryManager:
             self.stats_collection = None
         
         print(f"💾 Memoria inicializada: {memory_type}")
-        if self.api_key:
-            print("✅ Usando embeddings de OpenAI")
+        if self.collection.metadata and self.collection.metadata.get("embedding_model") == OPENAI_EMBEDDING_MODEL:
+            print("✅ Usando embeddings de OpenAI (key de cada petición)")
     
     def get_memory_type(self) -> str:
         """Retorna el tipo de memoria"""
         return self.memory_type
     
+    def _openai_key(self) -> Optional[str]:
+        """Key de OpenAI de la petición en curso o, si no hay, la del servidor"""
+        return get_request_provider_keys().get("openai") or self.api_key
+    
+    def _stored_embedding_model(self, collection) -> Optional[str]:
+        """
+        Modelo con el que se embebió una colección: el de sus metadatos o, en colecciones
+        antiguas sin él, el que corresponde a la dimensión de los vectores guardados.
+        None si no se puede saber (colección antigua y vacía: vale cualquier modelo).
+        """
+        model_name = (collection.metadata or {}).get("embedding_model")
+        if model_name:
+            return model_name
+        try:
+            sample = collection.get(limit=1, include=["embeddings"])
+            embeddings = sample.get("embeddings")
+            if embeddings is not None and len(embeddings):
+                return EMBEDDING_MODEL_BY_DIMENSION.get(len(embeddings[0]), DEFAULT_EMBEDDING_MODEL)
+        except Exception as e:
+            print(f"⚠️ No se pudo leer la dimensión de {collection.name}: {e}")
+        return None
+    
+    def _build_embedding_function(self, model_name: Optional[str] = None) -> CachedEmbeddingFunction:
+        """
+        Crea la función de embeddings envuelta en la caché persistente
+        
+        Args:
+            model_name: Modelo con el que se creó la colección (None = colección nueva:
+                OpenAI si la petición en curso o el servidor tienen key)
+            
+        Returns:
+            Función de embeddings cacheada por (modelo, sha256(texto))
+        """
+        if model_name is None:
+            model_name = OPENAI_EMBEDDING_MODEL if self._openai_key() else DEFAULT_EMBEDDING_MODEL
+        if model_name == OPENAI_EMBEDDING_MODEL:
+            # La key se resuelve en cada llamada (la del usuario de la petición)
+            inner = RequestKeyOpenAIEmbeddingFunction(self.api_key, OPENAI_EMBEDDING_MODEL)
+        else:
+            model_name = DEFAULT_EMBEDDING_MODEL
+            inner = embedding_functions.DefaultEmbeddingFunction()
+        return CachedEmbeddingFunction(inner, model_name=model_name)
+    
+    @staticmethod
+    def _collection_metadata(embedding_function: CachedEmbeddingFunction) -> Dict[str, str]:
+        return {
+            "description": "Contenido educativo procesado",
+            "embedding_model": embedding_function.model_name,
+        }
+    
+    def embedding_cache_stats(self) -> Dict[str, Any]:
+        """Contadores de la caché de embeddings (aciertos, fallos, evicciones)"""
+        return get_embedding_cache().stats()
+    
+    def _get_partition(self, chat_id: Optional[str], user_id: Optional[str], create: bool = False):
+        """
+        Devuelve (abriéndola de forma perezosa) la colección de partición del chat
+        
+        Args:
+            chat_id: ID del chat
+            user_id: ID del usuario
+            create: Crear la partición si no existe
+            
+        Returns:
+            Colección de la partición, o None en modo global / sin IDs / si no existe
+        """
+        if self.partition_mode == "global" or not chat_id or not user_id:
+            return None
+        name = partition_name(self.partition_mode, chat_id, user_id)
+        with self._partitions_lock:
+            if name in self._partitions:
+                self._partitions.move_to_end(name)
+                return self._partitions[name]
+            try:
+                existing = self.client.get_collection(name=name)
+                collection = self.client.get_collection(
+                    name=name,
+                    embedding_function=self._build_embedding_function(self._stored_embedding_model(existing))
+                )
+            except Exception:
+                if not create:
+                    return None
+                embedding_function = self._build_embedding_function()
+                metadata = self._collection_metadata(embedding_function)
+                metadata.update({"partition_mode": self.partition_mode, "user_id": user_id})
+                if self.partition_mode == "chat":
+                    metadata["chat_id"] = chat_id
+                collection = self.client.get_or_create_collection(
+                    name=name,
+                    embedding_function=embedding_function,
+                    metadata=metadata
+                )
+                print(f"✨ Partición vectorial creada: {name} ({self.partition_mode})")
+            self._partitions[name] = collection
+            # Cerrar (soltar) las particiones menos usadas
+            while len(self._partitions) > MAX_OPEN_PARTITIONS:
+                self._partitions.popitem(last=False)
+            return collection
+    
+    def _has_legacy_chunks(self, chat_id: str, user_id: str) -> bool:
+        """Indica si el chat aún tiene chunks en la colección global (memorizado)"""
+        key = f"{user_id}\x1f{chat_id}"
+        with self._partitions_lock:
+            if key in self._legacy_chats:
+                self._legacy_chats.move_to_end(key)
+                return self._legacy_chats[key]
+        try:
+            found = self.collection.get(
+                where={"$and": [{"chat_id": chat_id}, {"user_id": user_id}]},
+                limit=1,
+                include=[],
+            )
+            has_legacy = bool(found.get("ids"))
+        except Exception:
+            has_legacy = False
+        with self._partitions_lock:
+            self._legacy_chats[key] = has_legacy
+            while len(self._legacy_chats) > MAX_LEGACY_CHAT_MEMO:
+                self._legacy_chats.popitem(last=False)
+        return has_legacy
+    
+    def _chat_sources(self, chat_id: str, user_id: str) -> List[tuple]:
+        """
+        Colecciones (y filtro where) donde viven los chunks de un chat
+        
+        Returns:
+            Lista de (colección, where) empezando por la partición del chat
+        """
+        chat_filter = {"$and": [{"chat_id": chat_id}, {"user_id": user_id}]}
+        sources = []
+        partition = self._get_partition(chat_id, user_id)
+        if partition is not None:
+            sources.append((partition, None if self.partition_mode == "chat" else {"chat_id": chat_id}))
+        if self.partition_mode == "global" or self._has_legacy_chunks(chat_id, user_id):
+            sources.append((self.collection, chat_filter))
+        return sources
+    
+    def _drop_partitions(self) -> int:
+        """Borra las colecciones de partición y olvida las abiertas y el memo de chats antiguos"""
+        dropped = 0
+        with self._partitions_lock:
+            try:
+                for collection in self.client.list_collections():
+                    if collection.name.startswith("part_"):
+                        self.client.delete_collection(name=collection.name)
+                        dropped += 1
+            except Exception as e:
+                print(f"⚠️ Error al borrar particiones: {e}")
+            self._partitions.clear()
+            self._legacy_chats.clear()
+        if dropped:
+            print(f"🗑️ {dropped} particiones vectoriales eliminadas")
+        return dropped
+    
+    def list_partitions(self) -> List[Dict[str, Any]]:
+        """Registro de particiones existentes con sus metadatos"""
+        partitions = []
+        try:
+            for collection in self.client.list_collections():
+                if not collection.name.startswith("part_"):
+                    continue
+                metadata = collection.metadata or {}
+                partitions.append({
+                    "name": collection.name,
+                    "mode": metadata.get("partition_mode"),
+                    "user_id": metadata.get("user_id"),
+                    "chat_id": metadata.get("chat_id"),
+                    "open": collection.name in self._partitions,
+                })
+        except Exception as e:
+            print(f"⚠️ list_partitions: {e}")
+        return partitions
+    
     def store_documents(self, documents: List[str], metadatas: Optional[List[Dict]] = None, chat_id: Optional[str] = None, user_id: Optional[str] = None):
         """
         Almacena documentos en la memoria con embeddings
@@ -123,32 +409,123 @@ class MemoryManager:
             return
         
         if metadatas is None:
-            metadatas = [{}] * len(documents)
+            metadatas = [{} for _ in documents]
+        
+        # Copia por documento: cada chunk lleva su propio content_hash
+        metadatas = [dict(metadata or {}) for metadata in metadatas]
         
         # Asegurarse de que cada documento tenga chat_id y user_id en metadatos
-        for i, metadata in enumerate(metadatas):
+        for document, metadata in zip(documents, metadatas):
             if chat_id:
                 metadata['chat_id'] = chat_id
             if user_id:
                 metadata['user_id'] = user_id
+            metadata['content_hash'] = content_hash(document)
+        
+        # IDs direccionados por contenido y ubicación: sin count() previo y sin colisiones entre
+        # subidas concurrentes; cada aparición de un texto conserva su página y doc_id
+        ids = [
+            chunk_id(metadata['content_hash'], chat_id, user_id, chunk_location(metadata))
+            for metadata in metadatas
+        ]
+        # IDs de antes (solo por texto): los chunks ya guardados así no se duplican
+        legacy_ids = [chunk_id(metadata['content_hash'], chat_id, user_id) for metadata in metadatas]
+        
+        # Partición del chat (o colección global en modo global / sin chat)
+        collection = self._get_partition(chat_id, user_id, create=True) or self.collection
+        
+        stored = reused = skipped = 0
+        for start in range(0, len(documents), STORE_BATCH_SIZE):
+            end = start + STORE_BATCH_SIZE
+            batch_stored, batch_reused, batch_skipped = self._store_batch(
+                collection, documents[start:end], metadatas[start:end], ids[start:end], legacy_ids[start:end]
+            )
+            stored += batch_stored
+            reused += batch_reused
+            skipped += batch_skipped
         
-        # Generar IDs únicos
-        existing_count = self.collection.count()
-        ids = [f"doc_{existing_count + i}" for i in range(len(documents))]
-        
-        # Añadir documentos con embeddings automáticos
-        self.collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
+        print(
+            f"📚 {stored} documentos almacenados en memoria (chat_id: {chat_id}; "
+            f"{reused} embeddings reutilizados, {skipped} ya existentes)"
         )
+        # El digest del chat ya no refleja su corpus; se recalcula al terminar la subida
+        if stored and chat_id and user_id:
+            get_corpus_digest_store().invalidate(user_id, chat_id)
+    
+    def _store_batch(
+        self,
+        collection,
+        documents: List[str],
+        metadatas: List[Dict],
+        ids: List[str],
+        legacy_ids: Optional[List[str]] = None,
+    ) -> tuple:
+        """
+        Escribe un lote en la colección deduplicando por contenido.
+        
+        - Chunks cuyo ID ya existe (mismo texto en el mismo sitio del chat) se omiten.
+        - Chunks cuyo texto ya está embebido en la colección reutilizan ese embedding
+          (se guardan con sus propios metadatos, sin volver a llamar al modelo).
+        - Un texto repetido dentro del lote se embebe una sola vez (CachedEmbeddingFunction
+          deduplica por hash) y cada aparición conserva su página y doc_id.
+        
+        Returns:
+            Tupla (almacenados, embeddings reutilizados, omitidos)
+        """
+        legacy_ids = legacy_ids or ids
+        # Deduplicar dentro del propio lote (mismo texto en la misma página)
+        unique: Dict[str, int] = {}
+        for i, doc_id in enumerate(ids):
+            unique.setdefault(doc_id, i)
+        order = list(unique.values())
+        skipped = len(ids) - len(order)
         
-        print(f"📚 {len(documents)} documentos almacenados en memoria (chat_id: {chat_id})")
+        existing_ids = set()
+        try:
+            lookup = list({ids[i] for i in order} | {legacy_ids[i] for i in order})
+            existing_ids = set(collection.get(ids=lookup, include=[]).get("ids") or [])
+        except Exception as e:
+            print(f"⚠️ No se pudo comprobar IDs existentes: {e}")
+        pending = [i for i in order if ids[i] not in existing_ids and legacy_ids[i] not in existing_ids]
+        skipped += len(order) - len(pending)
+        if not pending:
+            return 0, 0, skipped
+        
+        # Índice de deduplicación: content_hash → embedding ya calculado (una fila por hash)
+        known_embeddings: Dict[str, List[float]] = {}
+        for text_hash in dict.fromkeys(metadatas[i]['content_hash'] for i in pending):
+            try:
+                found = collection.get(where={"content_hash": text_hash}, limit=1, include=["embeddings"])
+            except Exception as e:
+                print(f"⚠️ Índice de deduplicación no disponible: {e}")
+                break
+            embeddings = found.get("embeddings")
+            if embeddings is not None and len(embeddings) and embeddings[0] is not None:
+                known_embeddings[text_hash] = list(embeddings[0])
+        
+        reuse = [i for i in pending if metadatas[i]['content_hash'] in known_embeddings]
+        fresh = [i for i in pending if metadatas[i]['content_hash'] not in known_embeddings]
+        
+        if reuse:
+            collection.add(
+                documents=[documents[i] for i in reuse],
+                metadatas=[metadatas[i] for i in reuse],
+                embeddings=[known_embeddings[metadatas[i]['content_hash']] for i in reuse],
+                ids=[ids[i] for i in reuse],
+            )
+        if fresh:
+            # Embeddings automáticos solo para texto nuevo
+            collection.add(
+                documents=[documents[i] for i in fresh],
+                metadatas=[metadatas[i] for i in fresh],
+                ids=[ids[i] for i in fresh],
+            )
+        return len(pending), len(reuse), skipped
     
     def retrieve_relevant_content(self, query: str, n_results: int = 5, chat_id: Optional[str] = None, user_id: Optional[str] = None) -> List[str]:
         """
         Recupera contenido relevante para una consulta usando búsqueda semántica
-        IMPORTANTE: Filtra por chat_id y user_id para mantener chats independientes
+        IMPORTANTE: Solo busca en la partición del chat para mantener chats independientes
         
         Args:
             query: Consulta de búsqueda
@@ -159,121 +536,57 @@ class MemoryManager:
         Returns:
             Lista de documentos relevantes del chat específico
         """
-        # Verificar si hay documentos en la colección
-        collection_count = self.collection.count()
-        if collection_count == 0:
-            # No hay documentos, retornar lista vacía sin intentar búsqueda
-            return []
-        
         # Si no hay chat_id o user_id, retornar lista vacía para evitar mezclar chats
         if not chat_id or not user_id:
             print(f"⚠️ retrieve_relevant_content: chat_id o user_id no proporcionado. No se recuperará contenido para evitar mezclar chats.")
             return []
         
-        try:
-            # Asegurarse de que n_results sea al menos 1
-            safe_n_results = max(1, n_results)
-            
-            # Buscar contenido relevante
-            # ChromaDB: varias condiciones requieren $and (no un dict plano con dos claves).
-            where_filter = None
-            if chat_id and user_id:
-                where_filter = {"$and": [{"chat_id": chat_id}, {"user_id": user_id}]}
-            results = self.collection.query(
-                query_texts=[query],
-                n_results=min(safe_n_results * 3, collection_count),  # Buscar más para tener opciones al filtrar
-                where=where_filter,
-            )
-            
-            documents = results.get('documents', [])
-            metadatas = results.get('metadatas', [])
-            
-            # Filtrar documentos por chat_id y user_id (doble verificación)
-            filtered_docs = []
-            if documents and len(documents) > 0:
-                # documents es una lista de listas: [['doc1', 'doc2', ...]]
-                doc_list = documents[0] if isinstance(documents[0], list) else documents
-                metadata_list = metadatas[0] if (metadatas and isinstance(metadatas[0], list)) else (metadatas if metadatas else [])
-                
-                # Filtrar por chat_id y user_id
-                for i, doc in enumerate(doc_list):
-                    if doc:
-                        metadata = metadata_list[i] if i < len(metadata_list) else {}
-                        # Solo incluir si pertenece al chat correcto
-                        if metadata.get('chat_id') == chat_id and metadata.get('user_id') == user_id:
-                            filtered_docs.append(str(doc))
-                            if len(filtered_docs) >= safe_n_results:
-                                break
-                
-                return filtered_docs
-            
-            return []
-        except Exception as e:
-            print(f"⚠️ Error al buscar contenido: {e}")
-            # Si el error es por el filtro where (puede no estar soportado en todas las versiones de ChromaDB)
-            # Intentar sin filtro y filtrar manualmente
+        # Asegurarse de que n_results sea al menos 1
+        safe_n_results = max(1, n_results)
+        # (distancia, documento) de todas las fuentes: partición y, si quedan, chunks antiguos
+        scored: List[tuple] = []
+        for collection, where_filter in self._chat_sources(chat_id, user_id):
             try:
-                results = self.collection.query(
+                collection_count = collection.count()
+                if collection_count == 0:
+                    continue
+                # La búsqueda ANN solo recorre los vectores del chat: sin sobre-muestreo ni re-filtrado
+                results = collection.query(
                     query_texts=[query],
-                    n_results=min(safe_n_results * 3, collection_count)
+                    n_results=min(safe_n_results, collection_count),
+                    where=where_filter,
+                    include=["documents", "distances"],
                 )
-                
-                documents = results.get('documents', [])
-                metadatas = results.get('metadatas', [])
-                
-                filtered_docs = []
-                if documents and len(documents) > 0:
-                    doc_list = documents[0] if isinstance(documents[0], list) else documents
-                    metadata_list = metadatas[0] if (metadatas and isinstance(metadatas[0], list)) else (metadatas if metadatas else [])
-                    
-                    for i, doc in enumerate(doc_list):
-                        if doc:
-                            metadata = metadata_list[i] if i < len(metadata_list) else {}
-                            if metadata.get('chat_id') == chat_id and metadata.get('user_id') == user_id:
-                                filtered_docs.append(str(doc))
-                                if len(filtered_docs) >= safe_n_results:
-                                    break
-                
-                return filtered_docs
-            except Exception as e2:
-                print(f"⚠️ Error en fallback: {e2}")
-            return []
+                found = results.get('documents') or []
+                doc_list = found[0] if found and isinstance(found[0], list) else found
+                distances = results.get('distances') or []
+                dist_list = distances[0] if distances and isinstance(distances[0], list) else distances
+                for i, doc in enumerate(doc_list):
+                    if doc:
+                        distance = dist_list[i] if i < len(dist_list) else float("inf")
+                        scored.append((distance, str(doc)))
+            except Exception as e:
+                print(f"⚠️ Error al buscar contenido: {e}")
+        
+        # Mezcla por distancia: los chunks antiguos solo entran si están más cerca que los de la partición
+        scored.sort(key=lambda item: item[0])
+        return [doc for _, doc in scored[:safe_n_results]]
     
     def list_chat_documents(self, chat_id: str, user_id: str) -> List[Dict[str, Any]]:
         """Lista documentos únicos indexados para un chat."""
-        try:
-            if self.collection.count() == 0:
-                return []
-            results = self.collection.get(
-                where={"$and": [{"chat_id": chat_id}, {"user_id": user_id}]},
-                limit=10000,
-            )
-            metadatas = results.get("metadatas") or []
-            docs_map: Dict[str, Dict[str, Any]] = {}
-            for meta in metadatas:
-                if not meta:
-                    continue
-                doc_id = meta.get("doc_id") or meta.get("source") or "unknown"
-                if doc_id not in docs_map:
-                    docs_map[doc_id] = {
-                        "doc_id": doc_id,
-                        "filename": meta.get("source", doc_id),
-                        "uploaded_at": meta.get("uploaded_at"),
-                        "chunk_count": 0,
-                    }
-                docs_map[doc_id]["chunk_count"] += 1
-            return list(docs_map.values())
-        except Exception as e:
-            print(f"⚠️ list_chat_documents fallback: {e}")
+        docs_map: Dict[str, Dict[str, Any]] = {}
+        for collection, where_filter in self._chat_sources(chat_id, user_id):
             try:
-                results = self.collection.get(limit=10000)
-                metadatas = results.get("metadatas") or []
-                docs_map: Dict[str, Dict[str, Any]] = {}
-                for meta in metadatas:
+                if collection.count() == 0:
+                    continue
+                results = collection.get(
+                    where=where_filter,
+                    limit=10000,
+                    include=["metadatas"],
+                )
+                for meta in results.get("metadatas") or []:
                     if not meta:
                         continue
-                    if meta.get("chat_id") != chat_id or meta.get("user_id") != user_id:
-                        continue
                     doc_id = meta.get("doc_id") or meta.get("source") or "unknown"
                     if doc_id not in docs_map:
                         docs_map[doc_id] = {
@@ -283,61 +596,110 @@ class MemoryManager:
                             "chunk_count": 0,
                         }
                     docs_map[doc_id]["chunk_count"] += 1
-                return list(docs_map.values())
-            except Exception as e2:
-                print(f"❌ list_chat_documents: {e2}")
-                return []
+            except Exception as e:
+                print(f"⚠️ list_chat_documents: {e}")
+        return list(docs_map.values())
 
+    def has_document(self, chat_id: str, user_id: str, source: str) -> bool:
+        """Indica si el chat ya tiene chunks del fichero source (nombre, como en los metadatos)"""
+        for collection, where_filter in self._chat_sources(chat_id, user_id):
+            where = {"$and": [where_filter, {"source": source}]} if where_filter else {"source": source}
+            try:
+                if collection.get(where=where, limit=1, include=[]).get("ids"):
+                    return True
+            except Exception as e:
+                print(f"⚠️ has_document: {e}")
+        return False
+    
     def get_chat_corpus_text(self, chat_id: str, user_id: str, max_chars: int = 14000) -> str:
-        """Concatena chunks del chat para extracción de conceptos."""
-        try:
-            if self.collection.count() == 0:
-                return ""
-            results = self.collection.get(
-                where={"$and": [{"chat_id": chat_id}, {"user_id": user_id}]},
-                limit=80,
-            )
-            documents = results.get("documents") or []
-            parts: List[str] = []
-            total = 0
-            for doc in documents:
-                if not doc:
+        """Texto del corpus del chat (chunks del digest) para extracción de conceptos y apuntes."""
+        parts: List[str] = []
+        total = 0
+        for chunk in self.get_chat_digest(chat_id, user_id):
+            if total + len(chunk) > max_chars:
+                remain = max_chars - total
+                if remain > 100:
+                    parts.append(chunk[:remain])
+                break
+            parts.append(chunk)
+            total += len(chunk)
+        return "\n\n".join(parts)
+
+    def get_chat_digest(self, chat_id: Optional[str], user_id: Optional[str]) -> List[str]:
+        """
+        Chunks representativos del corpus de un chat (ver memory/corpus_digest.py)
+        
+        Lee el digest precalculado; si falta (chat nuevo o invalidado) lo calcula una vez.
+        
+        Returns:
+            Lista de chunks (vacía sin chat_id/user_id o si el chat no tiene documentos)
+        """
+        if not chat_id or not user_id:
+            return []
+        chunks, version = get_corpus_digest_store().get(user_id, chat_id)
+        if chunks is not None:
+            return chunks
+        return self._build_chat_digest(chat_id, user_id, version)
+
+    def refresh_chat_digest(self, chat_id: Optional[str], user_id: Optional[str]) -> List[str]:
+        """Recalcula el digest del chat (al terminar de subir documentos)"""
+        if not chat_id or not user_id:
+            return []
+        _, version = get_corpus_digest_store().get(user_id, chat_id)
+        return self._build_chat_digest(chat_id, user_id, version)
+
+    def _build_chat_digest(self, chat_id: str, user_id: str, version: int) -> List[str]:
+        entries = []
+        for collection, where_filter in self._chat_sources(chat_id, user_id):
+            try:
+                if collection.count() == 0:
                     continue
-                chunk = str(doc)
-                if total + len(chunk) > max_chars:
-                    remain = max_chars - total
-                    if remain > 100:
-                        parts.append(chunk[:remain])
-                    break
-                parts.append(chunk)
-                total += len(chunk)
-            return "\n\n".join(parts)
-        except Exception as e:
-            print(f"⚠️ get_chat_corpus_text: {e}")
-            return ""
+                results = collection.get(
+                    where=where_filter,
+                    limit=10000,
+                    include=["documents", "metadatas"],
+                )
+            except Exception as e:
+                print(f"⚠️ _build_chat_digest: {e}")
+                continue
+            documents = results.get("documents") or []
+            metadatas = results.get("metadatas") or [{}] * len(documents)
+            entries.extend((str(doc), meta) for doc, meta in zip(documents, metadatas) if doc)
+        chunks = select_representative(entries)
+        get_corpus_digest_store().put(user_id, chat_id, chunks, version)
+        print(f"📚 Digest del chat {chat_id}: {len(chunks)} de {len(entries)} chunks")
+        return chunks
 
     def delete_chat_document(self, chat_id: str, user_id: str, doc_id: str) -> bool:
         """Elimina todos los chunks de un documento en un chat."""
-        try:
-            results = self.collection.get(
-                where={"$and": [{"chat_id": chat_id}, {"user_id": user_id}]},
-                limit=10000,
-            )
-            ids = results.get("ids") or []
-            metadatas = results.get("metadatas") or []
-            to_delete = [
-                chunk_id
-                for chunk_id, meta in zip(ids, metadatas)
-                if meta and (meta.get("doc_id") == doc_id or meta.get("source") == doc_id)
-            ]
-            if to_delete:
-                self.collection.delete(ids=to_delete)
-                print(f"🗑️ Eliminados {len(to_delete)} chunks del doc {doc_id}")
-                return True
-            return False
-        except Exception as e:
-            print(f"❌ delete_chat_document: {e}")
-            return False
+        deleted = 0
+        for collection, where_filter in self._chat_sources(chat_id, user_id):
+            try:
+                results = collection.get(
+                    where=where_filter,
+                    limit=10000,
+                    include=["metadatas"],
+                )
+                ids = results.get("ids") or []
+                metadatas = results.get("metadatas") or []
+                to_delete = [
+                    item_id
+                    for item_id, meta in zip(ids, metadatas)
+                    if meta and (meta.get("doc_id") == doc_id or meta.get("source") == doc_id)
+                ]
+                if to_delete:
+                    collection.delete(ids=to_delete)
+                    deleted += len(to_delete)
+            except Exception as e:
+                print(f"❌ delete_chat_document: {e}")
+        # Recalcular si quedan chunks antiguos en la colección global
+        with self._partitions_lock:
+            self._legacy_chats.pop(f"{user_id}\x1f{chat_id}", None)
+        if deleted:
+            get_corpus_digest_store().invalidate(user_id, chat_id)
+            print(f"🗑️ Eliminados {deleted} chunks del doc {doc_id}")
+            return True
+        return False
     
     def get_conversation_history(self, user_id: str, chat_id: Optional[str] = None) -> List[Dict]:
         """
@@ -350,16 +712,12 @@ class MemoryManager:
         Returns:
             Historial de conversación del chat específico
         """
-        if user_id not in self.conversation_histories:
-            return []
-        
         # Si no hay chat_id, devolver historial vacío (no mezclar chats)
         if chat_id is None:
             return []
         
-        # Devolver historial del chat específico
-        user_chats = self.conversation_histories[user_id]
-        return user_chats.get(chat_id, [])
+        # Devolver historial del chat específico (desde memoria si el chat está caliente)
+        return self.history.get(user_id, chat_id)
     
     def add_to_conversation_history(self, user_id: str, role: str, content: str, chat_id: Optional[str] = None):
         """
@@ -375,20 +733,8 @@ class MemoryManager:
             # Si no hay chat_id, usar "default" para mantener compatibilidad
             chat_id = "default"
         
-        if user_id not in self.conversation_histories:
-            self.conversation_histories[user_id] = {}
-        
-        if chat_id not in self.conversation_histories[user_id]:
-            self.conversation_histories[user_id][chat_id] = []
-        
-        self.conversation_histories[user_id][chat_id].append({
-            "role": role,
-            "content": content
-        })
-        
-        # Limitar historial a últimos 50 mensajes por chat
-        if len(self.conversation_histories[user_id][chat_id]) > 50:
-            self.conversation_histories[user_id][chat_id] = self.conversation_histories[user_id][chat_id][-50:]
+        # El store limita el historial a los últimos mensajes por chat (50 por defecto)
+        self.history.append(user_id, chat_id, role, content)
     
     def clear_conversation_history(self, user_id: str, chat_id: Optional[str] = None):
         """
@@ -398,57 +744,22 @@ class MemoryManager:
             user_id: ID del usuario
             chat_id: ID del chat (opcional, si no se proporciona, limpia todos los chats del usuario)
         """
-        if user_id not in self.conversation_histories:
-            return
-        
-        if chat_id is None:
-            # Limpiar todos los chats del usuario
-            self.conversation_histories[user_id] = {}
-        else:
-            # Limpiar solo el chat específico
-            if chat_id in self.conversation_histories[user_id]:
-                self.conversation_histories[user_id][chat_id] = []
+        self.history.clear(user_id, chat_id)
     
-    def get_all_documents(self, limit: int = 100) -> List[str]:
-        """
-        Obtiene todos los documentos almacenados
-        
-        Args:
-            limit: Límite de documentos a retornar
-            
-        Returns:
-            Lista de documentos
-        """
-        try:
-            count = self.collection.count()
-            print(f"📚 Total de documentos en memoria: {count}")
-            
-            if count == 0:
-                print("⚠️ No hay documentos en la colección")
-                return []
-            
-            results = self.collection.get(limit=min(limit, count))
-            documents = results.get('documents', [])
-            
-            # Filtrar documentos vacíos
-            valid_documents = [doc for doc in documents if doc and doc.strip()]
-            
-            print(f"📚 Documentos recuperados: {len(valid_documents)} de {len(documents)} (válidos)")
-            if valid_documents:
-                print(f"📄 Primer documento (primeros 100 chars): {valid_documents[0][:100]}...")
-            
-            return valid_documents
-        except Exception as e:
-            print(f"❌ Error al obtener documentos: {e}")
-            return []
+    def conversation_history_stats(self) -> Dict[str, Any]:
+        """Contadores del historial (chats calientes, hits/misses, recargas, evicciones)"""
+        return self.history.stats()
     
     def clear_all_documents(self):
         """
         Elimina todos los documentos de la memoria
         
-        Nota: Esto elimina todos los documentos pero mantiene la colección.
-        La colección se puede seguir usando después de limpiar.
+        Nota: Esto elimina todos los documentos pero mantiene la colección global.
+        La colección se puede seguir usando después de limpiar; las particiones se
+        borran enteras y se recrean al volver a subir documentos.
         """
+        self._drop_partitions()
+        get_corpus_digest_store().clear()
         try:
             # Obtener todos los IDs de documentos
             results = self.collection.get()
@@ -465,19 +776,12 @@ class MemoryManager:
             # Si falla, intentar eliminar la colección y recrearla
             try:
                 self.client.delete_collection(name="study_content")
-                # Recrear la colección
-                if self.api_key:
-                    embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-                        api_key=self.api_key,
-                        model_name="text-embedding-3-small"
-                    )
-                else:
-                    embedding_function = embedding_functions.DefaultEmbeddingFunction()
-                
+                # Recrear la colección con la misma función de embeddings
+                embedding_function = self._build_embedding_function()
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Colección recreada después de limpiar")
             except Exception as e2:
@@ -506,9 +810,12 @@ class MemoryManager:
         """
         Elimina todos los documentos de la memoria
         
-        Nota: Esto elimina todos los documentos pero mantiene la colección.
-        La colección se puede seguir usando después de limpiar.
+        Nota: Esto elimina todos los documentos pero mantiene la colección global.
+        La colección se puede seguir usando después de limpiar; las particiones se
+        borran enteras y se recrean al volver a subir documentos.
         """
+        self._drop_partitions()
+        get_corpus_digest_store().clear()
         try:
             # Obtener todos los IDs de documentos
             results = self.collection.get()
@@ -530,7 +837,7 @@ class MemoryManager:
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Colección recreada después de limpiar")
             except Exception as e2:
@@ -1264,9 +1571,12 @@ class MemoryManager:
         """
         Elimina todos los documentos de la memoria
         
-        Nota: Esto elimina todos los documentos pero mantiene la colección.
-        La colección se puede seguir usando después de limpiar.
+        Nota: Esto elimina todos los documentos pero mantiene la colección global.
+        La colección se puede seguir usando después de limpiar; las particiones se
+        borran enteras y se recrean al volver a subir documentos.
         """
+        self._drop_partitions()
+        get_corpus_digest_store().clear()
         try:
             # Obtener todos los IDs de documentos
             results = self.collection.get()
@@ -1288,7 +1598,7 @@ class MemoryManager:
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Colección recreada después de limpiar")
             except Exception as e2:
@@ -2022,9 +2332,12 @@ class MemoryManager:
         """
         Elimina todos los documentos de la memoria
         
-        Nota: Esto elimina todos los documentos pero mantiene la colección.
-        La colección se puede seguir usando después de limpiar.
+        Nota: Esto elimina todos los documentos pero mantiene la colección global.
+        La colección se puede seguir usando después de limpiar; las particiones se
+        borran enteras y se recrean al volver a subir documentos.
         """
+        self._drop_partitions()
+        get_corpus_digest_store().clear()
         try:
             # Obtener todos los IDs de documentos
             results = self.collection.get()
@@ -2046,7 +2359,7 @@ class MemoryManager:
                 self.collection = self.client.create_collection(
                     name="study_content",
                     embedding_function=embedding_function,
-                    metadata={"description": "Contenido educativo procesado"}
+                    metadata=self._collection_metadata(embedding_function)
                 )
                 print("✨ Colección recreada después de limpiar")
             except Exception as e2:
@@ -2756,3 +3069,19 @@ class MemoryManager:
                 "total_requests": 0,
                 "by_model": {}
             }
+
+
+_shared_memory: Optional[MemoryManager] = None
+_shared_memory_lock = threading.Lock()
+
+
+def get_shared_memory() -> MemoryManager:
+    """
+    MemoryManager único del proceso (colecciones, particiones e historial compartidos).
+    Los embeddings de OpenAI usan la key de cada petición.
+    """
+    global _shared_memory
+    with _shared_memory_lock:
+        if _shared_memory is None:
+            _shared_memory = MemoryManager()
+        return _shared_memory
@@ -6,28 +6,45 @@ Optimiza costes: Ollama/OpenRouter free → Groq → DeepSeek → OpenAI barato
 from __future__ import annotations
 
 import os
+import sys
 from typing import Optional, Dict, List, Tuple, Any
 from enum import Enum
 import logging
 
-try:
-    import requests
-except ImportError:
-    requests = None
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from llm_pool import LLM_HTTP_TIMEOUT_SECONDS, OLLAMA_BASE_URL, get_client_pool, get_ollama_inventory, key_fingerprint
+from model_router import get_router, routing_callbacks
+from execution_context import provider_keys as request_provider_keys
 
 logger = logging.getLogger(__name__)
 
-# Keys por petición (inyectadas desde FastAPI)
-_REQUEST_PROVIDER_KEYS: Dict[str, str] = {}
+QUALITY_ORDER = {"low": 0, "medium": 1, "high": 2, "premium": 3}
 
 
-def set_request_provider_keys(keys: Optional[Dict[str, str]]) -> None:
-    global _REQUEST_PROVIDER_KEYS
-    _REQUEST_PROVIDER_KEYS = {k: v for k, v in (keys or {}).items() if v}
+def _cost_key(model: "ModelConfig") -> Tuple[float, int]:
+    """Orden estático: más barato primero y, a igual coste, menor calidad"""
+    return (model.cost_per_1k_input + model.cost_per_1k_output, QUALITY_ORDER.get(model.quality_level, 0))
 
 
-def get_request_provider_keys() -> Dict[str, str]:
-    return dict(_REQUEST_PROVIDER_KEYS)
+class RequestScopedKey:
+    """
+    Descriptor para el atributo api_key de los agentes: devuelve la key de OpenAI
+    de la petición en curso y, si no hay, la configurada al crear el agente.
+    Así una misma instancia de agente sirve a usuarios con keys distintas.
+    """
+
+    def __set_name__(self, owner, name: str) -> None:
+        self._attr = f"_{name}_default"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return request_provider_keys().get("openai") or getattr(obj, self._attr, None)
+
+    def __set__(self, obj, value: Optional[str]) -> None:
+        setattr(obj, self._attr, value)
 
 
 class ModelProvider(Enum):
@@ -187,9 +204,11 @@ class ModelManager:
     def __init__(self, api_key: Optional[str] = None, mode: str = "auto", provider_keys: Optional[Dict[str, str]] = None):
         self.api_key = api_key
         self.mode = mode
+        # Keys del entorno y del constructor; las de la petición se superponen en _key_for
         self.provider_keys = self._resolve_keys(api_key, provider_keys)
-        self.ollama_available = self._check_ollama_availability()
-        self._model_cache: Dict[str, Any] = {}
+        # Clientes LLM e inventario de Ollama compartidos por todos los ModelManager
+        self._client_pool = get_client_pool()
+        self._ollama_inventory = get_ollama_inventory()
 
     def _resolve_keys(
         self,
@@ -208,11 +227,10 @@ class ModelManager:
             val = os.getenv(env_name)
             if val:
                 keys[prov] = val
-        # Request / constructor
-        for src in (get_request_provider_keys(), provider_keys or {}):
-            for k, v in src.items():
-                if v:
-                    keys[k] = v
+        # Constructor
+        for k, v in (provider_keys or {}).items():
+            if v:
+                keys[k] = v
         if openai_key:
             keys["openai"] = openai_key
         # Sync self.api_key
@@ -221,28 +239,31 @@ class ModelManager:
         return keys
 
     def _key_for(self, provider: ModelProvider) -> Optional[str]:
+        # Las keys de la petición en curso (execution_context) tienen prioridad y nunca se
+        # guardan en la instancia: un ModelManager compartido no filtra keys entre usuarios
+        request_keys = request_provider_keys()
         if provider == ModelProvider.OPENAI:
-            return self.provider_keys.get("openai") or self.api_key
+            return request_keys.get("openai") or self.provider_keys.get("openai") or self.api_key
         if provider == ModelProvider.DEEPSEEK:
-            return self.provider_keys.get("deepseek")
+            return request_keys.get("deepseek") or self.provider_keys.get("deepseek")
         if provider == ModelProvider.GROQ:
-            return self.provider_keys.get("groq")
+            return request_keys.get("groq") or self.provider_keys.get("groq")
         if provider == ModelProvider.OPENROUTER:
-            return self.provider_keys.get("openrouter")
+            return request_keys.get("openrouter") or self.provider_keys.get("openrouter")
         return None
 
-    def _check_ollama_availability(self) -> bool:
-        if requests is None:
-            return False
-        try:
-            response = requests.get("http://localhost:11434/api/tags", timeout=2)
-            return response.status_code == 200
-        except Exception:
-            return False
+    def _key_fingerprint(self, model: ModelConfig) -> str:
+        """Huella de la key con la que se llamaría a model (el router lleva la salud por key)"""
+        return key_fingerprint(self._key_for(model.provider))
+
+    @property
+    def ollama_available(self) -> bool:
+        # Inventario cacheado: no hace una petición HTTP por cada selección de modelo
+        return self._ollama_inventory.available()
 
     def get_available_models(self, min_quality: str = "low") -> List[ModelConfig]:
-        quality_order = {"low": 0, "medium": 1, "high": 2, "premium": 3}
-        min_quality_level = quality_order.get(min_quality, 0)
+        """Modelos utilizables, ordenados por el router (salud, SLO de latencia y coste)"""
+        min_quality_level = QUALITY_ORDER.get(min_quality, 0)
         available = []
 
         for model in self.MODELS:
@@ -250,17 +271,11 @@ class ModelManager:
                 continue
             if model.requires_api_key and not self._key_for(model.provider):
                 continue
-            if quality_order.get(model.quality_level, 0) < min_quality_level:
+            if QUALITY_ORDER.get(model.quality_level, 0) < min_quality_level:
                 continue
             available.append(model)
 
-        available.sort(
-            key=lambda m: (
-                m.cost_per_1k_input + m.cost_per_1k_output,
-                quality_order.get(m.quality_level, 0),
-            )
-        )
-        return available
+        return get_router().rank(available, _cost_key, key_of=self._key_fingerprint)
 
     def select_model(
         self,
@@ -269,10 +284,12 @@ class ModelManager:
         preferred_model: Optional[str] = None,
         context_length: Optional[int] = None,
         force_premium: bool = False,
+        temperature: float = 0.7,
     ) -> Tuple[ModelConfig, Any]:
-        # Refrescar keys por si cambió el request
-        self.provider_keys = self._resolve_keys(self.api_key, self.provider_keys)
-
+        """
+        Elige modelo y devuelve (config, cliente LLM). El cliente sale del pool
+        compartido: para otra temperatura hay que pedirla aquí, no modificarlo.
+        """
         if force_premium:
             min_quality = "premium"
             for premium_model in ("deepseek-reasoner", "gpt-5", "gpt-5-pro"):
@@ -281,7 +298,9 @@ class ModelManager:
                         continue
                     if model.requires_api_key and not self._key_for(model.provider):
                         continue
-                    llm = self._create_llm(model)
+                    if not get_router().allows(model.name, self._key_fingerprint(model)):
+                        continue
+                    llm = self._create_llm(model, temperature)
                     if llm:
                         logger.info(f"Usando modelo premium: {model.name}")
                         return model, llm
@@ -294,7 +313,11 @@ class ModelManager:
                     break
                 if model.requires_api_key and not self._key_for(model.provider):
                     break
-                llm = self._create_llm(model)
+                if not get_router().allows(model.name, self._key_fingerprint(model)):
+                    # Circuito abierto: se elige otro modelo automáticamente
+                    logger.warning(f"Modelo preferido {model.name} con circuito abierto")
+                    break
+                llm = self._create_llm(model, temperature)
                 if llm:
                     logger.info(f"Usando modelo preferido: {model.name}")
                     return model, llm
@@ -308,7 +331,7 @@ class ModelManager:
                 ]
             for model in available_models:
                 try:
-                    llm = self._create_llm(model)
+                    llm = self._create_llm(model, temperature)
                     if llm:
                         logger.info(f"Modelo auto: {model.name}")
                         return model, llm
@@ -322,46 +345,62 @@ class ModelManager:
         if not available_models:
             raise RuntimeError("No hay modelos disponibles.")
         model = available_models[0]
-        llm = self._create_llm(model)
+        llm = self._create_llm(model, temperature)
         return model, llm
 
-    def _create_llm(self, model_config: ModelConfig) -> Optional[Any]:
+    def _create_llm(self, model_config: ModelConfig, temperature: float = 0.7) -> Optional[Any]:
+        """Cliente del pool para (proveedor, modelo, key, temperatura, max_tokens); lo crea si no existe"""
         try:
             if model_config.provider == ModelProvider.OLLAMA:
-                return self._create_ollama_llm(model_config)
-            return self._create_openai_compatible_llm(model_config)
+                model_name = self._resolve_ollama_model(model_config.name)
+                if model_name is None:
+                    return None
+                key = (model_config.provider.value, model_name, "-", temperature, None)
+                return self._client_pool.get_or_create(
+                    key, lambda: self._create_ollama_llm(model_config, model_name, temperature)
+                )
+            api_key = self._key_for(model_config.provider)
+            if model_config.requires_api_key and not api_key:
+                logger.warning(f"Falta API key para {model_config.provider.value}")
+                return None
+            max_output_tokens = min(model_config.max_tokens or 4096, 4096)
+            key = (
+                model_config.provider.value,
+                model_config.api_model_id,
+                key_fingerprint(api_key),
+                temperature,
+                max_output_tokens,
+            )
+            return self._client_pool.get_or_create(
+                key,
+                lambda: self._create_openai_compatible_llm(model_config, api_key, temperature, max_output_tokens),
+            )
         except Exception as e:
             logger.error(f"Error creando LLM {model_config.name}: {e}")
             return None
 
-    def _create_ollama_llm(self, model_config: ModelConfig) -> Optional[Any]:
+    def _resolve_ollama_model(self, requested: str) -> Optional[str]:
+        model_names = self._ollama_inventory.models()
+        if not model_names:
+            return None
+        if requested in model_names:
+            return requested
+        # Preferir qwen/llama si el pedido no está
+        for candidate in ("qwen2.5", "llama3.1", "llama3.2"):
+            if candidate in model_names:
+                return candidate
+        return model_names[0]
+
+    def _create_ollama_llm(self, model_config: ModelConfig, model_name: str, temperature: float) -> Optional[Any]:
         try:
             from langchain_community.chat_models import ChatOllama
 
-            if requests is None:
-                return None
-            try:
-                response = requests.get("http://localhost:11434/api/tags", timeout=2)
-                if response.status_code != 200:
-                    return None
-                models = response.json().get("models", [])
-                model_names = [m.get("name", "").split(":")[0] for m in models]
-                model_name = model_config.name
-                if model_name not in model_names:
-                    if model_names:
-                        # Preferir qwen/llama si el pedido no está
-                        for candidate in (model_name, "qwen2.5", "llama3.1", "llama3.2"):
-                            if candidate in model_names:
-                                model_name = candidate
-                                break
-                        else:
-                            model_name = model_names[0]
-                    else:
-                        return None
-            except Exception:
-                return None
-
-            return ChatOllama(model=model_name, base_url="http://localhost:11434", temperature=0.7)
+            return ChatOllama(
+                model=model_name,
+                base_url=OLLAMA_BASE_URL,
+                temperature=temperature,
+                callbacks=routing_callbacks(model_config.name, model_config.provider.value, key_fingerprint(None)),
+            )
         except ImportError:
             logger.warning("langchain_community no instalado")
             return None
@@ -369,21 +408,26 @@ class ModelManager:
             logger.error(f"Error Ollama: {e}")
             return None
 
-    def _create_openai_compatible_llm(self, model_config: ModelConfig) -> Optional[Any]:
+    def _create_openai_compatible_llm(
+        self,
+        model_config: ModelConfig,
+        api_key: Optional[str],
+        temperature: float,
+        max_output_tokens: int,
+    ) -> Optional[Any]:
         try:
             from langchain_openai import ChatOpenAI
 
-            api_key = self._key_for(model_config.provider)
-            if model_config.requires_api_key and not api_key:
-                logger.warning(f"Falta API key para {model_config.provider.value}")
-                return None
-
-            max_output_tokens = min(model_config.max_tokens or 4096, 4096)
             kwargs: Dict[str, Any] = {
                 "model": model_config.api_model_id,
-                "temperature": 0.7,
+                "temperature": temperature,
                 "api_key": api_key or "not-needed",
                 "max_tokens": max_output_tokens,
+                "timeout": LLM_HTTP_TIMEOUT_SECONDS,
+                # Latencia, errores y 429 de cada llamada alimentan el router
+                "callbacks": routing_callbacks(
+                    model_config.name, model_config.provider.value, key_fingerprint(api_key)
+                ),
             }
             if model_config.base_url:
                 kwargs["base_url"] = model_config.base_url
@@ -404,6 +448,16 @@ class ModelManager:
             logger.error(f"Error LLM compatible: {e}")
             return None
 
+    @classmethod
+    def routing_table(cls) -> Dict[str, Any]:
+        """Salud por modelo y key, y orden actual del router (con las keys de la plataforma) sobre todo el catálogo"""
+        router = get_router()
+        platform = cls()
+        return {
+            "models": router.routing_table(),
+            "order": [m.name for m in router.rank(cls.MODELS, _cost_key, key_of=platform._key_fingerprint)],
+        }
+
     def get_model_info(self, model_name: str) -> Optional[ModelConfig]:
         for model in self.MODELS:
             if model.name == model_name:
@@ -0,0 +1,301 @@
+"""
+Model Router - Enrutado de modelos según salud y latencia
+Por cada modelo y API key (su huella, llm_pool.key_fingerprint) guarda una ventana
+deslizante de llamadas (latencia, error, 429) y un circuit breaker: un 401/429 de la
+key de un usuario no corta el modelo a los demás. ModelManager ordena los candidatos así:
+  1. fuera los que tienen el circuito abierto (salvo que lo estén todos),
+  2. primero los que cumplen el SLO de latencia (p95) y de errores,
+  3. dentro de cada grupo, por coste y calidad como antes.
+Las mediciones llegan de un callback de LangChain que se engancha a cada cliente
+del pool (llm_pool), así que ningún agente tiene que instrumentar sus llamadas; el
+mismo callback suma los tokens de cada llamada al contexto de ejecución de la petición.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+except ImportError:
+    BaseCallbackHandler = None
+
+from execution_context import record_usage
+
+# Llamadas recientes por modelo sobre las que se calculan p50/p95 y tasa de error
+ROUTER_WINDOW = max(5, int(os.getenv("ROUTER_WINDOW", "50")))
+# SLO de latencia: un modelo con p95 por encima pasa al final de la cola
+ROUTER_LATENCY_SLO_MS = max(1, int(os.getenv("ROUTER_LATENCY_SLO_MS", "20000")))
+# Tasa de error a partir de la cual se abre el circuito (con al menos ROUTER_MIN_SAMPLES llamadas)
+ROUTER_ERROR_RATE_THRESHOLD = float(os.getenv("ROUTER_ERROR_RATE_THRESHOLD", "0.5"))
+ROUTER_MIN_SAMPLES = max(1, int(os.getenv("ROUTER_MIN_SAMPLES", "5")))
+# Fallos seguidos que abren el circuito aunque no haya muestras suficientes
+ROUTER_CONSECUTIVE_FAILURES = max(1, int(os.getenv("ROUTER_CONSECUTIVE_FAILURES", "3")))
+# Segundos con el circuito abierto antes de dejar pasar una llamada de prueba
+ROUTER_OPEN_SECONDS = max(1, int(os.getenv("ROUTER_OPEN_SECONDS", "60")))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    """429 / rate limit del proveedor (OpenAI, Groq, OpenRouter... usan el SDK de OpenAI)"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    if type(error).__name__ == "RateLimitError":
+        return True
+    text = str(error).lower()
+    return "429" in text or "rate limit" in text or "rate_limit" in text
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ModelHealth:
+    """Ventana deslizante de llamadas y circuit breaker de un modelo con una API key"""
+
+    def __init__(self, name: str, provider: str, key: str):
+        self.name = name
+        self.provider = provider
+        self.key = key
+        self.calls: Deque[Tuple[float, float, bool, bool]] = deque(maxlen=ROUTER_WINDOW)
+        self.state = CLOSED
+        self.opened_until = 0.0
+        self.consecutive_failures = 0
+        self.rate_limited_total = 0
+        self.probe_in_flight = False
+        self.last_error: Optional[str] = None
+
+    def _latencies(self) -> List[float]:
+        return [latency for _, latency, ok, _ in self.calls if ok]
+
+    def p50_ms(self) -> Optional[float]:
+        return _percentile(self._latencies(), 0.5)
+
+    def p95_ms(self) -> Optional[float]:
+        return _percentile(self._latencies(), 0.95)
+
+    def error_rate(self) -> float:
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, _, ok, _ in self.calls if not ok) / len(self.calls)
+
+    def _open(self, now: float, seconds: float, reason: str) -> None:
+        self.state = OPEN
+        self.opened_until = now + seconds
+        self.probe_in_flight = False
+        self.last_error = reason
+
+    def record(self, latency_ms: float, error: Optional[BaseException], now: float) -> None:
+        rate_limited = error is not None and is_rate_limit(error)
+        self.calls.append((now, latency_ms, error is None, rate_limited))
+        if error is None:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self.probe_in_flight = False
+            return
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+        if rate_limited:
+            self.rate_limited_total += 1
+            # Un 429 abre el circuito ya: el proveedor nos ha pedido esperar
+            self._open(now, _retry_after(error) or ROUTER_OPEN_SECONDS, self.last_error)
+        elif self.state == HALF_OPEN:
+            self._open(now, ROUTER_OPEN_SECONDS, self.last_error)
+        elif self.consecutive_failures >= ROUTER_CONSECUTIVE_FAILURES or (
+            len(self.calls) >= ROUTER_MIN_SAMPLES and self.error_rate() >= ROUTER_ERROR_RATE_THRESHOLD
+        ):
+            self._open(now, ROUTER_OPEN_SECONDS, self.last_error)
+
+    def allows(self, now: float) -> bool:
+        """True si se le pueden mandar peticiones (en half-open, solo una de prueba)"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now >= self.opened_until:
+            self.state = HALF_OPEN
+        return self.state == HALF_OPEN and not self.probe_in_flight
+
+    def meets_slo(self) -> bool:
+        p95 = self.p95_ms()
+        if p95 is not None and p95 > ROUTER_LATENCY_SLO_MS:
+            return False
+        return len(self.calls) < ROUTER_MIN_SAMPLES or self.error_rate() < ROUTER_ERROR_RATE_THRESHOLD
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        p50, p95 = self.p50_ms(), self.p95_ms()
+        return {
+            "model": self.name,
+            "provider": self.provider,
+            "key": self.key[:8],
+            "state": self.state,
+            "open_for_seconds": round(max(0.0, self.opened_until - now), 1) if self.state == OPEN else 0.0,
+            "samples": len(self.calls),
+            "p50_ms": round(p50, 1) if p50 is not None else None,
+            "p95_ms": round(p95, 1) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "rate_limited_recent": sum(1 for *_, limited in self.calls if limited),
+            "rate_limited_total": self.rate_limited_total,
+            "consecutive_failures": self.consecutive_failures,
+            "meets_slo": self.meets_slo(),
+            "last_error": self.last_error,
+        }
+
+
+class ModelRouter:
+    """Estado de salud compartido por todos los ModelManager del proceso, por (modelo, key)"""
+
+    def __init__(self):
+        self._health: Dict[Tuple[str, str], ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, provider: str, key: str) -> ModelHealth:
+        health = self._health.get((name, key))
+        if health is None:
+            health = self._health[(name, key)] = ModelHealth(name, provider, key)
+        return health
+
+    def record(
+        self, name: str, provider: str, latency_ms: float, error: Optional[BaseException] = None, key: str = "-"
+    ) -> None:
+        with self._lock:
+            self._get(name, provider, key).record(latency_ms, error, time.monotonic())
+
+    def allows(self, name: str, key: str = "-") -> bool:
+        with self._lock:
+            health = self._health.get((name, key))
+            return health is None or health.allows(time.monotonic())
+
+    def begin_probe(self, name: str, key: str = "-") -> None:
+        """Marca la llamada de prueba de un circuito half-open para que no pasen más"""
+        with self._lock:
+            health = self._health.get((name, key))
+            if health is not None and health.state == HALF_OPEN:
+                health.probe_in_flight = True
+
+    def rank(
+        self,
+        models: Sequence[Any],
+        cost_key: Callable[[Any], Any],
+        key_of: Optional[Callable[[Any], str]] = None,
+    ) -> List[Any]:
+        """
+        Ordena ModelConfig: circuitos cerrados y dentro de SLO primero, luego por cost_key.
+        key_of(model) da la huella de la key con la que se llamaría a cada modelo.
+        Si todos tienen el circuito abierto se devuelven igualmente (mejor intentarlo que fallar).
+        """
+        now = time.monotonic()
+        key_of = key_of or (lambda model: "-")
+        with self._lock:
+            health_of = {id(m): self._health.get((m.name, key_of(m))) for m in models}
+            healthy = [m for m in models if health_of[id(m)] is None or health_of[id(m)].allows(now)]
+            candidates = healthy or list(models)
+
+            def key(model: Any) -> Tuple[bool, Any, float]:
+                health = health_of[id(model)]
+                within_slo = health is None or health.meets_slo()
+                p50 = health.p50_ms() if health is not None else None
+                return (not within_slo, cost_key(model), p50 if p50 is not None else 0.0)
+
+            return sorted(candidates, key=key)
+
+    def routing_table(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            for health in self._health.values():
+                health.allows(now)  # Pasa a half-open los circuitos cuyo tiempo ha vencido
+            return [health.snapshot(now) for health in self._health.values()]
+
+    def reset(self, name: Optional[str] = None) -> None:
+        with self._lock:
+            if name is None:
+                self._health.clear()
+            else:
+                for health_key in [k for k in self._health if k[0] == name]:
+                    del self._health[health_key]
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
+
+
+def routing_callbacks(name: str, provider: str, key: str = "-") -> List[Any]:
+    """Callbacks de LangChain que reportan latencia y errores de un cliente (modelo + key) al router"""
+    if BaseCallbackHandler is None:
+        return []
+    return [_RoutingCallbackHandler(name, provider, key)]
+
+
+if BaseCallbackHandler is not None:
+
+    class _RoutingCallbackHandler(BaseCallbackHandler):
+        """Mide cada llamada al modelo (start → end/error) por run_id"""
+
+        def __init__(self, name: str, provider: str, key: str):
+            self.name = name
+            self.provider = provider
+            self.key = key
+            self._started: Dict[Any, float] = {}
+
+        def _start(self, run_id: Any) -> None:
+            self._started[run_id] = time.monotonic()
+            get_router().begin_probe(self.name, self.key)
+
+        def _elapsed_ms(self, run_id: Any) -> float:
+            started = self._started.pop(run_id, None)
+            return (time.monotonic() - started) * 1000 if started is not None else 0.0
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+            self._start(run_id)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+            self._start(run_id)
+
+        def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+            get_router().record(self.name, self.provider, self._elapsed_ms(run_id), key=self.key)
+            record_usage(self.name, *_token_usage(response))
+
+        def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+            get_router().record(self.name, self.provider, self._elapsed_ms(run_id), error, key=self.key)
+
+
+def _token_usage(response: Any) -> Tuple[int, int]:
+    """(tokens de entrada, de salida) de un LLMResult, venga de llm_output o del mensaje"""
+    token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+    if token_usage:
+        return int(token_usage.get("prompt_tokens") or 0), int(token_usage.get("completion_tokens") or 0)
+    for generations in getattr(response, "generations", None) or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            if usage:
+                return int(usage.get("input_tokens") or 0), int(usage.get("output_tokens") or 0)
+    return 0, 0
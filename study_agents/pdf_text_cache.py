@@ -0,0 +1,245 @@
+"""
+PDF Text Cache - Extracción de texto de PDFs con caché por contenido
+El texto de cada página se guarda en disco (kv_cache, SQLite) con clave
+(sha256 del fichero, número de página), así que el mismo PDF no se vuelve a
+parsear al regenerar resúmenes, reindexar un curso o preparar preguntas de juego,
+aunque cambie de nombre o de ruta. Las páginas se sirven de forma perezosa: pedir
+un rango solo lee (o extrae) ese rango.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from kv_cache import LRUKVCache, prefix_range
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    try:
+        from PyPDF2 import PdfReader
+    except ImportError:
+        PdfReader = None
+
+PDF_BACKEND_AVAILABLE = PdfReader is not None
+
+# Documentos (PDFs completos) que se conservan como máximo; se expulsan por LRU
+MAX_DOCUMENTS = max(1, int(os.getenv("PDF_TEXT_CACHE_MAX_DOCUMENTS", "2000")))
+
+PdfSource = Union[str, Path, bytes]
+PageExtractor = Callable[[int, int], Iterable[Tuple[int, Optional[str]]]]
+
+
+def _open_reader(source: PdfSource) -> Any:
+    if PdfReader is None:
+        raise RuntimeError("pypdf no está instalado. Instálalo con: pip install pypdf")
+    if isinstance(source, bytes):
+        return PdfReader(io.BytesIO(source))
+    return PdfReader(str(source))
+
+
+def count_pages(source: PdfSource) -> int:
+    return len(_open_reader(source).pages)
+
+
+def extract_page_range(source: PdfSource, start: int, end: int) -> List[Tuple[int, Optional[str]]]:
+    """
+    Extrae el texto de las páginas [start, end) sin pasar por la caché.
+    Una página cuya extracción falla sale con texto None (distinto de una página vacía).
+    """
+    reader = _open_reader(source)
+    pages = []
+    for page_num in range(start, min(end, len(reader.pages))):
+        try:
+            text = reader.pages[page_num].extract_text() or ""
+        except Exception:
+            text = None
+        pages.append((page_num, text))
+    return pages
+
+
+class PdfTextCache:
+    """
+    Texto por página de cada PDF, indexado por el hash de su contenido.
+    Segura entre hilos; un documento se marca completo cuando están todas sus páginas.
+    """
+
+    def __init__(self, max_documents: int = MAX_DOCUMENTS):
+        self.max_documents = max_documents
+        self.pages_served = 0
+        self.pages_extracted = 0
+        self._lock = threading.Lock()
+        # (ruta, tamaño, mtime) -> sha256: no rehashear un fichero que no ha cambiado
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+        # Las páginas viven lo mismo que su documento: se borran al expulsarlo
+        self._pages = LRUKVCache("pdf_pages", None)
+        self._documents = LRUKVCache("pdf_documents", max_documents, on_evict=self._drop_pages)
+
+    # ------------------------------------------------------------------ hashes
+
+    def file_hash(self, source: PdfSource) -> str:
+        """sha256 del contenido (en streaming para ficheros)"""
+        if isinstance(source, bytes):
+            return hashlib.sha256(source).hexdigest()
+        path = os.path.abspath(str(source))
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._hashes.get(key)
+        if cached:
+            return cached
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        value = digest.hexdigest()
+        with self._lock:
+            self._hashes[key] = value
+        return value
+
+    # ------------------------------------------------------------------ acceso
+
+    @staticmethod
+    def _page_key(file_hash: str, page: int) -> str:
+        return f"{file_hash}:{page:06d}"
+
+    def _drop_pages(self, file_hashes: List[str]) -> None:
+        for file_hash in file_hashes:
+            self._pages.delete_range(*prefix_range(f"{file_hash}:"))
+
+    def _document(self, file_hash: str) -> Optional[Tuple[int, bool]]:
+        value = self._documents.get(file_hash, track=False)
+        if value is None:
+            return None
+        document = json.loads(value)
+        return document["page_count"], document["complete"]
+
+    def _cached_pages(self, file_hash: str, start: int, end: int) -> Dict[int, str]:
+        rows = self._pages.scan(self._page_key(file_hash, start), self._page_key(file_hash, end))
+        return {int(key.rsplit(":", 1)[1]): zlib.decompress(blob).decode("utf-8") for key, blob in rows}
+
+    def _store_pages(self, file_hash: str, page_count: int, pages: List[Tuple[int, str]]) -> None:
+        if pages:
+            self._pages.put_many({
+                self._page_key(file_hash, page): zlib.compress(text.encode("utf-8")) for page, text in pages
+            })
+        stored = self._pages.count(*prefix_range(f"{file_hash}:"))
+        self._documents.put(file_hash, json.dumps({"page_count": page_count, "complete": stored >= page_count}))
+        with self._lock:
+            self.pages_extracted += len(pages)
+
+    def page_count(self, source: PdfSource) -> int:
+        file_hash = self.file_hash(source)
+        document = self._document(file_hash)
+        if document is not None:
+            return document[0]
+        page_count = count_pages(source)
+        self._store_pages(file_hash, page_count, [])
+        return page_count
+
+    def iter_pages(
+        self,
+        source: PdfSource,
+        start: int = 0,
+        end: Optional[int] = None,
+        extractor: Optional[PageExtractor] = None,
+    ) -> Iterator[Tuple[int, str]]:
+        """
+        Itera (page_num, texto) de las páginas [start, end) en orden.
+        Las páginas cacheadas se leen de disco; los huecos se extraen con extractor
+        (por defecto extract_page_range en este proceso) y se guardan al vuelo.
+
+        Args:
+            source: Ruta del PDF o su contenido en bytes
+            start: Primera página (desde 0)
+            end: Página final exclusiva (None = hasta el final)
+            extractor: f(start, end) -> [(page_num, texto)] para los rangos que faltan
+        """
+        file_hash = self.file_hash(source)
+        document = self._document(file_hash)
+        page_count = document[0] if document else count_pages(source)
+        end = page_count if end is None else min(end, page_count)
+        if start >= end:
+            return
+
+        if document and document[1]:
+            cached = self._cached_pages(file_hash, start, end)
+            if len(cached) == end - start:
+                self._documents.record(hit=True)
+                with self._lock:
+                    self.pages_served += len(cached)
+                for page_num in range(start, end):
+                    yield page_num, cached[page_num]
+                return
+
+        self._documents.record(hit=False)
+        if document is None:
+            self._store_pages(file_hash, page_count, [])
+        cached = self._cached_pages(file_hash, start, end)
+        extract = extractor or (lambda s, e: extract_page_range(source, s, e))
+        page_num = start
+        while page_num < end:
+            if page_num in cached:
+                with self._lock:
+                    self.pages_served += 1
+                yield page_num, cached.pop(page_num)
+                page_num += 1
+                continue
+            gap_end = page_num
+            while gap_end < end and gap_end not in cached:
+                gap_end += 1
+            # El extractor puede entregar las páginas por partes: se guardan por lotes.
+            # Las que fallaron (None) no se guardan: se reintentan en la próxima lectura
+            batch: List[Tuple[int, str]] = []
+            for item_page, item_text in extract(page_num, gap_end):
+                if item_text is None:
+                    yield item_page, ""
+                    continue
+                batch.append((item_page, item_text))
+                yield item_page, item_text
+                if len(batch) >= 20:
+                    self._store_pages(file_hash, page_count, batch)
+                    batch = []
+            if batch:
+                self._store_pages(file_hash, page_count, batch)
+            page_num = gap_end
+
+    def text(self, source: PdfSource, start: int = 0, end: Optional[int] = None) -> str:
+        """Texto de las páginas [start, end), cada página seguida de un salto de línea"""
+        return "".join(f"{text}\n" for _, text in self.iter_pages(source, start, end))
+
+    def stats(self) -> Dict[str, Any]:
+        documents = self._documents.stats()
+        with self._lock:
+            return {
+                "documents": documents["entries"],
+                "pages": self._pages.stats()["entries"],
+                "max_documents": self.max_documents,
+                "hits": documents["hits"],
+                "misses": documents["misses"],
+                "hit_rate": documents["hit_rate"],
+                "pages_served": self.pages_served,
+                "pages_extracted": self.pages_extracted,
+                "evictions": documents["evictions"],
+                "backend_available": PDF_BACKEND_AVAILABLE,
+            }
+
+
+_cache: Optional[PdfTextCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_pdf_text_cache() -> PdfTextCache:
+    """Caché compartida por todo el proceso"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PdfTextCache()
+        return _cache
@@ -453,8 +453,7 @@ class ProgressTracker:
                     chats_to_remove = []
                     for chat_id, chat_data in user_progress["chats"].items():
                         # Validar que el chat existe
-                        chat_file = chat_storage.get_chat_file_path(user_id, chat_id)
-                        if not chat_file.exists():
+                        if not chat_storage.chat_exists(user_id, chat_id):
                             print(f"📊 [ProgressTracker] Chat {chat_id} no existe, marcado para eliminar del progreso")
                             chats_to_remove.append(chat_id)
                             continue
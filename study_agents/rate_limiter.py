@@ -0,0 +1,146 @@
+"""
+Rate Limiter - Límite de peticiones por proveedor externo (Gemini, DALL-E, Unsplash...)
+Token bucket (peticiones/minuto con ráfaga corta) más un semáforo de concurrencia.
+Es compartido por todo el proceso: los workers que generan resúmenes en paralelo
+respetan juntos la cuota de la API en lugar de cada uno por su cuenta.
+Tras un 429 el proveedor queda en pausa para todos durante el Retry-After.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+# Peticiones por minuto por proveedor; PROVIDER_RATE_LIMITS="gemini=30,openai_images=5"
+DEFAULT_RATE_LIMITS: Dict[str, int] = {
+    "gemini": 30,
+    "openai_images": 5,
+}
+# Peticiones simultáneas por proveedor; PROVIDER_CONCURRENCY="gemini=4"
+DEFAULT_CONCURRENCY: Dict[str, int] = {
+    "gemini": 4,
+    "openai_images": 2,
+    # Búsquedas de imágenes de stock (image_resolver resuelve muchas a la vez)
+    "unsplash": 2,
+    "pexels": 2,
+    "wikimedia": 2,
+}
+# Valores para proveedores sin configuración propia
+FALLBACK_RATE_LIMIT = max(1, int(os.getenv("PROVIDER_DEFAULT_RPM", "60")))
+FALLBACK_CONCURRENCY = max(1, int(os.getenv("PROVIDER_DEFAULT_CONCURRENCY", "4")))
+# Peticiones que se pueden lanzar de golpe antes de que actúe el ritmo por minuto
+RATE_LIMIT_BURST = max(1, int(os.getenv("PROVIDER_RATE_BURST", "3")))
+
+
+def _parse(env_name: str, defaults: Dict[str, int]) -> Dict[str, int]:
+    """"gemini=30,openai=60" sobrescribe los valores por defecto"""
+    values = dict(defaults)
+    for item in os.getenv(env_name, "").split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip() and value.strip().isdigit():
+            values[name.strip()] = max(1, int(value))
+    return values
+
+
+class _Bucket:
+    def __init__(self, per_minute: int, concurrency: int):
+        self.rate = per_minute / 60.0
+        self.capacity = float(min(RATE_LIMIT_BURST, per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.per_minute = per_minute
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.waited_seconds = 0.0
+        self.requests = 0
+        self.throttled = 0
+
+
+class ProviderRateLimiter:
+    def __init__(self, rate_limits: Optional[Dict[str, int]] = None, concurrency: Optional[Dict[str, int]] = None):
+        self._rate_limits = rate_limits or _parse("PROVIDER_RATE_LIMITS", DEFAULT_RATE_LIMITS)
+        self._concurrency = concurrency or _parse("PROVIDER_CONCURRENCY", DEFAULT_CONCURRENCY)
+        self._buckets: Dict[str, _Bucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, provider: str) -> _Bucket:
+        with self._lock:
+            bucket = self._buckets.get(provider)
+            if bucket is None:
+                bucket = self._buckets[provider] = _Bucket(
+                    self._rate_limits.get(provider, FALLBACK_RATE_LIMIT),
+                    self._concurrency.get(provider, FALLBACK_CONCURRENCY),
+                )
+            return bucket
+
+    def _take_token(self, bucket: _Bucket) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket.tokens = min(bucket.capacity, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                if now >= bucket.paused_until and bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return
+                wait = max(bucket.paused_until - now, (1 - bucket.tokens) / bucket.rate)
+                bucket.waited_seconds += wait
+            time.sleep(wait)
+
+    @contextmanager
+    def slot(self, provider: str) -> Iterator[None]:
+        """with limiter.slot("gemini"): requests.post(...) — espera turno y cuota"""
+        bucket = self._bucket(provider)
+        bucket.semaphore.acquire()
+        try:
+            self._take_token(bucket)
+            with self._lock:
+                bucket.in_flight += 1
+                bucket.requests += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    bucket.in_flight -= 1
+        finally:
+            bucket.semaphore.release()
+
+    def pause(self, provider: str, seconds: float) -> None:
+        """El proveedor ha respondido 429: nadie le envía nada durante seconds"""
+        bucket = self._bucket(provider)
+        with self._lock:
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+            bucket.tokens = 0.0
+            bucket.throttled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                provider: {
+                    "per_minute": bucket.per_minute,
+                    "concurrency": bucket.concurrency,
+                    "in_flight": bucket.in_flight,
+                    "requests": bucket.requests,
+                    "throttled": bucket.throttled,
+                    "paused_for_seconds": round(max(0.0, bucket.paused_until - now), 1),
+                    "waited_seconds": round(bucket.waited_seconds, 1),
+                }
+                for provider, bucket in self._buckets.items()
+            }
+
+
+_limiter: Optional[ProviderRateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> ProviderRateLimiter:
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = ProviderRateLimiter()
+        return _limiter
@@ -1,45 +1,69 @@
 """
 Sistema de almacenamiento de Códigos Canjeables
-Gestiona códigos promocionales que pueden añadir saldo a las wallets
+Gestiona códigos promocionales que pueden añadir saldo a las wallets.
+Cada código es una fila de la base de datos embebida (storage_engine); canjear un
+código es una actualización atómica de su fila. El antiguo all_codes.json se migra solo.
 """
 
 import json
 import os
+import sys
 from typing import List, Dict, Optional
 from datetime import datetime
 from pathlib import Path
 import uuid
 
-# Directorio para almacenar códigos
-REDEEM_CODES_DIR = Path("redeem_codes")
-REDEEM_CODES_DIR.mkdir(exist_ok=True)
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, transaction
+import data_paths
 
-# Archivo principal de códigos
+# Directorio de códigos en JSON (formato antiguo, solo para la migración)
+REDEEM_CODES_DIR = data_paths.REDEEM_CODES_DIR
+
+# Archivo principal de códigos (formato JSON antiguo)
 REDEEM_CODES_FILE = REDEEM_CODES_DIR / "all_codes.json"
 
 
 def get_redeem_codes_file() -> Path:
-    """Obtiene la ruta del archivo de códigos"""
+    """Obtiene la ruta del archivo de códigos (formato JSON antiguo)"""
     return REDEEM_CODES_FILE
 
 
-def load_all_codes() -> Dict[str, Dict]:
-    """Carga todos los códigos canjeables"""
+def _legacy_codes():
     if not REDEEM_CODES_FILE.exists():
-        return {}
-    
+        return
     try:
         with open(REDEEM_CODES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            yield from json.load(f).items()
+    except Exception as e:
+        print(f"Error al leer {REDEEM_CODES_FILE}: {e}")
+
+
+_codes = Repository(
+    "redeem_codes",
+    indexes={
+        "creator_id": "creator_id",
+        "status": lambda code: "active" if code.get("is_active", True) else "inactive",
+    },
+    legacy=_legacy_codes,
+    legacy_sources=[REDEEM_CODES_FILE],
+)
+
+
+def load_all_codes() -> Dict[str, Dict]:
+    """Carga todos los códigos canjeables"""
+    try:
+        return _codes.all()
     except Exception as e:
         print(f"Error al cargar códigos: {e}")
         return {}
 
 
 def save_all_codes(codes: Dict[str, Dict]):
-    """Guarda todos los códigos"""
-    with open(REDEEM_CODES_FILE, "w", encoding="utf-8") as f:
-        json.dump(codes, f, ensure_ascii=False, indent=2)
+    """Guarda todos los códigos (solo se escriben los que han cambiado)"""
+    _codes.replace_all(codes)
 
 
 def create_redeem_code(
@@ -68,11 +92,6 @@ def create_redeem_code(
         # Generar código aleatorio de 8 caracteres alfanuméricos en mayúsculas
         code = uuid.uuid4().hex[:8].upper()
     
-    # Verificar que el código no exista
-    all_codes = load_all_codes()
-    if code in all_codes:
-        raise ValueError(f"El código {code} ya existe")
-    
     code_data = {
         "code": code,
         "amount": amount,
@@ -86,16 +105,16 @@ def create_redeem_code(
         "is_active": True
     }
     
-    all_codes[code] = code_data
-    save_all_codes(all_codes)
+    # Verificar que el código no exista
+    if not _codes.insert(code, code_data):
+        raise ValueError(f"El código {code} ya existe")
     
     return code_data
 
 
 def get_code(code: str) -> Optional[Dict]:
     """Obtiene un código por su valor"""
-    all_codes = load_all_codes()
-    return all_codes.get(code)
+    return _codes.get(code)
 
 
 def redeem_code(code: str, user_id: str) -> Dict:
@@ -112,8 +131,12 @@ def redeem_code(code: str, user_id: str) -> Dict:
     Raises:
         ValueError: Si el código no es válido o no se puede canjear
     """
-    all_codes = load_all_codes()
-    code_data = all_codes.get(code.upper())
+    with transaction():
+        return _redeem_code(code, user_id)
+
+
+def _redeem_code(code: str, user_id: str) -> Dict:
+    code_data = _codes.get(code.upper())
     
     if not code_data:
         raise ValueError("Código no encontrado")
@@ -141,8 +164,7 @@ def redeem_code(code: str, user_id: str) -> Dict:
     code_data["updated_at"] = datetime.now().isoformat()
     
     # Guardar cambios
-    all_codes[code.upper()] = code_data
-    save_all_codes(all_codes)
+    _codes.put(code.upper(), code_data)
     
     return {
         "success": True,
@@ -163,43 +185,33 @@ def list_codes(creator_id: Optional[str] = None, active_only: bool = True) -> Li
     Returns:
         Lista de códigos
     """
-    all_codes = load_all_codes()
-    
-    codes_list = []
-    for code, code_data in all_codes.items():
-        if active_only and not code_data.get("is_active", True):
-            continue
-        
-        if creator_id and code_data.get("creator_id") != creator_id:
-            continue
-        
-        codes_list.append(code_data)
+    codes_list = _codes.find(
+        creator_id=creator_id or None,
+        status="active" if active_only else None,
+    )
     
     # Ordenar por fecha de creación (más recientes primero)
     codes_list.sort(key=lambda x: x.get("created_at", ""), reverse=True)
     return codes_list
 
 
+def _set_active(code: str, is_active: bool) -> bool:
+    def apply(code_data: Optional[Dict]) -> Optional[Dict]:
+        if code_data is None:
+            return None
+        code_data["is_active"] = is_active
+        code_data["updated_at"] = datetime.now().isoformat()
+        return code_data
+    
+    return _codes.update(code.upper(), apply) is not None
+
+
 def deactivate_code(code: str) -> bool:
     """Desactiva un código"""
-    all_codes = load_all_codes()
-    if code.upper() not in all_codes:
-        return False
-    
-    all_codes[code.upper()]["is_active"] = False
-    all_codes[code.upper()]["updated_at"] = datetime.now().isoformat()
-    save_all_codes(all_codes)
-    return True
+    return _set_active(code, False)
 
 
 def activate_code(code: str) -> bool:
     """Activa un código"""
-    all_codes = load_all_codes()
-    if code.upper() not in all_codes:
-        return False
-    
-    all_codes[code.upper()]["is_active"] = True
-    all_codes[code.upper()]["updated_at"] = datetime.now().isoformat()
-    save_all_codes(all_codes)
-    return True
+    return _set_active(code, True)
 
@@ -0,0 +1,225 @@
+"""
+Request Executor - Ejecuta el trabajo síncrono de los endpoints fuera del event loop
+Las llamadas a LLM, Chroma y ficheros JSON corren en un pool de hilos acotado,
+con un límite de concurrencia por endpoint y métricas de cola.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+# Hilos totales del pool compartido
+EXECUTOR_MAX_WORKERS = max(1, int(os.getenv("EXECUTOR_MAX_WORKERS", "32")))
+# Límite por defecto de peticiones simultáneas por endpoint
+DEFAULT_ENDPOINT_LIMIT = max(1, int(os.getenv("EXECUTOR_DEFAULT_LIMIT", "8")))
+# Peticiones en espera por endpoint antes de rechazar (0 = sin límite)
+MAX_QUEUE_PER_ENDPOINT = max(0, int(os.getenv("EXECUTOR_MAX_QUEUE", "64")))
+
+ENDPOINT_LIMITS: Dict[str, int] = {
+    "ask-question": 16,
+    "ask-question-stream": 16,
+    "generate-test": 6,
+    "grade-test": 8,
+    "generate-notes": 6,
+    "generate-study-plan": 4,
+    "generate-exercise": 6,
+    "correct-exercise": 8,
+    "upload-documents": 4,
+    "system-init": 4,
+}
+
+
+def _limits_from_env() -> Dict[str, int]:
+    """EXECUTOR_LIMITS="ask-question=20,generate-test=4" sobrescribe los límites."""
+    limits = dict(ENDPOINT_LIMITS)
+    for item in os.getenv("EXECUTOR_LIMITS", "").split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip().isdigit():
+            limits[name.strip()] = max(1, int(value))
+    return limits
+
+
+class ExecutorSaturated(Exception):
+    """La cola de un endpoint está llena; la API responde 503."""
+
+
+class _EndpointStats:
+    __slots__ = ("limit", "queued", "running", "completed", "failed", "rejected",
+                 "max_queued", "total_wait_s", "total_run_s")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self.total_wait_s = 0.0
+        self.total_run_s = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "limit": self.limit,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "max_queued": self.max_queued,
+            "avg_wait_ms": round(self.total_wait_s / finished * 1000, 1) if finished else 0.0,
+            "avg_run_ms": round(self.total_run_s / finished * 1000, 1) if finished else 0.0,
+        }
+
+
+class RequestExecutor:
+    """
+    Pool de hilos compartido con semáforos por endpoint.
+    Copia el contexto (contextvars) de la petición al hilo que ejecuta la llamada.
+    """
+
+    def __init__(self, max_workers: int = EXECUTOR_MAX_WORKERS, limits: Optional[Dict[str, int]] = None):
+        self.max_workers = max_workers
+        self.limits = limits if limits is not None else _limits_from_env()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="study-agents")
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, _EndpointStats] = {}
+        self._lock = threading.Lock()
+        self._in_pool = 0
+
+    def _endpoint(self, name: str):
+        with self._lock:
+            if name not in self._semaphores:
+                limit = self.limits.get(name, DEFAULT_ENDPOINT_LIMIT)
+                self._semaphores[name] = asyncio.Semaphore(limit)
+                self._stats[name] = _EndpointStats(limit)
+            return self._semaphores[name], self._stats[name]
+
+    async def run(self, endpoint: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Ejecuta fn(*args, **kwargs) en el pool respetando el límite del endpoint."""
+        semaphore, stats = self._endpoint(endpoint)
+        if MAX_QUEUE_PER_ENDPOINT and semaphore.locked() and stats.queued >= MAX_QUEUE_PER_ENDPOINT:
+            stats.rejected += 1
+            raise ExecutorSaturated(f"Demasiadas peticiones en cola para {endpoint}")
+
+        enqueued_at = time.perf_counter()
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        try:
+            await semaphore.acquire()
+        finally:
+            stats.queued -= 1
+        started_at = time.perf_counter()
+        stats.total_wait_s += started_at - enqueued_at
+        stats.running += 1
+        self._in_pool += 1
+        loop = asyncio.get_running_loop()
+
+        def finish(failed: bool) -> None:
+            # El hueco se libera cuando termina el hilo, no cuando se cancela la petición:
+            # si el cliente se desconecta, la llamada sigue ocupando el pool hasta acabar
+            self._in_pool -= 1
+            stats.running -= 1
+            stats.total_run_s += time.perf_counter() - started_at
+            if failed:
+                stats.failed += 1
+            else:
+                stats.completed += 1
+            semaphore.release()
+
+        def on_done(future) -> None:
+            try:
+                loop.call_soon_threadsafe(finish, future.cancelled() or future.exception() is not None)
+            except RuntimeError:
+                pass  # loop cerrado (apagado): ya no hay nadie esperando el semáforo
+
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        try:
+            future = self._pool.submit(call)
+        except BaseException:
+            finish(True)
+            raise
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    async def iterate(self, endpoint: str, fn: Callable[..., Iterator[Any]], *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        """
+        Consume un generador síncrono en el pool y entrega sus elementos de forma asíncrona
+        (p. ej. tokens de un LLM en streaming). Ocupa un hueco del endpoint mientras dure.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        cancelled = threading.Event()
+
+        def produce() -> None:
+            try:
+                for item in fn(*args, **kwargs):
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except BaseException as e:  # se relanza en el lado asíncrono
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+        def on_task_done(task: asyncio.Future) -> None:
+            # Errores antes de arrancar el productor (p. ej. ExecutorSaturated)
+            if not task.cancelled() and task.exception() is not None:
+                queue.put_nowait((done, task.exception()))
+
+        task = asyncio.ensure_future(self.run(endpoint, produce))
+        task.add_done_callback(on_task_done)
+        try:
+            while True:
+                item, error = await queue.get()
+                if item is done:
+                    if error is not None:
+                        raise error
+                    break
+                yield item
+            await task
+        finally:
+            # Cliente desconectado: el productor se detiene en el siguiente elemento
+            cancelled.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {name: stats.as_dict() for name, stats in self._stats.items()}
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self._in_pool,
+            "pool_queue_depth": max(0, self._in_pool - self.max_workers),
+            "queued": sum(e["queued"] for e in endpoints.values()),
+            "endpoints": endpoints,
+        }
+
+
+_executor: Optional[RequestExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> RequestExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = RequestExecutor()
+        return _executor
+
+
+async def run_blocking(endpoint: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Atajo: await run_blocking("ask-question", system.ask_question, ...)"""
+    return await get_executor().run(endpoint, fn, *args, **kwargs)
+
+
+def iterate_blocking(endpoint: str, fn: Callable[..., Iterator[Any]], *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+    """Atajo: async for event in iterate_blocking("ask-question-stream", system.stream_question, ...)"""
+    return get_executor().iterate(endpoint, fn, *args, **kwargs)
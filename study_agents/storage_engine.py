@@ -0,0 +1,595 @@
+"""
+Storage Engine - Base de datos embebida (SQLite, modo WAL) para los módulos *_storage
+Cada registro es una fila (namespace, key) con su JSON; los índices secundarios
+(user_id, course_id, status...) viven en record_index. Las escrituras tocan solo
+las filas que cambian y van dentro de transacciones.
+Los ficheros JSON antiguos se migran una única vez, la primera vez que se usa cada
+repositorio (o de golpe con: python storage_engine.py).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+_ROOT = Path(__file__).resolve().parent
+DB_PATH = Path(os.getenv("STORAGE_DB_PATH", str(_ROOT / "data" / "storage.sqlite3")))
+# Espera máxima por el lock de escritura de SQLite
+BUSY_TIMEOUT_MS = max(0, int(os.getenv("STORAGE_BUSY_TIMEOUT_MS", "10000")))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS record_index (
+    namespace TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (namespace, field, value, key)
+);
+CREATE INDEX IF NOT EXISTS idx_record_index_key ON record_index(namespace, key);
+CREATE TABLE IF NOT EXISTS storage_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Límite de parámetros por consulta en SQLite
+_BATCH = 500
+
+Record = Dict[str, Any]
+IndexSpec = Union[str, Callable[[Record], Any]]
+
+
+def _dumps(record: Record) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def _index_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class StorageEngine:
+    """
+    Conexión SQLite por hilo (modo WAL: lectores concurrentes con un escritor).
+    transaction() es reentrante dentro del mismo hilo: las llamadas anidadas
+    (p. ej. inscripción + pago) se confirman juntas o no se confirman.
+    """
+
+    def __init__(self, path: Path = DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                str(self.path),
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.on_commit = []
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """BEGIN IMMEDIATE ... COMMIT; ROLLBACK si salta una excepción"""
+        conn = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self._local.on_commit = []
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+        callbacks, self._local.on_commit = self._local.on_commit, []
+        for callback in callbacks:
+            callback()
+
+    @contextmanager
+    def snapshot(self) -> Iterator[sqlite3.Connection]:
+        """
+        BEGIN (diferida) ... COMMIT: varias lecturas ven el mismo estado sin tomar el
+        lock de escritura. Dentro de una transacción abierta se reutiliza esa.
+        No se debe escribir dentro (el snapshot podría estar ya obsoleto).
+        """
+        conn = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN")
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.depth = 0
+            conn.execute("COMMIT")
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Ejecuta callback cuando se confirme la transacción abierta (o ya, si no hay ninguna)"""
+        self._connection()
+        if not self._local.depth:
+            callback()
+        elif callback not in self._local.on_commit:
+            self._local.on_commit.append(callback)
+
+    def read(self) -> sqlite3.Connection:
+        """Conexión del hilo para lecturas (ve las escrituras de su transacción abierta)"""
+        return self._connection()
+
+    def get_meta(self, name: str) -> Optional[str]:
+        row = self.read().execute("SELECT value FROM storage_meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name: str, value: str) -> None:
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO storage_meta (name, value) VALUES (?, ?)", (name, value))
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self.read()
+        rows = conn.execute("SELECT namespace, COUNT(*) FROM records GROUP BY namespace").fetchall()
+        return {
+            "path": str(self.path),
+            "size_mb": round(self.path.stat().st_size / (1024 * 1024), 2) if self.path.exists() else 0.0,
+            "namespaces": {namespace: count for namespace, count in rows},
+        }
+
+
+_engine: Optional[StorageEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> StorageEngine:
+    """Motor compartido por todo el proceso"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = StorageEngine()
+        return _engine
+
+
+def transaction():
+    """Atajo: with transaction(): ... agrupa escrituras de varios repositorios"""
+    return get_engine().transaction()
+
+
+def snapshot(*repositories: "Repository"):
+    """Atajo: with snapshot(repo_a, repo_b): ... lecturas coherentes de esos repositorios"""
+    for repository in repositories:
+        # La migración escribe: tiene que hacerse antes de abrir la lectura
+        repository._ensure_migrated()
+    return get_engine().snapshot()
+
+
+_repositories: Dict[str, "Repository"] = {}
+
+
+class Repository:
+    """
+    Colección de registros JSON de un tipo (chats, cursos, wallets...).
+
+    - indexes: {campo: nombre_de_clave | función(registro)}; una función puede
+      devolver una lista (p. ej. todos los jugadores de una partida).
+    - legacy: generador de (key, registro) que lee los ficheros JSON antiguos;
+      se ejecuta una sola vez y nunca sobrescribe filas existentes.
+    - legacy_sources: ficheros o directorios que lee legacy; si no existe ninguno
+      no se marca la migración (se reintenta en el próximo arranque).
+    - versioned: mantiene un contador de versión en storage_meta que sube con cada
+      escritura, para que las cachés en memoria detecten cambios de otros procesos.
+    - index_versions: {campo: versión} de los índices calculados con función; hay que
+      subirla al cambiar la función (no se puede comparar el código de una lambda).
+    Si cambia la definición de los índices (campos, clave de la que leen o versión),
+    las filas existentes se reindexan una vez.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        indexes: Optional[Dict[str, IndexSpec]] = None,
+        legacy: Optional[Callable[[], Iterable[Tuple[str, Record]]]] = None,
+        legacy_sources: Optional[Iterable[Union[str, Path]]] = None,
+        versioned: bool = False,
+        index_versions: Optional[Dict[str, int]] = None,
+    ):
+        self.namespace = namespace
+        self.indexes = indexes or {}
+        self.index_versions = index_versions or {}
+        self.legacy = legacy
+        self.legacy_sources = [Path(p) for p in legacy_sources] if legacy_sources is not None else None
+        self.versioned = versioned
+        self._version_key = f"version:{namespace}"
+        self._listeners: List[Callable[[], None]] = []
+        self._migrated = False
+        self._migrate_lock = threading.Lock()
+        _repositories[namespace] = self
+
+    # ---- internos ----
+
+    def _index_rows(self, key: str, record: Record) -> List[Tuple[str, str, str, str]]:
+        rows = []
+        for field, spec in self.indexes.items():
+            value = spec(record) if callable(spec) else record.get(spec)
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            for item in values:
+                if item is None or item == "":
+                    continue
+                rows.append((self.namespace, field, _index_value(item), key))
+        return rows
+
+    def _changed(self, conn: sqlite3.Connection) -> None:
+        if self.versioned:
+            conn.execute(
+                "INSERT INTO storage_meta (name, value) VALUES (?, '1')"
+                " ON CONFLICT(name) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (self._version_key,),
+            )
+        for listener in self._listeners:
+            get_engine().after_commit(listener)
+
+    def _write(self, conn: sqlite3.Connection, key: str, record: Record, data: Optional[str] = None) -> None:
+        self._changed(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO records (namespace, key, data, updated_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, data if data is not None else _dumps(record), time.time()),
+        )
+        if self.indexes:
+            conn.execute("DELETE FROM record_index WHERE namespace = ? AND key = ?", (self.namespace, key))
+            conn.executemany(
+                "INSERT OR IGNORE INTO record_index (namespace, field, value, key) VALUES (?, ?, ?, ?)",
+                self._index_rows(key, record),
+            )
+
+    def _delete(self, conn: sqlite3.Connection, key: str) -> bool:
+        cursor = conn.execute("DELETE FROM records WHERE namespace = ? AND key = ?", (self.namespace, key))
+        if cursor.rowcount == 0:
+            return False
+        if self.indexes:
+            conn.execute("DELETE FROM record_index WHERE namespace = ? AND key = ?", (self.namespace, key))
+        self._changed(conn)
+        return True
+
+    def _read(self, conn: sqlite3.Connection, key: str) -> Optional[Record]:
+        row = conn.execute(
+            "SELECT data FROM records WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _query(self, columns: str, filters: Dict[str, Any], order: bool = True) -> Tuple[str, List[Any]]:
+        sql = f"SELECT {columns} FROM records r WHERE r.namespace = ?"
+        params: List[Any] = [self.namespace]
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field not in self.indexes:
+                raise KeyError(f"'{field}' no es un índice de {self.namespace}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            placeholders = ",".join("?" for _ in values)
+            sql += (
+                " AND r.key IN (SELECT key FROM record_index"
+                f" WHERE namespace = ? AND field = ? AND value IN ({placeholders}))"
+            )
+            params += [self.namespace, field, *(_index_value(v) for v in values)]
+        if order:
+            sql += " ORDER BY r.key"
+        return sql, params
+
+    def _range_query(
+        self, columns: str, field: str, lower: Any, upper: Any, filters: Dict[str, Any], by_value: bool = False
+    ) -> Tuple[str, List[Any]]:
+        if field not in self.indexes:
+            raise KeyError(f"'{field}' no es un índice de {self.namespace}")
+        sql, params = self._query(columns, filters, order=False)
+        conditions = "i.namespace = ? AND i.field = ?"
+        range_params: List[Any] = [self.namespace, field]
+        if lower is not None:
+            conditions += " AND i.value >= ?"
+            range_params.append(_index_value(lower))
+        if upper is not None:
+            conditions += " AND i.value <= ?"
+            range_params.append(_index_value(upper))
+        sql = sql.replace(
+            "FROM records r WHERE",
+            f"FROM record_index i JOIN records r ON r.namespace = i.namespace AND r.key = i.key WHERE {conditions} AND",
+            1,
+        )
+        sql += " ORDER BY i.value, r.key" if by_value else " ORDER BY r.key"
+        return sql, range_params + params
+
+    def _reindex(self, conn: sqlite3.Connection) -> int:
+        """Recalcula todas las filas de record_index del namespace"""
+        conn.execute("DELETE FROM record_index WHERE namespace = ?", (self.namespace,))
+        rows = conn.execute("SELECT key, data FROM records WHERE namespace = ?", (self.namespace,)).fetchall()
+        for key, data in rows:
+            conn.executemany(
+                "INSERT OR IGNORE INTO record_index (namespace, field, value, key) VALUES (?, ?, ?, ?)",
+                self._index_rows(key, json.loads(data)),
+            )
+        return len(rows)
+
+    def _index_signature(self) -> str:
+        """Huella de la definición de los índices: campo[=clave][@versión], ordenados"""
+        parts = []
+        for field in sorted(self.indexes):
+            spec = self.indexes[field]
+            part = field
+            if isinstance(spec, str) and spec != field:
+                part += f"={spec}"
+            if self.index_versions.get(field, 1) != 1:
+                part += f"@{self.index_versions[field]}"
+            parts.append(part)
+        return ",".join(parts)
+
+    def _has_legacy_source(self) -> bool:
+        """Sin legacy_sources declarados se asume que legacy sabe si hay datos"""
+        if self.legacy_sources is None:
+            return True
+        return any(path.exists() for path in self.legacy_sources)
+
+    def _ensure_migrated(self) -> None:
+        if self._migrated:
+            return
+        with self._migrate_lock:
+            if self._migrated:
+                return
+            engine = get_engine()
+            marker = f"migrated:{self.namespace}"
+            if self.legacy is not None and engine.get_meta(marker) is None and self._has_legacy_source():
+                migrated = 0
+                with engine.transaction() as conn:
+                    # Otro proceso pudo migrar mientras esperábamos el lock de escritura
+                    if conn.execute("SELECT 1 FROM storage_meta WHERE name = ?", (marker,)).fetchone() is None:
+                        for key, record in self.legacy():
+                            exists = conn.execute(
+                                "SELECT 1 FROM records WHERE namespace = ? AND key = ?", (self.namespace, key)
+                            ).fetchone()
+                            if exists is None:
+                                self._write(conn, key, record)
+                                migrated += 1
+                        conn.execute(
+                            "INSERT OR REPLACE INTO storage_meta (name, value) VALUES (?, ?)",
+                            (marker, _dumps({"rows": migrated, "at": datetime.now().isoformat()})),
+                        )
+                if migrated:
+                    origin = ", ".join(str(p) for p in self.legacy_sources or [] if p.exists())
+                    print(f"📦 Migrados {migrated} registros JSON a SQLite ({self.namespace}){' desde ' + origin if origin else ''}")
+            # Si el módulo declara índices nuevos o cambia su definición, las filas existentes
+            # se reindexan una vez
+            signature = self._index_signature()
+            index_marker = f"indexes:{self.namespace}"
+            if engine.get_meta(index_marker) != signature:
+                with engine.transaction() as conn:
+                    reindexed = self._reindex(conn)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO storage_meta (name, value) VALUES (?, ?)", (index_marker, signature)
+                    )
+                if reindexed:
+                    print(f"📦 Reindexados {reindexed} registros ({self.namespace}: {signature or '-'})")
+            self._migrated = True
+
+    # ---- API pública ----
+
+    def version(self) -> int:
+        """Contador de escrituras del namespace (solo si versioned=True; 0 si no hay ninguna)"""
+        self._ensure_migrated()
+        value = get_engine().get_meta(self._version_key)
+        return int(value) if value else 0
+
+    def on_change(self, listener: Callable[[], None]) -> None:
+        """Registra listener para ejecutarse tras cada commit que modifique este repositorio"""
+        self._listeners.append(listener)
+
+    def get(self, key: str) -> Optional[Record]:
+        self._ensure_migrated()
+        return self._read(get_engine().read(), key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Record]:
+        self._ensure_migrated()
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, Record] = {}
+        conn = get_engine().read()
+        for start in range(0, len(keys), _BATCH):
+            part = keys[start:start + _BATCH]
+            placeholders = ",".join("?" for _ in part)
+            rows = conn.execute(
+                f"SELECT key, data FROM records WHERE namespace = ? AND key IN ({placeholders})",
+                [self.namespace, *part],
+            ).fetchall()
+            found.update((key, json.loads(data)) for key, data in rows)
+        return found
+
+    def exists(self, key: str) -> bool:
+        self._ensure_migrated()
+        row = get_engine().read().execute(
+            "SELECT 1 FROM records WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        return row is not None
+
+    def put(self, key: str, record: Record) -> Record:
+        self._ensure_migrated()
+        with get_engine().transaction() as conn:
+            self._write(conn, key, record)
+        return record
+
+    def insert(self, key: str, record: Record) -> bool:
+        """Inserta solo si la clave no existe; False si ya existía"""
+        self._ensure_migrated()
+        with get_engine().transaction() as conn:
+            if self._read(conn, key) is not None:
+                return False
+            self._write(conn, key, record)
+        return True
+
+    def delete(self, key: str) -> bool:
+        self._ensure_migrated()
+        with get_engine().transaction() as conn:
+            return self._delete(conn, key)
+
+    def update(self, key: str, fn: Callable[[Optional[Record]], Optional[Record]]) -> Optional[Record]:
+        """
+        Lee-modifica-escribe atómico: fn recibe el registro actual (o None) y
+        devuelve el nuevo. Si devuelve None no se escribe nada.
+        """
+        self._ensure_migrated()
+        with get_engine().transaction() as conn:
+            record = fn(self._read(conn, key))
+            if record is not None:
+                self._write(conn, key, record)
+            return record
+
+    def items(self, **filters: Any) -> List[Tuple[str, Record]]:
+        """(key, registro) ordenados por key; los filtros usan los índices (valor o lista de valores)"""
+        self._ensure_migrated()
+        sql, params = self._query("r.key, r.data", filters)
+        return [(key, json.loads(data)) for key, data in get_engine().read().execute(sql, params)]
+
+    def find(self, **filters: Any) -> List[Record]:
+        return [record for _, record in self.items(**filters)]
+
+    def keys(self, **filters: Any) -> List[str]:
+        self._ensure_migrated()
+        sql, params = self._query("r.key", filters)
+        return [row[0] for row in get_engine().read().execute(sql, params)]
+
+    def keys_in_range(self, field: str, lower: Any = None, upper: Any = None, **filters: Any) -> List[str]:
+        """
+        Keys cuyo índice field está en [lower, upper] (None = sin límite), además de los filtros.
+        Los valores se comparan como texto: el índice debe guardar valores de ancho fijo.
+        """
+        self._ensure_migrated()
+        sql, params = self._range_query("r.key", field, lower, upper, filters)
+        return [row[0] for row in get_engine().read().execute(sql, params)]
+
+    def items_in_range(
+        self, field: str, lower: Any = None, upper: Any = None, limit: Optional[int] = None, **filters: Any
+    ) -> List[Tuple[str, Record]]:
+        """(key, registro) con el índice field en [lower, upper], ordenados por ese índice"""
+        self._ensure_migrated()
+        sql, params = self._range_query("r.key, r.data", field, lower, upper, filters, by_value=True)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [(key, json.loads(data)) for key, data in get_engine().read().execute(sql, params)]
+
+    def count_in_range(self, field: str, lower: Any = None, upper: Any = None) -> int:
+        """Número de entradas del índice field en [lower, upper] (solo lee el índice)"""
+        self._ensure_migrated()
+        if field not in self.indexes:
+            raise KeyError(f"'{field}' no es un índice de {self.namespace}")
+        sql = "SELECT COUNT(*) FROM record_index WHERE namespace = ? AND field = ?"
+        params: List[Any] = [self.namespace, field]
+        if lower is not None:
+            sql += " AND value >= ?"
+            params.append(_index_value(lower))
+        if upper is not None:
+            sql += " AND value <= ?"
+            params.append(_index_value(upper))
+        return get_engine().read().execute(sql, params).fetchone()[0]
+
+    def count(self, **filters: Any) -> int:
+        self._ensure_migrated()
+        sql, params = self._query("COUNT(*)", filters, order=False)
+        return get_engine().read().execute(sql, params).fetchone()[0]
+
+    def all(self) -> Dict[str, Record]:
+        return dict(self.items())
+
+    def index_values(self, field: str) -> List[str]:
+        """Valores distintos de un índice (p. ej. todos los user_id con registros)"""
+        self._ensure_migrated()
+        rows = get_engine().read().execute(
+            "SELECT DISTINCT value FROM record_index WHERE namespace = ? AND field = ? ORDER BY value",
+            (self.namespace, field),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def replace_all(self, records: Dict[str, Record], **filters: Any) -> int:
+        """
+        Sustituye el conjunto de registros (o el subconjunto que cumple los filtros)
+        escribiendo solo las filas que cambian. Devuelve el número de filas tocadas.
+        """
+        self._ensure_migrated()
+        changed = 0
+        with get_engine().transaction() as conn:
+            sql, params = self._query("r.key, r.data", filters, order=False)
+            current = dict(conn.execute(sql, params).fetchall())
+            for key, record in records.items():
+                data = _dumps(record)
+                if current.get(key) != data:
+                    self._write(conn, key, record, data)
+                    changed += 1
+            for key in current.keys() - records.keys():
+                self._delete(conn, key)
+                changed += 1
+        return changed
+
+    def migrate(self) -> int:
+        """Fuerza la migración de los ficheros JSON y devuelve el total de filas"""
+        self._ensure_migrated()
+        return self.count()
+
+
+def migrate_all() -> Dict[str, int]:
+    """Migra todos los repositorios registrados (los módulos deben estar importados)"""
+    return {namespace: repo.migrate() for namespace, repo in _repositories.items()}
+
+
+if __name__ == "__main__":
+    import importlib
+    import sys
+
+    # Migración one-shot de todos los ficheros JSON: python storage_engine.py
+    sys.path.insert(0, str(_ROOT))
+    for module_name in (
+        "chat_storage",
+        "course_storage",
+        "wallet_storage",
+        "game_storage",
+        "flashcard_storage",
+        "learned_words_storage",
+        "redeem_codes_storage",
+        "summary_jobs_storage",
+        "core.card_store",
+        "core.concept_store",
+    ):
+        importlib.import_module(module_name)
+    for namespace, rows in migrate_all().items():
+        print(f"✅ {namespace}: {rows} registros")
+    print(f"📁 Base de datos: {get_engine().path}")
@@ -0,0 +1,202 @@
+"""
+Sistema de almacenamiento de trabajos de generación de resúmenes
+Guarda el estado de cada apartado/subapartado (pendiente, hecho o fallido) en la
+base de datos embebida (storage_engine), para poder reanudar una generación
+interrumpida sin repetir (ni volver a pagar) los apartados ya terminados.
+Cada item lleva la huella de sus entradas (PDFs, modelo, comentarios...): si
+cambian, el resultado guardado deja de valer y el item se vuelve a generar.
+También guarda los resúmenes parciales del modo map-reduce (por huella del trozo
+o de la fusión), compartidos entre cursos y ejecuciones; caducan si no se usan en
+SUMMARY_CHUNK_TTL_SECONDS.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from datetime import datetime
+
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, transaction
+
+# Segundos que se conserva un resumen parcial sin usarse (cada uso renueva el plazo)
+SUMMARY_CHUNK_TTL_SECONDS = max(3600, int(os.getenv("SUMMARY_CHUNK_TTL_SECONDS", str(30 * 24 * 3600))))
+# Cada cuántos resúmenes parciales guardados se borran los caducados
+_PURGE_EVERY = 200
+
+
+def _chunk_expires_at(chunk: Dict) -> float:
+    """Caducidad del resumen parcial; los guardados antes del TTL cuentan desde created_at"""
+    if chunk.get("expires_at") is not None:
+        return chunk["expires_at"]
+    try:
+        created = datetime.fromisoformat(chunk["created_at"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        created = time.time()
+    return created + SUMMARY_CHUNK_TTL_SECONDS
+
+
+def _expires_value(expires_at: float) -> str:
+    """Segundos epoch con ancho fijo: el orden de texto del índice es el orden temporal"""
+    return f"{max(0, int(expires_at)):012d}"
+
+
+_jobs = Repository("summary_jobs")
+_items = Repository("summary_job_items", indexes={"course_id": "course_id", "status": "status"})
+_chunks = Repository(
+    "summary_chunks",
+    indexes={"kind": "kind", "expires": lambda c: _expires_value(_chunk_expires_at(c))},
+)
+
+_chunk_lock = threading.Lock()
+_chunk_saves = 0
+
+
+def _item_key(course_id: str, item_id: str) -> str:
+    return f"{course_id}/{item_id}"
+
+
+def fingerprint(*parts) -> str:
+    """Huella estable de las entradas de un item"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+
+def start_job(course_id: str, params: Dict, item_ids: List[str]) -> Dict:
+    """
+    Registra (o reanuda) el trabajo de un curso
+
+    Args:
+        course_id: ID del curso
+        params: Parámetros de la generación (sin API keys) para poder reanudarla
+        item_ids: IDs de todos los items del trabajo
+
+    Returns:
+        Datos del trabajo
+    """
+    now = datetime.now().isoformat()
+
+    def apply(job: Optional[Dict]) -> Dict:
+        job = job or {"course_id": course_id, "created_at": now, "runs": 0}
+        job.update({
+            "params": params,
+            "item_ids": item_ids,
+            "status": "processing",
+            "runs": job.get("runs", 0) + 1,
+            "updated_at": now,
+        })
+        return job
+
+    return _jobs.update(course_id, apply)
+
+
+def finish_job(course_id: str, status: str, failed: int) -> Optional[Dict]:
+    """Marca el trabajo como terminado ("completed" o "failed" si quedan items fallidos)"""
+    def apply(job: Optional[Dict]) -> Optional[Dict]:
+        if job is None:
+            return None
+        job.update({"status": status, "failed_items": failed, "updated_at": datetime.now().isoformat()})
+        return job
+
+    return _jobs.update(course_id, apply)
+
+
+def get_job(course_id: str) -> Optional[Dict]:
+    """Obtiene el trabajo de un curso con el estado de cada item"""
+    job = _jobs.get(course_id)
+    if job is None:
+        return None
+    items = {item["item_id"]: item for item in _items.find(course_id=course_id)}
+    return {**job, "items": [items[i] for i in job.get("item_ids", []) if i in items]}
+
+
+def get_completed_items(course_id: str, fingerprints: Dict[str, str]) -> Dict[str, str]:
+    """Resúmenes ya generados cuyos inputs no han cambiado: {item_id: resumen}"""
+    done = {}
+    for item in _items.find(course_id=course_id, status="done"):
+        item_id = item.get("item_id")
+        if fingerprints.get(item_id) == item.get("fingerprint") and item.get("summary"):
+            done[item_id] = item["summary"]
+    return done
+
+
+def save_item_result(
+    course_id: str,
+    item_id: str,
+    item_fingerprint: str,
+    name: str,
+    summary: Optional[str] = None,
+    error: Optional[str] = None
+) -> Dict:
+    """Guarda el resultado de un item: "done" si hay resumen, "failed" si no"""
+    def apply(item: Optional[Dict]) -> Dict:
+        item = item or {"course_id": course_id, "item_id": item_id, "attempts": 0}
+        item.update({
+            "name": name,
+            "fingerprint": item_fingerprint,
+            "status": "done" if summary else "failed",
+            "summary": summary,
+            "error": None if summary else (error or "No se generó resumen"),
+            "attempts": item.get("attempts", 0) + 1,
+            "updated_at": datetime.now().isoformat(),
+        })
+        return item
+
+    return _items.update(_item_key(course_id, item_id), apply)
+
+
+def delete_job(course_id: str) -> bool:
+    """Elimina el trabajo de un curso y todos sus items"""
+    with transaction():
+        for key in _items.keys(course_id=course_id):
+            _items.delete(key)
+        return _jobs.delete(course_id)
+
+
+def get_chunk_summary(chunk_key: str) -> Optional[str]:
+    """Resumen parcial (map) o fusión (reduce) ya calculado para esa huella"""
+    chunk = _chunks.get(chunk_key)
+    if chunk is None:
+        return None
+    now = time.time()
+    expires_at = _chunk_expires_at(chunk)
+    if expires_at <= now:
+        _chunks.delete(chunk_key)
+        return None
+    # Renovar el plazo al usarlo (solo pasada la mitad, para no escribir en cada lectura)
+    if expires_at - now < SUMMARY_CHUNK_TTL_SECONDS / 2:
+        _chunks.put(chunk_key, {**chunk, "expires_at": now + SUMMARY_CHUNK_TTL_SECONDS})
+    return chunk.get("summary")
+
+
+def save_chunk_summary(chunk_key: str, kind: str, summary: str) -> None:
+    """Guarda un resumen parcial ("map") o una fusión ("reduce")"""
+    global _chunk_saves
+    _chunks.put(chunk_key, {
+        "kind": kind,
+        "summary": summary,
+        "created_at": datetime.now().isoformat(),
+        "expires_at": time.time() + SUMMARY_CHUNK_TTL_SECONDS,
+    })
+    with _chunk_lock:
+        _chunk_saves += 1
+        purge = _chunk_saves % _PURGE_EVERY == 1
+    if purge:
+        purge_expired_chunks()
+
+
+def purge_expired_chunks() -> int:
+    """Borra los resúmenes parciales caducados; devuelve cuántos"""
+    keys = _chunks.keys_in_range("expires", upper=_expires_value(time.time()))
+    if not keys:
+        return 0
+    with transaction():
+        for chunk_key in keys:
+            _chunks.delete(chunk_key)
+    print(f"🧹 {len(keys)} resumen(es) parcial(es) caducados eliminados")
+    return len(keys)
@@ -0,0 +1,104 @@
+"""
+System Cache - Instancias StudyAgentsSystem compartidas
+Los sistemas comparten cliente Chroma, memoria y pool de clientes LLM; las keys de
+cada usuario y el modelo elegido por cada agente viven en el contexto de la petición
+(execution_context). Así lo único que distingue a un sistema es el modo, y hay como
+mucho uno por modo: se construye una vez y se reutiliza sin expiración.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class _Entry:
+    __slots__ = ("value", "created_at", "last_used")
+
+    def __init__(self, value: Any):
+        now = time.monotonic()
+        self.value = value
+        self.created_at = now
+        self.last_used = now
+
+
+class SystemCache:
+    """Un objeto caro de construir (StudyAgentsSystem) por clave, construido una sola vez"""
+
+    def __init__(self):
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        # Serializa las construcciones: dos peticiones no crean el mismo sistema a la vez
+        self._build_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.build_seconds = 0.0
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.last_used = time.monotonic()
+        return entry
+
+    def get_or_create(self, key: str, build: Callable[[], Any]) -> Any:
+        """Devuelve el objeto cacheado para key o lo construye con build()"""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        with self._build_lock:
+            # Verificar de nuevo por si otro thread lo creó
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry.value
+            started_at = time.perf_counter()
+            value = build()
+            elapsed = time.perf_counter() - started_at
+            with self._lock:
+                self.builds += 1
+                self.build_seconds += elapsed
+                self._entries[key] = _Entry(value)
+            return value
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Descarta una entrada (o todas si key es None)"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def metrics(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "builds": self.builds,
+                "avg_build_ms": round(self.build_seconds / self.builds * 1000, 1) if self.builds else 0.0,
+                "systems": [
+                    {
+                        "key": key,
+                        "age_s": round(now - entry.created_at, 1),
+                        "idle_s": round(now - entry.last_used, 1),
+                    }
+                    for key, entry in self._entries.items()
+                ],
+            }
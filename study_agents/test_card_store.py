@@ -0,0 +1,75 @@
+"""
+Prueba de las revisiones en lote de core.card_store
+Uso:  python test_card_store.py   (o con pytest)
+Usa una base de datos temporal; no toca data/storage.sqlite3.
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import storage_engine
+from storage_engine import StorageEngine
+from core import card_store
+
+
+def _cards(user_id: str):
+    return card_store.create_cards(user_id, "chat_1", [
+        {"front": "¿Qué es una clave primaria?", "back": "Identifica cada fila"},
+        {"front": "¿Qué es un índice?", "back": "Acelera las búsquedas"},
+    ])
+
+
+def test_review_batch_applies_in_order() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_engine._engine = StorageEngine(Path(tmp) / "storage.sqlite3")
+        first, second = _cards("alice")
+        updated, missing = card_store.review_cards("alice", [
+            {"card_id": first["card_id"], "rating": "good"},
+            {"card_id": second["card_id"], "rating": "again"},
+            {"card_id": first["card_id"], "rating": "easy"},
+            {"card_id": "no_existe", "rating": "good"},
+        ])
+        assert missing == ["no_existe"]
+        by_id = {card["card_id"]: card for card in updated}
+        assert by_id[first["card_id"]]["reps"] == first["reps"] + 2
+        assert by_id[second["card_id"]]["reps"] == second["reps"] + 1
+        assert by_id[second["card_id"]]["lapses"] == second["lapses"] + 1
+
+        # Lo guardado coincide con lo devuelto y el historial conserva el orden por tarjeta
+        stored = {card["card_id"]: card for card in card_store.load_cards("alice")}
+        assert stored[first["card_id"]]["reps"] == by_id[first["card_id"]]["reps"]
+        histories = {h[0]["card_id"]: h for h in card_store.review_histories("alice")}
+        assert [e["rating"] for e in histories[first["card_id"]]] == [3, 4]
+        assert [e["rating"] for e in histories[second["card_id"]]] == [1]
+
+
+def test_invalid_rating_writes_nothing() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_engine._engine = StorageEngine(Path(tmp) / "storage.sqlite3")
+        first, _ = _cards("bob")
+        try:
+            card_store.review_cards("bob", [
+                {"card_id": first["card_id"], "rating": "good"},
+                {"card_id": first["card_id"], "rating": "perfecto"},
+            ])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("un rating inválido debe rechazar el lote")
+        stored = {card["card_id"]: card for card in card_store.load_cards("bob")}
+        assert stored[first["card_id"]]["reps"] == first["reps"]
+        assert card_store.review_histories("bob") == []
+
+
+def main() -> int:
+    for test in (test_review_batch_applies_in_order, test_invalid_rating_writes_nothing):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
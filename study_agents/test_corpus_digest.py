@@ -0,0 +1,60 @@
+"""
+Prueba del control de versión de memory/corpus_digest.py
+Uso:  python test_corpus_digest.py   (o con pytest)
+Un digest calculado antes de una invalidación no se guarda. Usa un SQLite temporal.
+"""
+from __future__ import annotations
+
+import importlib.util
+import sys
+import tempfile
+from pathlib import Path
+
+_ROOT = Path(__file__).resolve().parent
+# Se carga el módulo suelto: memory/__init__ importa memory_manager (chromadb)
+_spec = importlib.util.spec_from_file_location("corpus_digest", _ROOT / "memory" / "corpus_digest.py")
+corpus_digest = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(corpus_digest)
+
+
+def test_digest_invalidated_mid_build_is_discarded() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        store = corpus_digest.CorpusDigestStore(Path(tmp) / "digest.sqlite3")
+        chunks, version = store.get("u1", "c1")
+        assert chunks is None
+
+        # Mientras se calcula el digest llega un documento nuevo al chat
+        store.invalidate("u1", "c1")
+        assert store.put("u1", "c1", ["chunk antiguo"], version) is False
+        assert store.get("u1", "c1")[0] is None
+        assert store.stats()["stale_builds"] == 1
+
+        # Un cálculo con la versión nueva sí se guarda
+        _, version = store.get("u1", "c1")
+        assert store.put("u1", "c1", ["chunk nuevo"], version) is True
+        assert store.get("u1", "c1")[0] == ["chunk nuevo"]
+
+
+def test_invalidate_drops_stored_digest() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        store = corpus_digest.CorpusDigestStore(Path(tmp) / "digest.sqlite3")
+        _, version = store.get("u1", "c1")
+        assert store.put("u1", "c1", ["a", "b"], version) is True
+        store.invalidate("u1", "c1")
+        chunks, new_version = store.get("u1", "c1")
+        assert chunks is None
+        assert new_version == version + 1
+        # Otros chats no se ven afectados
+        _, other = store.get("u1", "c2")
+        assert store.put("u1", "c2", ["x"], other) is True
+
+
+def main() -> int:
+    for test in (test_digest_invalidated_mid_build_is_discarded, test_invalidate_drops_stored_digest):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
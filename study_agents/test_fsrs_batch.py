@@ -0,0 +1,62 @@
+"""
+Prueba de equivalencia entre core.fsrs_batch (NumPy) y core.fsrs (escalar)
+Uso:  python test_fsrs_batch.py   (o con pytest)
+"""
+from __future__ import annotations
+
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from core import fsrs, fsrs_batch
+
+NOW = datetime(2026, 1, 15, tzinfo=timezone.utc)
+# (estabilidad, dificultad, días desde el último repaso)
+STATES = [(0.5, 8.0, 0.0), (2.3, 5.5, 1.5), (10.0, 3.2, 12.0), (45.0, 6.8, 30.0), (120.0, 1.4, 400.0)]
+CUSTOM_W = [w * (1.05 if i % 2 else 0.97) for i, w in enumerate(fsrs.W)]
+
+
+def _check(weights) -> None:
+    stability, difficulty, elapsed, grades = [], [], [], []
+    expected = []
+    for s, d, days in STATES:
+        for grade in (1, 2, 3, 4):
+            state = fsrs.FsrsState(
+                stability=s, difficulty=d, due=NOW, last_review=NOW - timedelta(days=days), reps=3, lapses=0
+            )
+            after = fsrs.review(state, grade, now=NOW, w=weights)
+            expected.append((after.stability, after.difficulty, (after.due - NOW).total_seconds() / 86400.0))
+            stability.append(s)
+            difficulty.append(d)
+            elapsed.append(days)
+            grades.append(grade)
+
+    new_s, new_d, interval = fsrs_batch.review_batch(stability, difficulty, elapsed, grades, w=weights)
+    for i, (s, d, days) in enumerate(expected):
+        # El escalar redondea a 4 decimales
+        assert abs(new_s[i] - s) <= 1e-4 * max(1.0, s), (i, new_s[i], s)
+        assert abs(new_d[i] - d) <= 1e-4, (i, new_d[i], d)
+        assert abs(interval[i] - days) <= 1e-6 * max(1.0, days), (i, interval[i], days)
+
+
+def test_batch_matches_scalar_default_weights() -> None:
+    _check(fsrs.W)
+
+
+def test_batch_matches_scalar_custom_weights() -> None:
+    _check(CUSTOM_W)
+
+
+def main() -> int:
+    if not fsrs_batch.NUMPY_AVAILABLE:
+        print("SKIP: numpy no está instalado")
+        return 0
+    for test in (test_batch_matches_scalar_default_weights, test_batch_matches_scalar_custom_weights):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Prueba de la caducidad (TTL) de generated_tests_storage
+Uso:  python test_generated_tests_storage.py   (o con pytest)
+Usa una base de datos temporal; no toca data/storage.sqlite3.
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import storage_engine
+from storage_engine import StorageEngine
+import generated_tests_storage as tests_storage
+
+TEST = {"questions": [{"question": "2 + 2", "correct_answer": "B"}]}
+
+
+def _reset(tmp: Path) -> None:
+    storage_engine._engine = StorageEngine(tmp / "storage.sqlite3")
+    with tests_storage._lock:
+        tests_storage._cache.clear()
+
+
+def _expire(test_id: str) -> None:
+    """Adelanta la caducidad del test guardado (en disco y en la LRU del proceso)"""
+    record = tests_storage._tests.get(test_id)
+    record["expires_at"] = time.time() - 1
+    tests_storage._tests.put(test_id, record)
+    with tests_storage._lock:
+        tests_storage._cache.pop(test_id, None)
+
+
+def test_expired_test_is_not_served() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        _reset(Path(tmp))
+        tests_storage.save_test("t1", TEST)
+        assert tests_storage.get_test("t1") == TEST
+        _expire("t1")
+        assert tests_storage.get_test("t1") is None
+        # Al detectarlo caducado se borra
+        assert tests_storage._tests.get("t1") is None
+
+
+def test_purge_removes_only_expired() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        _reset(Path(tmp))
+        tests_storage.save_test("old", TEST)
+        tests_storage.save_test("fresh", TEST)
+        _expire("old")
+        assert tests_storage.purge_expired() == 1
+        assert tests_storage._tests.get("old") is None
+        assert tests_storage.get_test("fresh") == TEST
+
+
+def main() -> int:
+    for test in (test_expired_test_is_not_served, test_purge_removes_only_expired):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Prueba del límite por endpoint de request_executor
+Uso:  python test_request_executor.py   (o con pytest)
+Comprueba que cancelar una petición no libera su hueco mientras el hilo sigue trabajando.
+"""
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from request_executor import RequestExecutor
+
+
+async def _cancelled_call_keeps_slot() -> None:
+    executor = RequestExecutor(max_workers=4, limits={"slow": 1})
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow() -> str:
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    task = asyncio.ensure_future(executor.run("slow", slow))
+    while not started.is_set():
+        await asyncio.sleep(0.01)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    semaphore, stats = executor._endpoint("slow")
+    # El hilo sigue en marcha: el hueco del endpoint sigue ocupado
+    assert semaphore.locked()
+    assert stats.running == 1
+
+    # Una segunda petición espera hasta que el hilo termina de verdad
+    second = asyncio.ensure_future(executor.run("slow", lambda: "next"))
+    await asyncio.sleep(0.05)
+    assert not second.done()
+    release.set()
+    assert await asyncio.wait_for(second, 5) == "next"
+    assert stats.running == 0
+    assert not semaphore.locked()
+
+
+def test_cancelled_call_keeps_slot() -> None:
+    asyncio.run(_cancelled_call_keeps_slot())
+
+
+def main() -> int:
+    for test in (test_cancelled_call_keeps_slot,):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Prueba de la migración de JSON antiguos en storage_engine
+Uso:  python test_storage_engine.py   (o con pytest)
+Usa una base de datos y un directorio JSON temporales; no toca data/storage.sqlite3.
+"""
+from __future__ import annotations
+
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import storage_engine
+from storage_engine import Repository, StorageEngine
+
+
+def _legacy_reader(source: Path):
+    def legacy():
+        if not source.exists():
+            return
+        for path in source.glob("*.json"):
+            yield path.stem, json.loads(path.read_text(encoding="utf-8"))
+    return legacy
+
+
+def _with_engine(tmp: Path) -> StorageEngine:
+    storage_engine._engine = StorageEngine(tmp / "storage.sqlite3")
+    return storage_engine._engine
+
+
+def test_migrates_legacy_dir() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        engine = _with_engine(tmp)
+        source = tmp / "items"
+        source.mkdir()
+        for i in range(3):
+            (source / f"item_{i}.json").write_text(json.dumps({"n": i}), encoding="utf-8")
+        repo = Repository("test_items", legacy=_legacy_reader(source), legacy_sources=[source])
+        assert repo.migrate() == 3
+        assert repo.get("item_1") == {"n": 1}
+        assert json.loads(engine.get_meta("migrated:test_items"))["rows"] == 3
+
+
+def test_missing_source_is_not_marked() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        engine = _with_engine(tmp)
+        source = tmp / "items"
+        repo = Repository("test_items", legacy=_legacy_reader(source), legacy_sources=[source])
+        assert repo.migrate() == 0
+        assert engine.get_meta("migrated:test_items") is None
+
+        # El directorio aparece más tarde (p. ej. montado tras el primer arranque): se migra entonces
+        source.mkdir()
+        (source / "late.json").write_text(json.dumps({"n": 7}), encoding="utf-8")
+        repo = Repository("test_items", legacy=_legacy_reader(source), legacy_sources=[source])
+        assert repo.migrate() == 1
+        assert engine.get_meta("migrated:test_items") is not None
+
+
+def test_reindexes_when_index_version_changes() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        _with_engine(Path(tmp))
+        repo = Repository("test_items", indexes={"size": lambda r: "small" if r["n"] < 5 else "big"})
+        repo.put("a", {"n": 3})
+        assert repo.keys(size="small") == ["a"]
+
+        # Misma función con otro umbral: sin subir la versión el índice se queda obsoleto
+        repo = Repository("test_items", indexes={"size": lambda r: "small" if r["n"] < 2 else "big"})
+        assert repo.keys(size="small") == ["a"]
+
+        repo = Repository(
+            "test_items",
+            indexes={"size": lambda r: "small" if r["n"] < 2 else "big"},
+            index_versions={"size": 2},
+        )
+        assert repo.keys(size="small") == []
+        assert repo.keys(size="big") == ["a"]
+
+
+def main() -> int:
+    for test in (test_migrates_legacy_dir, test_missing_source_is_not_marked, test_reindexes_when_index_version_changes):
+        test()
+        print(f"OK: {test.__name__}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,142 @@
 """
 Sistema de almacenamiento de Wallet (billetera) de usuarios
-Gestiona el dinero de los usuarios y la distribución de ingresos
+Gestiona el dinero de los usuarios y la distribución de ingresos.
+Los saldos (wallets, ingresos de creadores y de la plataforma) son filas de la base
+de datos embebida (storage_engine); cada transacción es una fila aparte, así que
+registrar un movimiento no reescribe el historial. Los JSON antiguos se migran solos.
 """
 
 import json
+import os
+import sys
+import time
+import uuid
 from typing import Dict, Optional, List
 from datetime import datetime
 from pathlib import Path
 
-# Directorio para almacenar wallets
-WALLETS_DIR = Path("courses/wallets")
-WALLETS_DIR.mkdir(parents=True, exist_ok=True)
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+from storage_engine import Repository, transaction
+import data_paths
 
-# Directorio para almacenar ingresos de creadores
-CREATOR_EARNINGS_DIR = Path("courses/creator_earnings")
-CREATOR_EARNINGS_DIR.mkdir(parents=True, exist_ok=True)
+# Directorio de wallets en JSON (formato antiguo, solo para la migración)
+WALLETS_DIR = data_paths.COURSES_DIR / "wallets"
 
-# Archivo para ingresos de la plataforma
-PLATFORM_EARNINGS_FILE = Path("courses/platform_earnings.json")
+# Directorio de ingresos de creadores en JSON (formato antiguo)
+CREATOR_EARNINGS_DIR = data_paths.COURSES_DIR / "creator_earnings"
+
+# Archivo de ingresos de la plataforma en JSON (formato antiguo)
+PLATFORM_EARNINGS_FILE = data_paths.COURSES_DIR / "platform_earnings.json"
+
+# Libros de transacciones
+WALLET_LEDGER = "wallet"
+CREATOR_LEDGER = "creator"
+PLATFORM_LEDGER = "platform"
+PLATFORM_ID = "platform"
 
 
 def get_wallet_file(user_id: str) -> Path:
-    """Obtiene la ruta del archivo de wallet de un usuario"""
+    """Obtiene la ruta del archivo de wallet de un usuario (formato JSON antiguo)"""
     return WALLETS_DIR / f"{user_id}.json"
 
 
 def get_creator_earnings_file(creator_id: str) -> Path:
-    """Obtiene la ruta del archivo de ingresos de un creador"""
+    """Obtiene la ruta del archivo de ingresos de un creador (formato JSON antiguo)"""
     return CREATOR_EARNINGS_DIR / f"{creator_id}.json"
 
 
+def _read_json(path: Path) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error al leer {path}: {e}")
+        return {}
+
+
+def _header(data: Dict) -> Dict:
+    """Saldo sin el historial de transacciones"""
+    return {k: v for k, v in data.items() if k != "transactions"}
+
+
+def _transaction_key(ledger: str, owner_id: str, timestamp_ns: int, suffix: str) -> str:
+    # Claves ordenables por tiempo dentro de cada libro
+    return f"{ledger}:{owner_id}/{timestamp_ns:020d}-{suffix}"
+
+
+def _keyed_transactions(ledger: str, owner_id: str, transactions: List[Dict]):
+    """(key, fila) de un historial en lista, con claves derivadas de su timestamp"""
+    for i, entry in enumerate(transactions):
+        try:
+            timestamp_ns = int(datetime.fromisoformat(entry.get("timestamp", "")).timestamp() * 1e9)
+        except (TypeError, ValueError):
+            timestamp_ns = 0
+        record = {**entry, "ledger": ledger, "owner_id": owner_id}
+        yield _transaction_key(ledger, owner_id, timestamp_ns, f"{i:06d}"), record
+
+
+def _legacy_wallets():
+    for wallet_file in WALLETS_DIR.glob("*.json"):
+        yield wallet_file.stem, _header(_read_json(wallet_file))
+
+
+def _legacy_creator_earnings():
+    for earnings_file in CREATOR_EARNINGS_DIR.glob("*.json"):
+        yield earnings_file.stem, _header(_read_json(earnings_file))
+
+
+def _legacy_platform_earnings():
+    if PLATFORM_EARNINGS_FILE.exists():
+        yield PLATFORM_ID, _header(_read_json(PLATFORM_EARNINGS_FILE))
+
+
+def _legacy_ledger():
+    for wallet_file in WALLETS_DIR.glob("*.json"):
+        transactions = _read_json(wallet_file).get("transactions", [])
+        yield from _keyed_transactions(WALLET_LEDGER, wallet_file.stem, transactions)
+    for earnings_file in CREATOR_EARNINGS_DIR.glob("*.json"):
+        transactions = _read_json(earnings_file).get("transactions", [])
+        yield from _keyed_transactions(CREATOR_LEDGER, earnings_file.stem, transactions)
+    if PLATFORM_EARNINGS_FILE.exists():
+        transactions = _read_json(PLATFORM_EARNINGS_FILE).get("transactions", [])
+        yield from _keyed_transactions(PLATFORM_LEDGER, PLATFORM_ID, transactions)
+
+
+_wallets = Repository("wallets", legacy=_legacy_wallets, legacy_sources=[WALLETS_DIR])
+_creator_earnings = Repository(
+    "creator_earnings", legacy=_legacy_creator_earnings, legacy_sources=[CREATOR_EARNINGS_DIR]
+)
+_platform_earnings = Repository(
+    "platform_earnings", legacy=_legacy_platform_earnings, legacy_sources=[PLATFORM_EARNINGS_FILE]
+)
+_ledger = Repository(
+    "wallet_transactions",
+    indexes={
+        "owner": lambda t: f"{t.get('ledger')}:{t.get('owner_id')}",
+        "ledger": "ledger",
+        "type": "type",
+    },
+    legacy=_legacy_ledger,
+    legacy_sources=[WALLETS_DIR, CREATOR_EARNINGS_DIR, PLATFORM_EARNINGS_FILE],
+)
+
+
+def _append_transaction(ledger: str, owner_id: str, entry: Dict) -> None:
+    key = _transaction_key(ledger, owner_id, time.time_ns(), uuid.uuid4().hex[:8])
+    _ledger.put(key, {**entry, "ledger": ledger, "owner_id": owner_id})
+
+
+def _strip(entry: Dict) -> Dict:
+    return {k: v for k, v in entry.items() if k not in ("ledger", "owner_id")}
+
+
+def _transactions(ledger: str, owner_id: str) -> List[Dict]:
+    """Historial de un libro en orden cronológico"""
+    return [_strip(t) for t in _ledger.find(owner=f"{ledger}:{owner_id}")]
+
+
 def get_user_wallet(user_id: str) -> Dict:
     """
     Obtiene el wallet de un usuario
@@ -42,19 +149,16 @@ def get_user_wallet(user_id: str) -> Dict:
             "transactions": List[Dict]  # Historial de transacciones
         }
     """
-    wallet_file = get_wallet_file(user_id)
-    
-    if not wallet_file.exists():
-        return {
-            "balance": 0.0,
-            "total_deposited": 0.0,
-            "total_spent": 0.0,
-            "transactions": []
-        }
-    
     try:
-        with open(wallet_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        header = _wallets.get(user_id)
+        if header is None:
+            return {
+                "balance": 0.0,
+                "total_deposited": 0.0,
+                "total_spent": 0.0,
+                "transactions": []
+            }
+        return {**header, "transactions": _transactions(WALLET_LEDGER, user_id)}
     except Exception as e:
         print(f"Error cargando wallet de {user_id}: {e}")
         return {
@@ -66,11 +170,15 @@ def get_user_wallet(user_id: str) -> Dict:
 
 
 def save_user_wallet(user_id: str, wallet_data: Dict):
-    """Guarda el wallet de un usuario"""
-    wallet_file = get_wallet_file(user_id)
-    
-    with open(wallet_file, "w", encoding="utf-8") as f:
-        json.dump(wallet_data, f, ensure_ascii=False, indent=2)
+    """Guarda el wallet de un usuario (saldo e historial completo)"""
+    transactions = dict(_keyed_transactions(WALLET_LEDGER, user_id, wallet_data.get("transactions", [])))
+    with transaction():
+        _wallets.put(user_id, _header(wallet_data))
+        _ledger.replace_all(transactions, owner=f"{WALLET_LEDGER}:{user_id}")
+
+
+def _get_wallet_header(user_id: str) -> Dict:
+    return _wallets.get(user_id) or {"balance": 0.0, "total_deposited": 0.0, "total_spent": 0.0}
 
 
 def add_to_wallet(user_id: str, amount: float, transaction_type: str = "deposit", metadata: Optional[Dict] = None) -> Dict:
@@ -86,23 +194,21 @@ def add_to_wallet(user_id: str, amount: float, transaction_type: str = "deposit"
     Returns:
         Datos actualizados del wallet
     """
-    wallet = get_user_wallet(user_id)
-    
-    wallet["balance"] = wallet.get("balance", 0.0) + amount
-    wallet["total_deposited"] = wallet.get("total_deposited", 0.0) + amount
-    
-    transaction = {
-        "type": transaction_type,
-        "amount": amount,
-        "timestamp": datetime.now().isoformat(),
-        "metadata": metadata or {}
-    }
-    
-    wallet.setdefault("transactions", []).append(transaction)
-    
-    save_user_wallet(user_id, wallet)
-    
-    return wallet
+    with transaction():
+        wallet = _get_wallet_header(user_id)
+        
+        wallet["balance"] = wallet.get("balance", 0.0) + amount
+        wallet["total_deposited"] = wallet.get("total_deposited", 0.0) + amount
+        
+        _wallets.put(user_id, wallet)
+        _append_transaction(WALLET_LEDGER, user_id, {
+            "type": transaction_type,
+            "amount": amount,
+            "timestamp": datetime.now().isoformat(),
+            "metadata": metadata or {}
+        })
+    
+    return get_user_wallet(user_id)
 
 
 def deduct_from_wallet(user_id: str, amount: float, transaction_type: str = "purchase", metadata: Optional[Dict] = None) -> Dict:
@@ -121,26 +227,24 @@ def deduct_from_wallet(user_id: str, amount: float, transaction_type: str = "pur
     Raises:
         ValueError: Si no hay suficiente saldo
     """
-    wallet = get_user_wallet(user_id)
-    
-    if wallet["balance"] < amount:
-        raise ValueError(f"Saldo insuficiente. Disponible: {wallet['balance']:.2f}€, Necesario: {amount:.2f}€")
-    
-    wallet["balance"] = wallet.get("balance", 0.0) - amount
-    wallet["total_spent"] = wallet.get("total_spent", 0.0) + amount
-    
-    transaction = {
-        "type": transaction_type,
-        "amount": -amount,
-        "timestamp": datetime.now().isoformat(),
-        "metadata": metadata or {}
-    }
-    
-    wallet.setdefault("transactions", []).append(transaction)
-    
-    save_user_wallet(user_id, wallet)
-    
-    return wallet
+    with transaction():
+        wallet = _get_wallet_header(user_id)
+        
+        if wallet["balance"] < amount:
+            raise ValueError(f"Saldo insuficiente. Disponible: {wallet['balance']:.2f}€, Necesario: {amount:.2f}€")
+        
+        wallet["balance"] = wallet.get("balance", 0.0) - amount
+        wallet["total_spent"] = wallet.get("total_spent", 0.0) + amount
+        
+        _wallets.put(user_id, wallet)
+        _append_transaction(WALLET_LEDGER, user_id, {
+            "type": transaction_type,
+            "amount": -amount,
+            "timestamp": datetime.now().isoformat(),
+            "metadata": metadata or {}
+        })
+    
+    return get_user_wallet(user_id)
 
 
 def get_creator_earnings(creator_id: str) -> Dict:
@@ -156,25 +260,22 @@ def get_creator_earnings(creator_id: str) -> Dict:
             "transactions": List[Dict]  # Historial
         }
     """
-    earnings_file = get_creator_earnings_file(creator_id)
-    
-    if not earnings_file.exists():
-        return {
-            "total_earned": 0.0,
-            "available_to_withdraw": 0.0,
-            "pending": 0.0,
-            "withdrawn": 0.0,
-            "transactions": []
-        }
-    
     try:
-        with open(earnings_file, "r", encoding="utf-8") as f:
-            earnings = json.load(f)
-            # Calcular disponible y pendiente
-            total = earnings.get("total_earned", 0.0) - earnings.get("withdrawn", 0.0)
-            earnings["available_to_withdraw"] = total if total >= 5.0 else 0.0
-            earnings["pending"] = total if total < 5.0 else 0.0
-            return earnings
+        header = _creator_earnings.get(creator_id)
+        if header is None:
+            return {
+                "total_earned": 0.0,
+                "available_to_withdraw": 0.0,
+                "pending": 0.0,
+                "withdrawn": 0.0,
+                "transactions": []
+            }
+        earnings = {**header, "transactions": _transactions(CREATOR_LEDGER, creator_id)}
+        # Calcular disponible y pendiente
+        total = earnings.get("total_earned", 0.0) - earnings.get("withdrawn", 0.0)
+        earnings["available_to_withdraw"] = total if total >= 5.0 else 0.0
+        earnings["pending"] = total if total < 5.0 else 0.0
+        return earnings
     except Exception as e:
         print(f"Error cargando ingresos de creador {creator_id}: {e}")
         return {
@@ -199,39 +300,53 @@ def add_creator_earnings(creator_id: str, amount: float, course_id: str, course_
     Returns:
         Datos actualizados de ingresos
     """
-    earnings = get_creator_earnings(creator_id)
-    
-    earnings["total_earned"] = earnings.get("total_earned", 0.0) + amount
-    
-    transaction = {
-        "type": "course_sale",
-        "amount": amount,
-        "course_id": course_id,
-        "course_title": course_title,
-        "timestamp": datetime.now().isoformat()
-    }
-    
-    earnings.setdefault("transactions", []).append(transaction)
+    with transaction():
+        earnings = _creator_earnings.get(creator_id) or {"total_earned": 0.0, "withdrawn": 0.0}
+        
+        earnings["total_earned"] = earnings.get("total_earned", 0.0) + amount
+        
+        # Guardar
+        _creator_earnings.put(creator_id, earnings)
+        _append_transaction(CREATOR_LEDGER, creator_id, {
+            "type": "course_sale",
+            "amount": amount,
+            "course_id": course_id,
+            "course_title": course_title,
+            "timestamp": datetime.now().isoformat()
+        })
     
-    # Guardar
-    earnings_file = get_creator_earnings_file(creator_id)
-    with open(earnings_file, "w", encoding="utf-8") as f:
-        json.dump(earnings, f, ensure_ascii=False, indent=2)
+    return get_creator_earnings(creator_id)
+
+
+def withdraw_creator_earnings(creator_id: str, amount: float) -> Dict:
+    """
+    Marca como retirada una cantidad de los ingresos de un creador
     
-    return earnings
+    Raises:
+        ValueError: Si la cantidad supera lo disponible para retirar
+    """
+    with transaction():
+        earnings = get_creator_earnings(creator_id)
+        if amount > earnings["available_to_withdraw"]:
+            raise ValueError(f"Fondos insuficientes. Disponible: {earnings['available_to_withdraw']:.2f}€")
+        
+        header = _creator_earnings.get(creator_id) or {"total_earned": 0.0}
+        header["withdrawn"] = header.get("withdrawn", 0.0) + amount
+        _creator_earnings.put(creator_id, header)
+        _append_transaction(CREATOR_LEDGER, creator_id, {
+            "type": "withdrawal",
+            "amount": -amount,
+            "timestamp": datetime.now().isoformat()
+        })
+    
+    return get_creator_earnings(creator_id)
 
 
 def get_platform_earnings() -> Dict:
     """Obtiene los ingresos totales de la plataforma"""
-    if not PLATFORM_EARNINGS_FILE.exists():
-        return {
-            "total_earned": 0.0,
-            "transactions": []
-        }
-    
     try:
-        with open(PLATFORM_EARNINGS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        header = _platform_earnings.get(PLATFORM_ID) or {"total_earned": 0.0}
+        return {**header, "transactions": _transactions(PLATFORM_LEDGER, PLATFORM_ID)}
     except Exception as e:
         print(f"Error cargando ingresos de plataforma: {e}")
         return {
@@ -242,24 +357,21 @@ def get_platform_earnings() -> Dict:
 
 def add_platform_earnings(amount: float, course_id: str, course_title: str) -> Dict:
     """Añade ingresos a la plataforma"""
-    earnings = get_platform_earnings()
-    
-    earnings["total_earned"] = earnings.get("total_earned", 0.0) + amount
-    
-    transaction = {
-        "type": "course_sale",
-        "amount": amount,
-        "course_id": course_id,
-        "course_title": course_title,
-        "timestamp": datetime.now().isoformat()
-    }
-    
-    earnings.setdefault("transactions", []).append(transaction)
-    
-    with open(PLATFORM_EARNINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(earnings, f, ensure_ascii=False, indent=2)
+    with transaction():
+        earnings = _platform_earnings.get(PLATFORM_ID) or {"total_earned": 0.0}
+        
+        earnings["total_earned"] = earnings.get("total_earned", 0.0) + amount
+        
+        _platform_earnings.put(PLATFORM_ID, earnings)
+        _append_transaction(PLATFORM_LEDGER, PLATFORM_ID, {
+            "type": "course_sale",
+            "amount": amount,
+            "course_id": course_id,
+            "course_title": course_title,
+            "timestamp": datetime.now().isoformat()
+        })
     
-    return earnings
+    return get_platform_earnings()
 
 
 def distribute_course_payment(user_id: str, course_id: str, course_price: float, course: Dict) -> Dict:
@@ -286,6 +398,12 @@ def distribute_course_payment(user_id: str, course_id: str, course_price: float,
     Raises:
         ValueError: Si no hay suficiente saldo en wallet
     """
+    # Cargo al comprador y abonos al creador y la plataforma: todo o nada
+    with transaction():
+        return _distribute_course_payment(user_id, course_id, course_price, course)
+
+
+def _distribute_course_payment(user_id: str, course_id: str, course_price: float, course: Dict) -> Dict:
     print(f"[Payment Distribution] 🚀 Iniciando distribución de pago para curso {course_id}")
     print(f"[Payment Distribution] Usuario comprador: {user_id}, Precio: {course_price}€")
     print(f"[Payment Distribution] Datos del curso: {course}")
@@ -383,3 +501,19 @@ def distribute_course_payment(user_id: str, course_id: str, course_price: float,
     }
 
 
+def list_wallet_user_ids() -> List[str]:
+    """IDs de todos los usuarios con wallet"""
+    return _wallets.keys()
+
+
+def get_total_deposited() -> float:
+    """Suma de lo depositado en todos los wallets"""
+    return sum(wallet.get("total_deposited", 0.0) for wallet in _wallets.find())
+
+
+def list_wallet_transactions(transaction_types: Optional[List[str]] = None) -> List[Dict]:
+    """Transacciones de los wallets de usuario (con su user_id), filtradas por tipo"""
+    return [
+        {**_strip(t), "user_id": t.get("owner_id")}
+        for t in _ledger.find(ledger=WALLET_LEDGER, type=transaction_types)
+    ]